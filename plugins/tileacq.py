@@ -56,7 +56,7 @@ from odemis.acq.stream import (
     SpectrumStream,
     StaticStream,
 )
-from odemis.dataio import get_available_formats
+from odemis.dataio import get_available_formats, tiff
 from odemis.gui.comp import popup
 from odemis.gui.comp.stream_panel import OPT_BTN_REMOVE, OPT_BTN_SHOW
 from odemis.gui.conf import get_acqui_conf
@@ -651,6 +651,14 @@ class TileAcqPlugin(Plugin):
                     orig_hw_values[s.emitter.external] = s.emitter.external.value
                     s.emitter.external.value = True
 
+            # When a single stream is stitched into a TIFF file, weave it directly
+            # into the file, so that the stitched image is never completely in memory.
+            exporter = dataio.find_fittest_converter(fn)
+            if self.stitch.value and len(stitch_ss) == 1 and exporter is tiff:
+                stitched_path = fn
+            else:
+                stitched_path = None
+
             # Start the tiled acquisition task
             region = self._get_region(orig_pos)
             ft = acquireTiledArea(
@@ -662,6 +670,7 @@ class TileAcqPlugin(Plugin):
                 log_path=fn,
                 weaver=self.weaver.value if self.stitch.value else None,
                 registrar=self.register.value if self.stitch.value else None,
+                stitched_path=stitched_path,
             )
 
             dlg.showProgress(ft)
@@ -673,8 +682,9 @@ class TileAcqPlugin(Plugin):
 
             # Open analysis tab
             if st_data:
-                exporter = dataio.find_fittest_converter(fn)
-                if exporter.CAN_SAVE_PYRAMID:
+                if stitched_path:
+                    logging.debug("Stitched data already saved to %s", fn)
+                elif exporter.CAN_SAVE_PYRAMID:
                     exporter.export(fn, st_data, pyramid=True)
                 else:
                     logging.warning("File format doesn't support saving image in pyramidal form")
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on 18 Oct 2026
+
+@author: agent
+
+Copyright © 2026 agent
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License version 2 as published by the Free Software Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with Odemis. If not, see http://www.gnu.org/licenses/.
+
+This is a script to compare the transports available to receive the data of
+a DataFlow (0MQ and shared memory). For each transport, it subscribes to the
+dataflow of a detector during a given time, and reports the number of frames
+received per second and the CPU time used by this process (and the backend,
+if psutil is available).
+
+run as:
+./scripts/dataflow_transport.py --role ccd --duration 10
+
+The backend must be running. The detector settings are not changed, so set
+them beforehand, for instance with:
+odemis-cli --set-attr ccd exposureTime 0.001
+"""
+
+import argparse
+import logging
+import sys
+import time
+
+from odemis import model
+
+logging.getLogger().setLevel(logging.INFO)
+
+
+class FrameCounter(object):
+
+    def __init__(self):
+        self.count = 0
+        self.shape = None
+
+    def on_data(self, df, data):
+        self.count += 1
+        self.shape = data.shape
+
+
+def get_backend_process():
+    """
+    return (psutil.Process or None): the process of the backend, or None if
+      it cannot be found
+    """
+    try:
+        import psutil
+    except ImportError:
+        logging.info("psutil not available, the CPU usage of the backend will not be reported")
+        return None
+
+    for p in psutil.process_iter(["cmdline"]):
+        cmdline = p.info["cmdline"] or []
+        if any("odemisd" in a for a in cmdline[:2]):
+            return p
+    logging.info("Failed to find the backend process")
+    return None
+
+
+def measure_transport(df, transport, duration, backend):
+    """
+    Receive the data of the dataflow for the given duration
+    return (float, float, float or None): frames per second, CPU usage of this
+      process and of the backend (in %)
+    """
+    df.transport = transport
+    counter = FrameCounter()
+
+    if backend:
+        bkd_cpu_start = sum(backend.cpu_times()[:2])
+    cpu_start = time.process_time()
+    tstart = time.time()
+    df.subscribe(counter.on_data)
+    try:
+        time.sleep(duration)
+    finally:
+        df.unsubscribe(counter.on_data)
+    dur = time.time() - tstart
+    cpu = (time.process_time() - cpu_start) / dur * 100
+    if backend:
+        bkd_cpu = (sum(backend.cpu_times()[:2]) - bkd_cpu_start) / dur * 100
+    else:
+        bkd_cpu = None
+
+    logging.info("Received %d frames of shape %s via %s", counter.count, counter.shape, transport)
+    return counter.count / dur, cpu, bkd_cpu
+
+
+def main(args):
+    """
+    Handles the command line arguments
+    args is the list of arguments passed
+    return (int): value to return to the OS as program exit code
+    """
+    parser = argparse.ArgumentParser(description="Compare the DataFlow transports")
+    parser.add_argument("--role", dest="role", default="ccd",
+                        help="Role of the detector to use (default: ccd)")
+    parser.add_argument("--duration", "-d", dest="duration", type=float, default=10,
+                        help="Time to receive data for each transport (in s)")
+    options = parser.parse_args(args[1:])
+
+    try:
+        det = model.getComponent(role=options.role)
+        backend = get_backend_process()
+
+        for transport in (model.TRANSPORT_ZMQ, model.TRANSPORT_SHM):
+            fps, cpu, bkd_cpu = measure_transport(det.data, transport, options.duration, backend)
+            if bkd_cpu is None:
+                print("%s: %.1f fps, CPU usage: %.1f %%" % (transport, fps, cpu))
+            else:
+                print("%s: %.1f fps, CPU usage: %.1f %% (backend: %.1f %%)" % (transport, fps, cpu, bkd_cpu))
+        det.data.transport = model.TRANSPORT_ZMQ
+    except KeyboardInterrupt:
+        logging.info("Interrupted before the end of the execution")
+        return 1
+    except Exception:
+        logging.exception("Unexpected error while performing action.")
+        return 127
+
+    return 0
+
+
+if __name__ == '__main__':
+    ret = main(sys.argv)
+    exit(ret)
@@ -20,8 +20,8 @@ You should have received a copy of the GNU General Public License along with
 Odemis. If not, see http://www.gnu.org/licenses/.
 """
 import numpy
-from numpy import fft
 from numpy.fft import fftfreq
+from scipy import fft
 
 
 def _upsampled_dft(data, upsampled_region_size,
@@ -108,16 +108,31 @@ def MeasureShift(previous_img, current_img, precision=1):
       shape as previous_img
     precision (1<=int): Calculate drift within 1/precision of a pixel
     returns (tuple of floats): Drift in pixels (horizontal, vertical).
+    Note: the FFTs are computed with scipy.fft, which keeps a cache of the FFT
+    plans of the last shapes used, and releases the GIL. So calling it repeatedly
+    on images of the same shape, from several threads, is efficient.
     """
     if precision < 1:
         raise ValueError("Precision cannot be less than 1, got %s." % (precision,))
     assert previous_img.shape == current_img.shape, "Prev shape %s != new shape %s" % (
         previous_img.shape, current_img.shape)
 
-    previous_fft = fft.fft2(previous_img)
-    current_fft = fft.fft2(current_img)
-    shape = previous_fft.shape
-    m, n = previous_fft.shape
+    shape = previous_img.shape
+    # For real images, when no upsampling is needed, the cross-correlation is
+    # computed on just half of the spectrum (the other half is symmetric), which
+    # is twice faster. The upsampling needs the full spectrum.
+    is_complex = numpy.iscomplexobj(previous_img) or numpy.iscomplexobj(current_img)
+    use_rfft = precision == 1 and not is_complex
+    # Always compute in double precision (as numpy.fft does)
+    dtype = numpy.complex128 if is_complex else numpy.float64
+    previous_img = numpy.asarray(previous_img, dtype=dtype)
+    current_img = numpy.asarray(current_img, dtype=dtype)
+    if use_rfft:
+        previous_fft = fft.rfft2(previous_img)
+        current_fft = fft.rfft2(current_img)
+    else:
+        previous_fft = fft.fft2(previous_img)
+        current_fft = fft.fft2(current_img)
     image_product = previous_fft * current_fft.conj()
 
     # Cross-correlation computation
@@ -126,7 +141,10 @@ def MeasureShift(previous_img, current_img, precision=1):
     # this helps in finding low magnitude pixels which are related to small shifts
     image_product /= numpy.maximum(numpy.abs(image_product), 100 * eps)
     float_dtype = image_product.real.dtype
-    cross_correlation = fft.ifft2(image_product)
+    if use_rfft:
+        cross_correlation = fft.irfft2(image_product, s=shape)
+    else:
+        cross_correlation = fft.ifft2(image_product)
     # Locate maximum
     maxima = numpy.unravel_index(numpy.argmax(numpy.abs(cross_correlation)),
                                  cross_correlation.shape)
@@ -206,5 +206,19 @@ class TestMeasureShift(unittest.TestCase):
         drift = MeasureShift(self.small_data, self.small_data_random_drifted_noisy, 10)
         numpy.testing.assert_almost_equal(drift, (self.small_deltac, self.small_deltar), 0)
 
+    # @unittest.skip("skip")
+    def test_odd_shape_integer(self):
+        """
+        Tests for integer images with an odd shape, on which the cross-correlation
+        is computed with a real FFT (when precision is 1).
+        """
+        data = self.data[0][100:301, 150:287].astype(numpy.uint16)
+        data_drifted = self.data[0][103:304, 145:282].astype(numpy.uint16)
+        drift = MeasureShift(data, data_drifted, 1)
+        numpy.testing.assert_almost_equal(drift, (-5, 3), 1)
+        # Same result with the full spectrum (used for subpixel precision)
+        drift = MeasureShift(data, data_drifted, 10)
+        numpy.testing.assert_almost_equal(drift, (-5, 3), 0)
+
 if __name__ == '__main__':
     unittest.main()
@@ -278,6 +278,58 @@ def apply_spectrum_corrections(data, bckg=None, coef=None):
       theta is NaN. The MD_THETA_LIST is updated to only contain the part with numbers.
     """
 
+    _check_spectrum_corrections(data, bckg, coef)
+
+    # TODO: use MD_BASELINE as a fallback?
+    if bckg is not None:
+        data = img.Subtract(data, bckg)
+    elif model.MD_THETA_LIST in data.metadata:
+        # If no background is provided on EK data, estimate and subtract a constant noise floor.
+        # In an EK acquisition, the corner regions are outside the mirror image, so typically always get dark signal.
+        # A robust method is to take the median of pixel values from corner regions.
+        # This is resistant to outliers (hot pixels, cosmic rays) and signal bleed-over.
+        corner_size = 5  # Use a 5x5 pixel square from each corner
+
+        # This slices the C and A dimensions (the CCD image dimensions).
+        top_left = data[:corner_size, :corner_size]
+        top_right = data[:corner_size, -corner_size:]
+        bottom_left = data[-corner_size:, :corner_size]
+        bottom_right = data[-corner_size:, -corner_size:]
+
+        # Concatenate all corner pixels into a single 1D array
+        # .ravel() flattens the N-D corner arrays into 1D arrays
+        all_corners = numpy.concatenate((
+            top_left.ravel(),
+            top_right.ravel(),
+            bottom_left.ravel(),
+            bottom_right.ravel()
+        ))
+
+        # Calculate the median of all corner pixels.
+        noise = numpy.median(all_corners)
+
+        # Subtract the estimated noise floor
+        data = img.Subtract(data, noise)
+
+    if model.MD_THETA_LIST in data.metadata:
+        try:
+            data = project_angular_spectrum_to_grid_5d(data)
+        except (ValueError, KeyError) as ex:
+            logging.warning("Failed to correct chromatic aberration on angular spectrum data: %s", ex)
+
+    if coef is not None:
+        # Compensate the data
+        data = data * _get_efficiency_factors(data, coef)  # will keep metadata from data
+
+    return data
+
+
+def _check_spectrum_corrections(data, bckg=None, coef=None):
+    """
+    Check that the background and the spectrum efficiency compensation can be
+    applied on the data. See apply_spectrum_corrections() for the parameters.
+    :raises ValueError: if the data and calibration data are not compatible.
+    """
     # handle time correlator data (chronograph) data
     # -> no spectrum efficiency compensation and bg correction supported
     if data.shape[-5] <= 1 and data.shape[-4] > 1:
@@ -285,9 +337,7 @@ def apply_spectrum_corrections(data, bckg=None, coef=None):
             raise ValueError("Background correction and spectrum efficiency compensation "
                              "not supported on time correlator (chronograph) data")
 
-    # TODO: use MD_BASELINE as a fallback?
     if bckg is not None:
-
         # Check that the bg matches the data.
         # TODO: support if the data is binned?
         if data.shape[0:2] != bckg.shape[0:2]:
@@ -314,8 +364,6 @@ def apply_spectrum_corrections(data, bckg=None, coef=None):
             if model.MD_WL_LIST in bckg.metadata:
                 raise ValueError("Found MD_WL_LIST metadata in background image, but "
                                  "data does not provide any wavelength information")
-            data = img.Subtract(data, bckg)
-
         else:
             # temporal spectrum with wl info (with/without time info)
             # spectrum data with wl info
@@ -336,41 +384,6 @@ def apply_spectrum_corrections(data, bckg=None, coef=None):
                                 wl_bckg[0] * 1e9, wl_bckg[-1] * 1e9,
                                 wl_data[0] * 1e9, wl_data[-1] * 1e9)
 
-            data = img.Subtract(data, bckg)
-    elif model.MD_THETA_LIST in data.metadata:
-        # If no background is provided on EK data, estimate and subtract a constant noise floor.
-        # In an EK acquisition, the corner regions are outside the mirror image, so typically always get dark signal.
-        # A robust method is to take the median of pixel values from corner regions.
-        # This is resistant to outliers (hot pixels, cosmic rays) and signal bleed-over.
-        corner_size = 5  # Use a 5x5 pixel square from each corner
-
-        # This slices the C and A dimensions (the CCD image dimensions).
-        top_left = data[:corner_size, :corner_size]
-        top_right = data[:corner_size, -corner_size:]
-        bottom_left = data[-corner_size:, :corner_size]
-        bottom_right = data[-corner_size:, -corner_size:]
-
-        # Concatenate all corner pixels into a single 1D array
-        # .ravel() flattens the N-D corner arrays into 1D arrays
-        all_corners = numpy.concatenate((
-            top_left.ravel(),
-            top_right.ravel(),
-            bottom_left.ravel(),
-            bottom_right.ravel()
-        ))
-
-        # Calculate the median of all corner pixels.
-        noise = numpy.median(all_corners)
-
-        # Subtract the estimated noise floor
-        data = img.Subtract(data, noise)
-
-    if model.MD_THETA_LIST in data.metadata:
-        try:
-            data = project_angular_spectrum_to_grid_5d(data)
-        except (ValueError, KeyError) as ex:
-            logging.warning("Failed to correct chromatic aberration on angular spectrum data: %s", ex)
-
     if coef is not None:
         # Check if we have any wavelength information in data.
         if model.MD_WL_LIST not in data.metadata:
@@ -379,24 +392,108 @@ def apply_spectrum_corrections(data, bckg=None, coef=None):
         if coef.shape[1:] != (1, 1, 1, 1):
             raise ValueError("Spectrum efficiency compensation should have shape C1111.")
 
-        # Need to get the calibration data for each wavelength of the data
-        wl_data = spectrum.get_wavelength_per_pixel(data)
-        wl_coef = spectrum.get_wavelength_per_pixel(coef)
 
-        # Warn if the calibration is not enough for the data
-        if wl_coef[0] > wl_data[0] or wl_coef[-1] < wl_data[-1]:
-            logging.warning("Spectrum efficiency compensation is only between "
-                            "%g->%g nm, while the spectrum is between %g->%g nm.",
-                            wl_coef[0] * 1e9, wl_coef[-1] * 1e9,
-                            wl_data[0] * 1e9, wl_data[-1] * 1e9)
+def _get_efficiency_factors(data, coef):
+    """
+    Compute the spectrum efficiency compensation factor for each wavelength of the data.
+    If the wavelength of the calibration doesn't cover the whole data wavelength,
+    the missing wavelength is filled by the same value as the border.
+    :param data: (DataArray of at least 5 dims) The data, with MD_WL_LIST.
+    :param coef: (DataArray of at least 5 dims) The coefficient data, with CTZYX = C1111.
+    :returns: (ndarray of shape C1111) The factor to multiply the data with.
+    """
+    # Need to get the calibration data for each wavelength of the data
+    wl_data = spectrum.get_wavelength_per_pixel(data)
+    wl_coef = spectrum.get_wavelength_per_pixel(coef)
 
-        # Interpolate the calibration data for each wl_data
-        calib_fitted = numpy.interp(wl_data, wl_coef, coef[:, 0, 0, 0, 0])
-        calib_fitted.shape += (1, 1, 1, 1)  # put TZYX dims
-        # Compensate the data
-        data = data * calib_fitted  # will keep metadata from data
+    # Warn if the calibration is not enough for the data
+    if wl_coef[0] > wl_data[0] or wl_coef[-1] < wl_data[-1]:
+        logging.warning("Spectrum efficiency compensation is only between "
+                        "%g->%g nm, while the spectrum is between %g->%g nm.",
+                        wl_coef[0] * 1e9, wl_coef[-1] * 1e9,
+                        wl_data[0] * 1e9, wl_data[-1] * 1e9)
 
-    return data
+    # Interpolate the calibration data for each wl_data
+    calib_fitted = numpy.interp(wl_data, wl_coef, coef[:, 0, 0, 0, 0])
+    calib_fitted.shape += (1, 1, 1, 1)  # put TZYX dims
+    return calib_fitted
+
+
+def _expand_ellipsis(key, ndim):
+    """
+    Replace the Ellipsis of a numpy selection by the equivalent slices
+    :param key: (int, slice, Ellipsis or tuple of them) the selection
+    :param ndim: (int) number of dimensions of the data selected
+    :returns: (tuple of int and slice) the same selection, without Ellipsis
+    """
+    if not isinstance(key, tuple):
+        key = (key,)
+    if Ellipsis in key:
+        i = key.index(Ellipsis)
+        key = key[:i] + (slice(None),) * (ndim - len(key) + 1) + key[i + 1:]
+    return key
+
+
+class DataArrayShadowCorrected(model.DataArrayShadow):
+    """
+    Spectrum data with the background correction and the spectrum efficiency
+    compensation applied lazily: the corrections are only computed on the part
+    of the data which is accessed. This avoids a full (float) copy of the data
+    every time the corrections change, and (typically) only computing a small
+    part of it (eg, the spectrum of a pixel, or the image of a wavelength band).
+    It gives the same result as apply_spectrum_corrections(), but it doesn't
+    support angular spectrum data (as its shape is changed by the correction).
+    The correction factor for each wavelength is computed only once.
+    """
+
+    def __init__(self, data, bckg=None, coef=None):
+        """
+        :param data: (DataArray or DataArrayShadow of 5 dims) The original data.
+          See apply_spectrum_corrections(). If it's a DataArrayShadow, it must
+          support getSubData(), and only the part accessed is read from the file.
+        :param bckg: (None or DataArray of 5 dims) The background data.
+        :param coef: (None or DataArray of 5 dims) The coefficient data.
+        :raises ValueError: if the data and calibration data are not compatible.
+        """
+        if model.MD_THETA_LIST in data.metadata:
+            raise ValueError("Angular spectrum data cannot be corrected lazily")
+        _check_spectrum_corrections(data, bckg, coef)
+
+        self._data = data
+        # Views with the same shape as the data, so that they can be sliced
+        # identically. Thanks to the broadcasting, they don't take extra memory.
+        if bckg is not None:
+            self._bckg = numpy.broadcast_to(bckg, data.shape)
+        else:
+            self._bckg = None
+        if coef is not None:
+            self._factors = numpy.broadcast_to(_get_efficiency_factors(data, coef), data.shape)
+        else:
+            self._factors = None
+
+        # Find the type of the result by correcting just one element
+        dtype = self[(slice(0, 1),) * data.ndim].dtype
+        super().__init__(data.shape, dtype, data.metadata)
+
+    def __getitem__(self, key):
+        """
+        Computes the corrections for a part of the data.
+        :param key: the selection, as with a numpy array (advanced indexing is not supported)
+        :returns: (DataArray) the corrected data. The metadata is the same as the whole data.
+        """
+        if isinstance(self._data, model.DataArrayShadow):
+            key = _expand_ellipsis(key, self._data.ndim)
+            data = self._data.getSubData(key)
+        else:
+            data = self._data[key]
+        if self._bckg is not None:
+            data = img.Subtract(data, self._bckg[key])
+        if self._factors is not None:
+            data = data * self._factors[key]
+        return model.DataArray(data, self._data.metadata)
+
+    def getData(self):
+        return self[...]
 
 
 def project_angular_spectrum_to_grid_5d(data: model.DataArray) -> model.DataArray:
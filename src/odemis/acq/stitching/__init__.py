@@ -22,4 +22,4 @@ from odemis.acq.stitching._tiledacq import (acquireTiledArea, acquireOverview, e
                                             STITCH_SPEED)
 from odemis.acq.stitching._registrar import *
 from odemis.acq.stitching._weaver import *
-from odemis.acq.stitching._simple import register, weave
+from odemis.acq.stitching._simple import register, weave, weave_to_file, create_registrar, add_tile, update_positions
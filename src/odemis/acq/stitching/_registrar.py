@@ -30,16 +30,25 @@ content, in other words performing "image registration".
 
 import logging
 import math
-from collections import deque
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import numpy
-from scipy.sparse import csr_matrix
-from scipy.sparse.csgraph import minimum_spanning_tree
+from scipy.sparse import csr_matrix, diags
+from scipy.sparse.csgraph import breadth_first_order, minimum_spanning_tree
+from scipy.sparse.linalg import splu
 
 from odemis import model
 from odemis.acq.drift import MeasureShift
 
 GOOD_MATCH = 0.9  # consider all registrations with match > GOOD_MATCH
+# In the global registration, shifts which are further from the position found via the spanning
+# tree are considered wrong, and ignored.
+MAX_SHIFT_RESIDUAL = 3  # px
+MIN_SHIFT_WEIGHT = 0.01  # weight of a shift with a normalized cross-correlation <= 0
+MAX_FIT_ITERATIONS = 5  # maximum number of least-squares fits, to refine the selection of the shifts
+# Number of threads used to compute the shifts between neighbouring tiles in the global registration
+MAX_SHIFT_WORKERS = min(os.cpu_count() or 1, 8)
 LEFT_TO_RIGHT = 1
 RIGHT_TO_LEFT = -1
 
@@ -478,6 +487,11 @@ class GlobalShiftRegistrar(ShiftRegistrar):
         # Calculated position of each tile relative to the upper left (first) tile in pixels as a 3D array of floats
         self.registered_positions_px = None  # 3D array of calculated shifts in px
 
+        # The shifts are computed in parallel. Until getPositions() is called, the
+        # shifts grids contain the Futures of the computations.
+        self._executor = None  # ThreadPoolExecutor, created when the first shift is computed
+        self._tile_averages = {}  # id(tile) -> float: average value of each tile, to compute the ncc
+
     def addTile(self, tile, dependent_tiles=None):
         """
         Extends grid by one tile. The first tile is added at the top left position. Any following
@@ -507,9 +521,48 @@ class GlobalShiftRegistrar(ShiftRegistrar):
         :returns dep_tile_positions: (list of N tuples of K tuples of 2 floats) for each tile, it returns
         the adjusted position of all dependent tile (in the order they were passed)
         """
+        self._wait_shifts()
         self.registered_positions_px = self._assemble_mosaic()  # px
         return super().getPositions()
 
+    def _wait_shifts(self):
+        """
+        Waits for all the shifts being computed, and stores their result in the shifts grids.
+        :raises ValueError: if a shift couldn't be computed
+        """
+        try:
+            for shifts in (self.shifts_hor, self.shifts_ver):
+                for row in shifts:
+                    for col, s in enumerate(row):
+                        if isinstance(s, Future):
+                            row[col] = s.result()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def _submit_shift(self, prev_tile, tile):
+        """
+        Starts the computation of the shift between two tiles (see _get_shift()) in a separate thread.
+        :returns: (Future) the computation, which returns the same as _get_shift()
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=MAX_SHIFT_WORKERS)
+        return self._executor.submit(self._get_shift, prev_tile, tile)
+
+    def _get_average(self, tile):
+        """
+        :param tile: (DataArray) a tile of the grid
+        :returns: (float) the average value of the whole tile, computed only once per tile
+        """
+        # The tiles are kept in self.tiles, so their id is unique
+        try:
+            return self._tile_averages[id(tile)]
+        except KeyError:
+            avg = numpy.average(tile)
+            self._tile_averages[id(tile)] = avg
+            return avg
+
     def _insert_tile_to_grid(self, tile):
         """
         Stores the tile at the proper place in the grid. If necessary, the grid is
@@ -626,8 +679,8 @@ class GlobalShiftRegistrar(ShiftRegistrar):
             t2, b2 = 0, tile.shape[0] - int(exp_tile_dist_px[1])
 
         # TODO should we take a larger area?
-        prev_tile_roi = numpy.array(prev_tile)[t1:b1, l1:r1]
-        tile_roi = numpy.array(tile)[t2:b2, l2:r2]
+        prev_tile_roi = numpy.asarray(prev_tile)[t1:b1, l1:r1]
+        tile_roi = numpy.asarray(tile)[t2:b2, l2:r2]
 
         # If you need to crop the tile without changing the output shift,
         # you can do it here with the pattern tile_roi[t:-b, l:-r]
@@ -636,10 +689,11 @@ class GlobalShiftRegistrar(ShiftRegistrar):
         shift_px = numpy.subtract(exp_tile_dist_px, meas_tile_dist_px)
 
         # Measure accuracy (ncc value)
-        avg = numpy.average(prev_tile), numpy.average(tile)
-        diff = prev_tile_roi - avg[0], tile_roi - avg[1]
-        covar = numpy.sum(diff[0] * diff[1]) / prev_tile_roi.size
-        var = numpy.sum(diff[0] ** 2) / prev_tile_roi.size, numpy.sum(diff[1] ** 2) / tile_roi.size
+        avg = self._get_average(prev_tile), self._get_average(tile)
+        diff = (prev_tile_roi.ravel() - avg[0]), (tile_roi.ravel() - avg[1])
+        # Dot products avoid creating the intermediary arrays of the products
+        covar = numpy.dot(diff[0], diff[1]) / prev_tile_roi.size
+        var = numpy.dot(diff[0], diff[0]) / prev_tile_roi.size, numpy.dot(diff[1], diff[1]) / tile_roi.size
         st_dev = (numpy.sqrt(var[0]), numpy.sqrt(var[1]))
         if st_dev[0] == 0 or st_dev[1] == 0:
             return exp_tile_dist_px, 0
@@ -666,7 +720,7 @@ class GlobalShiftRegistrar(ShiftRegistrar):
         """
         Performs registration of the tile at grid position row, col with respect to every
         available neighbour. The computed shifts and the respective cross-correlation values
-        are stored in self.shifts.
+        are stored in self.shifts (as Futures, until getPositions() is called).
 
         :param row: (int) row index
         :param col: (int) col index
@@ -686,82 +740,139 @@ class GlobalShiftRegistrar(ShiftRegistrar):
         shift_top = self.shifts_ver[row - 1][col] if row > 0 else None
         shift_bottom = self.shifts_ver[row][col] if row < num_rows - 2 else None
 
-        # Calculate the shifts to all adjacent tiles that have not been calculated yet
+        # Calculate the shifts to all adjacent tiles that have not been calculated yet.
+        # They are computed in parallel, and only waited for when the positions are requested.
         if nbr_left is not None and not shift_left:
-            self.shifts_hor[row][col - 1] = self._get_shift(nbr_left, tile)
+            self.shifts_hor[row][col - 1] = self._submit_shift(nbr_left, tile)
         if nbr_right is not None and not shift_right:
-            self.shifts_hor[row][col] = self._get_shift(tile, nbr_right)
+            self.shifts_hor[row][col] = self._submit_shift(tile, nbr_right)
         if nbr_top is not None and not shift_top:
-            self.shifts_ver[row - 1][col] = self._get_shift(nbr_top, tile)
+            self.shifts_ver[row - 1][col] = self._submit_shift(nbr_top, tile)
         if nbr_bottom is not None and not shift_bottom:
-            self.shifts_ver[row][col] = self._get_shift(tile, nbr_bottom)
+            self.shifts_ver[row][col] = self._submit_shift(tile, nbr_bottom)
 
     def _assemble_mosaic(self):
         """
-        Performs a global optimization to find the best path through the tile grid using
-        a minimum spanning tree.
+        Performs a global optimization to find the best position of each tile. A minimum spanning
+        tree gives a first estimate, by following the best path through the tile grid. Then, the
+        positions are refined by a weighted least-squares fit on all the shifts which agree with
+        this estimate, so that the loops in the grid are also taken into account.
+        The graph only contains the edges between neighbouring tiles, so that the memory usage and
+        computation time scale linearly with the number of tiles.
 
         :returns: (numpy array with shape: num_rows x num_cols x 2) registered positions relative to the upper left
         tile in pixels
         """
-        # Transform shifts and errors to adjacency matrices
-        # The normalized cross correlation value needs to be transformed, so it can be
-        # used in the minimum spanning tree. Lower values are better and the value should
-        # never be 0 --> convert to error between [100, 200]
         num_cols = len(self.tiles[0])
         num_rows = len(self.tiles)
-        errors = numpy.zeros((num_rows * num_cols, num_rows * num_cols))
-        shifts = numpy.zeros((num_rows * num_cols, num_rows * num_cols, 2))
+        num_tiles = num_rows * num_cols
+
+        # List all the edges of the tile grid, in the "idx" notation (row * num_cols + col).
+        # The shift of an edge is the position of the second tile relative to the first one.
+        idx_a, idx_b, shifts, nccs = [], [], [], []
         for row in range(num_rows):
             for col in range(num_cols - 1):
-                idx = row * num_cols + col
                 if self.shifts_hor[row][col]:
-                    ncc = self.shifts_hor[row][col][1]
-                    errors[idx, idx + 1] = 200 - (ncc + 1) * 50
-                    shifts[idx, idx + 1] = self.shifts_hor[row][col][0]
+                    idx = row * num_cols + col
+                    idx_a.append(idx)
+                    idx_b.append(idx + 1)
+                    shifts.append(self.shifts_hor[row][col][0])
+                    nccs.append(self.shifts_hor[row][col][1])
 
         for row in range(num_rows - 1):
             for col in range(num_cols):
-                idx = row * num_cols + col
                 if self.shifts_ver[row][col]:
-                    ncc = self.shifts_ver[row][col][1]
-                    errors[idx, idx + num_cols] = 200 - (ncc + 1) * 50
-                    shifts[idx, idx + num_cols] = self.shifts_ver[row][col][0]
-
-        # Build the minimum spanning tree
-        tree = minimum_spanning_tree(csr_matrix(errors))
-        tree = tree.toarray().astype(int)
-
-        # Follow the path through the tree and update positions with the corresponding shifts.
-        # The minimum spanning tree is converted to an adjacency list that contains for every
-        # tile a list of all tiles that should be updated based on the current tile.
-        # The children of the newly updated tile will be placed in a queue waiting to be
-        # updated themselves.
-        adj_list = {}
-        for i in range(len(tree)):
-            adj = []
-            for j in range(len(tree[0])):
-                if tree[i][j] != 0:
-                    adj.append([j, shifts[i][j]])
-                if tree[j][i] != 0:
-                    adj.append([j, shifts[j][i]])
-            adj_list[i] = adj
+                    idx = row * num_cols + col
+                    idx_a.append(idx)
+                    idx_b.append(idx + num_cols)
+                    shifts.append(self.shifts_ver[row][col][0])
+                    nccs.append(self.shifts_ver[row][col][1])
 
         positions = numpy.zeros((num_rows, num_cols, 2))  # start with no shift for each tile
-        positions_flat = positions.reshape((num_rows * num_cols, 2))  # the tiles in the "idx" notation
-        idx_queue = deque([0])  # start with index 0
-        idx_done = set()  # set of positions that have already been updated
-        while idx_queue:
-            key = idx_queue.popleft()
-            for next_idx, shift in adj_list[key]:
-                if next_idx not in idx_done:  # don't consider positions that have already been dealt with
-                    if next_idx > key:
-                        positions_flat[next_idx] = numpy.add(positions_flat[key], shift)
-                    else:
-                        positions_flat[next_idx] = numpy.subtract(positions_flat[key], shift)
-
-                    idx_done.add(next_idx)
-                    if next_idx not in idx_queue:
-                        idx_queue.append(next_idx)
+        if not idx_a:
+            return positions
+        positions_flat = positions.reshape((num_tiles, 2))  # the tiles in the "idx" notation
+
+        idx_a = numpy.array(idx_a, dtype=int)
+        idx_b = numpy.array(idx_b, dtype=int)
+        shifts = numpy.array(shifts, dtype=float).reshape(-1, 2)
+        nccs = numpy.array(nccs, dtype=float)
+
+        # The normalized cross correlation value needs to be transformed, so it can be
+        # used in the minimum spanning tree. Lower values are better and the value should
+        # never be 0 --> convert to error between [100, 200]
+        errors = 200 - (nccs + 1) * 50
+        graph = csr_matrix((errors, (idx_a, idx_b)), shape=(num_tiles, num_tiles))
+        tree = minimum_spanning_tree(graph)
+
+        # Follow the path through the tree, starting from the first tile, and update positions
+        # with the corresponding shifts. The tiles not connected to the first tile stay at 0.
+        edges = {(a, b): i for i, (a, b) in enumerate(zip(idx_a.tolist(), idx_b.tolist()))}
+        order, predecessors = breadth_first_order(tree, 0, directed=False, return_predecessors=True)
+        for idx in order[1:]:
+            prev_idx = predecessors[idx]
+            if prev_idx < idx:
+                positions_flat[idx] = positions_flat[prev_idx] + shifts[edges[(prev_idx, idx)]]
+            else:
+                positions_flat[idx] = positions_flat[prev_idx] - shifts[edges[(idx, prev_idx)]]
+
+        if len(order) > 1:
+            in_tree = numpy.zeros(len(idx_a), dtype=bool)
+            tree = tree.tocoo()
+            for a, b in zip(tree.row.tolist(), tree.col.tolist()):
+                in_tree[edges[(min(a, b), max(a, b))]] = True
+            positions_flat[order[1:]] = self._fit_positions(positions_flat, order, idx_a, idx_b, shifts, nccs,
+                                                            in_tree)
 
         return positions
+
+    @staticmethod
+    def _fit_positions(positions, order, idx_a, idx_b, shifts, nccs, in_tree):
+        """
+        Finds the positions which best fit all the shifts between the tiles, using weighted least
+        squares. The shifts which don't agree with the positions are considered wrong, and ignored.
+        As the positions change with the fit, this is repeated until the set of shifts used is stable.
+
+        :param positions: (numpy array of shape N x 2) initial position of each tile in pixels
+        :param order: (numpy array of int) index of the tiles to fit. The first one is fixed.
+        :param idx_a: (numpy array of E int) index of the first tile of each edge
+        :param idx_b: (numpy array of E int) index of the second tile of each edge
+        :param shifts: (numpy array of shape E x 2) shift from the first to the second tile of each edge, in pixels
+        :param nccs: (numpy array of E floats) normalized cross correlation of each edge
+        :param in_tree: (numpy array of E bool) True for the edges of the spanning tree of the initial positions
+        :returns: (numpy array of shape len(order) - 1 x 2) the position of the tiles in order[1:], in pixels
+        """
+        positions = positions.copy()
+        variables = numpy.full(len(positions), -1, dtype=int)
+        variables[order[1:]] = numpy.arange(len(order) - 1)
+        # Only the edges connected to the tiles to fit are used
+        used = (variables[idx_a] >= 0) | (variables[idx_b] >= 0)
+        var_a, var_b = variables[idx_a[used]], variables[idx_b[used]]
+        num_edges = len(var_a)
+
+        # Incidence matrix: for each edge, +1 for the second tile, and -1 for the first tile.
+        # As the first tile is fixed (at 0), it is not part of the variables.
+        rows = numpy.concatenate([numpy.arange(num_edges)] * 2)
+        cols = numpy.concatenate([var_b, var_a])
+        vals = numpy.concatenate([numpy.ones(num_edges), -numpy.ones(num_edges)])
+        fitted = cols >= 0
+        incidence = csr_matrix((vals[fitted], (rows[fitted], cols[fitted])), shape=(num_edges, len(order) - 1))
+
+        idx_a, idx_b, shifts, nccs, in_tree = idx_a[used], idx_b[used], shifts[used], nccs[used], in_tree[used]
+        prev_consistent = None
+        for i in range(MAX_FIT_ITERATIONS):
+            residuals = positions[idx_b] - positions[idx_a] - shifts
+            consistent = numpy.hypot(residuals[:, 0], residuals[:, 1]) <= MAX_SHIFT_RESIDUAL
+            if prev_consistent is not None and numpy.array_equal(consistent, prev_consistent):
+                break
+            prev_consistent = consistent
+
+            # The best matches weight more. The inconsistent shifts are ignored, but the ones of
+            # the spanning tree are kept with a tiny weight, so that all the tiles stay connected.
+            weights = numpy.where(consistent, numpy.maximum(nccs, 0) + MIN_SHIFT_WEIGHT, 0)
+            weights[in_tree & ~consistent] = MIN_SHIFT_WEIGHT
+            wincidence = incidence.T @ diags(weights)
+            lhs = (wincidence @ incidence).tocsc()
+            positions[order[1:]] = splu(lhs).solve(wincidence @ shifts)
+
+        return positions[order[1:]]
@@ -32,32 +32,65 @@ def register(tiles, method=REGISTER_GLOBAL_SHIFT):
         tiles (list of DataArray of shape YX or tuples of DataArrays): The tiles as passed, but with updated
         MD_POS metadata
     """
+    registrar = create_registrar(method)
 
+    # Register tiles
+    for ts in tiles:
+        add_tile(registrar, ts)
+
+    return update_positions(registrar, tiles)
+
+
+def create_registrar(method):
+    """
+    method (REGISTER_*): REGISTER_SHIFT → ShiftRegistrar, REGISTER_IDENTITY → IdentityRegistrar,
+      REGISTER_GLOBAL_SHIFT → GlobalShiftRegistrar
+    returns (IdentityRegistrar, ShiftRegistrar or GlobalShiftRegistrar): a new (empty) registrar
+    """
     if method == REGISTER_SHIFT:
-        registrar = ShiftRegistrar()
+        return ShiftRegistrar()
     elif method == REGISTER_IDENTITY:
-        registrar = IdentityRegistrar()
+        return IdentityRegistrar()
     elif method == REGISTER_GLOBAL_SHIFT:
-        registrar = GlobalShiftRegistrar()
+        return GlobalShiftRegistrar()
     else:
         raise ValueError("Invalid registrar %s" % (method,))
 
-    # Register tiles
-    updatedTiles = []
-    for ts in tiles:
-        # Separate tile and dependent_tiles
-        if isinstance(ts, tuple):
-            tile = ts[0]
-            dep_tiles = ts[1:]
-        else:
-            tile = ts
-            dep_tiles = None
-        registrar.addTile(tile, dep_tiles)
 
+def add_tile(registrar, ts):
+    """
+    Pass a tile to the registrar, which computes its shift with the tiles already added.
+    It can be called as soon as the tile is acquired, in order to spread the computation
+    over the acquisition time.
+    registrar (IdentityRegistrar, ShiftRegistrar or GlobalShiftRegistrar): the registrar
+    ts (DataArray of shape YX or tuple of DataArrays): the tile, as in register()
+    """
+    # Separate tile and dependent_tiles
+    if isinstance(ts, tuple):
+        tile = ts[0]
+        dep_tiles = ts[1:]
+    else:
+        tile = ts
+        dep_tiles = None
+    registrar.addTile(tile, dep_tiles)
+
+
+def update_positions(registrar, tiles):
+    """
+    Compute the positions of all the tiles registered, and apply them to the tiles.
+    registrar (IdentityRegistrar, ShiftRegistrar or GlobalShiftRegistrar): the registrar,
+      to which all the tiles have been added (with add_tile())
+    tiles (list of DataArray of shape YX or tuples of DataArrays): The tiles, in the same
+      order as they were added
+    returns:
+        tiles (list of DataArray of shape YX or tuples of DataArrays): The tiles as passed, but with updated
+        MD_POS metadata
+    """
     # Compute the positions
     positions, dep_positions = registrar.getPositions()
 
     # Update positions, by creating DataArrays with the same data, but different MD_POS
+    updatedTiles = []
     for i, ts in enumerate(tiles):
         # Return tuple of positions if dependent tiles are present
         if isinstance(ts, tuple):
@@ -87,23 +120,31 @@ def register(tiles, method=REGISTER_GLOBAL_SHIFT):
     return updatedTiles
 
 
-def weave(tiles, method=WEAVER_MEAN, adjust_brightness=False):
+def _create_weaver(method, adjust_brightness=False):
     """
-    tiles (list of DataArray or DataArrayShadow of shape YX): The tiles to draw
-    method (WEAVER_*): WEAVER_MEAN → MeanWeaver, WEAVER_COLLAGE → CollageWeaver
-    return:
-        image (DataArray of shape Y'X'): A large image containing all the tiles
+    method (WEAVER_*): WEAVER_MEAN → MeanWeaver, WEAVER_COLLAGE → CollageWeaver,
+      WEAVER_COLLAGE_REVERSE → CollageWeaverReverse
+    return (Weaver): a new weaver
     """
-
     if method == WEAVER_MEAN:
-        weaver = MeanWeaver(adjust_brightness)
+        return MeanWeaver(adjust_brightness)
     elif method == WEAVER_COLLAGE:
-        weaver = CollageWeaver(adjust_brightness)
+        return CollageWeaver(adjust_brightness)
     elif method == WEAVER_COLLAGE_REVERSE:
-        weaver = CollageWeaverReverse(adjust_brightness)
+        return CollageWeaverReverse(adjust_brightness)
     else:
         raise ValueError("Invalid weaver %s" % (method,))
 
+
+def weave(tiles, method=WEAVER_MEAN, adjust_brightness=False):
+    """
+    tiles (list of DataArray or DataArrayShadow of shape YX): The tiles to draw
+    method (WEAVER_*): WEAVER_MEAN → MeanWeaver, WEAVER_COLLAGE → CollageWeaver
+    return:
+        image (DataArray of shape Y'X'): A large image containing all the tiles
+    """
+    weaver = _create_weaver(method, adjust_brightness)
+
     for t in tiles:
         if isinstance(t, model.DataArrayShadow):
             t =  t.getData()
@@ -111,3 +152,21 @@ def weave(tiles, method=WEAVER_MEAN, adjust_brightness=False):
     stitched_image = weaver.getFullImage()
 
     return stitched_image
+
+
+def weave_to_file(tiles, filename, method=WEAVER_MEAN, adjust_brightness=False):
+    """
+    Same as weave(), but the large image is directly written to a pyramidal TIFF
+    file, one band of rows at a time. The large image is never completely in
+    memory, and DataArrayShadows tiles are only loaded while the band they
+    intersect is weaved. So it works even if the image is larger than the memory.
+    tiles (list of DataArray or DataArrayShadow of shape YX): The tiles to draw
+    filename (str): name of the TIFF file to create (including path)
+    method (WEAVER_*): WEAVER_MEAN → MeanWeaver, WEAVER_COLLAGE → CollageWeaver
+    return (tuple of int): the shape of the large image written
+    """
+    weaver = _create_weaver(method, adjust_brightness)
+
+    for t in tiles:
+        weaver.addTile(t)
+    return weaver.exportFullImage(filename)
@@ -37,6 +37,7 @@ from scipy.spatial import Delaunay
 from shapely.geometry import Polygon, box
 
 from odemis import dataio, model
+from odemis.dataio import tiff
 from odemis.acq import acqmng
 from odemis.acq.align.autofocus import MTD_EXHAUSTIVE, AutoFocus
 from odemis.acq.align.roi_autofocus import (
@@ -48,7 +49,8 @@ from odemis.acq.stitching._constants import (
     REGISTER_IDENTITY,
     WEAVER_MEAN,
 )
-from odemis.acq.stitching._simple import register, weave
+from odemis.acq.stitching._simple import (add_tile, create_registrar, register, update_positions, weave,
+                                          weave_to_file)
 from odemis.acq.stream import (
     ARStream,
     CLStream,
@@ -88,6 +90,9 @@ MAX_DISTANCE_FOCUS_POINTS = 450e-06  # in m
 
 DEFAULT_FOV = (100e-6, 100e-6) # m
 STITCH_SPEED = 1e8  # px/s
+# Maximum number of tiles waiting to be saved (in the log path). When reached, the
+# acquisition waits, so that the memory doesn't fill up if the disk is too slow.
+MAX_PENDING_SAVES = 10
 
 class FocusingMethod(Enum):
     NONE = 0  # Never auto-focus
@@ -105,7 +110,7 @@ class TiledAcquisitionTask(object):
 
     def __init__(self, streams, stage, region, overlap, settings_obs=None, log_path=None, future=None, zlevels=None,
                  registrar=REGISTER_GLOBAL_SHIFT, weaver=WEAVER_MEAN, focusing_method=FocusingMethod.NONE,
-                 focus_points=None, focus_range=None, centered_acq=True):
+                 focus_points=None, focus_range=None, centered_acq=True, stitched_path=None):
         """
         :param streams: (list of Streams) the streams to acquire
         :param stage: (Actuator) the sample stage to move to the possible tiles locations
@@ -131,6 +136,12 @@ class TiledAcquisitionTask(object):
         :param centered_acq: (bool) If True, center the acquisition area on the given region; any extra area is added
             symmetrically to all sides of the bounding box. If False, the top-left of the acquisition area is aligned
             with the top-left of the bounding box.
+        :param stitched_path: (str or None) filename of a TIFF file where to save the stitched
+            data, in the pyramidal format. The tiles are directly weaved into the file, one
+            row of TIFF tiles at a time, so that neither the stitched image nor its zoom levels
+            are ever completely in memory, which allows to stitch very large mosaics. In such
+            case, the stitched data returned are DataArrayShadows of the file.
+            If there are several streams, the index of the stream is added to the filename.
         """
         self._future = future
         self._streams = streams
@@ -248,10 +259,18 @@ class TiledAcquisitionTask(object):
             self._fn_bs, self._fn_ext = udataio.splitext(filename)
             self._log_dir = os.path.dirname(self._log_path)
             self._save_executor = ThreadPoolExecutor(max_workers=5)
+            self._save_slots = threading.BoundedSemaphore(MAX_PENDING_SAVES)
 
         self._registrar = registrar
         self._weaver = weaver
         self._focus_plane = {}
+        self._stitched_path = stitched_path
+
+        # To compute the shift of each tile with its neighbours, while the next tiles are acquired
+        self._tile_registrar = None
+        self._register_executor = None
+        self._register_futures = []
+        self._registration_error = None  # ValueError if the registration failed
 
     def _convert_region_to_polygon(
             self,
@@ -443,40 +462,25 @@ class TiledAcquisitionTask(object):
 
         return sorted_indices
 
-    def _moveToTile(self, idx, prev_idx, tile_size):
+    def _moveToTile(self, idx, prev_idx, tile_size, move_f=None):
         """
         Move the stage to the tile position
         :param idx: (tuple (float, float)) current index of tile
         :param prev_idx: (tuple (float, float)) previous index of tile
         :param tile_size: (tuple (float, float)) total tile size
+        :param move_f: (Future or None) the move to the tile, if it was already started
+          by _startMoveToTile(). If it fails, the move is retried as usual.
         """
-        overlap = 1 - self._overlap
-        # don't move on the axis that is not supposed to have changed
-        m = {}
-        idx_change = numpy.subtract(idx, prev_idx)
-        if idx[0] != prev_idx[0]:  # x-axis changed
-            m["x"] = self._starting_pos["x"] + idx[0] * tile_size[0] * overlap
-        if idx[1] != prev_idx[1]:  # y-axis changed
-            m["y"] = self._starting_pos["y"] - idx[1] * tile_size[1] * overlap
-
-        # Compute the time to wait
-        if prev_idx == START_INDEX:
-            # If this is the first tile, wait for a long time to allow the stage to move
-            # This is needed because the current stage position may be far from the first tile
-            # so it may take a long time to move there
-            timeout = 100  # s
-        else:
-            # For any tile after the first, don't wait forever for the stage to move,
-            # guess the time it should take and then give a large margin
-            t = math.hypot(abs(idx_change[0]) * tile_size[0] * overlap,
-                           abs(idx_change[1]) * tile_size[1] * overlap) / self._move_speed
-            timeout = 5 * t + 3  # s
+        m, timeout = self._getTileMove(idx, prev_idx, tile_size)
 
         logging.debug("Moving to tile %s at %s m", idx, m)
         for i in range(3):  # Try moving up to 3 times
             if self._future._task_state == CANCELLED:
                 raise CancelledError()
-            self._future.running_subf = self._stage.moveAbs(m)
+            if i == 0 and move_f is not None:
+                self._future.running_subf = move_f
+            else:
+                self._future.running_subf = self._stage.moveAbs(m)
             try:
                 self._future.running_subf.result(timeout)
             except ValueError:  # Typically, asked to move to the wrong place, let's give up
@@ -507,6 +511,59 @@ class TiledAcquisitionTask(object):
             logging.error("Failed to move to tile %s after 3 trials", idx)
             raise OSError(f"Failed to move to tile {idx} after 3 trials")
 
+    def _getTileMove(self, idx, prev_idx, tile_size):
+        """
+        Computes the stage move to go to the tile position
+        :param idx: (tuple (float, float)) current index of tile
+        :param prev_idx: (tuple (float, float)) previous index of tile
+        :param tile_size: (tuple (float, float)) total tile size
+        :returns:
+          (dict str -> float): the absolute move of the stage
+          (float): the maximum time the move should take (s)
+        """
+        overlap = 1 - self._overlap
+        # don't move on the axis that is not supposed to have changed
+        m = {}
+        idx_change = numpy.subtract(idx, prev_idx)
+        if idx[0] != prev_idx[0]:  # x-axis changed
+            m["x"] = self._starting_pos["x"] + idx[0] * tile_size[0] * overlap
+        if idx[1] != prev_idx[1]:  # y-axis changed
+            m["y"] = self._starting_pos["y"] - idx[1] * tile_size[1] * overlap
+
+        # Compute the time to wait
+        if prev_idx == START_INDEX:
+            # If this is the first tile, wait for a long time to allow the stage to move
+            # This is needed because the current stage position may be far from the first tile
+            # so it may take a long time to move there
+            timeout = 100  # s
+        else:
+            # For any tile after the first, don't wait forever for the stage to move,
+            # guess the time it should take and then give a large margin
+            t = math.hypot(abs(idx_change[0]) * tile_size[0] * overlap,
+                           abs(idx_change[1]) * tile_size[1] * overlap) / self._move_speed
+            timeout = 5 * t + 3  # s
+
+        return m, timeout
+
+    def _startMoveToTile(self, idx, prev_idx, tile_size):
+        """
+        Starts moving the stage to the tile position, without waiting for the move to end.
+        To be followed by a call to _moveToTile(), with the returned future.
+        :param idx: (tuple (float, float)) next index of tile
+        :param prev_idx: (tuple (float, float)) current index of tile
+        :param tile_size: (tuple (float, float)) total tile size
+        :returns: (Future) the move
+        """
+        m, _ = self._getTileMove(idx, prev_idx, tile_size)
+        logging.debug("Starting to move to tile %s at %s m", idx, m)
+        # Start the move as the sub-future, under the lock, so that a cancellation
+        # of the task always stops it.
+        with self._future._task_lock:
+            if self._future._task_state == CANCELLED:
+                raise CancelledError()
+            self._future.running_subf = self._stage.moveAbs(m)
+            return self._future.running_subf
+
     def _sortDAs(self, das, ss):
         """
         Sorts das based on priority for stitching, i.e. largest SEM da first, then
@@ -659,8 +716,9 @@ class TiledAcquisitionTask(object):
 
         # After the acquisition of first tile, update the time taken for subsequent tiles based on time taken for
         # previous tiles
-        if self.average_acquisition_time:
-            return self.average_acquisition_time * remaining
+        tile_time = self._getMeasuredTileTime()
+        if tile_time:
+            return tile_time * remaining
 
         zlevels_dict = {s: self._zlevels for s in self._streams
                         if isinstance(s, (FluoStream))}
@@ -692,22 +750,62 @@ class TiledAcquisitionTask(object):
 
         return acq_time + move_time + stitch_time
 
+    def _getMeasuredTileTime(self):
+        """
+        Estimates the time per tile, based on the time each stage took on the
+        previous tiles.
+        :returns: (float or None) the time per tile (s), or None if not yet known
+        """
+        stage_times = {key: statistics.mean(val) for key, val in self._save_time.items() if len(val) > 0}
+        if "move" not in stage_times:
+            # The move to the first tile is not representative, so only rely on
+            # the average time, which includes it
+            return self.average_acquisition_time
+
+        # The acquisition thread moves the stage, acquires the tile, and processes
+        # the data (while the stage already moves to the next tile).
+        acq_time = stage_times["move"] + stage_times["acq"] + stage_times.get("process", 0)
+        # The registration runs in parallel, in a single thread, so if it's slower
+        # than the acquisition, it's the one which determines the time per tile.
+        # (The saving also runs in parallel, but if it's slower, the acquisition
+        # waits for it, which is already counted in the processing time.)
+        return max(acq_time, stage_times.get("register", 0))
+
     def _save_tiles(self, ix, iy, das, stream_cube_id=None):
         """
-        Save the acquired data array to disk (for debugging)
+        Save the acquired data array to disk (for debugging).
+        The data is saved in a separate thread. If already MAX_PENDING_SAVES tiles
+        are waiting to be saved, it blocks until one of them is saved.
         """
 
         def save_tile(ix, iy, das, stream_cube_id=None):
-            if stream_cube_id is not None:
-                # Indicate it's a stream cube in the file name
-                fn_tile = "%s-cube%d-%.5dx%.5d%s" % (self._fn_bs, stream_cube_id, ix, iy, self._fn_ext)
-            else:
-                fn_tile = "%s-%.5dx%.5d%s" % (self._fn_bs, ix, iy, self._fn_ext)
-            logging.debug("Will save data of tile %dx%d to %s", ix, iy, fn_tile)
-            self._exporter.export(os.path.join(self._log_dir, fn_tile), das)
+            save_start = time.time()
+            try:
+                if stream_cube_id is not None:
+                    # Indicate it's a stream cube in the file name
+                    fn_tile = "%s-cube%d-%.5dx%.5d%s" % (self._fn_bs, stream_cube_id, ix, iy, self._fn_ext)
+                else:
+                    fn_tile = "%s-%.5dx%.5d%s" % (self._fn_bs, ix, iy, self._fn_ext)
+                logging.debug("Will save data of tile %dx%d to %s", ix, iy, fn_tile)
+                self._exporter.export(os.path.join(self._log_dir, fn_tile), das)
+            except Exception:
+                logging.exception("Failed to save tile %dx%d", ix, iy)
+            finally:
+                self._save_time["save"].append(time.time() - save_start)
+                self._save_slots.release()
+
+        # Wait for a slot in the queue, in case the disk is slower than the acquisition
+        wait_start = time.time()
+        self._save_slots.acquire()
+        self._save_time["save_wait"].append(time.time() - wait_start)
 
         # Run in a separate thread via the executor
-        self._save_executor.submit(save_tile, ix, iy, das, stream_cube_id)
+        try:
+            self._save_executor.submit(save_tile, ix, iy, das, stream_cube_id)
+        except Exception:
+            # The tile will not be saved, so it doesn't use the slot
+            self._save_slots.release()
+            raise
 
     def _acquireStreamCompressedZStack(self, i, ix, iy, stream):
         """
@@ -822,55 +920,84 @@ class TiledAcquisitionTask(object):
         prev_idx = START_INDEX
         i = 0
 
-        self._save_time = {"acq": [], "stitch": [], "move": [], "save": []}
+        # Time of each stage of the pipeline, for each tile:
+        # * move: waiting for the stage to reach the tile (the move starts during the processing of the previous tile)
+        # * acq: acquiring the tile (including the focus adjustment)
+        # * process: processing the data, while the stage moves to the next tile (including save_wait)
+        # * save_wait: waiting for the tile to be accepted in the queue of tiles to save
+        # * save: saving the tile on disk, in a separate thread
+        # * register: registering the tile with its neighbours, in a separate thread
+        self._save_time = {"acq": [], "stitch": [], "move": [], "process": [], "save": [], "save_wait": [],
+                           "register": []}
         # The increase in the number of scanning indices increase with overlap between tiles. The time take
         # by stage to move to different indices also includes the time taken to move when scanning indices increase due
         # to increase in overlap. This means stitching time is included when move time between tiles is observed.
         # Hence, observed time due to stitching is set to zero
         self._save_time["stitch"] = [0]
-        move_to_tile_start = None
+        move_f = None  # move to the next tile, started during the processing of the current tile
         start_time = time.time()
 
         # Sort the tile_indices in zigzag order to optimize the stage movement
         zigzag_indices = self._sort_tile_indices_zigzag(self._tile_indices)
 
-        for ix, iy in zigzag_indices:
-            if i > 0:
-                self.average_acquisition_time = (time.time() - start_time) / i
+        if self._registrar is not None and self._weaver is not None:
+            # The registration of each tile is done in a separate thread, in the acquisition order,
+            # while the stage moves and the next tile is acquired.
+            self._register_executor = ThreadPoolExecutor(max_workers=1)
+
+        try:
+            for ix, iy in zigzag_indices:
+                if i > 0:
+                    self.average_acquisition_time = (time.time() - start_time) / i
 
-            self._moveToTile((ix, iy), prev_idx, self._sfov)
-            if move_to_tile_start:
-                self._save_time["move"].append(time.time() - move_to_tile_start)
-            prev_idx = ix, iy
+                move_start = time.time()
+                self._moveToTile((ix, iy), prev_idx, self._sfov, move_f)
+                if i > 0:  # The first move can be much longer, so it's not representative
+                    self._save_time["move"].append(time.time() - move_start)
+                prev_idx = ix, iy
 
-            acquisition_start = time.time()
-            if self._focus_points is not None:
-                self._refocus()
+                acquisition_start = time.time()
+                if self._focus_points is not None:
+                    self._refocus()
 
-            logging.debug("Acquiring tile %dx%d", ix, iy)
-            das = self._getTileDAs(i, ix, iy)
+                logging.debug("Acquiring tile %dx%d", ix, iy)
+                das = self._getTileDAs(i, ix, iy)
 
-            if i == 0:
-                # Check the FoV is correct using the data, and if not update
-                self._sfov = self._updateFov(das, self._sfov)
+                if i == 0:
+                    # Check the FoV is correct using the data, and if not update
+                    self._sfov = self._updateFov(das, self._sfov)
 
-            if self._focus_stream:
-                # Check if the acquisition was not good enough, then adjusts focus of current tile and reacquires image
-                das = self._adjustFocus(das, i, ix, iy)
+                if self._focus_stream:
+                    # Check if the acquisition was not good enough, then adjusts focus of current tile and reacquires image
+                    das = self._adjustFocus(das, i, ix, iy)
 
-            self._save_time["acq"].append(time.time() - acquisition_start)
+                self._save_time["acq"].append(time.time() - acquisition_start)
 
-            # Save the das on disk if a log path exists
-            save_tile_start = time.time()
-            if self._log_path:
-                self._save_tiles(ix, iy, das)
+                # The detector is done with this tile, so the stage can already move
+                # to the next one, while the data is processed.
+                process_start = time.time()
+                if i + 1 < len(zigzag_indices):
+                    move_f = self._startMoveToTile(zigzag_indices[i + 1], prev_idx, self._sfov)
 
-            # Sort tiles (largest sem on first position)
-            da_list.append(self._sortDAs(das, self._streams))
-            self._save_time["save"].append(time.time() - save_tile_start)
+                # Save the das on disk if a log path exists
+                if self._log_path:
+                    self._save_tiles(ix, iy, das)
 
-            i += 1
-            move_to_tile_start = time.time()
+                # Sort tiles (largest sem on first position)
+                da_list.append(self._sortDAs(das, self._streams))
+
+                if self._register_executor is not None:
+                    f = self._register_executor.submit(self._registerTile, da_list[-1])
+                    self._register_futures.append(f)
+                self._save_time["process"].append(time.time() - process_start)
+
+                i += 1
+        except Exception:
+            # Don't leave the stage moving to the next tile, if the acquisition
+            # failed or was cancelled while processing the current tile.
+            if move_f is not None:
+                move_f.cancel()
+            raise
 
         return da_list
 
@@ -1033,17 +1160,66 @@ class TiledAcquisitionTask(object):
 
         return das
 
+    def _registerTile(self, das):
+        """
+        Computes the shift between the tile and its neighbours already acquired.
+        Runs in a separate thread, while the next tiles are acquired.
+        :param das: (tuple of DataArrays) the data of the tile, as returned by _sortDAs()
+        """
+        if self._registration_error is not None:
+            return  # Already failed, no need to continue
+
+        register_start = time.time()
+        try:
+            if self._tile_registrar is None:
+                self._tile_registrar = create_registrar(self._registrar)
+            add_tile(self._tile_registrar, das)
+        except ValueError as exp:
+            logging.info("Registration of tile failed: %s", exp)
+            self._registration_error = exp
+        self._save_time["register"].append(time.time() - register_start)
+
+    def _getRegisteredTiles(self, da_list):
+        """
+        Waits for the registration of all the tiles (started during the acquisition),
+        and then computes their global positions.
+        :param da_list: (list of tuples of DataArrays) the acquired tiles, in the acquisition order
+        :return: (list of tuples of DataArrays) the tiles with the registered MD_POS
+        :raise ValueError: if the registration failed
+        """
+        for f in self._register_futures:
+            f.result()  # Raises an exception if something unexpected happened
+        if self._registration_error is not None:
+            raise self._registration_error
+        return update_positions(self._tile_registrar, da_list)
+
+    def _stopRegistration(self):
+        """
+        Stops the registration thread, without waiting for it. The registrations
+        not yet started are dropped, as in case of cancellation, they are not needed.
+        """
+        if self._register_executor is None:
+            return
+        for f in self._register_futures:
+            f.cancel()
+        self._register_executor.shutdown(wait=False)
+
     def _stitchTiles(self, da_list):
         """
         Stitch the acquired tiles to create a complete view of the required total area
-        :return: (list of DataArrays): a stitched data for each stream acquisition
+        :return: (list of DataArrays or DataArrayShadows): a stitched data for each stream acquisition.
+          If stitched_path is defined, they are DataArrayShadows of the file(s) written.
         """
         st_data = []
         logging.info("Computing big image out of %d images", len(da_list))
 
-        # TODO: Do this registration step in a separate thread while acquiring
         try:
-            das_registered = register(da_list, method=self._registrar)
+            if self._register_futures:
+                # The shifts between tiles were computed during the acquisition,
+                # so only the global positions are left to compute.
+                das_registered = self._getRegisteredTiles(da_list)
+            else:
+                das_registered = register(da_list, method=self._registrar)
         except ValueError as exp:
             logging.warning("Registration with %s failed %s. Retrying with identity registrar.", self._registrar, exp)
             das_registered = register(da_list, method=REGISTER_IDENTITY)
@@ -1051,22 +1227,44 @@ class TiledAcquisitionTask(object):
         logging.info("Using weaving method %s.", self._weaver)
         # Weave every stream
         if isinstance(das_registered[0], tuple):
-            for s in range(len(das_registered[0])):
-                streams = []
-                for da in das_registered:
-                    streams.append(da[s])
-                da = weave(streams, self._weaver)
-                st_data.append(da)
+            st_tiles = [[da[s] for da in das_registered] for s in range(len(das_registered[0]))]
         else:
-            da = weave(das_registered, self._weaver)
+            st_tiles = [das_registered]
+
+        for i, tiles in enumerate(st_tiles):
+            if self._stitched_path:
+                da = self._weaveToFile(tiles, i, len(st_tiles))
+            else:
+                da = weave(tiles, self._weaver)
             st_data.append(da)
         return st_data
 
+    def _weaveToFile(self, tiles, idx, n):
+        """
+        Weave the tiles of one stream directly into a pyramidal TIFF file, one
+        row of TIFF tiles at a time, so that the stitched image is never
+        completely in memory.
+        :param tiles: (list of DataArrays) the registered tiles of the stream
+        :param idx: (int) index of the stream
+        :param n: (int) number of streams stitched
+        :return: (DataArrayShadow) the stitched data, as read from the file
+        """
+        if n > 1:
+            fn_bs, fn_ext = udataio.splitext(self._stitched_path)
+            fn = "%s-%d%s" % (fn_bs, idx, fn_ext)
+        else:
+            fn = self._stitched_path
+        save_start = time.time()
+        shape = weave_to_file(tiles, fn, self._weaver)
+        logging.info("Saved stitched data of shape %s to %s in %g s", shape, fn, time.time() - save_start)
+        return tiff.open_data(fn).content[0]
+
     def run(self):
         """
         Runs the tiled acquisition procedure
         returns:
-            (list of DataArrays): a stitched data for each stream acquisition
+            (list of DataArrays): a stitched data for each stream acquisition.
+              If stitched_path is defined, they are DataArrayShadows of the file(s) written.
         raise:
             CancelledError: if acquisition is cancelled
             Exception: if it failed before any result were acquired
@@ -1105,6 +1303,7 @@ class TiledAcquisitionTask(object):
             logging.debug(f"The average time taken per tile is {self.average_acquisition_time}")
             if self._save_executor is not None:
                 self._save_executor.shutdown()
+            self._stopRegistration()
             with self._future._task_lock:
                 self._future._task_state = FINISHED
         return st_data
@@ -1134,7 +1333,7 @@ def estimateTiledAcquisitionMemory(*args, **kwargs):
 
 def acquireTiledArea(streams, stage, area, overlap=0.2, settings_obs=None, log_path=None, zlevels=None,
                      registrar=REGISTER_GLOBAL_SHIFT, weaver=WEAVER_MEAN, focusing_method=FocusingMethod.NONE,
-                     focus_points=None, focus_range=None, centered_acq=True):
+                     focus_points=None, focus_range=None, centered_acq=True, stitched_path=None):
     """
     Start a tiled acquisition task for the given streams (SEM or FM) in order to
     build a complete view of the TEM grid. Needed tiles are first acquired for
@@ -1144,14 +1343,16 @@ def acquireTiledArea(streams, stage, area, overlap=0.2, settings_obs=None, log_p
     :return: (ProgressiveFuture) an object that represents the task, allow to
         know how much time before it is over and to cancel it. It also permits
         to receive the result of the task, which is a list of model.DataArray:
-        the stitched acquired tiles data
+        the stitched acquired tiles data. If stitched_path is defined, they are
+        model.DataArrayShadow of the file(s) written.
     """
     # Create a progressive future with running sub future
     future = model.ProgressiveFuture()
     # Create a tiled acquisition task
     task = TiledAcquisitionTask(streams, stage, area, overlap, settings_obs, log_path, future=future, zlevels=zlevels,
                                 registrar=registrar, weaver=weaver, focusing_method=focusing_method,
-                                focus_points=focus_points, focus_range=focus_range, centered_acq=centered_acq)
+                                focus_points=focus_points, focus_range=focus_range, centered_acq=centered_acq,
+                                stitched_path=stitched_path)
     future.task_canceller = task._cancelAcquisition  # let the future cancel the task
     # Estimate memory and check if it's sufficient to decide on running the task
     mem_sufficient, mem_est = task.estimateMemory()
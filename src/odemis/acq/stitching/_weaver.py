@@ -21,6 +21,7 @@ import copy
 import numpy
 from abc import abstractmethod
 from odemis import model, util
+from odemis.dataio import tiff
 from odemis.util import img
 
 
@@ -32,6 +33,24 @@ from odemis.util import img
 # directly copy the image already transformed.
 # TODO: handle higher dimensions by just copying them as-is
 
+class _TileShadow(model.DataArrayShadow):
+    """
+    DataArrayShadow of a tile, with the metadata as updated by the weaver.
+    """
+
+    def __init__(self, das, metadata):
+        """
+        das (DataArrayShadow): the original tile
+        metadata (dict str->val): the metadata to use instead of the one of the tile
+        """
+        # Always refer to the original tile, to not stack the wrappers
+        self._das = das._das if isinstance(das, _TileShadow) else das
+        super().__init__(das.shape, das.dtype, metadata)
+
+    def getData(self):
+        return model.DataArray(self._das.getData(), self.metadata)
+
+
 class Weaver(metaclass=ABCMeta):
     """
     Abstract class representing a weaver.
@@ -49,21 +68,29 @@ class Weaver(metaclass=ABCMeta):
         self.gbbx_px = None  # the global bounding box of the weaved image in pixel coordinates
         self.gbbx_phy = None  # the global bounding box of the weaved image in physical coordinates
         self.stage_bare_pos = None # the stage-bare position of the weaved image
+        self._background = None  # the value of the pixels where there is no tile
+        self._tiles_mean = None  # the mean of all the tiles, to adjust the brightness
+        self._tiles_brt = None  # the mean of each tile, to adjust the brightness
 
     def addTile(self, tile):
         """
         Adds one tile to the weaver.
-        tile (2D DataArray): the image must have at least MD_POS and
+        tile (2D DataArray or DataArrayShadow): the image must have at least MD_POS and
         MD_PIXEL_SIZE metadata. All provided tiles should have the same dtype.
+        A DataArrayShadow is only loaded when its data is needed. With
+        exportFullImage(), only the tiles of the row band being weaved are loaded.
         """
         # Merge the correction metadata inside each image (to keep the rest of the
         # code simple)
         if isinstance(tile, model.DataArrayShadow):
-            raise TypeError(f"Tile must be a loaded DataArray, not a DataArrayShadow. To load a DataArrayShadow, call: tile = tile.getData()")
-        if not isinstance(tile, model.DataArray):
-            raise TypeError(f"Tile must be a DataArray, not {type(tile)}")
-        tile = model.DataArray(tile, tile.metadata.copy())
-        img.mergeMetadata(tile.metadata)
+            md = tile.metadata.copy()
+            img.mergeMetadata(md)
+            tile = _TileShadow(tile, md)  # Don't modify the metadata of the original one
+        elif isinstance(tile, model.DataArray):
+            tile = model.DataArray(tile, tile.metadata.copy())
+            img.mergeMetadata(tile.metadata)
+        else:
+            raise TypeError(f"Tile must be a DataArray or DataArrayShadow, not {type(tile)}")
         self.tiles.append(tile)
 
     def getFullImage(self):
@@ -71,6 +98,51 @@ class Weaver(metaclass=ABCMeta):
         Assembles the tiles into a large image.
         return (2D DataArray): same dtype as the tiles, with shape corresponding to the bounding box of the tiles.
         """
+        # Everything is done in memory, so load all the tiles at once
+        self.tiles = [self._load_tile(t) for t in self.tiles]
+        rotation, center_of_rot = self._prepare_tiles()
+        im = self.weave_tiles()
+        md = self.get_final_metadata(self.tiles[0].metadata.copy())
+        weaved_image = img.rotate_img_metadata(model.DataArray(im, md), rotation, center_of_rot)
+
+        return weaved_image
+
+    def exportFullImage(self, filename, band_height=tiff.TILE_SIZE):
+        """
+        Assembles the tiles into a large image, directly written as a pyramidal
+        TIFF file. Contrarily to getFullImage(), the complete image is never in
+        memory: it's weaved one band of rows at a time, and only the tiles
+        intersecting the current band are loaded. So it can be used to weave
+        images larger than the memory, with tiles passed as DataArrayShadows.
+        filename (str): name of the TIFF file to create (including path)
+        band_height (0<int): number of rows weaved at once. It should be a multiple
+          of the TIFF tile size.
+        return (tuple of int): the shape of the image written
+        """
+        if band_height % tiff.TILE_SIZE:
+            raise ValueError("band_height should be a multiple of %d, but got %d" % (tiff.TILE_SIZE, band_height))
+
+        rotation, center_of_rot = self._prepare_tiles()
+        md = self.get_final_metadata(self.tiles[0].metadata.copy())
+        md = self._rotate_metadata(md, rotation, center_of_rot)
+        shape = self.gbbx_px[-1], self.gbbx_px[-2]
+        logging.debug("Weaving global image of size %dx%d px to %s", shape[1], shape[0], filename)
+
+        with tiff.PyramidalTIFFWriter(filename, shape, self.tiles[0].dtype, md) as writer:
+            for y, band in zip(range(0, shape[0], band_height), self._iter_bands(band_height)):
+                for ys in range(0, band.shape[0], tiff.TILE_SIZE):
+                    writer.write_strip((y + ys) // tiff.TILE_SIZE, band[ys:ys + tiff.TILE_SIZE])
+
+        return shape
+
+    def _prepare_tiles(self):
+        """
+        Aligns the tiles with the horizontal axis, and computes their bounding boxes
+        and the values over all the tiles needed for weaving them.
+        return:
+          rotation (float): the rotation of the tiles (rad), removed from their metadata
+          center_of_rot (float, float): the center of this rotation (m)
+        """
         # NOTE on rotation:
         # Total image rotation is the sum of the "standard" rotation, relative to the sample coordinates, and the scan rotation.
         # The scan rotation is not used when displaying the images, because it causes images to be displayed 'upside down' from
@@ -85,22 +157,133 @@ class Weaver(metaclass=ABCMeta):
         tiles = []
         # Rotate all tiles by the inverse of the rotation, such that each tile is aligned with the horizontal axis.
         for tile in self.tiles:
-            tiles.append(img.rotate_img_metadata(tile, -rotation, center_of_rot))
+            if isinstance(tile, model.DataArrayShadow):
+                tile = _TileShadow(tile, self._rotate_metadata(tile.metadata, -rotation, center_of_rot))
+            else:
+                tile = img.rotate_img_metadata(tile, -rotation, center_of_rot)
+            tiles.append(tile)
         self.tiles = tiles
 
         self.tbbx_px, self.gbbx_px, self.gbbx_phy, self.stage_bare_pos = self.get_bounding_boxes(self.tiles)
-        im = self.weave_tiles()
-        md = self.get_final_metadata(self.tiles[0].metadata.copy())
-        weaved_image = img.rotate_img_metadata(model.DataArray(im, md), rotation, center_of_rot)
 
-        return weaved_image
+        # The background value and the mean brightness are computed one tile at
+        # a time, so that the tiles don't need to be all in memory.
+        mins = []
+        sums = []
+        for t in self.tiles:
+            t = self._load_tile(t)
+            mins.append(t.min())
+            sums.append(numpy.sum(t, dtype=numpy.float64))
+        self._background = min(mins)
+        self._tiles_brt = [s / (t.shape[0] * t.shape[1]) for s, t in zip(sums, self.tiles)]
+        self._tiles_mean = sum(sums) / sum(t.shape[0] * t.shape[1] for t in self.tiles)
+
+        return rotation, center_of_rot
+
+    @staticmethod
+    def _rotate_metadata(md, rotation, center_of_rot):
+        """
+        Same as img.rotate_img_metadata(), but only for the metadata.
+        md (dict): the metadata of the image
+        return (dict): a copy of the metadata, with MD_POS and MD_ROTATION updated
+        """
+        # Only the metadata is needed, so use a stand-in image without any pixel
+        return img.rotate_img_metadata(model.DataArray(numpy.empty((0, 0)), md), rotation, center_of_rot).metadata
+
+    @staticmethod
+    def _load_tile(tile):
+        """
+        tile (DataArray or DataArrayShadow): a tile as stored by the weaver
+        return (DataArray): the tile with its data loaded
+        """
+        if isinstance(tile, model.DataArrayShadow):
+            return tile.getData()
+        return tile
+
+    def _get_tile(self, i):
+        """
+        Loads a tile, with its brightness adjusted if requested. The adjustment is
+        done once per tile, and not every time (part of) the tile is pasted.
+        i (int): index of the tile
+        return (DataArray): the tile, ready to be pasted
+        """
+        t = self._load_tile(self.tiles[i])
+        if self.adjust_brt:
+            t = self._adjust_brightness(t, self._tiles_brt[i], self._tiles_mean)
+        return t
+
+    def _iter_bands(self, band_height):
+        """
+        Weaves the global image one band of rows at a time, from top to bottom.
+        Only the tiles intersecting the current band are kept in memory.
+        band_height (0<int): number of rows of each band
+        yields (2D numpy.ndarray): the band, of band_height rows (or less for the last one)
+        """
+        height = self.gbbx_px[-1]
+        loaded = {}  # tile index -> DataArray
+        for y0 in range(0, height, band_height):
+            y1 = min(y0 + band_height, height)
+            for i, (b, t) in enumerate(zip(self.tbbx_px, self.tiles)):
+                if b[1] < y1 and b[3] > y0 and i not in loaded:
+                    loaded[i] = self._get_tile(i)
+
+            # The tiles must be pasted in the order they were added, as the order
+            # matters for most of the weavers.
+            band_tiles = sorted(loaded.items())
+            yield self._weave_band(y0, y1 - y0, [self.tbbx_px[i] for i, _ in band_tiles],
+                                   [t for _, t in band_tiles])
+
+            # Drop the tiles which are fully above the next band
+            for i in list(loaded.keys()):
+                if self.tbbx_px[i][3] <= y1:
+                    del loaded[i]
 
-    @abstractmethod
     def weave_tiles(self):
         """
         Weave the tiles into a single image.
         return (2D DataArray): The weaved image.
         """
+        logging.debug("Generating global image of size %dx%d px",
+                      self.gbbx_px[-2], self.gbbx_px[-1])
+        tiles = [self._get_tile(i) for i in range(len(self.tiles))]
+        return self._weave_band(0, self.gbbx_px[-1], self.tbbx_px, tiles)
+
+    def _weave_band(self, y0, height, tbbx_px, tiles):
+        """
+        Weave the tiles into a band of rows of the global image.
+        y0 (0<=int): first row of the band in the global image
+        height (0<int): number of rows in the band
+        tbbx_px (list of tuples): the ltrb bounding boxes of each tile in pixel coordinates
+        tiles (list of 2D DataArray): the (loaded) tiles intersecting the band,
+          in the order they were added
+        return (2D numpy.ndarray): the band of the weaved image
+        """
+        # Create a background of the image using the minimum value of all the tiles
+        im = numpy.full((height, self.gbbx_px[-2]), self._background, dtype=self.tiles[0].dtype)
+        # Indicates the parts of the image which already contain image data (True)
+        mask = numpy.zeros(im.shape, dtype=bool)
+
+        for b, t in zip(tbbx_px, tiles):
+            # Only the rows of the tile in the band
+            ty0, ty1 = max(b[1], y0), min(b[1] + t.shape[0], y0 + height)
+            if ty0 >= ty1:
+                continue
+            roi = im[ty0 - y0:ty1 - y0, b[0]:b[0] + t.shape[1]]
+            moi = mask[ty0 - y0:ty1 - y0, b[0]:b[0] + t.shape[1]]
+            self._paste_tile(roi, moi, t, slice(ty0 - b[1], ty1 - b[1]))
+        return im
+
+    @abstractmethod
+    def _paste_tile(self, roi, moi, t, rows):
+        """
+        Paste (part of) a tile into the global image.
+        roi (2D numpy.ndarray): part of the global image overlapping with the tile
+          (rows). To be updated.
+        moi (2D numpy.ndarray of bool): part of the mask corresponding to roi. True
+          where the image already contains data. To be updated.
+        t (2D DataArray): the whole tile
+        rows (slice): the rows of the tile which correspond to roi
+        """
         pass
 
     @staticmethod
@@ -196,11 +379,12 @@ class Weaver(metaclass=ABCMeta):
                 pass
         return md
 
-    def _adjust_brightness(self, tile, tiles):
+    def _adjust_brightness(self, tile, tile_brt, im_brt):
         """
-        Adjusts the brightness of a tile, so its mean corresponds to the mean of a list of tiles.
-        :param tile (DataArray): tile to adjust
-        :param tiles (2D DataArray): input tiles
+        Adjusts the brightness of a tile, so its mean corresponds to the mean of all the tiles.
+        :param tile (DataArray): tile to adjust. It is not modified.
+        :param tile_brt (float): mean of the tile
+        :param im_brt (float): mean of all the tiles
         :returns (2D DataArray): tiles with adjusted brightness
         """
         # This is a very simple algorithm. In reality, not every tile should have the same brightness. A better
@@ -209,9 +393,6 @@ class Weaver(metaclass=ABCMeta):
         # In general, even this simple calculation helps to improve the quality of the overall image
         # if there are a lot of bleaching/deposition effects, which cause a small number of tiles to have
         # a very different (typically higher) brightness than the others.
-        tile = copy.deepcopy(tile)  # don't change the input tile
-        im_brt = numpy.mean(tiles)
-        tile_brt = numpy.mean(tile)
         diff = im_brt - tile_brt
         # To avoid overflows, we need to clip the results to the dtype range.
         if numpy.issubdtype(tile.dtype, numpy.integer):
@@ -237,24 +418,12 @@ class CollageWeaver(Weaver):
       the bounding box.
     """
 
-    def weave_tiles(self):
+    def _paste_tile(self, roi, moi, t, rows):
         """
-        Weave tiles by pasting the tiles where their center position is.
-        return (2D DataArray): The weaved image.
+        Paste the tile where its center position is.
         """
-        # Paste each tile
-        logging.debug("Generating global image of size %dx%d px",
-                      self.gbbx_px[-2], self.gbbx_px[-1])
-
-        # Create a background of the image using the minimum value of self.tiles
-        im = numpy.ones((self.gbbx_px[-1], self.gbbx_px[-2]), dtype=self.tiles[0].dtype) * numpy.amin(self.tiles)
-
-        for b, t in zip(self.tbbx_px, self.tiles):
-            if self.adjust_brt:
-                t = self._adjust_brightness(t, self.tiles)
-            im[b[1]:b[1] + t.shape[0], b[0]:b[0] + t.shape[1]] = t
-            # TODO: border
-        return im
+        roi[...] = t[rows]
+        # TODO: border
 
 
 class CollageWeaverReverse(Weaver):
@@ -265,34 +434,17 @@ class CollageWeaverReverse(Weaver):
     with the last tile and pastes the older tiles in reverse order of acquisition.
     """
 
-    def weave_tiles(self):
+    def _paste_tile(self, roi, moi, t, rows):
         """
-        Weave tiles by filling parts of the global image that are still empty with the new tile.
-        return (2D DataArray): The weaved image.
+        Fill the parts of the global image that are still empty with the tile.
         """
-        # Paste each tile
-        logging.debug("Generating global image of size %dx%d px",
-                      self.gbbx_px[-2], self.gbbx_px[-1])
-        # Create a background of the image using the minimum value of self.tiles
-        im = numpy.ones((self.gbbx_px[-1], self.gbbx_px[-2]), dtype=self.tiles[0].dtype) * numpy.amin(self.tiles)
+        t = t[rows]
 
-        # The mask is multiplied with the tile, thereby creating a tile with a gradient
-        mask = numpy.zeros((self.gbbx_px[-1], self.gbbx_px[-2]), dtype=bool)
+        # Insert image at positions that are still empty
+        roi[~moi] = t[~moi]
 
-        for b, t in zip(self.tbbx_px, self.tiles):
-            # Part of image overlapping with tile
-            roi = im[b[1]:b[1] + t.shape[0], b[0]:b[0] + t.shape[1]]
-            moi = mask[b[1]:b[1] + t.shape[0], b[0]:b[0] + t.shape[1]]
-
-            if self.adjust_brt:
-                t = self._adjust_brightness(t, self.tiles)
-
-            # Insert image at positions that are still empty
-            roi[~moi] = t[~moi]
-
-            # Update mask
-            mask[b[1]:b[1] + t.shape[0], b[0]:b[0] + t.shape[1]] = True
-        return im
+        # Update mask
+        moi[...] = True
 
 
 class MeanWeaver(Weaver):
@@ -301,10 +453,9 @@ class MeanWeaver(Weaver):
     average of the pixel of each tile.
     """
 
-    def weave_tiles(self):
+    def _paste_tile(self, roi, moi, t, rows):
         """
-        Weave tiles by using a smooth gradient.
-        return (2D DataArray): The weaved image.
+        Paste the tile by using a smooth gradient with the data already present.
         """
         #  The part of the tile that does not overlap
         # with any previous tiles is inserted into the part of the
@@ -323,48 +474,33 @@ class MeanWeaver(Weaver):
         # the ovv image are added, so the resulting image contains a gradient in the overlapping regions
         # between all the tiles that have been inserted before and the newly inserted tile.
 
-        # Paste each tile
-        logging.debug("Generating global image of size %dx%d px",
-                      self.gbbx_px[-2], self.gbbx_px[-1])
-        # Create a background of the image using the minimum value of self.tiles
-        im = numpy.ones((self.gbbx_px[-1], self.gbbx_px[-2]), dtype=self.tiles[0].dtype) * numpy.amin(self.tiles)
-
-        # The mask is multiplied with the tile, thereby creating a tile with a gradient
-        mask = numpy.zeros((self.gbbx_px[-1], self.gbbx_px[-2]), dtype=bool)
-
-        for b, t in zip(self.tbbx_px, self.tiles):
-            # Part of image overlapping with tile
-            roi = im[b[1]:b[1] + t.shape[0], b[0]:b[0] + t.shape[1]]
-            moi = mask[b[1]:b[1] + t.shape[0], b[0]:b[0] + t.shape[1]]
-
-            if self.adjust_brt:
-                self._adjust_brightness(t, self.tiles)
-            # Insert image at positions that are still empty
-            roi[~moi] = t[~moi]
-
-            # Create gradient in overlapping region. Ratio between old image and new tile values determined by
-            # distance to the center of the tile
-
-            # Create weight matrix with decreasing values from its center that
-            # has the same size as the tile.
-            sz = numpy.array(roi.shape)
-            hh, hw = sz / 2  # half-height, half-width
-            x = numpy.linspace(-hw, hw, sz[1])
-            y = numpy.linspace(-hh, hh, sz[0])
-            xx, yy = numpy.meshgrid((x / hw) ** 6, (y / hh) ** 6)
-            w = numpy.maximum(xx, yy)
-            # Hardcoding a weight function is quite arbitrary and might result in
-            # suboptimal solutions in some cases.
-            # Alternatively, different weights might be used. One option would be to select
-            # a fixed region on the sides of the image, e.g. 20% (expected overlap), and
-            # only apply a (linear) gradient to these parts, while keeping the new tile for the
-            # rest of the region. However, this approach does not solve the hardcoding problem
-            # since the overlap region is still arbitrary. Future solutions might adaptively
-            # select this region.
-
-            # Use weights to create gradient in overlapping region
-            roi[moi] = (t * (1 - w))[moi] + (roi * w)[moi]
-
-            # Update mask
-            mask[b[1]:b[1] + t.shape[0], b[0]:b[0] + t.shape[1]] = True
-        return im
+        t_band = t[rows]
+
+        # Insert image at positions that are still empty
+        roi[~moi] = t_band[~moi]
+
+        # Create gradient in overlapping region. Ratio between old image and new tile values determined by
+        # distance to the center of the tile
+
+        # Create weight matrix with decreasing values from its center that
+        # has the same size as the tile (and keep only the rows in the band).
+        sz = numpy.array(t.shape)
+        hh, hw = sz / 2  # half-height, half-width
+        x = numpy.linspace(-hw, hw, sz[1])
+        y = numpy.linspace(-hh, hh, sz[0])[rows]
+        xx, yy = numpy.meshgrid((x / hw) ** 6, (y / hh) ** 6)
+        w = numpy.maximum(xx, yy)
+        # Hardcoding a weight function is quite arbitrary and might result in
+        # suboptimal solutions in some cases.
+        # Alternatively, different weights might be used. One option would be to select
+        # a fixed region on the sides of the image, e.g. 20% (expected overlap), and
+        # only apply a (linear) gradient to these parts, while keeping the new tile for the
+        # rest of the region. However, this approach does not solve the hardcoding problem
+        # since the overlap region is still arbitrary. Future solutions might adaptively
+        # select this region.
+
+        # Use weights to create gradient in overlapping region
+        roi[moi] = (t_band * (1 - w))[moi] + (roi * w)[moi]
+
+        # Update mask
+        moi[...] = True
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Created on 18 Oct 2026
+
+@author: agent
+
+Benchmark of the global shift registration. It registers a synthetic grid of
+tiles, with the shifts between neighbouring tiles computed with one thread
+(ie, serial), and in parallel, and reports the duration and the position error.
+
+Example:
+python3 -m odemis.acq.stitching.test.registrar_bench --tiles 20
+
+Copyright © 2026 agent
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Odemis. If not, see http://www.gnu.org/licenses/.
+'''
+import argparse
+import logging
+import time
+
+import numpy
+
+from odemis import model
+from odemis.acq.stitching import _registrar
+from odemis.acq.stitching.test.stitching_test import decompose_image
+from odemis.util import synthetic
+
+
+def generate_image(size, seed=0):
+    """
+    Generate an image with a random texture, which is easy to register
+    size (int): width and height of the image
+    seed (int): seed of the random generator
+    return (DataArray of uint16): the image
+    """
+    arr = synthetic.generate_texture((size, size), numpy.uint16, sigma=3, seed=seed)
+    md = {
+        model.MD_DIMS: "YX",
+        model.MD_PIXEL_SIZE: (1e-7, 1e-7),
+        model.MD_POS: (0, 0),
+    }
+    return model.DataArray(arr, md)
+
+
+def register_speed(tiles, workers):
+    """
+    Register the tiles with the GlobalShiftRegistrar
+    tiles (list of DataArray): the tiles, in acquisition order
+    workers (int): number of threads to use
+    return:
+      (float): the duration of the registration (s)
+      (numpy.array of shape N x 2): the position of each tile (m)
+    """
+    orig_workers = _registrar.MAX_SHIFT_WORKERS
+    _registrar.MAX_SHIFT_WORKERS = workers
+    try:
+        start = time.time()
+        registrar = _registrar.GlobalShiftRegistrar()
+        for t in tiles:
+            registrar.addTile(t)
+        positions, _ = registrar.getPositions()
+        return time.time() - start, numpy.array(positions)
+    finally:
+        _registrar.MAX_SHIFT_WORKERS = orig_workers
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the speed of the global shift registration.")
+    parser.add_argument("--tiles", type=int, default=20,
+                        help="Number of tiles per side of the grid.")
+    parser.add_argument("--tile-size", type=int, default=256,
+                        help="Width (and height) of each tile (px).")
+    parser.add_argument("--overlap", type=float, default=0.2,
+                        help="Overlap between neighbouring tiles (ratio).")
+    parser.add_argument("--workers", type=int, default=_registrar.MAX_SHIFT_WORKERS,
+                        help="Number of threads for the parallel registration.")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    n = args.tiles
+    # Image size such as decompose_image() generates tiles of the requested size
+    size = int(args.tile_size * (n - n * args.overlap + args.overlap + 1)) + 1
+    image = generate_image(size)
+    tiles, exp_pos = decompose_image(image, args.overlap, n, "horizontalZigzag", True)
+    exp_pos = numpy.array(exp_pos)
+    pxs = tiles[0].metadata[model.MD_PIXEL_SIZE][0]
+    num_pairs = 2 * n * (n - 1)
+
+    results = []
+    for workers in (1, args.workers):
+        dur, pos = register_speed(tiles, workers)
+        # A global translation of the mosaic doesn't matter
+        diff = pos - exp_pos
+        error = numpy.linalg.norm(diff - diff.mean(axis=0), axis=1) / pxs
+        print("%d x %d tiles of %d px, %d threads: %.2f s (%.2f ms/pair), error mean %.2f px, max %.2f px" %
+              (n, n, tiles[0].shape[0], workers, dur, dur / num_pairs * 1e3, error.mean(), error.max()))
+        results.append(pos)
+
+    identical = numpy.allclose(results[0], results[1], atol=1e-12)
+    print("Positions %s" % ("identical" if identical else "DIFFERENT",))
+
+
+if __name__ == '__main__':
+    main()
@@ -26,6 +26,7 @@ import logging
 import os
 import random
 import re
+import tracemalloc
 import unittest
 import warnings
 
@@ -919,5 +920,42 @@ class TestGlobalShiftRegistrar(unittest.TestCase):
                     self.assertAlmostEqual(dep_tile[1], p[1] + r2 * px_size[1])
 
 
+    def test_large_grid(self):
+        """
+        Test the global optimization on a large grid, with noisy and wrong shifts (without the images,
+        which would be too slow to register)
+        """
+        num = 100  # tiles per side
+        rng = numpy.random.default_rng(1)
+        # positions in px of each tile (rows x cols x XY), with some random error
+        grid = numpy.stack(numpy.meshgrid(numpy.arange(num) * 900, numpy.arange(num) * 900), axis=-1)
+        exp_pos = grid + rng.normal(0, 3, (num, num, 2))
+        exp_pos -= exp_pos[0, 0]
+
+        registrar = GlobalShiftRegistrar()
+        registrar.tiles = [[object()] * num for _ in range(num)]
+        registrar.shifts_hor = [[(exp_pos[r, c + 1] - exp_pos[r, c] + rng.normal(0, 0.3, 2), rng.uniform(0.5, 1))
+                                 for c in range(num - 1)] for r in range(num)]
+        registrar.shifts_ver = [[(exp_pos[r + 1, c] - exp_pos[r, c] + rng.normal(0, 0.3, 2), rng.uniform(0.5, 1))
+                                 for c in range(num)] for r in range(num - 1)]
+        # Some registrations fail: far from the expected position, and with a bad match
+        for r, c in rng.integers(0, num - 1, (num * 5, 2)):
+            registrar.shifts_hor[r][c] = (exp_pos[r, c + 1] - exp_pos[r, c] + (30, -25), rng.uniform(0, 0.4))
+
+        # Check the memory used, rather than the time, which depends on the computer.
+        # Dense (rows * cols)² matrices would need 800 MB each.
+        tracemalloc.start()
+        try:
+            positions = registrar._assemble_mosaic()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        logging.info("Assembled %d tiles using %g MB", num * num, peak / 2 ** 20)
+        self.assertEqual(positions.shape, (num, num, 2))
+        # The error accumulates over the grid, but should stay small thanks to the many loops
+        numpy.testing.assert_allclose(positions, exp_pos, atol=3)
+        self.assertLess(peak, 100 * 2 ** 20)
+
+
 if __name__ == '__main__':
     unittest.main()
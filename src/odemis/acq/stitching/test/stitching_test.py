@@ -31,8 +31,9 @@ import numpy
 
 import odemis
 from odemis import model
-from odemis.acq.stitching import (REGISTER_IDENTITY, REGISTER_SHIFT,
-                                  WEAVER_COLLAGE, WEAVER_MEAN, register, weave)
+from odemis.acq.stitching import (REGISTER_GLOBAL_SHIFT, REGISTER_IDENTITY, REGISTER_SHIFT,
+                                  WEAVER_COLLAGE, WEAVER_MEAN, add_tile, create_registrar,
+                                  register, update_positions, weave)
 from odemis.dataio import find_fittest_converter
 from odemis.util.img import ensure2DImage
 
@@ -94,6 +95,40 @@ class TestRegister(unittest.TestCase):
                 self.assertAlmostEqual(calculatedPosition[0], pos[i][0], places=1)
                 self.assertAlmostEqual(calculatedPosition[1], pos[i][1], places=1)
 
+    def test_progressive(self):
+        """
+        Test registering the tiles one at a time finds the actual positions of the tiles
+        """
+        img = IMGS[1]
+        conv = find_fittest_converter(img)
+        img = ensure2DImage(conv.read_data(img)[0])
+        [tiles, pos] = decompose_image(img, 0.2, 3, "horizontalZigzag")
+        px_size = tiles[0].metadata[model.MD_PIXEL_SIZE]
+
+        for method in (REGISTER_GLOBAL_SHIFT, REGISTER_SHIFT):
+            registrar = create_registrar(method)
+            for t in tiles:
+                add_tile(registrar, t)
+            prog_tiles = update_positions(registrar, tiles)
+
+            self.assertEqual(len(prog_tiles), len(tiles))
+            # The registration is relative, so only compare the positions relative to the first tile
+            ref = numpy.array(prog_tiles[0].metadata[model.MD_POS]) - pos[0]
+            for pt, p in zip(prog_tiles, pos):
+                numpy.testing.assert_allclose(numpy.array(pt.metadata[model.MD_POS]) - ref, p,
+                                              atol=3 * px_size[0])
+
+        # Identity => the positions are not changed
+        registrar = create_registrar(REGISTER_IDENTITY)
+        for t in tiles:
+            add_tile(registrar, t)
+        prog_tiles = update_positions(registrar, tiles)
+        for t, pt in zip(tiles, prog_tiles):
+            numpy.testing.assert_allclose(pt.metadata[model.MD_POS], t.metadata[model.MD_POS])
+
+        with self.assertRaises(ValueError):
+            create_registrar("not a registrar")
+
     # @unittest.skip("skip")
     def test_dep_tiles(self):
         """
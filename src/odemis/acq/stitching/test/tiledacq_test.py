@@ -20,9 +20,13 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 import logging
 import math
 import os
+import shutil
+import tempfile
+import threading
 import time
 import unittest
-from concurrent.futures._base import FINISHED, CancelledError
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures._base import CANCELLED, FINISHED, RUNNING, CancelledError
 from typing import List, Tuple
 from unittest import mock
 
@@ -31,18 +35,22 @@ from shapely.affinity import rotate
 from shapely.geometry import Polygon
 
 import odemis
-from odemis import model
+from odemis import dataio, model
 from odemis.acq import acqmng, stream
 from odemis.acq.acqmng import SettingsObserver
 from odemis.acq.move import MicroscopePostureManager, FM_IMAGING
 from odemis.acq.stitching import (
+    REGISTER_GLOBAL_SHIFT,
     REGISTER_IDENTITY,
     WEAVER_COLLAGE_REVERSE,
     WEAVER_MEAN,
     FocusingMethod,
     acquireTiledArea,
+    register,
+    weave,
 )
 from odemis.acq.stitching._tiledacq import (
+    MAX_PENDING_SAVES,
     START_INDEX,
     TiledAcquisitionTask,
     clip_tiling_bbox_to_range,
@@ -52,6 +60,7 @@ from odemis.acq.stitching._tiledacq import (
     get_tiled_bboxes,
     get_zstack_levels,
 )
+from odemis.acq.stitching.test.stitching_test import decompose_image
 from odemis.acq.stream import FluoStream
 from odemis.util import img, testing
 from odemis.util.comp import compute_camera_fov, compute_scanner_fov
@@ -62,6 +71,8 @@ logging.basicConfig(format="%(asctime)s  %(levelname)-7s %(module)s:%(lineno)d %
 CONFIG_PATH = os.path.dirname(odemis.__file__) + "/../../install/linux/usr/share/odemis/"
 METEOR_CONFIG = CONFIG_PATH + "sim/meteor-sim.odm.yaml"
 METEOR_FIBSEM_CONFIG = CONFIG_PATH + "sim/meteor-fibsem-sim.odm.yaml"
+# Image to generate tiles to register
+TILES_IMG = os.path.dirname(odemis.__file__) + "/acq/align/test/images/Slice69_stretched.tif"
 
 
 class CRYOSECOMTestCase(unittest.TestCase):
@@ -209,6 +220,42 @@ class CRYOSECOMTestCase(unittest.TestCase):
                    'y': starting_pos["y"] - exp_shift[1]}
         testing.assert_pos_almost_equal(self.stage.position.value, exp_pos, atol=1e-6, match_all=False)
 
+        # Move started in advance (as done while the data of the previous tile is processed)
+        move_f = tiled_acq_task._startMoveToTile((0, 2), (0, 1), fov)
+        tiled_acq_task._moveToTile((0, 2), (0, 1), fov, move_f)
+        self.assertTrue(move_f.done())
+        time.sleep(0.01)
+        exp_pos = {'x': starting_pos["x"],
+                   'y': starting_pos["y"] - 2 * exp_shift[1]}
+        testing.assert_pos_almost_equal(self.stage.position.value, exp_pos, atol=1e-6, match_all=False)
+
+    def test_measured_tile_time(self):
+        """
+        Test the estimation of the time per tile based on the time of each stage of the acquisition
+        """
+        self.posture_manager.cryo_switch_sample_position(FM_IMAGING).result()
+        area = (-0.001, -0.001, 0.001, 0.001)
+        tiled_acq_task = TiledAcquisitionTask(self.fm_streams, self.stage,
+                                              area, overlap=0.2, future=model.InstantaneousFuture())
+        # Nothing acquired yet => based on the hardware settings
+        self.assertIsNone(tiled_acq_task._getMeasuredTileTime())
+        self.assertGreater(tiled_acq_task.estimateTime(10), 0)
+
+        # Only the first tile => use the average time
+        tiled_acq_task._save_time = {"acq": [2], "stitch": [0], "move": [], "process": [0.1],
+                                     "save": [], "save_wait": [], "register": []}
+        tiled_acq_task.average_acquisition_time = 5
+        self.assertAlmostEqual(tiled_acq_task.estimateTime(10), 50)
+
+        # Acquisition slower than registration
+        tiled_acq_task._save_time = {"acq": [2, 2], "stitch": [0], "move": [0.5], "process": [0.1, 0.3],
+                                     "save": [1, 1], "save_wait": [0, 0], "register": [1, 1]}
+        self.assertAlmostEqual(tiled_acq_task.estimateTime(10), 10 * (2 + 0.5 + 0.2))
+
+        # Registration slower than acquisition
+        tiled_acq_task._save_time["register"] = [4, 6]
+        self.assertAlmostEqual(tiled_acq_task.estimateTime(10), 10 * 5)
+
     def test_get_fov(self):
         """
         Test getting the fov for sem and fm streams
@@ -917,6 +964,211 @@ class TiledAcquisitionTaskTestCase(unittest.TestCase):
         sorted_indices = tiled_acq_task._sort_tile_indices_zigzag([])
         self.assertListEqual(sorted_indices, [])
 
+    def _create_register_task(self):
+        """
+        Create a task, ready to register tiles in the background, as done by _acquireTiles()
+        """
+        task = TiledAcquisitionTask(streams=self.streams, stage=mock.Mock(spec=model.Actuator),
+                                    region=(0, 0, 1e-3, 1e-3), overlap=0.2,
+                                    registrar=REGISTER_GLOBAL_SHIFT, weaver=WEAVER_MEAN)
+        task._save_time = {"register": []}
+        task._register_executor = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(task._stopRegistration)
+        return task
+
+    def _submit_tiles(self, task, tiles):
+        for t in tiles:
+            f = task._register_executor.submit(task._registerTile, (t,))
+            task._register_futures.append(f)
+
+    def _get_tiles(self):
+        """
+        return (list of DataArray, list of (float, float)): the tiles and their actual position
+        """
+        conv = dataio.find_fittest_converter(TILES_IMG)
+        image = img.ensure2DImage(conv.read_data(TILES_IMG)[0])
+        return decompose_image(image, 0.2, 3, "horizontalZigzag")
+
+    def test_register_tiles(self):
+        """
+        Test registering the tiles in the background, while acquiring them
+        """
+        tiles, pos = self._get_tiles()
+        task = self._create_register_task()
+        self._submit_tiles(task, tiles)
+
+        da_list = task._getRegisteredTiles([(t,) for t in tiles])
+        self.assertEqual(len(da_list), len(tiles))
+        self.assertEqual(len(task._save_time["register"]), len(tiles))
+        # Should be the same as registering all the tiles at the end
+        exp_tiles = register(tiles, method=REGISTER_GLOBAL_SHIFT)
+        for (da,), et in zip(da_list, exp_tiles):
+            numpy.testing.assert_allclose(da.metadata[model.MD_POS], et.metadata[model.MD_POS])
+
+        # Compare to the actual positions, relative to the first tile
+        px_size = tiles[0].metadata[model.MD_PIXEL_SIZE]
+        ref = numpy.array(da_list[0][0].metadata[model.MD_POS]) - pos[0]
+        for (da,), p in zip(da_list, pos):
+            numpy.testing.assert_allclose(numpy.array(da.metadata[model.MD_POS]) - ref, p,
+                                          atol=3 * px_size[0])
+
+    def test_register_failure(self):
+        """
+        Test that when the registration fails in the background, the identity registrar is used
+        """
+        tiles, pos = self._get_tiles()
+        task = self._create_register_task()
+        with mock.patch("odemis.acq.stitching._tiledacq.add_tile",
+                        side_effect=ValueError("No overlap")) as add_tile:
+            self._submit_tiles(task, tiles)
+            with self.assertRaises(ValueError):
+                task._getRegisteredTiles([(t,) for t in tiles])
+        # After the first failure, the next tiles are not registered
+        add_tile.assert_called_once()
+
+        # Stitching the tiles falls back to the identity registrar => the positions are not changed
+        with mock.patch("odemis.acq.stitching._tiledacq.register", wraps=register) as reg:
+            st_data = task._stitchTiles([(t,) for t in tiles])
+        reg.assert_called_once()
+        self.assertEqual(reg.call_args[1]["method"], REGISTER_IDENTITY)
+        self.assertEqual(len(st_data), 1)
+        exp = weave(tiles, WEAVER_MEAN)
+        self.assertEqual(st_data[0].shape, exp.shape)
+        numpy.testing.assert_allclose(st_data[0].metadata[model.MD_POS], exp.metadata[model.MD_POS])
+
+    def test_register_cancel(self):
+        """
+        Test that stopping the registration drops the tiles not yet registered
+        """
+        tiles, pos = self._get_tiles()
+        task = self._create_register_task()
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_add_tile(registrar, das):
+            started.set()
+            release.wait(10)
+
+        with mock.patch("odemis.acq.stitching._tiledacq.add_tile", side_effect=slow_add_tile) as add_tile:
+            self._submit_tiles(task, tiles)
+            self.assertTrue(started.wait(10))
+            # Cancel while the first tile is being registered
+            task._stopRegistration()
+            release.set()
+            task._register_futures[0].result(10)
+
+        add_tile.assert_called_once()
+        for f in task._register_futures[1:]:
+            self.assertTrue(f.cancelled())
+
+    def _create_acq_task(self):
+        """
+        Create a task, ready to run _acquireTiles() on a few tiles, with the tiles
+        saved in a temporary directory
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        task = TiledAcquisitionTask(streams=self.streams, stage=mock.Mock(spec=model.Actuator),
+                                    region=(0, 0, 6e-3, 2e-3), overlap=0.2,
+                                    registrar=None, weaver=None, future=model.ProgressiveFuture(),
+                                    log_path=os.path.join(tmpdir, "tile.ome.tiff"))
+        task._future._task_state = RUNNING
+        self.addCleanup(task._save_executor.shutdown)
+        return task, tmpdir
+
+    def _assert_save_slots_free(self, task):
+        """
+        Check that no tile is waiting to be saved, or has leaked its slot
+        """
+        for i in range(MAX_PENDING_SAVES):
+            self.assertTrue(task._save_slots.acquire(blocking=False))
+        self.assertFalse(task._save_slots.acquire(blocking=False))
+
+    def test_acquire_tiles_pipelined(self):
+        """
+        Test that the stage moves to the next tile while the current tile is processed
+        """
+        task, tmpdir = self._create_acq_task()
+        events = []
+
+        def move(m):
+            events.append("move")
+            return model.InstantaneousFuture()
+
+        def acquire(i, ix, iy):
+            events.append("acq")
+            md = {model.MD_PIXEL_SIZE: (1e-4, 1e-4), model.MD_ACQ_TYPE: model.MD_AT_EM}
+            return [model.DataArray(numpy.zeros((18, 21), dtype=numpy.uint16), md)]
+
+        def sort_das(das, ss):
+            events.append("process")
+            return das
+
+        task._stage.moveAbs.side_effect = move
+        with mock.patch.object(task, "_getTileDAs", side_effect=acquire), \
+             mock.patch.object(task, "_sortDAs", side_effect=sort_das):
+            da_list = task._acquireTiles()
+
+        n = len(task._tile_indices)
+        self.assertGreaterEqual(n, 3)
+        self.assertEqual(len(da_list), n)
+        # A single move per tile, started before the processing of the previous tile
+        self.assertEqual(events, ["move", "acq"] + ["move", "process", "acq"] * (n - 1) + ["process"])
+        for k in ("acq", "process", "save_wait"):
+            self.assertEqual(len(task._save_time[k]), n)
+        self.assertEqual(len(task._save_time["move"]), n - 1)
+
+        task._save_executor.shutdown(wait=True)
+        self.assertEqual(len(task._save_time["save"]), n)
+        self.assertEqual(len(os.listdir(tmpdir)), n)
+        self._assert_save_slots_free(task)
+
+    def test_acquire_tiles_error(self):
+        """
+        Test that the move to the next tile is stopped if the processing of the current tile fails
+        """
+        task, tmpdir = self._create_acq_task()
+        moves = []
+
+        def move(m):
+            # The first move is immediate, the next ones never end
+            f = model.InstantaneousFuture() if not moves else Future()
+            moves.append(f)
+            return f
+
+        md = {model.MD_PIXEL_SIZE: (1e-4, 1e-4), model.MD_ACQ_TYPE: model.MD_AT_EM}
+        das = [model.DataArray(numpy.zeros((18, 21), dtype=numpy.uint16), md)]
+        task._stage.moveAbs.side_effect = move
+        with mock.patch.object(task, "_getTileDAs", return_value=das), \
+             mock.patch.object(task, "_sortDAs", side_effect=ValueError("Failed to process")):
+            with self.assertRaises(ValueError):
+                task._acquireTiles()
+
+        self.assertEqual(len(moves), 2)
+        self.assertTrue(moves[1].cancelled())
+
+        # Once the task is cancelled, no new move is started
+        task._future._task_state = CANCELLED
+        with self.assertRaises(CancelledError):
+            task._startMoveToTile((1, 0), (0, 0), task._sfov)
+        self.assertEqual(len(moves), 2)
+
+        task._save_executor.shutdown(wait=True)
+        self._assert_save_slots_free(task)
+
+    def test_save_tiles_error(self):
+        """
+        Test that a tile which cannot be queued for saving doesn't keep its slot
+        """
+        task, tmpdir = self._create_acq_task()
+        task._save_time = {"save": [], "save_wait": []}
+        das = [model.DataArray(numpy.zeros((18, 21), dtype=numpy.uint16))]
+        task._save_executor.shutdown()
+        # Submitting to an executor already shutdown raises a RuntimeError
+        with self.assertRaises(RuntimeError):
+            task._save_tiles(0, 0, das)
+        self._assert_save_slots_free(task)
+
 
 if __name__ == '__main__':
     unittest.main()
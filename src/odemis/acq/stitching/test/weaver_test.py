@@ -26,6 +26,8 @@ import math
 import os
 import random
 import re
+import shutil
+import tempfile
 import time
 import unittest
 import warnings
@@ -42,7 +44,7 @@ from odemis.acq.stitching import (
     MeanWeaver,
 )
 from odemis.acq.stitching.test.stitching_test import decompose_image
-from odemis.dataio import find_fittest_converter
+from odemis.dataio import find_fittest_converter, tiff
 from odemis.util.img import ensure2DImage
 
 logging.getLogger().setLevel(logging.DEBUG)
@@ -311,6 +313,64 @@ class WeaverBaseTest:
                                    mean_stage_bare[axes],
                                    places=3)
 
+    def test_export_full_image(self):
+        """
+        Check that weaving the tiles band by band, directly to a file, gives the
+        same image as weaving them in memory.
+        """
+        # 4x3 tiles of 300x400 px, with ~20% overlap and some jitter, so that
+        # every band of the output overlaps several rows of tiles
+        numpy.random.seed(0)
+        tiles = []
+        px = 1e-6
+        for iy in range(3):
+            for ix in range(4):
+                im = numpy.random.randint(1000, 5000, size=(300, 400), dtype=numpy.uint16)
+                md = {
+                    model.MD_PIXEL_SIZE: (px, px),
+                    model.MD_POS: ((ix * 320 + numpy.random.randint(-5, 6)) * px,
+                                   (-iy * 240 + numpy.random.randint(-5, 6)) * px),
+                    model.MD_ROTATION: 0.1,
+                }
+                tiles.append(model.DataArray(im, md))
+
+        if self.weaver_type == WEAVER_COLLAGE:
+            weaver_class = CollageWeaver
+        elif self.weaver_type == WEAVER_COLLAGE_REVERSE:
+            weaver_class = CollageWeaverReverse
+        elif self.weaver_type == WEAVER_MEAN:
+            weaver_class = MeanWeaver
+
+        # Pass the tiles as DataArrayShadows, so that they are only loaded when needed
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        tiles_fn = os.path.join(tmpdir, "tiles.ome.tiff")
+        tiff.export(tiles_fn, tiles)
+        tiles_sh = tiff.open_data(tiles_fn).content
+        self.assertIsInstance(tiles_sh[0], model.DataArrayShadow)
+
+        fn = os.path.join(tmpdir, "weaved.ome.tiff")
+        for adjust in (False, True):
+            weaver = weaver_class(adjust_brightness=adjust)
+            for t in tiles:
+                weaver.addTile(t)
+            expd = weaver.getFullImage()
+
+            weaver = weaver_class(adjust_brightness=adjust)
+            for t in tiles_sh:
+                weaver.addTile(t)
+            shape = weaver.exportFullImage(fn)
+            self.assertEqual(shape, expd.shape)
+
+            outd = tiff.read_data(fn)[0]
+            numpy.testing.assert_array_equal(outd, expd)
+            numpy.testing.assert_allclose(outd.metadata[model.MD_POS], expd.metadata[model.MD_POS])
+            self.assertAlmostEqual(outd.metadata[model.MD_ROTATION], expd.metadata[model.MD_ROTATION])
+        # Bands must be made of full rows of TIFF tiles
+        with self.assertRaises(ValueError):
+            weaver.exportFullImage(fn, band_height=100)
+
+
 class TestCollageWeaver(WeaverBaseTest, unittest.TestCase):
 
     def setUp(self):
@@ -26,7 +26,6 @@ import weakref
 from collections.abc import Iterable
 from typing import List, Tuple, Optional
 
-import matplotlib
 import numpy
 
 from odemis import model, util
@@ -41,8 +40,11 @@ from odemis.util import img
 # TODO: move to odemis.acq (once it doesn't depend on odemis.acq.stream)
 # Contains the base of the streams. Can be imported from other stream modules.
 # to identify a ROI which must still be defined by the user
+from odemis.util.imports import lazy_import
 from odemis.util.transform import AffineTransform, alt_transformation_matrix_from_implicit
 
+mpl_colors = lazy_import("matplotlib.colors")
+
 UNDEFINED_ROI = (0, 0, 0, 0)
 
 # use hardcode list of polarization positions necessary for polarimetry analysis
@@ -115,6 +117,10 @@ class Stream(object):
     # Minimum overhead time in seconds when acquiring an image
     SETUP_OVERHEAD = 0.1
 
+    # Maximum number of pixels used to compute the histogram. On bigger data,
+    # it's estimated from a subset of the pixels. None => always exact.
+    HISTOGRAM_MAX_SAMPLES = None
+
     def __init__(self, name, detector, dataflow, emitter, focuser=None, opm=None,
                  hwdetvas=None, hwemtvas=None, detvas=None, emtvas=None, axis_map={},
                  raw=None, acq_type=None):
@@ -221,8 +227,7 @@ class Stream(object):
         # maybe the max/min of the smaller image is different from the min/max of the full image.
         # And the histogram of both images will probably be a bit different also.
         if raw and isinstance(raw[0], model.DataArrayShadow):
-            # if the image is pyramidal, use the smaller image
-            drange_raw = img.get_merged_raw_image(raw[0], raw[0].maxzoom)
+            drange_raw = self._getRawPreview(raw[0])
         else:
             drange_raw = None
 
@@ -824,6 +829,19 @@ class Stream(object):
                 self._unlinkHwAxes()
         return active
 
+    def _getRawPreview(self, das):
+        """
+        Read a version of the raw data small enough to compute the drange and
+        the histogram quickly.
+        das (DataArrayShadow): the raw data
+        return (DataArray): if the image is pyramidal, the smallest zoom level,
+          otherwise the whole data
+        """
+        if hasattr(das, "maxzoom"):
+            return img.get_merged_raw_image(das, das.maxzoom)
+        else:
+            return das.getData()
+
     def _updateDRange(self, data=None):
         """
         Update the ._drange, with whatever data is known so far.
@@ -847,8 +865,7 @@ class Stream(object):
             if data is None and self.raw:
                 data = self.raw[0]
                 if isinstance(data, model.DataArrayShadow):
-                    # if the image is pyramidal, use the smaller image
-                    data = img.get_merged_raw_image(data, data.maxzoom)
+                    data = self._getRawPreview(data)
 
             # 2 types of drange management:
             # * dtype is int -> follow MD_BPP/shape/dtype.max, and if too wide use data.max
@@ -1191,7 +1208,7 @@ class Stream(object):
             if len(tint) != 3:
                 raise ValueError("RGB Value for tint should be of length 3")
             return tuple(tint)
-        elif isinstance(tint, matplotlib.colors.Colormap):
+        elif isinstance(tint, mpl_colors.Colormap):
             return tint
         elif tint == TINT_FIT_TO_RGB:
             return tint
@@ -1217,8 +1234,7 @@ class Stream(object):
 
             data = self.raw[0]
             if isinstance(data, model.DataArrayShadow):
-                # Pyramidal => use the smallest version
-                data = img.get_merged_raw_image(data, data.maxzoom)
+                data = self._getRawPreview(data)
 
             # We only do background subtraction when automatically selecting raw
             bkg = self.background.value
@@ -1232,7 +1248,7 @@ class Stream(object):
         self._updateDRange(data)
 
         # Initially, _drange might be None, in which case it will be guessed
-        hist, edges = img.histogram(data, irange=self._drange)
+        hist, edges = img.histogram(data, irange=self._drange, max_samples=self.HISTOGRAM_MAX_SAMPLES)
         if hist.size > 256:
             chist = img.compactHistogram(hist, 256)
         else:
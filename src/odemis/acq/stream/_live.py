@@ -42,6 +42,10 @@ class LiveStream(Stream):
     Abstract class for any stream that can do continuous acquisition.
     """
 
+    # The histogram is recomputed for every frame, so on large frames, just
+    # estimate it (which is precise enough for display).
+    HISTOGRAM_MAX_SAMPLES = 2 ** 18  # px
+
     def __init__(self, name, detector, dataflow, emitter, forcemd=None, **kwargs):
         """
         forcemd (None or dict of MD_* -> value): force the metadata of the
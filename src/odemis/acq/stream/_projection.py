@@ -26,9 +26,11 @@ import logging
 import time
 import math
 import gc
+import heapq
 import numpy
 
-from typing import Tuple, Dict, Union
+from functools import partial
+from typing import Tuple, Dict, List, Union
 from odemis.acq.stream import POL_POSITIONS
 from odemis.model import TINT_FIT_TO_RGB
 
@@ -39,12 +41,43 @@ except ImportError:
 
 from odemis import model
 from odemis.util import img, angleres
+from odemis.util.cache import LRUCache
 from scipy import ndimage
 from odemis.model import MD_PIXEL_SIZE, MD_POL_EPHI, MD_POL_EX, MD_POL_EY, MD_POL_EZ, MD_POL_ETHETA, MD_POL_DS0, \
     MD_POL_S0, MD_POL_DOP, MD_POL_DOLP, MD_POL_UP
 from odemis.acq.stream._static import StaticSpectrumStream
 from abc import abstractmethod
 
+# Maximum memory used by each cache of projected AR images
+AR_CACHE_MAX_BYTES = 512 * 2 ** 20  # bytes
+# Number of ebeam positions around the current one which are projected in advance
+AR_PRECOMPUTE_NEIGHBOURS = 8
+# Maximum memory used by the cumulative sum of a spectrum cube, to compute quickly
+# the image of any band. For larger data, each band is computed from the data.
+SPECTRUM_BAND_PREFIX_MAX_BYTES = 2 ** 30  # bytes
+# Maximum memory used at a time to compute the mean spectrum of data not in memory
+MEAN_SPECTRUM_BLOCK_BYTES = 64 * 2 ** 20  # bytes
+
+
+def _crop_around_pixel(data, key, center, radius):
+    """
+    Select the part of the data within the square around a circle, so that only
+    this part is computed when the data is corrected lazily (cf DataArrayShadowCorrected).
+    data (DataArray or DataArrayShadow): at least 2 dims, the last two being YX
+    key (tuple): selection in the other dimensions
+    center (int, int): x, y coordinates of the center of the circle
+    radius (float): radius of the circle (px)
+    return:
+        cropped (DataArray): the data within the square
+        center (int, int): the x, y coordinates of the center of the circle in the cropped data
+    """
+    x, y = center
+    x0 = max(0, int(x - radius))
+    y0 = max(0, int(y - radius))
+    x1 = min(int(x + radius) + 1, data.shape[-1])
+    y1 = min(int(y + radius) + 1, data.shape[-2])
+    return data[key + (slice(y0, y1), slice(x0, x1))], (x - x0, y - y0)
+
 
 class DataProjection(object):
 
@@ -246,6 +279,11 @@ class ARProjection(RGBProjection):
         """
         super(ARProjection, self).__init__(stream)
 
+        # To project in advance the images at the ebeam positions close to the current one,
+        # so that they are immediately available if the user selects them.
+        self._precompute_thread = None  # Thread computing the neighbours
+        self._precompute_cancelled = threading.Event()  # set to stop the current precomputation
+
         self.stream.point.subscribe(self._onPoint)
         self.stream.background.subscribe(self._onBackground)
 
@@ -281,6 +319,65 @@ class ARProjection(RGBProjection):
         """
         self._shouldUpdateImage()
 
+    def _getNeighbours(self, ebeam_pos):
+        """
+        Find the ebeam positions closest to the given one.
+        :param ebeam_pos: (float, float) The reference ebeam position.
+        :returns: (list of (float, float)) The AR_PRECOMPUTE_NEIGHBOURS closest ebeam positions,
+          sorted from the closest.
+        """
+        positions = (p for p in self.stream.point.choices if p != (None, None) and p != ebeam_pos)
+        return heapq.nsmallest(AR_PRECOMPUTE_NEIGHBOURS, positions,
+                               key=lambda p: (p[0] - ebeam_pos[0]) ** 2 + (p[1] - ebeam_pos[1]) ** 2)
+
+    def _precomputeNeighbours(self, ebeam_pos, compute):
+        """
+        Schedule the projection of the ebeam positions around the given one, in the background.
+        :param ebeam_pos: (float, float) The current ebeam position.
+        :param compute: (callable) Function taking the projection and an ebeam position, which
+          computes and caches the projection.
+        """
+        # The previous requests are most likely not relevant anymore
+        self._precompute_cancelled.set()
+        self._precompute_cancelled = threading.Event()
+
+        # A new thread each time, as the AR conversion allocates a lot of memory, which is only
+        # released when the thread ends. It only holds a weakref, so that the projection can be
+        # garbage collected, which stops the thread.
+        t = threading.Thread(target=self._precompute_neighbours_thread,
+                             args=(weakref.ref(self), compute, self._getNeighbours(ebeam_pos),
+                                   self._precompute_cancelled),
+                             name="AR neighbours projection")
+        t.daemon = True
+        t.start()
+        self._precompute_thread = t
+
+    @staticmethod
+    def _precompute_neighbours_thread(wprojection, compute, positions, cancelled):
+        """
+        Computes the projection at each position, until cancelled, or the projection is deleted.
+        :param wprojection: (weakref to ARProjection) The projection
+        :param compute: (callable) see _precomputeNeighbours()
+        :param positions: (list of (float, float)) The ebeam positions to compute
+        :param cancelled: (threading.Event) Set when the computation should stop
+        """
+        for p in positions:
+            projection = wprojection()
+            if projection is None or cancelled.is_set():
+                return
+            try:
+                compute(projection, p)
+            except Exception:
+                logging.exception("Failed to precompute the projection at %s", p)
+            del projection
+
+    def getCacheStatistics(self):
+        """
+        For debugging, returns information about the caches of projected images.
+        :returns: (dict str -> dict str -> int) Name of the cache -> statistics (see LRUCache.get_stats())
+        """
+        return {}
+
     def _getBackground(self, pol_mode):
         """
         Get the background image from the .background VA on the stream.
@@ -317,17 +414,7 @@ class ARProjection(RGBProjection):
         :return: (DataArray) The background corrected data.
         """
         bg_image = self._getBackground(pol_mode)
-        if bg_image is None:
-            # Simple version: remove the background value, will clip data
-            data_corr = angleres.ARBackgroundSubtract(data)
-        else:
-            if clip_data:
-                data_corr = img.Subtract(data, bg_image)  # metadata from data
-            else:
-                # subtract bg image, but don't clip (keep negative values for export)
-                data_corr = (data.astype(numpy.float64) - bg_image.astype(numpy.float64))
-
-        return data_corr
+        return angleres.ARBackgroundCorrect(data, bg_image, clip_data)
 
     def _resizeImage(self, data, size):
         """
@@ -337,21 +424,7 @@ class ARProjection(RGBProjection):
                      ratio is kept, when computing the other dimension.
         :returns: (2D DataArray) Resized image.
         """
-        # Note: AR conversion might fail with very large images due to too much memory consumed (> 2Gb).
-        # So, rescale + use a "degraded" type that uses less memory. As the display size is small (compared
-        # to the size of the input image, it shouldn't actually affect much the output.
-
-        logging.info("AR image is very large %s, will convert to projection in reduced precision.", data.shape)
-
-        y, x = data.shape
-        if y > x:
-            small_shape = size, int(round(size * x / y))
-        else:
-            small_shape = int(round(size * y / x)), size
-        # resize
-        image_resized = img.rescale_hq(data, small_shape)
-
-        return image_resized
+        return angleres.ARResize(data, size)
 
 
 class ARRawProjection(ARProjection):
@@ -372,8 +445,8 @@ class ARRawProjection(ARProjection):
         super(ARRawProjection, self).__init__(stream)
 
         # Cached conversion of the detector image to polar representation
-        self._polar_cache = {}  # dict tuple (float, float, str or None) -> DataArray
-        # represents (ebeam posX, ebeam posY, polarization pos)
+        self._polar_cache = LRUCache(AR_CACHE_MAX_BYTES)  # tuple ((float, float), str or None) -> DataArray
+        # represents ((ebeam posX, ebeam posY), polarization pos)
 
         if hasattr(stream, "polarization"):
             self.polarization = self.stream.polarization  # make it an attribute of the projection
@@ -386,15 +459,14 @@ class ARRawProjection(ARProjection):
         :param pol_pos: (str or None) Polarization position (must be part of the .stream._pos).
         :returns: (2D DataArray) The polar projection.
         """
-        # Note: Need a copy of the link to the dict. If self._polar_cache is reset while
-        # still running this method, the dict might get new entries again, though it should be empty.
+        # Note: Need a copy of the link to the cache. If self._polar_cache is reset while
+        # still running this method, the cache might get new entries again, though it should be empty.
         polar_cache = self._polar_cache
 
-        try:
-            polar_data = polar_cache.setdefault(ebeam_pos, {})[pol_pos]
-        except KeyError:
+        polar_data = polar_cache.get((ebeam_pos, pol_pos))
+        if polar_data is None:
             # Compute the polar representation
-            data = self.stream._pos[ebeam_pos + (pol_pos,)]
+            data = self.stream._get_ar_data(ebeam_pos + (pol_pos,))
             # TODO: stream._pos can be then also be structured ebeam_pos/pol_pos.
             #   That would also simplify the check for the correct bg image etc.
 
@@ -416,9 +488,7 @@ class ARRawProjection(ARProjection):
                 # Warning: allocates lot of memory, which will not be free'd until
                 # the current thread is terminated.
                 polar_data = angleres.AngleResolved2Polar(calibrated, output_size, hole=False)
-
-                # TODO: don't hold too many of them in cache (eg, max 3 * 1134**2)
-                polar_cache[ebeam_pos][pol_pos] = polar_data
+                polar_cache.put((ebeam_pos, pol_pos), polar_data)
             except Exception:
                 logging.exception("Failed to convert to azimuthal projection")
                 return data  # display its raw as fallback
@@ -443,6 +513,7 @@ class ARRawProjection(ARProjection):
                     pol_pos = None
 
                 polar_data = self._project2Polar(ebeam_pos, pol_pos)
+                self._precomputeNeighbours(ebeam_pos, partial(type(self)._project2Polar, pol_pos=pol_pos))
 
                 # update the histogram
                 # TODO: cache the histogram per image
@@ -469,9 +540,15 @@ class ARRawProjection(ARProjection):
         :param data: (list) List of data arrays.
         """
         # un-cache all the polar images
-        self._polar_cache = {}
+        self._polar_cache = LRUCache(self._polar_cache.max_bytes)
         super(ARRawProjection, self)._onBackground(data)
 
+    def getCacheStatistics(self):
+        """
+        See ARProjection.getCacheStatistics()
+        """
+        return {"polar": self._polar_cache.get_stats()}
+
     def projectAsRaw(self):
         """
         Returns the raw data for the currently selected pixel (ebeam position).
@@ -490,22 +567,12 @@ class ARRawProjection(ARProjection):
             pol_positions = [None]
 
         for pol_pos in pol_positions:
-            data = self.stream._pos[ebeam_pos + (pol_pos,)]
-
-            # Correct image for background. It must match the polarization (defaulting to MD_POL_NONE).
-            calibrated = self._processBackground(data, data.metadata.get(model.MD_POL_MODE, model.MD_POL_NONE),
-                                                 clip_data=False)
-
-            # resize if too large to not run into memory problems
-            if numpy.prod(calibrated.shape) > (800 * 800):
-                calibrated = self._resizeImage(calibrated, size=768)
-
-            output_size = (90, 360)  # Note: increase if data is high def
+            data = self.stream._get_ar_data(ebeam_pos + (pol_pos,))
 
-            # calculate raw theta/phi representation
-            data = angleres.AngleResolved2Rectangular(calibrated, output_size, hole=False)
-
-            data.metadata[model.MD_ACQ_TYPE] = model.MD_AT_AR
+            # Correct image for background. It must match the polarization (defaulting to MD_POL_NONE),
+            # and calculate raw theta/phi representation
+            bg_image = self._getBackground(data.metadata.get(model.MD_POL_MODE, model.MD_POL_NONE))
+            data = angleres.AngleResolved2RawRectangular(data, bg_image)
             data_dict[pol_pos] = data
 
         # TODO for now we distinguish in export between dict and array...
@@ -550,27 +617,27 @@ class ARPolarimetryProjection(ARProjection):
         """
         :param stream: (Stream) The stream the projection is connected to.
         """
-        # If the stream does not have polarimetry data, the GUI tries anyway to have a projection.
-        # In this case we have a simple projection, which has no data ever.
-        if not hasattr(stream, "polarimetry"):
-            self.image = model.VigilantAttribute(None)
-            return
-
-        super(ARPolarimetryProjection, self).__init__(stream)
-
         # Cached conversion of the raw 6 polarization images to:
         #   *Stokes parameters in the detector plane (4 images)
         #   *Stokes parameters in the sample plane (4 images)
         #   *E-fields in polar and Cartesian coordinates (5 images)
         #   *DOPs (degree of polarization) (4 images)
         # All images in polar representation.
-        self._polarimetry_cache = {}  # dict tuple (float, float) -> dict(MD_POL_* (str) -> DataArray)
-        # represents (ebeam posX, ebeam posY) -> (polarimetry pos -> DataArray)
+        self._polarimetry_cache = LRUCache(AR_CACHE_MAX_BYTES)  # tuple ((float, float), str) -> DataArray
+        # represents ((ebeam posX, ebeam posY), polarimetry pos)
 
         # TODO: share the raw data with the cache from ARRawProjection
         # Same as above, but the raw (aka rectangular representation -> phi/theta) images.
         # Images are background corrected.
-        self._polarimetry_cache_raw = {}  # dict tuple (float, float) -> dict(MD_POL_* (str) -> DataArray)
+        self._polarimetry_cache_raw = LRUCache(AR_CACHE_MAX_BYTES)  # tuple (float, float) -> dict(MD_POL_* (str) -> DataArray)
+
+        # If the stream does not have polarimetry data, the GUI tries anyway to have a projection.
+        # In this case we have a simple projection, which has no data ever.
+        if not hasattr(stream, "polarimetry"):
+            self.image = model.VigilantAttribute(None)
+            return
+
+        super(ARPolarimetryProjection, self).__init__(stream)
 
         self.polarimetry = self.stream.polarimetry  # make VA an attribute of the projection
         self.polarimetry.subscribe(self._onPolarimetry)
@@ -584,7 +651,7 @@ class ARPolarimetryProjection(ARProjection):
         """
         data_raw = {}
         for polpos in POL_POSITIONS:
-            data_raw[polpos] = self.stream._pos[ebeam_pos + (polpos,)]
+            data_raw[polpos] = self.stream._get_ar_data(ebeam_pos + (polpos,))
 
         return data_raw
 
@@ -597,12 +664,13 @@ class ARPolarimetryProjection(ARProjection):
                   visualization results as raw images (aka rectangular representation -> phi/theta) for one ebeam
                   position. Images are background corrected.
         """
-        # Note: Need a copy of the link to the dict. If self._polarimetry_cache is reset while
-        # still running this method, the dict might get new entries again, though it should be empty.
+        # Note: Need a copy of the link to the cache. If self._polarimetry_cache is reset while
+        # still running this method, the cache might get new entries again, though it should be empty.
         polarimetry_cache_raw = self._polarimetry_cache_raw
 
         # Note: Method needs about 4sec to display the image for selecting a new ebeam position
-        if ebeam_pos not in polarimetry_cache_raw:
+        polarimetry_raw = polarimetry_cache_raw.get(ebeam_pos)
+        if polarimetry_raw is None:
             # Compute the polarimetry representation
             data_raw = self._getRawData(ebeam_pos)  # get the 6 images for requested ebeam pos
 
@@ -646,19 +714,20 @@ class ARPolarimetryProjection(ARProjection):
                 # Calculate the polarimetry results for the requested ebeam pos (pixel):
                 # Note: Takes about 0.25 sec to calc all polarimetry results for one ebeam pos
                 # and tested on an image of size (256, 1024)
-                polarimetry_cache_raw[ebeam_pos] = arpolarimetry.calcPolarimetry(calibrated_raw, wl)
+                polarimetry_raw = arpolarimetry.calcPolarimetry(calibrated_raw, wl)
 
                 # set acq type on metadata
                 md = {model.MD_ACQ_TYPE: model.MD_AT_AR}
-                for polpos in polarimetry_cache_raw[ebeam_pos]:
+                for polpos in polarimetry_raw:
                     # Note: already background corrected data in dict
-                    polarimetry_cache_raw[ebeam_pos][polpos].metadata.update(md)
+                    polarimetry_raw[polpos].metadata.update(md)
 
+                polarimetry_cache_raw.put(ebeam_pos, polarimetry_raw)
             except Exception:
                 logging.exception("Failed to calculate raw polarimetry results for visualization.")
                 return None
 
-        return polarimetry_cache_raw[ebeam_pos]
+        return polarimetry_raw
 
     def _project2RGBPolar(self, ebeam_pos, pol_pos, cache_raw):
         """
@@ -671,18 +740,14 @@ class ARPolarimetryProjection(ARProjection):
                           position. Images are background corrected.
         :returns: (DataArray) The polarimetry visualization projection.
         """
-        # Note: Need a copy of the link to the dict. If self._polarimetry_cache is reset while
-        # still running this method, the dict might get new entries again, though it should be empty.
+        # Note: Need a copy of the link to the cache. If self._polarimetry_cache is reset while
+        # still running this method, the cache might get new entries again, though it should be empty.
         polarimetry_cache = self._polarimetry_cache
 
-        if ebeam_pos in polarimetry_cache and pol_pos in polarimetry_cache[ebeam_pos]:
-            polarimetry_data = polarimetry_cache[ebeam_pos][pol_pos]
-        else:
+        polarimetry_data = polarimetry_cache.get((ebeam_pos, pol_pos))
+        if polarimetry_data is None:
             try:
                 # Note: Takes 0.24 sec to convert one image for display and tested on an image of size (256, 1024)
-                # Create empty dict for processed ebeam position in cache
-                polarimetry_cache[ebeam_pos] = {}
-
                 # select a color map based on the data
                 if pol_pos in [MD_POL_EPHI, MD_POL_ETHETA, MD_POL_EX, MD_POL_EY, MD_POL_EZ]:
                     data = numpy.abs(cache_raw[pol_pos])
@@ -712,10 +777,8 @@ class ARPolarimetryProjection(ARProjection):
 
                 new_md = self._find_metadata(polarimetry_data.metadata)
                 new_md[model.MD_DIMS] = "YXC"
-                polarimetry_cache[ebeam_pos][pol_pos] = model.DataArray(polarimetry_data, new_md)
-
-                # return an array
-                polarimetry_data = polarimetry_cache[ebeam_pos][pol_pos]
+                polarimetry_data = model.DataArray(polarimetry_data, new_md)
+                polarimetry_cache.put((ebeam_pos, pol_pos), polarimetry_data)
 
             except Exception:
                 logging.exception("Failed to convert the raw polarimetry data to RGB polar representation.")
@@ -747,6 +810,7 @@ class ARPolarimetryProjection(ARProjection):
                 if cache_raw is None:
                     self.image.value = None
                     return
+                self._precomputeNeighbours(ebeam_pos, type(self)._projectAsRaw)
 
                 # Project the raw polarimetry data to RGB polar representation.
                 polarimetry_data = self._project2RGBPolar(ebeam_pos, pol_pos, cache_raw)
@@ -774,10 +838,17 @@ class ARPolarimetryProjection(ARProjection):
         :param data: (list) List of data arrays.
         """
         # un-cache all the polar images
-        self._polarimetry_cache = {}
-        self._polarimetry_cache_raw = {}
+        self._polarimetry_cache = LRUCache(self._polarimetry_cache.max_bytes)
+        self._polarimetry_cache_raw = LRUCache(self._polarimetry_cache_raw.max_bytes)
         super(ARPolarimetryProjection, self)._onBackground(data)
 
+    def getCacheStatistics(self):
+        """
+        See ARProjection.getCacheStatistics()
+        """
+        return {"raw": self._polarimetry_cache_raw.get_stats(),
+                "polar": self._polarimetry_cache.get_stats()}
+
     def projectAsRaw(self):
         """
         Returns the raw data of the polarimetry visualization for the currently selected pixel (ebeam position).
@@ -797,11 +868,10 @@ class ARPolarimetryProjection(ARProjection):
         data_dict = {}
 
         for pol_pos in self.polarimetry.choices:
-            try:
-                # the visualized data is only calculated when the user selects the corresponding
-                # value in the legend --> therefore there might be still some visualizations that need calculation
-                data = self._polarimetry_cache[ebeam_pos][pol_pos]
-            except KeyError:
+            # the visualized data is only calculated when the user selects the corresponding
+            # value in the legend --> therefore there might be still some visualizations that need calculation
+            data = self._polarimetry_cache.get((ebeam_pos, pol_pos))
+            if data is None:
                 # Note: If this method is called, while cache is empty e.g. the bg image was loaded (which empties
                 # the cache), recalculate raw (should always work).
                 raw = self._projectAsRaw(ebeam_pos)
@@ -844,7 +914,10 @@ class RGBSpatialProjection(RGBProjection):
             self.max_projection = stream.max_projection
             self.max_projection.subscribe(self._on_max_projection)
 
-        if stream.raw and isinstance(stream.raw[0], model.DataArrayShadow):
+        # Note: spectrum data can also be a DataArrayShadow, but it's never
+        # displayed by tiles (cf RGBSpatialSpectrumProjection).
+        if (stream.raw and isinstance(stream.raw[0], model.DataArrayShadow)
+            and not isinstance(stream, StaticSpectrumStream)):
             # The raw tiles corresponding to the .image, updated whenever .image is updated
             self._raw = (())  # 2D tuple of DataArrays
             raw = stream.raw[0]
@@ -940,7 +1013,7 @@ class RGBSpatialProjection(RGBProjection):
         if isinstance(data, model.DataArrayShadow):
             tx, px = divmod(pixel_pos[0], data.tile_shape[0])
             ty, py = divmod(pixel_pos[1], data.tile_shape[1])
-            raw_tile = data.getTile(tx, ty, 0)
+            raw_tile = self._readRawTiles([(tx, ty, 0)], self._getSelectedPlane())[0]
             return raw_tile[py, px]
         else:
             dims = data.metadata.get(model.MD_DIMS, "CTZYX"[-data.ndim::])
@@ -1016,6 +1089,56 @@ class RGBSpatialProjection(RGBProjection):
             int(round(rect[1] / (-ps[1]) + img_shape[1] / 2)) - 1,
         )
 
+    def _getSelectedPlane(self) -> Union[None, int, str]:
+        """
+        Get which plane of the raw data is displayed, in case it's a Z stack
+        return: None if the raw data is not a Z stack, otherwise the index of
+          the Z plane, or "max" if the maximum intensity projection is displayed.
+        """
+        das = self.stream.raw[0]
+        dims = das.metadata.get(model.MD_DIMS, "CTZYX"[-das.ndim::])
+        if dims != "ZYX" or not model.hasVA(self.stream, "zIndex"):
+            return None
+        if model.hasVA(self.stream, "max_projection") and self.stream.max_projection.value:
+            return "max"
+        return self.stream.zIndex.value
+
+    @staticmethod
+    def _getTileKey(x: int, y: int, z: int, plane: Union[None, int, str]) -> str:
+        """
+        return: the key of the tile in the caches
+        """
+        if plane is None:
+            return "%d-%d-%d" % (x, y, z)
+        return "%d-%d-%d-%s" % (x, y, z, plane)
+
+    def _readRawTiles(self, tiles: List[Tuple[int, int, int]],
+                      plane: Union[None, int, str]) -> List[model.DataArray]:
+        """
+        Read tiles from the DataArrayShadow. In case of a Z stack, only the
+        plane displayed is read.
+        tiles: X, Y, and zoom level of each tile
+        plane: the plane to read, as returned by _getSelectedPlane()
+        return: the 2D raw tiles, in the same order as requested
+        """
+        das = self.stream.raw[0]
+        kwargs = {}
+        if plane == "max":
+            if getattr(das, "mip", None) is not None:
+                das = das.mip  # Projection already computed => much less to read
+        elif plane is not None:
+            kwargs["z"] = plane
+
+        if hasattr(das, "getTiles"):
+            raw_tiles = das.getTiles(tiles, **kwargs)
+        else:
+            raw_tiles = [das.getTile(x, y, z, **kwargs) for x, y, z in tiles]
+
+        if plane == "max" and das is self.stream.raw[0]:
+            # Tiles contain all the planes => project them
+            raw_tiles = [img.max_intensity_projection(t, axis=0) for t in raw_tiles]
+        return raw_tiles
+
     def _getTile(
         self,
         x: int,
@@ -1023,6 +1146,7 @@ class RGBSpatialProjection(RGBProjection):
         z: int,
         prev_raw_cache: Dict[str, model.DataArray],
         prev_proj_cache: Dict[str, model.DataArray],
+        plane: Union[None, int, str] = None,
     ) -> Tuple[model.DataArray, model.DataArray]:
         """
         Get a tile from a DataArrayShadow. Uses cache.
@@ -1034,10 +1158,11 @@ class RGBSpatialProjection(RGBProjection):
             last execution of _updateImage
         prev_proj_cache (dictionary): projected tiles cache from the
             last execution of _updateImage
+        plane (None, int or str): the plane displayed, as returned by _getSelectedPlane()
         return (DataArray, DataArray): raw tile and projected tile
         """
         # the key of the tile on the cache
-        tile_key = "%d-%d-%d" % (x, y, z)
+        tile_key = self._getTileKey(x, y, z, plane)
 
         # if the raw tile has been already cached, read it from the cache
         if tile_key in prev_raw_cache:
@@ -1046,7 +1171,7 @@ class RGBSpatialProjection(RGBProjection):
             raw_tile = self._rawTilesCache[tile_key]
         else:
             # The tile was not cached, so it must be read from the file
-            raw_tile = self.stream.raw[0].getTile(x, y, z)
+            raw_tile = self._readRawTiles([(x, y, z)], plane)[0]
 
         # if the projected tile has been already cached, read it from the cache
         if tile_key in prev_proj_cache:
@@ -1119,6 +1244,8 @@ class RGBSpatialProjection(RGBProjection):
         need_recompute = True
         while need_recompute:
             z = self._zFromMpp()
+            # In case of Z stack, only the plane displayed is read
+            plane = self._getSelectedPlane()
 
             # calculate the image pixels inside the view (rect)
             view_rect = self._rectWorldToPixel(self.rect.value)
@@ -1140,6 +1267,14 @@ class RGBSpatialProjection(RGBProjection):
             self._rawTilesCache = {}
             self._projectedTilesCache = {}
 
+            # Read all the tiles not yet cached at once, as they can be decoded in parallel
+            if hasattr(das, "getTiles"):
+                missing = [(x, y, z) for x in range(x1, x2 + 1) for y in range(y1, y2 + 1)
+                           if self._getTileKey(x, y, z, plane) not in prev_raw_cache]
+                if len(missing) > 1:
+                    for (tx, ty, tz), raw_tile in zip(missing, self._readRawTiles(missing, plane)):
+                        prev_raw_cache[self._getTileKey(tx, ty, tz, plane)] = raw_tile
+
             raw_tiles = []
             projected_tiles = []
             need_recompute = False
@@ -1164,7 +1299,7 @@ class RGBSpatialProjection(RGBProjection):
                             raise NeedRecomputeException()
 
                         raw_tile, proj_tile = \
-                            self._getTile(x, y, z, prev_raw_cache, prev_proj_cache)
+                            self._getTile(x, y, z, prev_raw_cache, prev_proj_cache, plane)
                         rt_column.append(raw_tile)
                         pt_column.append(proj_tile)
 
@@ -1208,9 +1343,8 @@ class RGBSpatialProjection(RGBProjection):
 
         if isinstance(data, model.DataArrayShadow):
             raw_tiles, _ = self._getTilesFromSelectedArea()
+            # Note: no need to handle zIndex here, as only the tiles of the plane displayed are read
             data = img.mergeTiles(raw_tiles)
-            # Note: no need to handle zIndex here, as (for now) DataArrayShadow only come from pyramidal
-            # TIFF images, which don't support Z-stacks
             return data
         else:
             dims = data.metadata.get(model.MD_DIMS, "CTZYX"[-data.ndim::])
@@ -1236,6 +1370,13 @@ class RGBSpatialSpectrumProjection(RGBSpatialProjection):
     def __init__(self, stream):
 
         super(RGBSpatialSpectrumProjection, self).__init__(stream)
+        # To compute the image of a band as the difference between two planes
+        # of the cumulative sum of the data along C (summed over T).
+        # It's computed in the background, every time the data changes.
+        self._band_prefix = None  # None or (calibrated data, ndarray of shape (C+1)YX)
+        self._prefix_thread = None  # Thread computing the cumulative sum
+        self._startBandPrefix(stream.calibrated.value)
+
         stream.selected_pixel.subscribe(self._on_selected_pixel)
         stream.calibrated.subscribe(self._on_new_spec_data)
         if hasattr(stream, "spectrumBandwidth"):
@@ -1247,9 +1388,94 @@ class RGBSpatialSpectrumProjection(RGBSpatialProjection):
     def _on_tint(self, _):
         self._shouldUpdateImage()
 
-    def _on_new_spec_data(self, _):
+    def _on_new_spec_data(self, data):
+        self._startBandPrefix(data)
         self._shouldUpdateImage()
 
+    def _startBandPrefix(self, data):
+        """
+        Schedule the computation of the cumulative sum of the data, in the background.
+        :param data: (DataArray or DataArrayShadow or None) The calibrated data, of shape CTZYX.
+        """
+        # A computation on previous data stops by itself, as it checks the data is still the current one
+        self._band_prefix = None
+        if data is None or data.shape[0] <= 1:
+            return
+
+        dtype = self._getBandPrefixDtype(data.dtype)
+        nbytes = (data.shape[0] + 1) * data.shape[-2] * data.shape[-1] * dtype.itemsize
+        if nbytes > SPECTRUM_BAND_PREFIX_MAX_BYTES:
+            logging.debug("Not precomputing the band images of data of shape %s, as it would take %d MB",
+                          data.shape, nbytes // 2 ** 20)
+            return
+
+        # A new thread each time, as it's only needed once per data. It only holds a weakref,
+        # so that the projection can be garbage collected, which stops the thread.
+        t = threading.Thread(target=self._computeBandPrefix, args=(weakref.ref(self), data, dtype),
+                             name="Spectrum band cumulative sum")
+        t.daemon = True
+        t.start()
+        self._prefix_thread = t
+
+    @staticmethod
+    def _getBandPrefixDtype(dtype):
+        """
+        :param dtype: (numpy.dtype) The type of the data.
+        :returns: (numpy.dtype) The type to store the cumulative sum of the data along C.
+        """
+        if dtype.kind in "biu":
+            # Exact, and it would need a huge amount of data to overflow
+            return numpy.dtype(numpy.int64)
+        else:
+            # Same precision as the data, which is typically float32
+            return numpy.promote_types(dtype, numpy.float32)
+
+    @staticmethod
+    def _computeBandPrefix(wprojection, data, dtype):
+        """
+        Computes the cumulative sum of the data along C, one wavelength at a time.
+        The result is stored in ._band_prefix, if the data is still the current one.
+        :param wprojection: (weakref to RGBSpatialSpectrumProjection) The projection
+        :param data: (DataArray or DataArrayShadow) The calibrated data, of shape CTZYX.
+        :param dtype: (numpy.dtype) The type of the cumulative sum.
+        """
+        start = time.time()
+        prefix = numpy.empty((data.shape[0] + 1,) + data.shape[-2:], dtype=dtype)
+        prefix[0] = 0
+        for c in range(data.shape[0]):
+            projection = wprojection()
+            if projection is None or projection.stream.calibrated.value is not data:
+                logging.debug("Stopping computation of band images, as data changed")
+                return
+            try:
+                # Sum the time or theta values if they exist (iow, flatten axis 1).
+                # The division is done when computing the band image.
+                plane = numpy.sum(data[c, :, 0], axis=0, dtype=dtype)
+                numpy.add(prefix[c], plane, out=prefix[c + 1])
+            except Exception:
+                logging.exception("Failed to compute the band images of %s", projection.stream.name.value)
+                return
+            del projection
+
+        projection = wprojection()
+        if projection is None:
+            return
+        projection._band_prefix = (data, prefix)
+        logging.debug("Computed cumulative sum of spectrum data of shape %s in %g s",
+                      data.shape, time.time() - start)
+        projection._shouldUpdateImage()
+
+    def _getBandPrefix(self, data):
+        """
+        :param data: (DataArray or DataArrayShadow) The calibrated data, of shape CTZYX.
+        :returns: (None or ndarray of shape (C+1)YX) The cumulative sum of the data
+          along C, or None if it's not (yet) available.
+        """
+        band_prefix = self._band_prefix
+        if band_prefix is None or band_prefix[0] is not data:
+            return None
+        return band_prefix[1]
+
     def _on_selected_pixel(self, _):
         self._shouldUpdateImage()
 
@@ -1262,6 +1488,12 @@ class RGBSpatialSpectrumProjection(RGBSpatialProjection):
             raw_md = self.stream.calibrated.value.metadata
             md = {k: raw_md[k] for k in (model.MD_PIXEL_SIZE, model.MD_POS, model.MD_THETA_LIST) if k in raw_md}
 
+            # pick only the data inside the bandwidth (first, so that only this part is computed)
+            spec_range = self.stream._get_bandwidth_in_pixel()
+
+            logging.debug("Spectrum range picked: %s px", spec_range)
+            data = data[spec_range[0]:spec_range[1] + 1]
+
             # Average time or theta values if they exist (iow, flatten axis 1).
             if data.shape[1] > 1:
                 data = numpy.mean(data, axis=1)
@@ -1269,12 +1501,7 @@ class RGBSpatialSpectrumProjection(RGBSpatialProjection):
             else:
                 data = data[:, 0, 0, :, :]
 
-            # pick only the data inside the bandwidth
-            spec_range = self.stream._get_bandwidth_in_pixel()
-
-            logging.debug("Spectrum range picked: %s px", spec_range)
-
-            av_data = numpy.mean(data[spec_range[0]:spec_range[1] + 1], axis=0)
+            av_data = numpy.mean(data, axis=0)
             av_data = img.ensure2DImage(av_data).astype(data.dtype)
             return model.DataArray(av_data, md)
 
@@ -1335,27 +1562,42 @@ class RGBSpatialSpectrumProjection(RGBSpatialProjection):
         """
 
         try:
-            data = self.stream.calibrated.value
-            raw_md = self.stream.calibrated.value.metadata
+            calibrated = self.stream.calibrated.value
+            raw_md = calibrated.metadata
 
-            # Average time or theta values if they exist (iow, flatten axis 1).
-            if data.shape[1] > 1:
-                data = numpy.mean(data, axis=1)
-                data = data[:, 0, :, :]
-            else:
-                data = data[:, 0, 0, :, :]
-
-            # pick only the data inside the bandwidth
+            # pick only the data inside the bandwidth (first, so that only this part is computed)
             spec_range = self.stream._get_bandwidth_in_pixel()
 
             logging.debug("Spectrum range picked: %s px", spec_range)
 
+            prefix = self._getBandPrefix(calibrated)
+            if prefix is None:  # No cumulative sum (yet) => compute from the data
+                data = calibrated[spec_range[0]:spec_range[1] + 1]
+                # Average time or theta values if they exist (iow, flatten axis 1).
+                if data.shape[1] > 1:
+                    data = numpy.mean(data, axis=1)
+                    data = data[:, 0, :, :]
+                else:
+                    data = data[:, 0, 0, :, :]
+
+            def band_mean(low, high):
+                """
+                Average image over a band (relative to the start of the bandwidth)
+                return (ndarray of shape YX)
+                """
+                if prefix is not None:
+                    # Sum of the band = difference of the cumulative sums at its borders
+                    av_data = ((prefix[spec_range[0] + high + 1] - prefix[spec_range[0] + low]) /
+                               ((high - low + 1) * calibrated.shape[1]))
+                else:
+                    av_data = numpy.mean(data[low:high + 1], axis=0)
+                return img.ensure2DImage(av_data)
+
             irange = self.stream._getDisplayIRange()  # will update histogram if not yet present
 
             if self.stream.tint.value != TINT_FIT_TO_RGB:
                 # TODO: use better intermediary type if possible?, cf semcomedi
-                av_data = numpy.mean(data[spec_range[0]:spec_range[1] + 1], axis=0)
-                av_data = img.ensure2DImage(av_data)
+                av_data = band_mean(0, spec_range[1] - spec_range[0])
                 rgbim = img.DataArray2RGB(av_data, irange, self.stream.tint.value)
 
             else:
@@ -1366,25 +1608,25 @@ class RGBSpatialSpectrumProjection(RGBSpatialProjection):
                 # useful.
 
                 # divide the range into 3 sub-ranges (BRG) of almost the same length
+                # (relative to the start of the data, which is already the bandwidth)
                 len_rng = spec_range[1] - spec_range[0] + 1
-                brange = [spec_range[0], int(round(spec_range[0] + len_rng / 3)) - 1]
-                grange = [brange[1] + 1, int(round(spec_range[0] + 2 * len_rng / 3)) - 1]
-                rrange = [grange[1] + 1, spec_range[1]]
-                # ensure each range contains at least one pixel
+                brange = [0, int(round(len_rng / 3)) - 1]
+                grange = [brange[1] + 1, int(round(2 * len_rng / 3)) - 1]
+                rrange = [grange[1] + 1, len_rng - 1]
+                # ensure each range contains at least one pixel, within the bandwidth
+                grange[0] = min(grange[0], len_rng - 1)
+                rrange[0] = min(rrange[0], len_rng - 1)
                 brange[1] = max(brange)
                 grange[1] = max(grange)
                 rrange[1] = max(rrange)
 
                 # FIXME: unoptimized, as each channel is duplicated 3 times, and discarded
-                av_data = numpy.mean(data[rrange[0]:rrange[1] + 1], axis=0)
-                av_data = img.ensure2DImage(av_data)
+                av_data = band_mean(*rrange)
                 rgbim = img.DataArray2RGB(av_data, irange)
-                av_data = numpy.mean(data[grange[0]:grange[1] + 1], axis=0)
-                av_data = img.ensure2DImage(av_data)
+                av_data = band_mean(*grange)
                 gim = img.DataArray2RGB(av_data, irange)
                 rgbim[:, :, 1] = gim[:, :, 0]
-                av_data = numpy.mean(data[brange[0]:brange[1] + 1], axis=0)
-                av_data = img.ensure2DImage(av_data)
+                av_data = band_mean(*brange)
                 bim = img.DataArray2RGB(av_data, irange)
                 rgbim[:, :, 2] = bim[:, :, 0]
 
@@ -1454,7 +1696,7 @@ class LineSpectrumProjection(RGBProjection):
         else:
             t = 0
 
-        spec2d = self.stream.calibrated.value[:, t, 0, :, :]  # same data but remove useless dims
+        data = self.stream.calibrated.value
         width = self.stream.selectionWidth.value
 
         # Number of points to return: the length of the line
@@ -1472,8 +1714,8 @@ class LineSpectrumProjection(RGBProjection):
         # Coordinates of each point: ndim of data (5-2), pos on line (Y), spectrum (X)
         # The line is scanned from the end till the start so that the spectra
         # closest to the origin of the line are at the bottom.
-        coord = numpy.empty((3, width, n, spec2d.shape[0]))
-        coord[0] = numpy.arange(spec2d.shape[0])  # spectra = all
+        coord = numpy.empty((3, width, n, data.shape[0]))
+        coord[0] = numpy.arange(data.shape[0])  # spectra = all
         coord_spc = coord.swapaxes(2, 3)  # just a view to have (line) space as last dim
         coord_spc[-1] = numpy.linspace(start[0], end[0], n)  # X axis
         coord_spc[-2] = numpy.linspace(start[1], end[1], n)  # Y axis
@@ -1489,6 +1731,14 @@ class LineSpectrumProjection(RGBProjection):
         coord_cw = coord[1:].swapaxes(0, 2).swapaxes(1, 3)  # view with coordinates and width as last dims
         coord_cw += width_coord
 
+        # Only take the part of the data around the line (so that only this part
+        # is computed), including the next pixels, used for the interpolation.
+        y0, x0 = (max(0, int(math.floor(coord[i].min()))) for i in (1, 2))
+        y1, x1 = (int(math.floor(coord[i].max())) + 2 for i in (1, 2))
+        spec2d = data[:, t, 0, y0:y1, x0:x1]  # same data but remove useless dims
+        coord[1] -= y0
+        coord[2] -= x0
+
         # Interpolate the values based on the data
         if width == 1:
             # simple version for the most usual case
@@ -1613,7 +1863,6 @@ class PixelTemporalSpectrumProjection(RGBProjection):
 
         x, y = self.stream.selected_pixel.value
 
-        spec2d = self.stream.calibrated.value[:, :, 0, :, :]  # same data but remove useless dims
         md = dict(data.metadata)
         md[model.MD_DIMS] = "TC"
 
@@ -1621,12 +1870,14 @@ class PixelTemporalSpectrumProjection(RGBProjection):
         # of the pixels to be taken into account
         width = self.stream.selectionWidth.value
         if width == 1:  # short-cut for simple case
-            data = spec2d[:, :, y, x]
+            data = data[:, :, 0, y, x]
             data = numpy.swapaxes(data, 0, 1)
             return model.DataArray(data, md)
 
         radius = width / 2
-        mean = img.mean_within_circle(spec2d, (x, y), radius)
+        # same data but remove useless dims
+        spec2d, center = _crop_around_pixel(data, (slice(None), slice(None), 0), (x, y), radius)
+        mean = img.mean_within_circle(spec2d, center, radius)
         mean = numpy.swapaxes(mean, 0, 1)
 
         return model.DataArray(mean.astype(spec2d.dtype), md)
@@ -1701,7 +1952,6 @@ class PixelAngularSpectrumProjection(RGBProjection):
         x, y = self.stream.selected_pixel.value
 
         # Shape is CA1YX
-        spec2d = data[:, :, 0, :, :]  # same data but remove useless dims
         md = dict(data.metadata)
         md[model.MD_DIMS] = "AC"
 
@@ -1709,12 +1959,14 @@ class PixelAngularSpectrumProjection(RGBProjection):
         # whose centers are to be taken into account
         width = self.stream.selectionWidth.value
         if width == 1:  # short-cut for simple case
-            data = spec2d[:, :, y, x]
+            data = data[:, :, 0, y, x]
             data = numpy.swapaxes(data, 0, 1)
             da = model.DataArray(data, md)
         else:
             radius = width / 2
-            mean = img.mean_within_circle(spec2d, (x, y), radius)
+            # same data but remove useless dims
+            spec2d, center = _crop_around_pixel(data, (slice(None), slice(None), 0), (x, y), radius)
+            mean = img.mean_within_circle(spec2d, center, radius)
             mean = numpy.swapaxes(mean, 0, 1)
             da = model.DataArray(mean.astype(spec2d.dtype), md)
 
@@ -1772,9 +2024,23 @@ class MeanSpectrumProjection(DataProjection):
         md = dict(data.metadata)
         md[model.MD_DIMS] = "C"
 
-        # flatten all but the C dimension, for the average
-        data = data.reshape((data.shape[0], numpy.prod(data.shape[1:])))
-        av_data = numpy.mean(data, axis=1)
+        if isinstance(data, model.DataArrayShadow):
+            # Corrected lazily, and maybe not even in memory => sum a few rows
+            # at a time, to not compute (or read) all the data at once.
+            row_bytes = numpy.prod(data.shape[:-2]) * data.shape[-1] * 8  # as float64
+            nrows = max(1, MEAN_SPECTRUM_BLOCK_BYTES // row_bytes)
+            sums = numpy.zeros(data.shape[0])
+            for y in range(0, data.shape[-2], nrows):
+                if self.stream.calibrated.value is not data:
+                    logging.debug("Stopping mean spectrum computation, as the data changed")
+                    return  # The new data will be projected next
+                block = data[:, :, :, y:y + nrows]
+                sums += numpy.sum(block.reshape(block.shape[0], -1), axis=1, dtype=numpy.float64)
+            av_data = sums / numpy.prod(data.shape[1:])
+        else:
+            # flatten all but the C dimension, for the average
+            data = data.reshape((data.shape[0], numpy.prod(data.shape[1:])))
+            av_data = numpy.mean(data, axis=1)
 
         self.image.value = model.DataArray(av_data, md)
 
@@ -1831,8 +2097,6 @@ class SinglePointSpectrumProjection(DataProjection):
             t = numpy.searchsorted(self.stream._calibrated_theta_list, self.stream.selected_angle.value)
         else:
             t = 0
-        spec2d = self.stream.calibrated.value[:, t, 0, :, :]  # same data but remove useless dims
-
         md = dict(data.metadata)
         md[model.MD_DIMS] = "C"
 
@@ -1840,11 +2104,13 @@ class SinglePointSpectrumProjection(DataProjection):
         # of the pixels to be taken into account
         width = self.stream.selectionWidth.value
         if width == 1:  # short-cut for simple case
-            data = spec2d[:, y, x]
+            data = data[:, t, 0, y, x]
             return model.DataArray(data, md)
 
         radius = width / 2
-        mean = img.mean_within_circle(spec2d, (x, y), radius)
+        # same data but remove useless dims
+        spec2d, center = _crop_around_pixel(data, (slice(None), t, 0), (x, y), radius)
+        mean = img.mean_within_circle(spec2d, center, radius)
 
         return model.DataArray(mean, md)
 
@@ -1901,21 +2167,23 @@ class SinglePointTemporalProjection(DataProjection):
             c = numpy.searchsorted(self.stream._wl_px_values, self.stream.selected_wavelength.value)
         else:
             c = 0
-        chrono2d = self.stream.calibrated.value[c, :, 0, :, :]  # same data but remove useless dims
+        data = self.stream.calibrated.value
 
         md = {model.MD_DIMS: "T"}
-        if model.MD_TIME_LIST in chrono2d.metadata:
-            md[model.MD_TIME_LIST] = chrono2d.metadata[model.MD_TIME_LIST]
+        if model.MD_TIME_LIST in data.metadata:
+            md[model.MD_TIME_LIST] = data.metadata[model.MD_TIME_LIST]
 
         # We treat width as the diameter of the circle which contains the center
         # of the pixels to be taken into account
         width = self.stream.selectionWidth.value
         if width == 1:  # short-cut for simple case
-            data = chrono2d[:, y, x]
+            data = data[c, :, 0, y, x]
             return model.DataArray(data, md)
 
         radius = width / 2
-        mean = img.mean_within_circle(chrono2d, (x, y), radius)
+        # same data but remove useless dims
+        chrono2d, center = _crop_around_pixel(data, (c, slice(None), 0), (x, y), radius)
+        mean = img.mean_within_circle(chrono2d, center, radius)
 
         return model.DataArray(mean.astype(chrono2d.dtype), md)
 
@@ -1974,21 +2242,23 @@ class SinglePointAngularProjection(DataProjection):
             c = numpy.searchsorted(self.stream._wl_px_values, self.stream.selected_wavelength.value)
         else:
             c = 0
-        angle2d = self.stream.calibrated.value[c, :, 0, :, :]  # same data but remove useless dims
+        data = self.stream.calibrated.value
 
         md = {model.MD_DIMS: "A"}
-        if model.MD_THETA_LIST in angle2d.metadata:
-            md[model.MD_THETA_LIST] = angle2d.metadata[model.MD_THETA_LIST]
+        if model.MD_THETA_LIST in data.metadata:
+            md[model.MD_THETA_LIST] = data.metadata[model.MD_THETA_LIST]
 
         # We treat width as the diameter of the circle which contains the center
         # of the pixels to be taken into account
         width = self.stream.selectionWidth.value
         if width == 1:  # short-cut for simple case
-            data = angle2d[:, y, x]
+            data = data[c, :, 0, y, x]
             return model.DataArray(data, md)
 
         radius = width / 2
-        mean = img.mean_within_circle(angle2d, (x, y), radius)
+        # same data but remove useless dims
+        angle2d, center = _crop_around_pixel(data, (c, slice(None), 0), (x, y), radius)
+        mean = img.mean_within_circle(angle2d, center, radius)
 
         return model.DataArray(mean.astype(angle2d.dtype), md)
 
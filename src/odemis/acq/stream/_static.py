@@ -47,6 +47,12 @@ from odemis.model._dataio import DataArrayShadow
 from odemis.util import almost_equal, conversion, find_closest, img, spectrum
 from ._base import POL_POSITIONS, POL_POSITIONS_RESULTS, Stream
 
+# The drange and histogram of the spectrum data are computed by blocks of rows.
+# When the data is not in memory, only a few blocks (evenly distributed) are
+# used, to avoid reading all the file.
+SPECTRUM_PREVIEW_BLOCK_ROWS = 8
+SPECTRUM_PREVIEW_MAX_BLOCKS = 8
+
 
 class StaticStream(Stream):
     """
@@ -264,7 +270,11 @@ class Static2DStreamBase(StaticStream):
             dims = data.metadata.get(model.MD_DIMS, "CTZYX"[-data.ndim::])
 
             if dims == "ZYX" and data.ndim == 3:
-                if hasattr(self, "max_projection") and self.max_projection.value:
+                mip = hasattr(self, "max_projection") and self.max_projection.value
+                if isinstance(data, model.DataArrayShadow):
+                    # Pyramidal => use the smallest version, of just the plane displayed
+                    data = img.get_merged_raw_image(data, data.maxzoom, None if mip else self.zIndex.value)
+                elif mip:
                     data = img.max_intensity_projection(data, axis=0)
                 else:
                     data = img.getYXFromZYX(data, self.zIndex.value)  # Remove extra dimensions (of length 1)
@@ -462,19 +472,15 @@ class StaticARStream(StaticStream):
         """
         :param name: (string)
         :param data: (model.DataArray(Shadow) of shape (YX) or list of such DataArray(Shadow)).
-        The metadata MD_POS, MD_AR_POLE and MD_POL_MODE should be provided
+        The metadata MD_POS, MD_AR_POLE and MD_POL_MODE should be provided.
+        A DataArrayShadow is only read when the projection of its data is needed
+        (see _get_ar_data()).
         """
         if not isinstance(data, Iterable):
             data = [data]  # from now it's just a list of DataArray
 
-        # TODO: support DAS, as a "delayed loading" by only calling .getData()
-        # when the projection for the particular data needs to be computed (or
-        # .raw needs to be accessed?)
-        # Ensure all the data is a DataArray, as we don't handle (yet) DAS
-        data = [d.getData() if isinstance(d, model.DataArrayShadow) else d for d in data]
-
         # find positions of each acquisition
-        # (float, float, str or None)) -> DataArray: position on SEM + polarization -> data
+        # (float, float, str or None)) -> DataArray(Shadow): position on SEM + polarization -> data
         self._pos = {}
 
         sempositions = set()
@@ -492,7 +498,7 @@ class StaticARStream(StaticStream):
                     if almost_equal(sempos_cur[0], sempos[0]) and almost_equal(sempos_cur[1], sempos[1]):
                         sempos_cur = sempos
                         break
-                self._pos[sempos_cur + (d.metadata.get(MD_POL_MODE, None),)] = img.ensure2DImage(d)
+                self._pos[sempos_cur + (d.metadata.get(MD_POL_MODE, None),)] = self._ensure2D(d)
 
                 sempositions.add(sempos_cur)
                 if MD_POL_MODE in d.metadata:
@@ -561,6 +567,39 @@ class StaticARStream(StaticStream):
         except KeyError:
             logging.info("No emission wavelength for AR stream")
 
+    @staticmethod
+    def _ensure2D(d):
+        """
+        Reshape the data to 2D, without reading it if it's a DataArrayShadow.
+        :param d: (DataArray or DataArrayShadow) the data, with all the high dimensions == 1
+        :return: (DataArray or DataArrayShadow) the data of shape YX
+        :raise ValueError: if the data is not 2D
+        """
+        if isinstance(d, model.DataArrayShadow):
+            if d.ndim == 2:
+                return d
+            if numpy.prod(d.shape[:-2]) == 1:
+                try:
+                    return d[(0,) * (d.ndim - 2)]
+                except (TypeError, IndexError):
+                    pass  # Doesn't support selecting the high dimensions
+            d = d.getData()
+        return img.ensure2DImage(d)
+
+    def _get_ar_data(self, pos):
+        """
+        Return the AR image at a given position, reading it from the file if needed.
+        :param pos: (float, float, str or None) ebeam position + polarization
+          (must be part of ._pos)
+        :return: (DataArray of shape YX) the raw AR image
+        """
+        d = self._pos[pos]
+        if isinstance(d, model.DataArrayShadow):
+            # Not stored, as the projections keep (a limited number of) the
+            # results in their own caches
+            d = img.ensure2DImage(d.getData())
+        return d
+
     def _init_projection_vas(self):
         # override Stream._init_projection_vas.
         # This stream doesn't provide the projection(s) to an .image by itself.
@@ -672,10 +711,13 @@ class StaticSpectrumStream(StaticStream):
         #  * coordinates of 1st point (1-point, line)
         #  * coordinates of 2nd point (line)
 
-        # TODO: need to handle DAS properly, in case it's tiled (in XY), to avoid
-        # loading too much data in memory.
-        # Ensure the data is a DataArray, as we don't handle (yet) DAS
-        if isinstance(image, model.DataArrayShadow):
+        # A DAS is kept as-is if it's possible to read just a part of it, so that
+        # only the data needed by the projections is read from the file.
+        # Otherwise (or if all the data is needed anyway), read it all.
+        if isinstance(image, model.DataArrayShadow) and (
+            not hasattr(image, "getSubData") or image.ndim != 5
+            or model.MD_THETA_LIST in image.metadata
+        ):
             image = image.getData()
 
         if len(image.shape) == 3:
@@ -836,15 +878,50 @@ class StaticSpectrumStream(StaticStream):
     # The tricky part is we need to keep the raw data as .raw for things
     # like saving the stream or updating the calibration, but all the
     # display-related methods must work on the calibrated data.
+    def _getPreviewRows(self, height):
+        """
+        Return the rows of the data used to compute the drange and histogram.
+        If the data is not in memory, only some of them, as the smallest zoom
+        level would be used for pyramidal data.
+        height (int): number of rows of the data
+        return (list of slices): selections on the Y dimension, of consecutive rows
+        """
+        n = SPECTRUM_PREVIEW_BLOCK_ROWS
+        starts = range(0, height, n)
+        if (self.raw and isinstance(self.raw[0], model.DataArrayShadow) and
+            len(starts) > SPECTRUM_PREVIEW_MAX_BLOCKS):
+            idx = numpy.linspace(0, len(starts) - 1, SPECTRUM_PREVIEW_MAX_BLOCKS).round()
+            starts = [starts[int(i)] for i in idx]
+        return [slice(y, y + n) for y in starts]
+
+    def _getRawPreview(self, das):
+        # Use the current band of the calibrated data, instead of the raw data
+        data = self.calibrated.value
+        spec_range = self._get_bandwidth_in_pixel()
+        band = slice(spec_range[0], spec_range[1] + 1)
+        if not isinstance(self.raw[0], model.DataArrayShadow):
+            return data[band]
+        # Only (some of) the rows
+        blocks = [data[band, :, :, rows] for rows in self._getPreviewRows(data.shape[-2])]
+        return model.DataArray(numpy.concatenate(blocks, axis=-2), data.metadata)
+
     def _updateDRange(self, data=None):
         if data is None:
             data = self.calibrated.value
+        if isinstance(data, model.DataArrayShadow):
+            # Only the min/max of the data are needed => compute them a few
+            # rows at a time, to not have to compute all the data at once.
+            mins, maxs = [], []
+            for rows in self._getPreviewRows(data.shape[-2]):
+                d = data[:, :, :, rows]
+                mins.append(d.min())
+                maxs.append(d.max())
+            data = model.DataArray(numpy.array([min(mins), max(maxs)], dtype=data.dtype), data.metadata)
         super(StaticSpectrumStream, self)._updateDRange(data)
 
     def _updateHistogram(self, data=None):
         if data is None:
-            spec_range = self._get_bandwidth_in_pixel()
-            data = self.calibrated.value[spec_range[0]:spec_range[1] + 1]
+            data = self._getRawPreview(self.raw[0])
         super(StaticSpectrumStream, self)._updateHistogram(data)
 
     def _setTime(self, value):
@@ -942,7 +1019,12 @@ class StaticSpectrumStream(StaticStream):
             self.calibrated.value = None
             return
 
-        calibrated = calibration.apply_spectrum_corrections(data, bckg, coef)
+        if model.MD_THETA_LIST in data.metadata:
+            # The correction changes the shape of angular spectrum data, so compute it all
+            calibrated = calibration.apply_spectrum_corrections(data, bckg, coef)
+        else:
+            # Only compute the corrections on the part of the data actually used
+            calibrated = calibration.DataArrayShadowCorrected(data, bckg, coef)
 
         # If angular spectrum, the length of the A dimension might have changed
         if hasattr(self, "selected_angle"):  # update the list of angles
@@ -1018,7 +1100,9 @@ class StaticSpectrumStream(StaticStream):
         """
         called when spectrumBandwidth is changed
         """
-        self._updateHistogram()
+        # The histogram needs to go through all the data of the band, so do it
+        # in the background, to not slow down the update of the image.
+        self._shouldUpdateHistogram()
         self._shouldUpdateImage()
 
 # TODO: It would make sense to inherit from RGBStream, however, it relies on
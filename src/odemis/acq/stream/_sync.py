@@ -30,6 +30,7 @@ import numpy
 
 import odemis.util.driver as udriver
 from odemis import model, util
+from odemis.dataio import hdf5
 from odemis.acq import leech
 from odemis.acq import scan
 from odemis.acq.leech import AnchorDriftCorrector, LeechAcquirer
@@ -76,6 +77,10 @@ GUI_ORANGE = (255, 163, 0) # FG_COLOUR_HIGHLIGHT - from src/odemis/gui/__init__.
 # all the time, and anyway, the camera overhead is around 8ms, so it's relatively small.
 CCD_FRAME_OVERHEAD = 2e-3  # s, extra time to wait by the e-beam for each spot position, to make sure the CCD is ready
 
+# When writing the data progressively to a file, the data is passed to the file after every line,
+# but only forced to disk at most this often, as flushing is slow on large files.
+FLUSH_PERIOD = 10  # s
+
 
 class MultipleDetectorStream(Stream, metaclass=ABCMeta):
     """
@@ -953,6 +958,16 @@ class SEMCCDMDStream(MultipleDetectorStream):
         self._trigger = self._emitter.startScan  # to acquire a CCD image every time the SEM starts a new scan
         self._ccd_idx = len(self._streams) - 1  # optical detector is always last in streams
 
+        # If set to a filename, the data is written to this HDF5 file during the acquisition, each
+        # time a line of e-beam positions is completed. So if the acquisition fails, the data
+        # acquired so far is not lost. The data is still returned at the end of the acquisition.
+        # Typically set by the GUI, to a temporary file next to the final file.
+        self.flush_filename: Optional[str] = None
+        self.flush_compression: Optional[str] = "lzf"
+        self._writer: Optional[hdf5.HDF5Writer] = None
+        self._writer_idx: Dict[Tuple[int, int], int] = {}  # (stream idx, pol idx) -> image index in the file
+        self._last_flush = 0  # time of the last flush of the file
+
     def _supports_hw_sync(self):
         """
         :returns (bool): True if hardware synchronised acquisition is supported.
@@ -1206,6 +1221,83 @@ class SEMCCDMDStream(MultipleDetectorStream):
 
         return int_das
 
+    def _open_flush_file(self):
+        """
+        Create the file to write the data during the acquisition, if requested.
+        """
+        self._writer_idx = {}
+        if not self.flush_filename:
+            return
+        try:
+            self._writer = hdf5.HDF5Writer(self.flush_filename, self.flush_compression)
+            self._last_flush = time.time()
+            logging.debug("Will write acquisition data progressively to %s", self.flush_filename)
+        except Exception:
+            logging.exception("Failed to create file %s, data will not be written progressively",
+                              self.flush_filename)
+
+    def _close_flush_file(self):
+        if self._writer:
+            try:
+                self._writer.close()
+            except Exception:
+                logging.exception("Failed to close file %s", self.flush_filename)
+            self._writer = None
+
+    def _flush_live_data(self, streams_idx: List[int], rep: Tuple[int, int], pol_idx: int,
+                         y_start: int, y_end: int):
+        """
+        Write part of the live data to the flush file (if any).
+        :param streams_idx: index of the streams to write
+        :param rep: size of entire data being assembled (aka repetition) in pixels: x, y
+        :param pol_idx: polarisation index
+        :param y_start: first line (of e-beam positions) to write
+        :param y_end: last line (excluded) to write
+        """
+        if not self._writer:
+            return
+
+        try:
+            for n in streams_idx:
+                self._flush_stream_data(n, rep, pol_idx, y_start, y_end)
+            now = time.time()
+            if now - self._last_flush > FLUSH_PERIOD:
+                self._writer.flush()
+                self._last_flush = now
+        except Exception:
+            # Don't stop the acquisition, as the data is still kept in memory
+            logging.exception("Failed to write data to %s, will stop writing it", self.flush_filename)
+            self._close_flush_file()
+
+    def _flush_stream_data(self, n: int, rep: Tuple[int, int], pol_idx: int, y_start: int, y_end: int):
+        """
+        Write some lines of the live data of one stream to the flush file.
+        The standard behaviour is to expect that the live data is one array, whose last two
+        dimensions correspond to the spatial dimensions (Y, X), possibly with multiple pixels
+        per e-beam position.
+        :param n: index of the stream
+        :param rep: size of entire data being assembled (aka repetition) in pixels: x, y
+        :param pol_idx: polarisation index
+        :param y_start: first line (of e-beam positions) to write
+        :param y_end: last line (excluded) to write
+        """
+        try:
+            da = self._live_data[n][pol_idx]
+        except IndexError:  # No data (yet) for this stream
+            return
+
+        if da.ndim < 2 or da.shape[-2] % rep[1] or da.shape[-1] % rep[0]:
+            logging.debug("Not writing live data of shape %s, not matching repetition %s", da.shape, rep)
+            return
+        tile_height = da.shape[-2] // rep[1]
+
+        key = (n, pol_idx)
+        if key not in self._writer_idx:
+            self._writer_idx[key] = self._writer.add_image(da.shape, da.dtype, da.metadata)
+        self._writer.write_rows(self._writer_idx[key],
+                                da[..., y_start * tile_height:y_end * tile_height, :],
+                                y_start * tile_height)
+
     def _assemble_final_data_all_streams(self):
         # Process all the (intermediary) ._live_data to the right shape/format for the final ._raw
         for stream_idx, das in enumerate(self._live_data):
@@ -1251,6 +1343,7 @@ class SEMCCDMDStream(MultipleDetectorStream):
             self._roa_center_phys = acquirer.pos_center
 
             self._reset_live_data(acquirer)
+            self._open_flush_file()
             logging.debug("Starting acquisition of %s px @ dt = %s s, roi = %s, rotation = %s rad",
                           rep, acquirer.snapshot_time * acquirer.integration_count,
                            self.roi.value, self.rotation.value)
@@ -1305,6 +1398,9 @@ class SEMCCDMDStream(MultipleDetectorStream):
 
                     # Update the SEM live area to indicate that the pixel/tile is done
                     self._update_live_area(px_idx, acquirer.tile_size, in_progress=False)
+                    if px_idx[1] == rep[0] - 1:  # End of a line => save it
+                        self._flush_live_data(list(range(len(self._streams))), rep, pol_idx,
+                                              px_idx[0], px_idx[0] + 1)
                     self._shouldUpdateImage()
                     logging.debug("Done acquiring image number %s out of %s.", n, tot_num)
 
@@ -1313,6 +1409,8 @@ class SEMCCDMDStream(MultipleDetectorStream):
                     if da is None:
                         continue
                     self._assembleLiveData2D(s_idx, da, (0, 0), None, rep, pol_idx)
+                self._flush_live_data([i for i, da in enumerate(spatial_das) if da is not None],
+                                      rep, pol_idx, 0, rep[1])
 
             # Stop the acquisition
             dur = time.time() - start_t
@@ -1357,6 +1455,7 @@ class SEMCCDMDStream(MultipleDetectorStream):
                 s._unlinkHwVAs()
             acquirer.restore_hardware()
 
+            self._close_flush_file()
             self._dc_estimator = None
             self._img_intor = []
             self._acq_done.set()
@@ -1468,21 +1567,26 @@ class SEMMDStream(MultipleDetectorStream):
 
         # TODO: check that no fuzzing is requested (as it's not supported and not useful).
 
-        dt = self._emitter.dwellTime.value
+        # Read all the settings needed in one go, to avoid many round-trips to the backend
+        names = ["dwellTime"] + [n for n in ("blanker", "external") if model.hasVA(self._emitter, n)]
+        hw_values, errors = self._emitter.getVAValues(names)
+        if errors:
+            raise next(iter(errors.values()))
+        dt = hw_values["dwellTime"]
 
         # Order matters (a bit)
-        if model.hasVA(self._emitter, "blanker") and self._emitter.blanker.value is None:
+        if "blanker" in hw_values and hw_values["blanker"] is None:
             # When the e-beam is set to automatic blanker mode, it would switch on/off for every
             # block of acquisition. This is not efficient, and can disrupt the e-beam. So we force
             # "blanker" off while the acquisition is running.
-            self._orig_hw_values[self._emitter.blanker] = self._emitter.blanker.value
+            self._orig_hw_values[self._emitter.blanker] = hw_values["blanker"]
             self._emitter.blanker.value = False
 
-        if model.hasVA(self._emitter, "external") and self._emitter.external.value is None:
+        if "external" in hw_values and hw_values["external"] is None:
             # When the e-beam is set to automatic external mode, it would switch on/off for every
             # block of acquisition. This is not efficient, and can disrupt the e-beam. So we force
             # "external" while the acquisition is running.
-            self._orig_hw_values[self._emitter.external] = self._emitter.external.value
+            self._orig_hw_values[self._emitter.external] = hw_values["external"]
             self._emitter.external.value = True
 
         return dt
@@ -2341,6 +2445,45 @@ class SEMARMDStream(SEMCCDMDStream):
 
         self._live_data[n].append(raw_data)
 
+    def _open_flush_file(self):
+        super()._open_flush_file()
+        self._ar_n_flushed = 0  # number of AR images already written
+        self._ar_file_idx: List[int] = []  # for each AR image written, its index in the file
+
+    def _close_flush_file(self):
+        # The file will not be accessible anymore => get back in memory the images released
+        if self._writer:
+            try:
+                self._reload_flushed_images()
+            except Exception:
+                logging.exception("Failed to read back the AR images from %s", self.flush_filename)
+        super()._close_flush_file()
+
+    def _reload_flushed_images(self):
+        """
+        Read back from the flush file the AR images which have been released from memory.
+        """
+        das = self._live_data[self._ccd_idx]
+        for i, da in enumerate(das):
+            if da is None:
+                das[i] = self._writer.read_image(self._ar_file_idx[i])
+
+    def _flush_stream_data(self, n: int, rep: Tuple[int, int], pol_idx: int, y_start: int, y_end: int):
+        """
+        See description on SEMCCDMDStream._flush_stream_data().
+        """
+        if n != self._ccd_idx:
+            return super()._flush_stream_data(n, rep, pol_idx, y_start, y_end)
+
+        # Each AR image is a separate image => write all the new ones
+        das = self._live_data[n]
+        for i in range(self._ar_n_flushed, len(das)):
+            self._ar_file_idx.append(self._writer.append(das[i]))
+            # The image is now in the file, so no need to keep it in memory (which can be
+            # large, with many big images). It's read back when the acquisition ends.
+            das[i] = None
+            self._ar_n_flushed += 1
+
     def _assembleFinalData(self, n, data):
         """
         :param n: (int) number of the current stream which is assembled into ._raw
@@ -2350,8 +2493,11 @@ class SEMARMDStream(SEMCCDMDStream):
         if n != self._ccd_idx:
             return super(SEMARMDStream, self)._assembleFinalData(n, data)
 
+        if self._writer:
+            self._reload_flushed_images()
+
         # Add all the DataArrays of the AR independently
-        self._raw.extend(data)
+        self._raw.extend(da for da in data if da is not None)
 
 
 # TODO: ideally it should inherit from FluoStream
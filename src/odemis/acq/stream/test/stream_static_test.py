@@ -25,6 +25,7 @@ import os
 import threading
 import time
 import unittest
+from unittest.mock import patch
 
 import numpy
 
@@ -33,7 +34,7 @@ from odemis.acq import stream, calibration
 from odemis.acq.stream import RGBSpatialSpectrumProjection, \
     SinglePointSpectrumProjection, SinglePointTemporalProjection, \
     LineSpectrumProjection, MeanSpectrumProjection, POL_POSITIONS
-from odemis.dataio import tiff
+from odemis.dataio import hdf5, tiff
 from odemis.model import MD_POL_NONE, MD_POL_HORIZONTAL, MD_POL_VERTICAL, \
     MD_POL_POSDIAG, MD_POL_NEGDIAG, MD_POL_RHC, MD_POL_LHC, DataArrayShadow, TINT_FIT_TO_RGB
 from odemis.util import testing, img, spectrum
@@ -42,6 +43,7 @@ logging.basicConfig(format="%(asctime)s  %(levelname)-7s %(module)s:%(lineno)d %
 logging.getLogger().setLevel(logging.DEBUG)
 
 FILENAME = "test" + tiff.EXTENSIONS[0]
+H5FILENAME = "test" + hdf5.EXTENSIONS[0]
 
 
 class StaticStreamsTestCase(unittest.TestCase):
@@ -51,10 +53,11 @@ class StaticStreamsTestCase(unittest.TestCase):
 
     def tearDown(self):
         # clean up
-        try:
-            os.remove(FILENAME)
-        except Exception:
-            pass
+        for fn in (FILENAME, H5FILENAME):
+            try:
+                os.remove(fn)
+            except Exception:
+                pass
 
     def test_fluo(self):
         """Test StaticFluoStream"""
@@ -392,6 +395,56 @@ class StaticStreamsTestCase(unittest.TestCase):
         # check if the .image VA has been updated
         testing.assert_array_not_equal(im2d1, im2d2)
 
+    def test_ar_cache(self):
+        """Test the cache of the ARRawProjection, and the precomputation of the neighbours"""
+        das = []
+        for i, pos in enumerate(((0, 0), (1e-6, 0), (0, 1e-6), (1e-6, 1e-6), (50e-6, 50e-6))):
+            data = self._create_ar_data((256, 512), tweak=i)
+            data.metadata[model.MD_POS] = pos
+            das.append(data)
+
+        ars = stream.StaticARStream("test", das)
+        ars_raw_pj = stream.ARRawProjection(ars)
+
+        e = threading.Event()
+
+        def on_im(im):
+            if im is not None:
+                e.set()
+
+        ars_raw_pj.image.subscribe(on_im)
+        ars.point.value = (0, 0)
+        self.assertTrue(e.wait(30))
+
+        # All the other positions are computed in the background (scheduled before the image is set)
+        ars_raw_pj._precompute_thread.join(30)
+        self.assertFalse(ars_raw_pj._precompute_thread.is_alive())
+        stats = ars_raw_pj.getCacheStatistics()["polar"]
+        self.assertEqual(stats["entries"], len(das))
+        self.assertGreater(stats["nbytes"], 0)
+        self.assertLessEqual(stats["nbytes"], stats["max_bytes"])
+
+        # Selecting a neighbour uses the cache
+        hits = stats["hits"]
+        e.clear()
+        ars.point.value = (1e-6, 1e-6)
+        # There might be a previous update still going on => wait for the image of the new position
+        for i in range(5):
+            self.assertTrue(e.wait(30))
+            e.clear()
+            stats = ars_raw_pj.getCacheStatistics()["polar"]
+            if stats["hits"] > hits:
+                break
+        self.assertGreater(stats["hits"], hits)
+        ars_raw_pj._precompute_thread.join(30)
+
+        # Reducing the cache size drops the least recently used images
+        im_nbytes = stats["nbytes"] // stats["entries"]
+        ars_raw_pj._polar_cache.max_bytes = 2 * im_nbytes
+        stats = ars_raw_pj.getCacheStatistics()["polar"]
+        self.assertLessEqual(stats["entries"], 2)
+        self.assertLessEqual(stats["nbytes"], 2 * im_nbytes)
+
     def test_ar_das(self):
         """Test StaticARStream with a DataArrayShadow"""
         logging.info("setting up stream")
@@ -424,6 +477,24 @@ class StaticStreamsTestCase(unittest.TestCase):
         # Check it's a RGB DataArray
         self.assertEqual(im2d0.shape[2], 3)
 
+        # The data is only read when projected
+        for r in ars.raw:
+            self.assertIsInstance(r, DataArrayShadow)
+            self.assertEqual(r.shape, data0.shape)
+
+        # Same projection as with the data in memory
+        ars_da = stream.StaticARStream("test", [data0, data1])
+        ars_da_raw_pj = stream.ARRawProjection(ars_da)
+        e_da = threading.Event()
+
+        def on_im_da(im):
+            if im is not None:
+                e_da.set()
+
+        ars_da_raw_pj.image.subscribe(on_im_da, init=True)
+        e_da.wait()
+        numpy.testing.assert_array_equal(im2d0, ars_da_raw_pj.image.value)
+
     def test_arpol_allpol(self):
         """Test StaticARStream with ARRawProjection and all possible polarization modes."""
         # AR polarization analyzer data: different for each polarization
@@ -678,20 +749,59 @@ class StaticStreamsTestCase(unittest.TestCase):
         """Test StaticSpectrumStream with DataArrayShadow"""
         # TODO: once it supports it, test the stream with pyramidal data
         spec = self._create_spectrum_data()
-        tiff.export(FILENAME, spec)
-        acd = tiff.open_data(FILENAME)
-
+        specs_da = stream.StaticSpectrumStream("test", spec)
+        proj_da = RGBSpatialSpectrumProjection(specs_da)
+        mean_da = MeanSpectrumProjection(specs_da)
+        pixel_da = SinglePointSpectrumProjection(specs_da)
+        specs_da.selected_pixel.value = (3, 10)
+
+        for exporter, fn in ((tiff, FILENAME), (hdf5, H5FILENAME)):
+            exporter.export(fn, spec)
+            acd = exporter.open_data(fn)
+
+            specs = stream.StaticSpectrumStream("test", acd.content[0])
+            # The data is not read all at once, just the part needed by each projection
+            self.assertIsInstance(specs.raw[0], DataArrayShadow)
+            proj_spatial = RGBSpatialSpectrumProjection(specs)
+            proj_mean = MeanSpectrumProjection(specs)
+            proj_pixel = SinglePointSpectrumProjection(specs)
+            specs.selected_pixel.value = (3, 10)
+            time.sleep(1)  # wait a bit for the image to update
+
+            # Control spatial spectrum
+            im2d = proj_spatial.image.value
+            # Check it's a RGB DataArray
+            self.assertEqual(im2d.shape, spec.shape[-2:] + (3,))
+            # Check it's at the right position
+            md2d = im2d.metadata
+            self.assertEqual(md2d[model.MD_POS], spec.metadata[model.MD_POS])
+            # Same image as with the data in memory (excepted rounding errors)
+            numpy.testing.assert_allclose(im2d.astype(int), proj_da.image.value.astype(int), atol=1)
+
+            numpy.testing.assert_allclose(proj_mean.image.value, mean_da.image.value)
+            numpy.testing.assert_array_equal(proj_pixel.image.value, pixel_da.image.value)
+            numpy.testing.assert_array_equal(proj_pixel.image.value, spec[:, 0, 0, 10, 3])
+
+            os.remove(fn)
+
+    def test_spectrum_das_calib(self):
+        """Test StaticSpectrumStream with DataArrayShadow and background correction"""
+        spec = self._create_spectrum_data()
+        hdf5.export(H5FILENAME, spec)
+        acd = hdf5.open_data(H5FILENAME)
         specs = stream.StaticSpectrumStream("test", acd.content[0])
-        proj_spatial = RGBSpatialSpectrumProjection(specs)
-        time.sleep(0.5)  # wait a bit for the image to update
+        proj_pixel = SinglePointSpectrumProjection(specs)
+        specs.selected_pixel.value = (3, 10)
 
-        # Control spatial spectrum
-        im2d = proj_spatial.image.value
-        # Check it's a RGB DataArray
-        self.assertEqual(im2d.shape, spec.shape[-2:] + (3,))
-        # Check it's at the right position
-        md2d = im2d.metadata
-        self.assertEqual(md2d[model.MD_POS], spec.metadata[model.MD_POS])
+        bckg = model.DataArray(numpy.ones((spec.shape[0], 1, 1, 1, 1), dtype=spec.dtype),
+                               spec.metadata.copy())
+        specs.background.value = bckg
+        time.sleep(1)  # wait a bit for the image to update
+        self.assertIsInstance(specs.raw[0], DataArrayShadow)
+        exp_spec = calibration.apply_spectrum_corrections(spec, bckg)[:, 0, 0, 10, 3]
+        numpy.testing.assert_array_equal(proj_pixel.image.value, exp_spec)
+        # The histogram is computed on (some of) the corrected data
+        self.assertGreater(specs.histogram.value.sum(), 0)
 
     def test_spectrum_2d(self):
         """Test StaticSpectrumStream 2D"""
@@ -883,6 +993,57 @@ class StaticStreamsTestCase(unittest.TestCase):
         testing.assert_array_not_equal(im2d_bgcorr, im2d_effcorr)
         testing.assert_array_not_equal(im2d_bgcorr, prev_im2d)
 
+    def test_spectrum_band_prefix(self):
+        """Test the image of a band computed from the cumulative sum of the data
+        is the same as computed directly from the data"""
+        for data in (self._create_spectrum_data(), self._create_temporal_spectrum_data()):
+            specs = stream.StaticSpectrumStream("test spectrum band", data)
+            specs.auto_bc.value = False
+            specs.intensityRange.value = (0, 500)
+            # One projection uses the cumulative sum, the other one always computes from the data
+            proj_prefix = RGBSpatialSpectrumProjection(specs)
+            with patch("odemis.acq.stream._projection.SPECTRUM_BAND_PREFIX_MAX_BYTES", 0):
+                proj_data = RGBSpatialSpectrumProjection(specs)
+            self.assertIsNone(proj_data._prefix_thread)
+
+            # Wait for the cumulative sum to be computed in the background
+            proj_prefix._prefix_thread.join(10)
+            self.assertIsNotNone(proj_prefix._getBandPrefix(specs.calibrated.value))
+
+            im_updated = threading.Event()
+
+            def on_image(im):
+                im_updated.set()
+
+            proj_prefix.image.subscribe(on_image)
+            proj_data.image.subscribe(on_image)
+
+            wl = specs._wl_px_values
+            for tint in ((255, 0, 0), TINT_FIT_TO_RGB):
+                specs.tint.value = tint
+                for band in ((wl[0], wl[-1]), (wl[10], wl[50]), (wl[3], wl[3])):
+                    prev_ims = proj_prefix.image.value, proj_data.image.value
+                    im_updated.clear()
+                    specs.spectrumBandwidth.value = band
+
+                    # Both images are updated in the background, possibly multiple times.
+                    # Rounding errors can cause 1 unit of difference in the RGB values.
+                    for i in range(20):
+                        self.assertTrue(im_updated.wait(10))
+                        im_updated.clear()
+                        im_prefix, im_data = proj_prefix.image.value, proj_data.image.value
+                        if (im_prefix is not prev_ims[0] and im_data is not prev_ims[1] and
+                            numpy.allclose(im_prefix.astype(int), im_data.astype(int), atol=1)):
+                            break
+                    else:
+                        numpy.testing.assert_allclose(im_prefix.astype(int), im_data.astype(int), atol=1)
+
+            # When the data changes, the cumulative sum is recomputed
+            dbckg = numpy.ones(data.shape[:2] + (1, 1, 1), dtype=numpy.uint16)
+            bckg = model.DataArray(dbckg, metadata=data.metadata.copy())
+            specs.background.value = bckg
+            self.assertIsNone(proj_prefix._getBandPrefix(specs.calibrated.value))
+
     def _create_temporal_spectrum_data(self):
         """Create temporal spectrum data."""
         data = numpy.random.randint(1, 100, size=(256, 128, 1, 20, 30), dtype="uint16")
@@ -1003,6 +1164,54 @@ class StaticStreamsTestCase(unittest.TestCase):
         testing.assert_array_not_equal(im2d_bgcorr, im2d_effcorr)
         testing.assert_array_not_equal(im2d_bgcorr, prev_im2d)
 
+    def test_temporal_spectrum_lazy_calib(self):
+        """Test the projections of a StaticSpectrumStream only compute the corrections
+        on the data needed, with the same result as if all the data was corrected."""
+        temporalspectrum = self._create_temporal_spectrum_data()
+        tss = stream.StaticSpectrumStream("test temporal spectrum lazy", temporalspectrum)
+
+        dbckg = numpy.random.randint(1, 50, size=temporalspectrum.shape[:2] + (1, 1, 1), dtype=numpy.uint16)
+        bckg = model.DataArray(dbckg, metadata={model.MD_WL_LIST: temporalspectrum.metadata[model.MD_WL_LIST],
+                                                model.MD_STREAK_MODE: True,
+                                                model.MD_STREAK_TIMERANGE: 1e-9,  # s
+                                                })
+        dcalib = numpy.array([1, 1.3, 2, 3.5, 4, 5, 1.3, 6, 9.1], dtype=float)
+        dcalib.shape = (dcalib.shape[0], 1, 1, 1, 1)
+        wl_calib = 400e-9 + numpy.arange(dcalib.shape[0]) * 10e-9
+        calib = model.DataArray(dcalib, metadata={model.MD_WL_LIST: wl_calib})
+        tss.efficiencyCompensation.value = calib
+        tss.background.value = bckg
+
+        self.assertIsInstance(tss.calibrated.value, DataArrayShadow)
+        expected = calibration.apply_spectrum_corrections(temporalspectrum, bckg, calib)
+
+        # Spectrum and chronogram of an area around a pixel
+        tss.selected_pixel.value = (3, 4)
+        tss.selectionWidth.value = 3
+        tss.selected_time.value = tss._tl_px_values[10]
+        tss.selected_wavelength.value = tss._wl_px_values[20]
+        exp_spec = img.mean_within_circle(expected[:, 10, 0], (3, 4), 1.5)
+        proj_spec = SinglePointSpectrumProjection(tss)
+        numpy.testing.assert_allclose(proj_spec.projectAsRaw(), exp_spec)
+        exp_chrono = img.mean_within_circle(expected[20, :, 0], (3, 4), 1.5)
+        proj_chrono = SinglePointTemporalProjection(tss)
+        numpy.testing.assert_allclose(proj_chrono.projectAsRaw(), exp_chrono)
+
+        # Line spectrum, over the whole width of the data
+        tss.selected_line.value = [(0, 2), (29, 15)]
+        proj_line = LineSpectrumProjection(tss)
+        line_spec = proj_line.projectAsRaw()
+        tss.calibrated.value = expected  # Reference: compute with all the data corrected
+        exp_line_spec = proj_line.projectAsRaw()
+        numpy.testing.assert_allclose(line_spec, exp_line_spec)
+
+        # Mean spectrum
+        tss.calibrated.value = calibration.DataArrayShadowCorrected(temporalspectrum, bckg, calib)
+        proj_mean = MeanSpectrumProjection(tss)
+        proj_mean._updateImage()
+        numpy.testing.assert_allclose(proj_mean.image.value,
+                                      expected.reshape(expected.shape[0], -1).mean(axis=1))
+
     def test_temporal_spectrum_false_calib_bg(self):
         """Test StaticSpectrumStream background image correction
          with temporal spectrum data using invalid bg images and calibration files."""
@@ -1283,13 +1492,15 @@ class StaticStreamsTestCase(unittest.TestCase):
     def test_rgb_tiled_stream_pan(self):
         read_tiles = []
 
-        def getTileMock(self, x, y, zoom):
-            tile_desc = "(%d, %d), z: %d" % (x, y, zoom)
-            read_tiles.append(tile_desc)
-            return tiff.DataArrayShadowPyramidalTIFF._getTileOldSP(self, x, y, zoom)
+        # getTile() also goes through getTiles()
+        def getTilesMock(self, tiles, **kwargs):
+            for x, y, zoom in tiles:
+                tile_desc = "(%d, %d), z: %d" % (x, y, zoom)
+                read_tiles.append(tile_desc)
+            return tiff.DataArrayShadowPyramidalTIFF._getTilesOldSP(self, tiles, **kwargs)
 
-        tiff.DataArrayShadowPyramidalTIFF._getTileOldSP = tiff.DataArrayShadowPyramidalTIFF.getTile
-        tiff.DataArrayShadowPyramidalTIFF.getTile = getTileMock
+        tiff.DataArrayShadowPyramidalTIFF._getTilesOldSP = tiff.DataArrayShadowPyramidalTIFF.getTiles
+        tiff.DataArrayShadowPyramidalTIFF.getTiles = getTilesMock
 
         POS = (5.0, 7.0)
         size = (3000, 2000, 3)
@@ -1358,18 +1569,20 @@ class StaticStreamsTestCase(unittest.TestCase):
             time.sleep(0.5)
 
         # get the old function back to the class
-        tiff.DataArrayShadowPyramidalTIFF.getTile = tiff.DataArrayShadowPyramidalTIFF._getTileOldSP
+        tiff.DataArrayShadowPyramidalTIFF.getTiles = tiff.DataArrayShadowPyramidalTIFF._getTilesOldSP
 
     def test_rgb_tiled_stream_zoom(self):
         read_tiles = []
 
-        def getTileMock(self, x, y, zoom):
-            tile_desc = "(%d, %d), z: %d" % (x, y, zoom)
-            read_tiles.append(tile_desc)
-            return tiff.DataArrayShadowPyramidalTIFF._getTileOldSZ(self, x, y, zoom)
+        # getTile() also goes through getTiles()
+        def getTilesMock(self, tiles, **kwargs):
+            for x, y, zoom in tiles:
+                tile_desc = "(%d, %d), z: %d" % (x, y, zoom)
+                read_tiles.append(tile_desc)
+            return tiff.DataArrayShadowPyramidalTIFF._getTilesOldSZ(self, tiles, **kwargs)
 
-        tiff.DataArrayShadowPyramidalTIFF._getTileOldSZ = tiff.DataArrayShadowPyramidalTIFF.getTile
-        tiff.DataArrayShadowPyramidalTIFF.getTile = getTileMock
+        tiff.DataArrayShadowPyramidalTIFF._getTilesOldSZ = tiff.DataArrayShadowPyramidalTIFF.getTiles
+        tiff.DataArrayShadowPyramidalTIFF.getTiles = getTilesMock
 
         POS = (5.0, 7.0)
         dtype = numpy.uint8
@@ -1425,8 +1638,9 @@ class StaticStreamsTestCase(unittest.TestCase):
         # top-left pixel of the left tile
         numpy.testing.assert_allclose([0, 0, 0], pj.image.value[0][0][0, 0, :])
         # top-right pixel of the left tile (which is little bit more half-way as the tile is 256px,
-        # this covers more than the half the 375 px at minimum zoom -> 255*256/375 ~ 174, depending on the rounding)
-        numpy.testing.assert_allclose([174, 0, 0], pj.image.value[0][0][0, 255, :], atol=1)
+        # this covers more than the half the 375 px at minimum zoom -> 255*256/375 ~ 174, depending on the rounding,
+        # which adds up as each zoom level is computed from the previous one)
+        numpy.testing.assert_allclose([174, 0, 0], pj.image.value[0][0][0, 255, :], atol=2)
         # bottom-left pixel of the left tile
         numpy.testing.assert_allclose([0, 255, 0], pj.image.value[0][0][249, 0, :], atol=1)
         # bottom-right pixel of the right tile
@@ -1444,7 +1658,7 @@ class StaticStreamsTestCase(unittest.TestCase):
         # top-left pixel of the only tile
         numpy.testing.assert_allclose([0, 0, 0], pj.image.value[0][0][0, 0, :], atol=1)
         # top-right pixel of the only tile
-        numpy.testing.assert_allclose([174, 0, 0], pj.image.value[0][0][0, 255, :], atol=1)
+        numpy.testing.assert_allclose([174, 0, 0], pj.image.value[0][0][0, 255, :], atol=2)
         # bottom-left pixel of the only tile
         numpy.testing.assert_allclose([0, 255, 0], pj.image.value[0][0][249, 0, :], atol=1)
 
@@ -1493,7 +1707,7 @@ class StaticStreamsTestCase(unittest.TestCase):
         # top-left pixel of the left tile
         numpy.testing.assert_allclose([0, 0, 0], pj.image.value[0][0][0, 0, :], atol=1)
         # bottom-right pixel of the left tile
-        numpy.testing.assert_allclose([174, 0, 0], pj.image.value[0][0][0, 255, :], atol=1)
+        numpy.testing.assert_allclose([174, 0, 0], pj.image.value[0][0][0, 255, :], atol=2)
         # bottom-right pixel of right tile
         numpy.testing.assert_allclose([255, 255, 0], pj.image.value[1][0][249, 117, :], atol=1)
 
@@ -1517,11 +1731,11 @@ class StaticStreamsTestCase(unittest.TestCase):
         # top-left pixel of a center tile
         numpy.testing.assert_allclose([88, 0, 0], pj.image.value[1][0][0, 0, :], atol=1)
         # top-right pixel of a center tile
-        numpy.testing.assert_allclose([174, 0, 0], pj.image.value[1][0][0, 255, :], atol=1)
+        numpy.testing.assert_allclose([174, 0, 0], pj.image.value[1][0][0, 255, :], atol=2)
         # bottom-left pixel of a center tile
         numpy.testing.assert_allclose([88, 130, 0], pj.image.value[1][0][255, 0, :], atol=1)
         # bottom pixel of a center tile
-        numpy.testing.assert_allclose([174, 130, 0], pj.image.value[1][0][255, 255, :], atol=1)
+        numpy.testing.assert_allclose([174, 130, 0], pj.image.value[1][0][255, 255, :], atol=2)
 
         delta = [d / 8 for d in dfr]
         # this rect is 1/8 the size of the full image, in the center of the image
@@ -1548,7 +1762,7 @@ class StaticStreamsTestCase(unittest.TestCase):
         numpy.testing.assert_allclose([130, 130, 0], pj.image.value[0][0][255, 255, :], atol=1)
 
         # get the old function back to the class
-        tiff.DataArrayShadowPyramidalTIFF.getTile = tiff.DataArrayShadowPyramidalTIFF._getTileOldSZ
+        tiff.DataArrayShadowPyramidalTIFF.getTiles = tiff.DataArrayShadowPyramidalTIFF._getTilesOldSZ
 
     def test_rgb_updatable_stream(self):
         """Test RGBUpdatableStream """
@@ -14,6 +14,7 @@ Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRAN
 
 You should have received a copy of the GNU General Public License along with Odemis. If not, see http://www.gnu.org/licenses/.
 '''
+import glob
 import logging
 import math
 import os
@@ -32,6 +33,18 @@ from odemis.util import img
 logging.getLogger().setLevel(logging.DEBUG)
 
 
+def remove_files(pattern):
+    """
+    Delete all the files matching the given pattern
+    pattern (str): glob pattern of the files to delete
+    """
+    for fn in glob.glob(pattern):
+        try:
+            os.remove(fn)
+        except OSError:
+            logging.exception("Failed to delete the file %s", fn)
+
+
 class TestAR(unittest.TestCase):
     """
     Test the AR related functions
@@ -46,6 +59,10 @@ class TestAR(unittest.TestCase):
             "ignore", category=RuntimeWarning, message=re.escape("numpy.ndarray size changed")
         )
 
+    def tearDown(self):
+        # Some formats export the data into several files (eg, test_ar.1.ome.tiff)
+        remove_files("test_ar.*")
+
     def test_load_simple(self):
         # AR background data
         dcalib = numpy.zeros((512, 1024), dtype=numpy.uint16)
@@ -231,6 +248,11 @@ class TestSpectrum(unittest.TestCase):
     Test the Spectrum related functions
     """
 
+    def tearDown(self):
+        # Some formats export the data into several files (eg, test_spec.1.ome.tiff)
+        remove_files("test_spec.*")
+        remove_files("test_bckg.*")
+
     def test_load_background(self):
         # Background data
         dcalib = numpy.array([1, 2, 2, 3, 4, 5, 4, 6, 9], dtype=numpy.uint16)
@@ -406,6 +428,42 @@ class TestSpectrum(unittest.TestCase):
             if wl <= wl_calib[0]:
                 self.assertEqual(vo * dcalib[0], vc)
 
+    def test_compensate_lazy(self):
+        """Test the corrections applied only on the part of the data accessed"""
+        # Temporal spectrum
+        data = numpy.random.randint(0, 1000, (51, 20, 1, 30, 40), dtype=numpy.uint16)
+        wld = 433e-9 + numpy.arange(data.shape[0]) * 0.1e-9
+        spec = model.DataArray(data, metadata={model.MD_WL_LIST: wld})
+
+        dbckg = numpy.random.randint(0, 200, (51, 20, 1, 1, 1), dtype=numpy.uint16)
+        bckg = model.DataArray(dbckg, metadata={model.MD_WL_LIST: wld})
+
+        dcalib = numpy.array([1, 1.3, 2, 3.5, 4, 5, 0.1, 6, 9.1], dtype=float)
+        dcalib.shape = (dcalib.shape[0], 1, 1, 1, 1)
+        wl_calib = 400e-9 + numpy.arange(dcalib.shape[0]) * 10e-9
+        calib = model.DataArray(dcalib, metadata={model.MD_WL_LIST: wl_calib})
+
+        for b, c in ((None, None), (bckg, None), (None, calib), (bckg, calib)):
+            compensated = calibration.apply_spectrum_corrections(spec, b, c)
+            lazy = calibration.DataArrayShadowCorrected(spec, b, c)
+            self.assertIsInstance(lazy, model.DataArrayShadow)
+            self.assertEqual(lazy.shape, compensated.shape)
+            self.assertEqual(lazy.dtype, compensated.dtype)
+            numpy.testing.assert_equal(lazy.metadata[model.MD_WL_LIST], wld)
+
+            for key in ((slice(None), 3, 0, 5, 7),  # spectrum of a pixel
+                        (slice(10, 20),),  # band
+                        (Ellipsis, 12, 4),
+                        (5, slice(None), 0, slice(2, 9), slice(3, 5))):
+                sub = lazy[key]
+                self.assertIsInstance(sub, model.DataArray)
+                numpy.testing.assert_array_equal(sub, compensated[key])
+            numpy.testing.assert_array_equal(lazy.getData(), compensated)
+
+        # Incompatible background
+        with self.assertRaises(ValueError):
+            calibration.DataArrayShadowCorrected(spec, bckg[:10])
+
     def test_angular_spec_compensation(self):
         """Check that the angular spec data is readjusted based on chromatic aberration info"""
         # AR Spectrum (aka EK1) data
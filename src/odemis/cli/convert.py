@@ -218,6 +218,15 @@ def main(args):
             "algorithm to correct for suboptimal stage movement), 'global_shift': GlobalShiftRegistrar "
             "(uses cross-correlation algorithm with global optimization)",
             choices=("identity", "shift", "global_shift"), default="global_shift")
+    parser.add_argument("--ar-export", dest="ar_export", action='store_true',
+            help="Convert each ebeam position of the angle-resolved data of the input file "
+            "to its theta/phi representation, and save each of them in a separate file, "
+            "named after the output file (eg, out.csv -> out_x0_y0.csv, out_x1_y0.csv...).")
+    parser.add_argument("--ar-background", dest="ar_background",
+            help="name of an acquisition file containing the background image(s) to subtract "
+            "from the angle-resolved data (default is to subtract the baseline).")
+    parser.add_argument("--workers", dest="workers", type=int,
+            help="number of processes used for --ar-export (default is one per CPU).")
 
     # TODO: --export (spatial) image that defaults to a HFW corresponding to the
     # smallest image, and can be overridden by --hfw xxx (in µm).
@@ -271,6 +280,17 @@ def main(args):
         thumbs = []
         logging.info("File contains %d coefficients", data[0].shape[0])
 
+    if options.ar_export:
+        if not infn:
+            raise ValueError("--ar-export requires --input.")
+        bg = None
+        if options.ar_background:
+            bg, _ = open_acq(options.ar_background)
+        results = io.export_ar_batch(data, outfn, bg, options.workers)
+        base, ext = io.splitext(outfn)
+        logging.info("Successfully generated %d files %s_x*_y*%s", len(results), base, ext)
+        return 0
+
     if options.minus:
         if thumbs:
             logging.info("Dropping thumbnail due to subtraction")
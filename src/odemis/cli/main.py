@@ -34,8 +34,10 @@ from odemis import model, util
 import odemis
 from odemis.util import units, inspect_getmembers
 from odemis.util.conversion import convert_to_object
+from odemis.util.imports import print_import_profile
 from odemis.util.driver import BACKEND_RUNNING, \
-    BACKEND_DEAD, BACKEND_STOPPED, get_backend_status, BACKEND_STARTING
+    BACKEND_DEAD, BACKEND_STOPPED, get_backend_status, BACKEND_STARTING, \
+    get_startup_critical_path
 import sys
 import threading
 
@@ -229,6 +231,34 @@ def list_components(pretty=True):
             print_component(c, pretty)
 
 
+def print_startup_timeline(pretty=True):
+    """
+    Display the time at which each component was instantiated, and the chain
+    of components which determined the start-up duration.
+    pretty (bool): if True, display with pretty-printing
+    """
+    microscope = model.getMicroscope()
+    timeline = microscope.startup.value
+    if not timeline:
+        logging.info("No component instantiated yet")
+        return
+    t0 = min(s for s, e, w in timeline.values())
+    path = get_startup_critical_path(timeline)
+
+    for n, (s, e, w) in sorted(timeline.items(), key=lambda i: i[1][0]):
+        if pretty:
+            crit = "*" if n in path else " "
+            waited = "\t(waited for %s)" % (w,) if w else ""
+            print("%s %s\t%.3f s -> %.3f s (%.3f s)%s" % (crit, n, s - t0, e - t0, e - s, waited))
+        else:
+            print("%s\tstart:%f\tend:%f\twaited:%s" % (n, s - t0, e - t0, w))
+
+    if pretty:
+        print("Critical path: %s" % (" -> ".join(path),))
+    else:
+        print("critical:%s" % (",".join(path),))
+
+
 def print_axes(name, value, pretty):
     if pretty:
         print("\t%s (RO Attribute)" % (name,))
@@ -279,14 +309,19 @@ def print_events(component, pretty):
         print_event(name, value, pretty)
 
 
-def print_vattribute(component, name, va, pretty):
+def print_vattribute(component, name, va, pretty, value=None):
     """
     Print on one line the information about a VigilantAttribute
     component (Component): the component containing the VigilantAttribute
     name (str): the name of the VigilantAttribute
     va (VigilantAttribute): the VigilantAttribute to display
     pretty (bool): whether to display for the user (True) or for a machine (False)
+    value: the current value of the VigilantAttribute, if already known. If
+      None, it is read from the VA.
     """
+    if value is None:
+        value = va.value
+
     if va.unit:
         if pretty:
             unit = " (unit: %s)" % va.unit
@@ -327,7 +362,7 @@ def print_vattribute(component, name, va, pretty):
         str_choices = ""
 
     if pretty:
-        val = va.value
+        val = value
         if name in VAS_COMPS:
             try:
                 val = {c.name for c in val}
@@ -346,11 +381,11 @@ def print_vattribute(component, name, va, pretty):
             val_converted = ""
 
         # For position, it's trickier, as the unit is on .axes
-        if (name == "position" and isinstance(va.value, dict) and
+        if (name == "position" and isinstance(value, dict) and
             hasattr(component, "axes") and isinstance(component.axes, dict)
            ):
             pos_deg = {}
-            for an, pos in va.value.items():
+            for an, pos in value.items():
                 try:
                     axis_def = component.axes[an]
                 except KeyError:
@@ -374,14 +409,17 @@ def print_vattribute(component, name, va, pretty):
               (readonly, sval, unit, str_range, str_choices, val_converted))
     else:
         print("%s\ttype:%sva\tvalue:%s%s%s%s" %
-              (name, readonly, str(va.value), unit, str_range, str_choices))
+              (name, readonly, str(value), unit, str_range, str_choices))
 
 
 def print_vattributes(component, pretty):
-    for name, va in model.getVAs(component).items():
-        if name in VAS_HIDDEN:
-            continue
-        print_vattribute(component, name, va, pretty)
+    vas = {n: va for n, va in model.getVAs(component).items() if n not in VAS_HIDDEN}
+    # Read all the values in one go, as it's much faster than one by one
+    values, errors = component.getVAValues(list(vas.keys()))
+    for name, va in vas.items():
+        if name in errors:
+            raise errors[name]
+        print_vattribute(component, name, va, pretty, values[name])
 
 
 def map_metadata_names():
@@ -936,6 +974,10 @@ def main(args):
                          default=0, help="set verbosity level (0-2, default = 0)")
     opt_grp.add_argument("--machine", dest="machine", action="store_true", default=False,
                          help="display in a machine-friendly way (i.e., no pretty printing)")
+    opt_grp.add_argument("--profile-imports", dest="profile_imports", nargs="?", metavar="module",
+                         const="odemis.cli.main", default=None,
+                         help="display the modules which take the most time to import at start-up "
+                              "(or when importing the given module, such as a driver), and exit")
     dm_grp = parser.add_argument_group('Microscope management')
     dm_grpe = dm_grp.add_mutually_exclusive_group()
     dm_grpe.add_argument("--kill", "-k", dest="kill", action="store_true", default=False,
@@ -949,6 +991,8 @@ def main(args):
                          "a specific hardware to scan can be specified.")
     dm_grpe.add_argument("--list", "-l", dest="list", action="store_true", default=False,
                          help="list the components of the microscope")
+    dm_grpe.add_argument("--startup", dest="startup", action="store_true", default=False,
+                         help="show when each component was instantiated, and the critical path of the start-up")
     dm_grpe.add_argument("--list-prop", "-L", dest="listprop", metavar="<component>",
                          help="list the properties of a component. Use '*' to list all the components.")
     dm_grpe.add_argument("--set-attr", "-s", dest="setattr", nargs="+", action='append',
@@ -1019,9 +1063,17 @@ def main(args):
         pyrolog = logging.getLogger("Pyro4")
         pyrolog.setLevel(min(pyrolog.getEffectiveLevel(), logging.INFO))
 
+    if options.profile_imports:
+        try:
+            print_import_profile(options.profile_imports)
+        except ImportError as exp:
+            logging.error("%s", exp)
+            return 127
+        return 0
+
     # anything to do?
     if not any((options.check, options.kill, options.scan,
-        options.list, options.stop, options.move,
+        options.list, options.startup, options.stop, options.move,
         options.position, options.reference,
         options.listprop, options.setattr, options.upmd,
         options.acquire, options.live)):
@@ -1070,6 +1122,8 @@ def main(args):
             kill_backend()
         elif options.list:
             list_components(pretty=not options.machine)
+        elif options.startup:
+            print_startup_timeline(pretty=not options.machine)
         elif options.listprop is not None:
             list_properties(options.listprop, pretty=not options.machine)
         elif options.setattr is not None:
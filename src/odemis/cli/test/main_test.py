@@ -42,6 +42,9 @@ from odemis.util import testing
 logging.getLogger().setLevel(logging.DEBUG)
 
 ODEMISCLI_CMD = [sys.executable, "-m", "odemis.cli.main"]
+# Maximum time to import the CLI (s). It's typically ~0.4s on a standard PC.
+# Modules which are slow to import, and not needed to just talk to the back-end
+HEAVY_MODULES = ("scipy", "cv2", "matplotlib")
 CONFIG_PATH = os.path.dirname(odemis.__file__) + "/../../install/linux/usr/share/odemis/"
 SECOM_CONFIG = CONFIG_PATH + "sim/secom-sim.odm.yaml"
 
@@ -102,6 +105,18 @@ class TestWithoutBackend(unittest.TestCase):
 
         self.assertTrue(b"andorcam2.FakeAndorCam2" in output)
 
+    def test_import_time(self):
+        """
+        Check that the CLI starts fast, by not importing heavy modules
+        """
+        # Done in a separate interpreter, as the other tests import these modules
+        code = "import sys, odemis.cli.main; print('\\n'.join(sys.modules))"
+        out = subprocess.check_output([sys.executable, "-c", code], universal_newlines=True)
+        names = set(out.split())
+        for m in HEAVY_MODULES:
+            loaded = {n for n in names if n == m or n.startswith(m + ".")}
+            self.assertFalse(loaded, "Modules %s imported at start-up" % (loaded,))
+
     def test_error_scan(self):
         try:
             cmdline = "cli --scan bar.foo"
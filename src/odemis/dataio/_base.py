@@ -19,6 +19,16 @@ PARTICULAR PURPOSE. See the GNU General Public License for more details.
 You should have received a copy of the GNU General Public License along with
 Odemis. If not, see http://www.gnu.org/licenses/.
 """
+from odemis.util.cache import LRUCache
+
+__all__ = ["AuthenticationError", "TileCache"]
 
 class AuthenticationError(IOError):
     pass
+
+
+class TileCache(LRUCache):
+    """
+    Least-recently-used cache of tiles (numpy arrays), bounded by the total
+    memory used by the tiles. It is safe to use from multiple threads.
+    """
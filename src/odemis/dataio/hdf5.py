@@ -32,8 +32,10 @@ from numpy.polynomial import polynomial
 
 import odemis
 from odemis import model
+from odemis.dataio._base import TileCache
+from odemis.model import AcquisitionData, DataArrayShadow
 from odemis.util import fluo, img, spectrum
-from odemis.util.conversion import JsonExtraEncoder
+from odemis.util.conversion import JsonExtraEncoder, get_tile_md_pos
 
 # User-friendly name
 FORMAT = "HDF5"
@@ -42,6 +44,13 @@ EXTENSIONS = [".h5", ".hdf5"]
 LOSSY = False
 CAN_SAVE_PYRAMID = False
 
+# Minimum size of the tiles (X and Y), when reading a chunked dataset by tiles
+TILE_SIZE = 256  # px
+# Maximum memory used to cache the tiles read from an HDF5 file
+TILE_CACHE_SIZE = 256 * 2 ** 20  # bytes
+# Approximate maximum size of a chunk, when writing a file progressively
+CHUNK_SIZE = 2 ** 20  # bytes
+
 # We are trying to follow the same format as SVI, as defined here:
 # http://www.svi.nl/HDF5
 # A file follows this structure:
@@ -139,7 +148,19 @@ def _create_image_dataset(group, dataset_name, image, **kwargs):
     """
     assert(len(image.shape) >= 2)
     image_dataset = group.create_dataset(dataset_name, data=image, **kwargs)
+    _set_image_attrs(image_dataset, image)
+    return image_dataset
+
 
+def _set_image_attrs(image_dataset, image, minmax=None):
+    """
+    Set the attributes of a dataset to follow the HDF5 image specification
+    image_dataset (HDF Dataset): the dataset containing the image
+    image (numpy.ndimage): the image (it is only used to detect RGB images,
+      and to compute the range of the values)
+    minmax (None or (number, number)): the range of the values. If None, it is
+      computed from the image.
+    """
     # numpy.string_ is to force fixed-length string (necessary for compatibility)
     # FIXME: needs to be NULLTERM, not NULLPAD... but h5py doesn't allow to distinguish
     image_dataset.attrs["CLASS"] = numpy.string_("IMAGE")
@@ -157,13 +178,13 @@ def _create_image_dataset(group, dataset_name, image, **kwargs):
     else:
         image_dataset.attrs["IMAGE_SUBCLASS"] = numpy.string_("IMAGE_GRAYSCALE")
         image_dataset.attrs["IMAGE_WHITE_IS_ZERO"] = numpy.array(0, dtype="uint8")
-        image_dataset.attrs["IMAGE_MINMAXRANGE"] = [image.min(), image.max()]
+        if minmax is None:
+            minmax = image.min(), image.max()
+        image_dataset.attrs["IMAGE_MINMAXRANGE"] = list(minmax)
 
     image_dataset.attrs["DISPLAY_ORIGIN"] = numpy.string_("UL") # not rotated
     image_dataset.attrs["IMAGE_VERSION"] = numpy.string_("1.2")
 
-    return image_dataset
-
 
 def _read_image_dataset(dataset):
     """
@@ -174,6 +195,18 @@ def _read_image_dataset(dataset):
      IOError: if it doesn't conform to the standard
      NotImplementedError: if the image uses so fancy standard features
     """
+    md = _read_image_dataset_md(dataset)
+    return model.DataArray(dataset[...], md)
+
+
+def _read_image_dataset_md(dataset):
+    """
+    Check a dataset respects the HDF5 image specification, without reading the data.
+    returns (dict): the metadata, which contains MD_DIMS if the image is RGB.
+    raises
+     IOError: if it doesn't conform to the standard
+     NotImplementedError: if the image uses so fancy standard features
+    """
     # check basic format
     if len(dataset.shape) < 2:
         raise IOError("Image has a shape of %s" % (dataset.shape,))
@@ -184,7 +217,7 @@ def _read_image_dataset(dataset):
     # conversion is almost entirely different depending on subclass
     subclass = dataset.attrs.get("IMAGE_SUBCLASS", b"IMAGE_GRAYSCALE")
 
-    image = model.DataArray(dataset[...])
+    md = {}
     if subclass == b"IMAGE_GRAYSCALE":
         pass
     elif subclass == b"IMAGE_TRUECOLOR":
@@ -203,9 +236,9 @@ def _read_image_dataset(dataset):
 
         if il_mode == b"INTERLACE_PLANE":
             # colour is first dim
-            image.metadata[model.MD_DIMS] = "CYX"
+            md[model.MD_DIMS] = "CYX"
         elif il_mode == b"INTERLACE_PIXEL":
-            image.metadata[model.MD_DIMS] = "YXC"
+            md[model.MD_DIMS] = "YXC"
         else:
             raise NotImplementedError("Unable to handle images of subclass '%s'" % subclass)
 
@@ -217,7 +250,7 @@ def _read_image_dataset(dataset):
     if dorig != b"UL":
         logging.warning("Image rotation %s not handled", dorig)
 
-    return image
+    return md
 
 
 def _add_image_info(group, dataset, image):
@@ -686,6 +719,23 @@ def _parse_physical_data(pdgroup, da):
     returns (list of DataArrays): The same data, but broken into smaller
       DataArrays if necessary, and with additional metadata.
     """
+    mds = _read_physical_data(pdgroup, da.shape, da.metadata)
+    if len(mds) > 1:
+        return [model.DataArray(c, md) for c, md in zip(da, mds)]
+    else:
+        return [da]
+
+
+def _read_physical_data(pdgroup, shape, md):
+    """
+    Parse the metadata found in PhysicalData.
+    pdgroup (HDF Group): the group "PhysicalData" associated to an image
+    shape (tuple of int): the shape of the image, with C as first dimension
+    md (dict): the metadata of the image, read from the ImageData
+    returns (list of dict): the metadata for each channel, if the image should
+      be broken into one image per channel. Otherwise, just one metadata (the
+      md passed, updated).
+    """
     # The information in PhysicalData might be different for each channel (e.g.
     # fluorescence image). In this case, the DA must be separated into smaller
     # ones, per channel.
@@ -700,18 +750,16 @@ def _parse_physical_data(pdgroup, da):
 
     if n > 1:
         # need to separate it
-        if n != da.shape[0]:
+        if n != shape[0]:
             logging.warning("Image has %d channels and %d metadata, failed to map",
-                            da.shape[0], n)
-            das = [da]
+                            shape[0], n)
+            mds = [md]
         else:
-            # list(da) does almost what we need, but metadata is shared
-            das = [model.DataArray(c, da.metadata.copy()) for c in da]
+            mds = [md.copy() for i in range(n)]
     else:
-        das = [da]
+        mds = [md]
 
-    for i, d in enumerate(das):
-        md = d.metadata
+    for i, md in enumerate(mds):
         try:
             cd = convert_to_str(pdgroup["ChannelDescription"][i])
             md[model.MD_DESCRIPTION] = cd
@@ -775,7 +823,7 @@ def _parse_physical_data(pdgroup, da):
         # acquisition recipes
         read_metadata(pdgroup, i, md, "AcquisitionRecipes", model.MD_ACQ_RECIPES, converter=convert_to_str)
 
-    return das
+    return mds
 
 
 def read_metadata(pdgroup, c_index, md, name, md_key, converter, bad_states=(ST_INVALID,)):
@@ -1473,7 +1521,17 @@ def _thumbFromHDF5(filename):
     return (list of model.DataArray)
     """
     f = h5py.File(filename, "r")
+    return [das.getData() for das in _thumbShadowsFromHDF5(f)]
 
+
+def _thumbShadowsFromHDF5(f, cache=None):
+    """
+    Find the thumbnails in an HDF5 file, without reading their data.
+    Expects to find them as IMAGE in Preview/Image.
+    f (h5py.File): the root of the file
+    cache (None or TileCache): cache for the tiles read
+    return (list of DataArrayShadowHDF5)
+    """
     thumbs = []
     # look for the Preview directory
     try:
@@ -1487,29 +1545,31 @@ def _thumbFromHDF5(filename):
         # an image? (== has the attribute CLASS: IMAGE)
         if isinstance(ds, h5py.Dataset) and ds.attrs.get("CLASS") == b"IMAGE":
             try:
-                da = _read_image_dataset(ds)
+                md = _read_image_dataset_md(ds)
             except Exception:
                 logging.info("Skipping image '%s' which couldn't be read.", name)
                 continue
 
             if name == "Image":
                 try:
-                    da.metadata = _read_image_info(grp)
+                    md = _read_image_info(grp)
                 except Exception:
                     logging.debug("Failed to parse metadata of acquisition '%s'", name)
                     continue
 
-            thumbs.append(da)
+            thumbs.append(DataArrayShadowHDF5(ds, md, cache=cache))
 
     return thumbs
 
 
-def _dataFromSVIHDF5(f):
+def _shadowsFromSVIHDF5(f, cache=None):
     """
-    Read microscopy data from an HDF5 file using the SVI convention.
+    Find the microscopy data in an HDF5 file using the SVI convention, without
+    reading it.
     Expects to find them as IMAGE in XXX/ImageData/Image + XXX/PhysicalData.
     f (h5py.File): the root of the file
-    return (list of model.DataArray)
+    cache (None or TileCache): cache for the tiles read
+    return (list of DataArrayShadowHDF5)
     """
     data = []
 
@@ -1523,37 +1583,41 @@ def _dataFromSVIHDF5(f):
         except KeyError:
             continue  # not conforming => try next object
 
-        # Read the raw data
+        # Check the raw data
         try:
-            da = _read_image_dataset(image)
+            md = _read_image_dataset_md(image)
         except Exception:
             logging.exception("Failed to read data of acquisition '%s'", obj.name)
+            continue
 
         # TODO: read more metadata
         try:
-            da.metadata.update(_read_image_info(imagedata))
+            md.update(_read_image_info(imagedata))
         except Exception:
             logging.exception("Failed to parse metadata of acquisition '%s'", obj.name)
 
-        das = _parse_physical_data(physicaldata, da)
-        data.extend(das)
+        mds = _read_physical_data(physicaldata, image.shape, md)
+        if len(mds) > 1:
+            # One DataArray per channel
+            data.extend(DataArrayShadowHDF5(image, cmd, (i,), cache) for i, cmd in enumerate(mds))
+        else:
+            data.append(DataArrayShadowHDF5(image, mds[0], cache=cache))
     return data
 
 
-def _dataFromHDF5(filename):
+def _shadowsFromHDF5(f, cache=None):
     """
-    Read microscopy data from an HDF5 file.
-    filename (string): path of the file to read
-    return (list of model.DataArray)
+    Find the microscopy data in an HDF5 file, without reading it.
+    f (h5py.File): the root of the file
+    cache (None or TileCache): cache for the tiles read
+    return (list of DataArrayShadowHDF5)
     """
-    f = h5py.File(filename, "r")
-
     # if follows SVI convention => use the special function
     # If it has at least one directory like XXX/SVIData => it follows SVI conventions
     for obj in f.values():
         if (isinstance(obj, h5py.Group) and
             isinstance(obj.get("SVIData"), h5py.Group)):
-            return _dataFromSVIHDF5(f)
+            return _shadowsFromSVIHDF5(f, cache)
 
     data = []
     # go rough: return any dataset with numbers (and more than one element)
@@ -1568,15 +1632,199 @@ def _dataFromHDF5(filename):
                 return
             # TODO: if it's an image, open it as an image
             # TODO: try to get some metadata?
-            da = model.DataArray(obj[...])
+            da = DataArrayShadowHDF5(obj, {}, cache=cache)
         except Exception:
             logging.info("Skipping '%s' as it doesn't seem a correct data", name)
+            return
         data.append(da)
 
     f.visititems(addIfWorthy)
     return data
 
 
+def _dataFromHDF5(filename):
+    """
+    Read microscopy data from an HDF5 file.
+    filename (string): path of the file to read
+    return (list of model.DataArray)
+    """
+    f = h5py.File(filename, "r")
+    return [das.getData() for das in _shadowsFromHDF5(f)]
+
+
+class DataArrayShadowHDF5(DataArrayShadow):
+    """
+    Represents an image stored in an HDF5 dataset, without holding its data.
+    Only the part of the data requested is read from the file: all of it with
+    getData(), any sub-part with getSubData() (eg, the spectrum of one pixel, or
+    the image at one wavelength), or one tile with getTile(), if the dataset
+    is chunked.
+    """
+
+    def __init__(self, dataset, metadata=None, index=(), cache=None):
+        """
+        dataset (h5py.Dataset): the dataset containing the image
+        metadata (dict str->val): The metadata
+        index (tuple of int): index of the image in the first dimensions of the
+          dataset, if the image is only a part of it (eg, one channel).
+        cache (None or TileCache): cache for the tiles read. Typically, shared
+          between all the images of the file.
+        """
+        self._dataset = dataset
+        self._index = tuple(index)
+        self._cache = cache
+        shape = dataset.shape[len(self._index):]
+        md = metadata if metadata else {}
+        dims = md.get(model.MD_DIMS, "CTZYX"[-len(shape)::])
+
+        # Tiles are only available if the data is chunked along X and Y (and
+        # not RGB, as the colour would be in the tile, with a non-standard order)
+        maxzoom, tile_shape = None, None
+        chunks = dataset.chunks
+        if (chunks is not None and len(dims) == len(shape) and dims.endswith("YX") and
+            not (dims == "CYX" and shape[0] in (3, 4))
+           ):
+            # Read at least TILE_SIZE px per tile, and at least a full chunk.
+            # Tiles are square, as it's what the tile users expect.
+            ts = max(TILE_SIZE, chunks[-1], chunks[-2])
+            tile_shape = (ts, ts)
+            maxzoom = 0
+
+        DataArrayShadow.__init__(self, shape, dataset.dtype, md, maxzoom, tile_shape)
+
+    def getData(self):
+        """
+        Fetches the whole data (at full resolution) of image.
+        return DataArray: the data, with its metadata
+        """
+        return model.DataArray(self._dataset[self._index], self.metadata.copy())
+
+    def __getitem__(self, key):
+        """
+        Selects a part of the data along the high dimensions (ie, all but the
+        last two, typically Y and X), without reading the data.
+        key (int or tuple of int): index in each of the first dimensions.
+        return (DataArrayShadowHDF5): the shadow of the selected data
+        raise IndexError: if the key doesn't only select high dimensions
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        # Selecting a whole dimension is the same as not selecting it
+        while key and key[-1] == slice(None):
+            key = key[:-1]
+
+        if (len(key) > self.ndim - 2 or
+            not all(isinstance(i, (int, numpy.integer)) for i in key)):
+            raise IndexError("Only the %d first dimensions can be selected, with integers, but got %s"
+                             % (self.ndim - 2, key))
+        sel = []
+        for i, l in zip(key, self.shape):
+            if not -l <= i < l:
+                raise IndexError("Index %d is out of bounds for dimension of size %d" % (i, l))
+            sel.append(int(i) % l)
+
+        dims = self.metadata.get(model.MD_DIMS, "CTZYX"[-self.ndim::])
+        md = self.metadata.copy()
+        md[model.MD_DIMS] = dims[len(sel):]
+        return DataArrayShadowHDF5(self._dataset, md, self._index + tuple(sel), self._cache)
+
+    def getSubData(self, key):
+        """
+        Reads a part of the data. Only this part is read from the file.
+        key (int, slice, or tuple of int and slice): the selection, as with a
+          numpy array (but Ellipsis, newaxis and advanced indexing are not supported)
+        return (DataArray): the selected data. The metadata is the same as the
+          whole data, excepted for MD_DIMS, which only has the dimensions kept.
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > self.ndim:
+            raise IndexError("Too many indices (%d) for data with %d dimensions" % (len(key), self.ndim))
+        for k in key:
+            if not isinstance(k, (int, numpy.integer, slice)):
+                raise TypeError("Only integers and slices are supported, but got %s" % (k,))
+
+        data = self._dataset[self._index + key]
+        dims = self.metadata.get(model.MD_DIMS, "CTZYX"[-self.ndim::])
+        md = self.metadata.copy()
+        md[model.MD_DIMS] = "".join(d for i, d in enumerate(dims)
+                                    if i >= len(key) or isinstance(key[i], slice))
+        return model.DataArray(data, md)
+
+    def getTile(self, x, y, zoom, z=None, c=None):
+        """
+        Fetches one tile. Only available if the dataset is chunked.
+        x (0<=int): X index of the tile.
+        y (0<=int): Y index of the tile
+        zoom (0<=int): zoom level to use. As there is no zoom level, only 0 is accepted.
+        z (None or 0<=int): index of the Z plane to read. If None, all the planes
+            are read (if the data has a Z dimension).
+        c (None or 0<=int): index of the channel to read. If None, all the
+            channels are read (if the data has a C dimension).
+        return (DataArray): the tile, with the high dimensions not selected (eg, CTZ),
+          and of shape tile_shape in YX (or less, on the borders).
+        """
+        if not hasattr(self, "maxzoom"):
+            raise ValueError("Data is not chunked, so cannot be read by tiles")
+        if zoom != 0:
+            raise ValueError("Image does not have zoom levels")
+        tw, th = self.tile_shape
+        xp, yp = x * tw, y * th
+        if not (0 <= xp < self.shape[-1] and 0 <= yp < self.shape[-2]):
+            raise IndexError("Tile %d,%d is outside of the image" % (x, y))
+
+        dims = self.metadata.get(model.MD_DIMS, "CTZYX"[-self.ndim::])
+        hsel = {"Z": z, "C": c}
+        for d, i in hsel.items():
+            if d in dims[:-2]:
+                l = self.shape[dims.index(d)]
+                if i is not None and not 0 <= i < l:
+                    raise IndexError("Index %s=%d is out of bounds for dimension of size %d"
+                                     % (d.lower(), i, l))
+            elif i not in (None, 0):
+                raise IndexError("Data has no %s dimension, cannot select %s=%d" % (d, d.lower(), i))
+        sel = tuple(slice(None) if hsel.get(d) is None else hsel[d] for d in dims[:-2])
+
+        key = (self._dataset.name, self._index, z, c, x, y)
+        tile = self._cache.get(key) if self._cache is not None else None
+        if tile is None:
+            tile = self._dataset[self._index + sel + (slice(yp, yp + th), slice(xp, xp + tw))]
+            tile.flags.writeable = False
+            if self._cache is not None:
+                self._cache.put(key, tile)
+
+        tile = model.DataArray(tile, self.metadata.copy())
+        tile.metadata[model.MD_DIMS] = "".join(d for d in dims[:-2] if hsel.get(d) is None) + dims[-2:]
+        if model.MD_PIXEL_SIZE in self.metadata:
+            tile.metadata[model.MD_POS] = get_tile_md_pos((x, y), self.tile_shape, tile, self)
+        return tile
+
+
+class AcquisitionDataHDF5(AcquisitionData):
+    """
+    Implements AcquisitionData for HDF5 files. The file is kept open, and the
+    data is only read when requested.
+    """
+
+    def __init__(self, filename):
+        """
+        filename (str): The name of the HDF5 file
+        """
+        # h5py serializes all the accesses, so it's safe to read from any thread
+        self._file = h5py.File(filename, "r")
+        # Share the cache of tiles between all the images
+        self._cache = TileCache(TILE_CACHE_SIZE)
+        data = _shadowsFromHDF5(self._file, self._cache)
+        thumbnails = _thumbShadowsFromHDF5(self._file, self._cache)
+
+        # Inject filename and in-file index for project management purposes
+        for i, da in enumerate(data):
+            da.metadata[model.MD_FILENAME] = filename
+            da.metadata[model.MD_IN_FILE_INDEX] = i
+
+        AcquisitionData.__init__(self, tuple(data), tuple(thumbnails))
+
+
 def _mergeCorrectionMetadata(da):
     """
     Create a new DataArray with metadata updated to with the correction metadata
@@ -1632,8 +1880,6 @@ def _saveAsHDF5(filename, ldata, thumbnail, compressed=True):
     f.close()
 
 
-# TODO: allow to append data to a file, or any other way to allow saving large
-# data without having everything in memory simultaneously.
 def export(filename, data, thumbnail=None):
     '''
     Write an HDF5 file with the given image and metadata
@@ -1658,6 +1904,174 @@ def export(filename, data, thumbnail=None):
     _saveAsHDF5(filename, data, thumbnail)
 
 
+def _guessRowChunks(shape, itemsize):
+    """
+    Compute a chunk shape adapted to writing an image progressively, row by row.
+    shape (tuple of int): shape of the dataset, the last 2 dimensions are YX
+    itemsize (int): number of bytes per element
+    return (tuple of int): the chunk shape
+    """
+    # A chunk contains only one row, as it avoids compressing again the same
+    # chunk each time a new row is written. The other dimensions are kept
+    # complete if possible, as a row is typically written all at once (eg, all
+    # the wavelengths of a spectrum).
+    hd = list(shape[:-2])
+    while hd and numpy.prod(hd) * itemsize > CHUNK_SIZE:
+        i = hd.index(max(hd))
+        hd[i] = (hd[i] + 1) // 2
+    px_size = int(numpy.prod(hd)) * itemsize
+    width = max(1, min(shape[-1], 1024, CHUNK_SIZE // px_size))
+    return tuple(hd) + (1, width)
+
+
+class HDF5Writer(object):
+    """
+    Writes an HDF5 (SVI) file progressively, for instance while the data is
+    being acquired. This avoids having to keep all the data in memory until the
+    end, and if the acquisition is interrupted, the data written so far is
+    still in the file.
+    Each image is stored as a separate acquisition. The datasets are created
+    (with all their metadata) as soon as the image is added, chunked and
+    resizable, and filled with 0 until the actual data is written.
+    """
+
+    def __init__(self, filename, compression="lzf"):
+        """
+        filename (str): name of the file to create. If it already exists, it
+          is overwritten.
+        compression (None or str): compression filter to use, as supported by
+          h5py. "lzf" is fast, "gzip" compresses more, but is slower.
+        """
+        self._filename = filename
+        self._compression = compression
+        # h5py will extend the current file by default, so we want to make sure
+        # there is no file at all.
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        self._file = h5py.File(filename, "w")
+        self._datasets = []  # HDF Dataset
+        self._mds = []  # dict: the metadata of each image, as passed by the caller
+        self._shapes = []  # tuple of int: the shape of each image, as passed by the caller
+        self._minmax = []  # None or (number, number): the range of each image written so far
+
+    def add_image(self, shape, dtype, metadata):
+        """
+        Create a new (empty) image in the file.
+        shape (tuple of int): the shape of the image, at least 2D, with the last
+          2 dimensions being Y and X.
+        dtype (numpy.dtype): the data type of the image
+        metadata (dict): the metadata of the image. It's written immediately.
+        return (int): the index of the image, to pass to write_rows()
+        """
+        if len(shape) < 2:
+            raise ValueError("Image must be at least 2D, but got shape %s" % (shape,))
+        # Use a placeholder (without memory) to compute the final shape and metadata
+        template = model.DataArray(numpy.broadcast_to(numpy.zeros((), dtype), shape), metadata)
+        template = _adjustDimensions(_mergeCorrectionMetadata(template))
+
+        ga = self._file.create_group("Acquisition%d" % len(self._datasets))
+        gi = ga.create_group("ImageData")
+        _h5py_enum_commit(ga, b"StateEnumeration", _dtstate)
+        # The shuffle filter makes the compression of multi-byte data (eg, uint16)
+        # both faster and more efficient.
+        ids = gi.create_dataset("Image", shape=template.shape, dtype=template.dtype,
+                                chunks=_guessRowChunks(template.shape, template.dtype.itemsize),
+                                maxshape=(None,) * template.ndim, fillvalue=0,
+                                compression=self._compression,
+                                shuffle=self._compression is not None)
+        _set_image_attrs(ids, template, minmax=(0, 0))
+        _add_image_info(gi, ids, template)
+        _add_image_metadata(ga, template, None)
+        _add_svi_info(ga)
+
+        self._datasets.append(ids)
+        self._mds.append(metadata)
+        self._shapes.append(tuple(shape))
+        self._minmax.append(None)
+        return len(self._datasets) - 1
+
+    def write_rows(self, index, data, y):
+        """
+        Write some rows of an image.
+        index (int): the index of the image, as returned by add_image()
+        data (numpy.ndarray): the rows, with the same dimensions as the image,
+          excepted for the Y dimension.
+        y (int): the index of the first row
+        raises IndexError: if the rows are outside of the image
+        """
+        ids = self._datasets[index]
+        # Convert the data to the same dimension order as the dataset
+        data = _adjustDimensions(model.DataArray(data, self._mds[index]))
+        if data.shape[:-2] != ids.shape[:-2] or data.shape[-1] != ids.shape[-1]:
+            raise ValueError("Rows of shape %s don't match image of shape %s" %
+                             (data.shape, ids.shape))
+        h = data.shape[-2]
+        if not 0 <= y <= ids.shape[-2] - h:
+            raise IndexError("Rows %d->%d outside of the image of height %d" %
+                             (y, y + h, ids.shape[-2]))
+        ids[..., y:y + h, :] = data
+
+        # Keep track of the range, to update the image attributes when closing
+        if data.size:
+            dmin, dmax = data.min(), data.max()
+            if self._minmax[index] is not None:
+                dmin = min(dmin, self._minmax[index][0])
+                dmax = max(dmax, self._minmax[index][1])
+            self._minmax[index] = dmin, dmax
+
+    def append(self, data):
+        """
+        Add a complete image to the file.
+        data (DataArray): the image, at least 2D, with its metadata
+        return (int): the index of the image
+        """
+        index = self.add_image(data.shape, data.dtype, data.metadata)
+        self.write_rows(index, data, 0)
+        return index
+
+    def read_image(self, index):
+        """
+        Read back an image written to the file. This allows the caller to not
+        keep in memory the data already written.
+        index (int): the index of the image, as returned by add_image() or append()
+        return (DataArray): the image, with the shape and metadata as originally
+          passed
+        raises ValueError: if the dimensions were reordered when writing the image
+        """
+        ids = self._datasets[index]
+        shape = self._shapes[index]
+        # Only a reshape is needed if the dimensions were only extended to 5D
+        if ids.shape[-len(shape):] != shape or numpy.prod(ids.shape) != numpy.prod(shape):
+            raise ValueError("Cannot read back image of shape %s stored as %s" % (shape, ids.shape))
+        return model.DataArray(ids[()].reshape(shape), dict(self._mds[index]))
+
+    def flush(self):
+        """
+        Ensure all the data written so far is stored on disk.
+        """
+        self._file.flush()
+
+    def close(self):
+        """
+        Finish writing the file. It's fine to call it multiple times.
+        """
+        if not self._file:
+            return
+        for ids, minmax in zip(self._datasets, self._minmax):
+            if minmax is not None and "IMAGE_MINMAXRANGE" in ids.attrs:
+                ids.attrs["IMAGE_MINMAXRANGE"] = list(minmax)
+        self._file.close()
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
 def read_data(filename):
     """
     Read an HDF5 file and return its content (skipping the thumbnail).
@@ -1683,6 +2097,18 @@ def read_data(filename):
     return data
 
 
+def open_data(filename):
+    """
+    Opens an HDF5 file, and returns an AcquisitionData instance. The data is
+    only read when requested (so it's fast to open, even for very large files).
+    filename (str): filename of the file to read
+    return (AcquisitionData): the opened file
+    raises:
+        IOError in case the file format is not as expected.
+    """
+    return AcquisitionDataHDF5(filename)
+
+
 def read_thumbnail(filename):
     """
     Read the thumbnail data of a given HDF5 file.
@@ -20,8 +20,10 @@ import unittest
 import warnings
 from unittest.case import skip
 
+import numpy
+
 from odemis import dataio
-from odemis.dataio import (find_fittest_converter, get_available_formats,
+from odemis.dataio import (TileCache, find_fittest_converter, get_available_formats,
                            get_converter)
 
 
@@ -107,5 +109,39 @@ class TestDataIO(unittest.TestCase):
                    "For '%s', expected format %s but got %s" % (args[0], fmt_exp, fmt_mng.FORMAT))
 
 
+class TestTileCache(unittest.TestCase):
+
+    def test_lru(self):
+        tile = numpy.zeros((16, 16), dtype=numpy.uint16)  # 512 bytes
+        cache = TileCache(3 * tile.nbytes)
+        self.assertIsNone(cache.get("a"))
+
+        for k in ("a", "b", "c"):
+            cache.put(k, tile.copy())
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.nbytes, 3 * tile.nbytes)
+
+        # Access "a", so that "b" is the least recently used
+        self.assertIsNotNone(cache.get("a"))
+        cache.put("d", tile.copy())
+        self.assertEqual(len(cache), 3)
+        self.assertIsNone(cache.get("b"))
+        for k in ("a", "c", "d"):
+            self.assertIsNotNone(cache.get(k))
+
+        # Replacing a tile doesn't count it twice
+        cache.put("d", tile.copy())
+        self.assertEqual(cache.nbytes, 3 * tile.nbytes)
+
+        # Tile bigger than the whole cache => not cached, and nothing dropped
+        cache.put("big", numpy.zeros((64, 64), dtype=numpy.uint16))
+        self.assertIsNone(cache.get("big"))
+        self.assertEqual(len(cache), 3)
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.nbytes, 0)
+
+
 if __name__ == "__main__":
     unittest.main()
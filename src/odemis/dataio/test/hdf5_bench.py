@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Created on 18 Oct 2026
+
+@author: agent
+
+Times the export of a large spectrum cube to HDF5: in one go, at the end, and
+row by row, as an acquisition writes it while it is running. Each compression
+filter is tried, and the file sizes are reported.
+
+Usage:
+python3 -m odemis.dataio.test.hdf5_bench --shape 1024 100 100
+
+Copyright © 2026 agent
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Odemis. If not, see http://www.gnu.org/licenses/.
+'''
+import argparse
+import logging
+import os
+import tempfile
+import time
+
+import numpy
+
+from odemis import model
+from odemis.dataio import hdf5
+from odemis.util import synthetic
+
+
+def generate_spectrum(shape, dtype):
+    """
+    Generate a spectrum cube which compresses approximately like a real
+    acquisition (ie, smooth signal + noise)
+    shape (int, int, int): C, Y, X
+    dtype (numpy.dtype): data type of the data
+    return (DataArray): the data, of shape CTZYX
+    """
+    c, h, w = shape
+    # Spectra are smoother along the wavelength than along the space
+    arr = synthetic.generate_texture((c, h, w), dtype, sigma=(c / 16, 3, 3), noise=0.05)
+    md = {
+        model.MD_DIMS: "CTZYX",
+        model.MD_PIXEL_SIZE: (1e-6, 1e-6),
+        model.MD_POS: (0, 0),
+        model.MD_WL_LIST: list(numpy.linspace(400e-9, 700e-9, c)),
+    }
+    return model.DataArray(arr.reshape(c, 1, 1, h, w), md)
+
+
+def export_speed(fn, data):
+    """
+    Export all the data at once with the standard export function
+    fn (str): the filename
+    data (DataArray): the data to export
+    return (float): the duration of the export (s)
+    """
+    start = time.time()
+    hdf5.export(fn, data)
+    return time.time() - start
+
+
+def write_lines_speed(fn, data, compression):
+    """
+    Write the data progressively, one line at a time
+    fn (str): the filename
+    data (DataArray): the data to write
+    compression (None or str): the compression filter
+    return (float): the duration of the writing (s)
+    """
+    start = time.time()
+    with hdf5.HDF5Writer(fn, compression) as writer:
+        i = writer.add_image(data.shape, data.dtype, data.metadata)
+        for y in range(data.shape[-2]):
+            writer.write_rows(i, data[..., y:y + 1, :], y)
+            writer.flush()
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the speed of the progressive HDF5 writing.")
+    parser.add_argument("--shape", type=int, nargs=3, default=[1024, 100, 100],
+                        help="Shape of the spectrum cube (C, Y, X).")
+    parser.add_argument("--dtype", default="uint16", choices=["uint16", "uint32"],
+                        help="Data type of the data.")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    fd, fn = tempfile.mkstemp(suffix=hdf5.EXTENSIONS[0])
+    os.close(fd)
+    try:
+        data = generate_spectrum(args.shape, numpy.dtype(args.dtype))
+        mb = data.nbytes / 2 ** 20
+        print("Spectrum cube %s (%d MB)" % (data.shape, mb))
+
+        dur = export_speed(fn, data)
+        print("export() with gzip, at the end: %.1f MB/s, file %.1f MB" %
+              (mb / dur, os.path.getsize(fn) / 2 ** 20))
+        for compression in (None, "lzf", "gzip"):
+            dur = write_lines_speed(fn, data, compression)
+            print("Line by line with %s: %.1f MB/s, file %.1f MB" %
+                  (compression, mb / dur, os.path.getsize(fn) / 2 ** 20))
+    finally:
+        os.remove(fn)
+
+
+if __name__ == '__main__':
+    main()
@@ -1476,6 +1476,119 @@ class TestHDF5IO(unittest.TestCase):
         im = rdata[0]
         self.assertEqual(im.metadata[model.MD_ACQ_RECIPES], metadata[model.MD_ACQ_RECIPES])
 
+    def testOpenData(self):
+        """
+        Checks the data can be opened lazily, and only the requested parts read
+        """
+        md = {model.MD_DESCRIPTION: "sem",
+              model.MD_PIXEL_SIZE: (1e-6, 1e-6),
+              model.MD_POS: (1e-3, -2e-3),
+              }
+        sem = model.DataArray(numpy.random.randint(0, 4000, (700, 900), dtype=numpy.uint16), md)
+        mds = {model.MD_DESCRIPTION: "spectrum",
+               model.MD_PIXEL_SIZE: (1e-6, 1e-6),
+               model.MD_POS: (1e-3, -2e-3),
+               model.MD_WL_LIST: list(numpy.linspace(400e-9, 700e-9, 50)),
+               }
+        spec = model.DataArray(numpy.random.randint(0, 500, (50, 1, 1, 30, 40), dtype=numpy.uint16), mds)
+        thumbnail = model.DataArray(numpy.zeros((30, 40, 3), dtype=numpy.uint8))
+        hdf5.export(FILENAME, [sem, spec], thumbnail)
+
+        rdata = hdf5.read_data(FILENAME)
+        acd = hdf5.open_data(FILENAME)
+        self.assertEqual(len(acd.content), 2)
+        self.assertEqual(len(acd.thumbnails), 1)
+        self.assertEqual(acd.thumbnails[0].shape, thumbnail.shape)
+
+        for das, da in zip(acd.content, rdata):
+            self.assertIsInstance(das, model.DataArrayShadow)
+            self.assertEqual(das.shape, da.shape)
+            self.assertEqual(das.dtype, da.dtype)
+            self.assertEqual(das.metadata, da.metadata)
+            numpy.testing.assert_array_equal(das.getData(), da)
+
+        # Spectrum of one pixel, and image at one wavelength
+        sdas = acd.content[1]
+        px_spec = sdas.getSubData((slice(None), 0, 0, 5, 6))
+        numpy.testing.assert_array_equal(px_spec, spec[:, 0, 0, 5, 6])
+        self.assertEqual(px_spec.metadata[model.MD_DIMS], "C")
+        wl_im = sdas.getSubData(12)
+        numpy.testing.assert_array_equal(wl_im, spec[12])
+        self.assertEqual(wl_im.metadata[model.MD_DIMS], "TZYX")
+
+        # Compressed data is chunked => can be read by tile
+        das = acd.content[0]
+        self.assertEqual(das.maxzoom, 0)
+        das2d = das[0, 0, 0]
+        self.assertEqual(das2d.shape, sem.shape)
+        self.assertEqual(das2d.metadata[model.MD_DIMS], "YX")
+        tw, th = das2d.tile_shape
+        tile = das2d.getTile(1, 1, 0)
+        numpy.testing.assert_array_equal(tile, sem[th:2 * th, tw:2 * tw])
+        # The whole image can be recreated from the tiles
+        numpy.testing.assert_array_equal(img.get_merged_raw_image(das2d, 0), sem)
+
+        with self.assertRaises(ValueError):
+            das2d.getTile(0, 0, 1)  # No zoom level
+        with self.assertRaises(IndexError):
+            das2d.getTile(100, 0, 0)
+
+        # Tiles of a spectrum cube contain all the wavelengths, or just one
+        tile = sdas.getTile(0, 0, 0)
+        numpy.testing.assert_array_equal(tile, spec)
+        tile = sdas.getTile(0, 0, 0, c=3)
+        numpy.testing.assert_array_equal(tile, spec[3])
+        self.assertEqual(tile.metadata[model.MD_DIMS], "TZYX")
+
+    def testHDF5Writer(self):
+        """
+        Checks the data can be written progressively, row by row
+        """
+        md = {model.MD_DESCRIPTION: "spectrum",
+              model.MD_PIXEL_SIZE: (1e-6, 1e-6),
+              model.MD_POS: (1e-3, -2e-3),
+              model.MD_WL_LIST: list(numpy.linspace(400e-9, 700e-9, 50)),
+              }
+        spec = model.DataArray(numpy.random.randint(1, 500, (50, 1, 1, 30, 40), dtype=numpy.uint16), md)
+        mdsem = {model.MD_DESCRIPTION: "sem",
+                 model.MD_PIXEL_SIZE: (0.5e-6, 0.5e-6),
+                 model.MD_POS: (1e-3, -2e-3),
+                 }
+        sem = model.DataArray(numpy.random.randint(1, 4000, (60, 80), dtype=numpy.uint16), mdsem)
+
+        for compression in (None, "lzf", "gzip"):
+            with hdf5.HDF5Writer(FILENAME, compression) as writer:
+                ispec = writer.add_image(spec.shape, spec.dtype, spec.metadata)
+                isem = writer.add_image(sem.shape, sem.dtype, sem.metadata)
+                for y in range(spec.shape[-2] - 1):  # Last row never written
+                    writer.write_rows(ispec, spec[..., y:y + 1, :], y)
+                    writer.write_rows(isem, sem[y * 2:y * 2 + 2], y * 2)
+                    writer.flush()
+
+                with self.assertRaises(IndexError):
+                    writer.write_rows(isem, sem[0:4], 58)
+                with self.assertRaises(ValueError):
+                    writer.write_rows(ispec, spec[:10, ..., 0:1, :], 0)
+
+                # The data can be read back, as passed
+                rsem = writer.read_image(isem)
+                self.assertEqual(rsem.shape, sem.shape)
+                numpy.testing.assert_array_equal(rsem[:-2], sem[:-2])
+                self.assertEqual(rsem.metadata[model.MD_DESCRIPTION], "sem")
+
+            rdata = hdf5.read_data(FILENAME)
+            self.assertEqual(len(rdata), 2)
+            rspec, rsem = rdata
+            self.assertEqual(rspec.shape, spec.shape)
+            numpy.testing.assert_array_equal(rspec[..., :-1, :], spec[..., :-1, :])
+            self.assertEqual(rspec[..., -1, :].max(), 0)  # Not written => filled with 0
+            self.assertEqual(rspec.metadata[model.MD_WL_LIST], md[model.MD_WL_LIST])
+            self.assertEqual(rspec.metadata[model.MD_DESCRIPTION], "spectrum")
+            self.assertEqual(rsem.shape[-2:], sem.shape)
+            numpy.testing.assert_array_equal(rsem[0, 0, 0, :-2], sem[:-2])
+            self.assertEqual(rsem.metadata[model.MD_PIXEL_SIZE], mdsem[model.MD_PIXEL_SIZE])
+            self.assertEqual(rsem.metadata[model.MD_POS], mdsem[model.MD_POS])
+
 
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Created on 18 Oct 2026
+
+@author: agent
+
+Measures how fast large images are exported as pyramidal TIFF, once with the
+tiles compressed one after another, and once with several threads. The two
+files written must be byte for byte the same.
+
+Example:
+python3 -m odemis.dataio.test.tiff_bench --size 4000 10000 20000
+
+Copyright © 2026 agent
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Odemis. If not, see http://www.gnu.org/licenses/.
+'''
+import argparse
+import filecmp
+import logging
+import os
+import tempfile
+import time
+
+import numpy
+
+from odemis import model
+from odemis.dataio import tiff
+from odemis.util import synthetic
+
+
+def generate_image(size, dtype):
+    """
+    Generate an image which compresses approximately like a real acquisition
+    (ie, smooth signal + noise)
+    size (int): width and height of the image
+    dtype (numpy.dtype): data type of the image
+    return (DataArray): the image
+    """
+    arr = synthetic.generate_texture((size, size), dtype, sigma=20, noise=0.05)
+    md = {
+        model.MD_DIMS: "YX",
+        model.MD_PIXEL_SIZE: (1e-6, 1e-6),
+        model.MD_POS: (0, 0),
+    }
+    return model.DataArray(arr, md)
+
+
+def export_speed(fn, data, workers):
+    """
+    Export the data as a pyramidal TIFF file
+    fn (str): the filename
+    data (DataArray): the image to export
+    workers (int): number of threads to use
+    return (float): the duration of the export (s)
+    """
+    orig_workers = tiff.MAX_TILE_WRITERS
+    tiff.MAX_TILE_WRITERS = workers
+    try:
+        start = time.time()
+        tiff.export(fn, data, pyramid=True)
+        return time.time() - start
+    finally:
+        tiff.MAX_TILE_WRITERS = orig_workers
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the speed of the pyramidal TIFF export.")
+    parser.add_argument("--size", type=int, nargs="+", default=[2000, 4000, 8000],
+                        help="Width (and height) of the images to export (px).")
+    parser.add_argument("--dtype", default="uint16", choices=["uint8", "uint16"],
+                        help="Data type of the images.")
+    parser.add_argument("--workers", type=int, default=tiff.MAX_TILE_WRITERS,
+                        help="Number of threads for the parallel export.")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    tmpdir = tempfile.mkdtemp()
+    fn_serial = os.path.join(tmpdir, "bench-serial.ome.tiff")
+    fn_parallel = os.path.join(tmpdir, "bench-parallel.ome.tiff")
+    try:
+        for size in args.size:
+            data = generate_image(size, numpy.dtype(args.dtype))
+            mb = data.nbytes / 2 ** 20
+            dur_serial = export_speed(fn_serial, data, 1)
+            dur_parallel = export_speed(fn_parallel, data, args.workers)
+            identical = filecmp.cmp(fn_serial, fn_parallel, shallow=False)
+            print("%d x %d px (%d MB): serial %.1f MB/s, %d threads %.1f MB/s (x%.2f), files %s" %
+                  (size, size, mb, mb / dur_serial, args.workers, mb / dur_parallel,
+                   dur_serial / dur_parallel, "identical" if identical else "DIFFERENT"))
+    finally:
+        for fn in (fn_serial, fn_parallel):
+            if os.path.exists(fn):
+                os.remove(fn)
+        os.rmdir(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -21,14 +21,17 @@ You should have received a copy of the GNU General Public License along with
 Odemis. If not, see http://www.gnu.org/licenses/.
 '''
 # Don't import unicode_literals to avoid issues with external functions. Code works on python2 and python3.
+import filecmp
 import json
 import logging
+import math
 import os
 import re
 import time
 import unittest
 import xml.etree.ElementTree as ET
 from datetime import datetime
+from unittest.mock import patch
 # from unittest.case import skip
 
 import libtiff
@@ -2092,6 +2095,39 @@ class TestTiffIO(unittest.TestCase):
         # this tile is only 2 x 1 in size
         self.assertEqual(tile.shape, (1, 2, 3))
 
+    def testAcquisitionDataTIFFSubData(self):
+        """
+        Check getSubData() reads the right part of a spectrum cube
+        """
+        md = {model.MD_PIXEL_SIZE: (1e-6, 1e-6),
+              model.MD_POS: (1e-3, -2e-3),
+              model.MD_WL_LIST: list(numpy.linspace(400e-9, 700e-9, 20)),
+              }
+        spec = model.DataArray(numpy.random.randint(0, 500, (20, 1, 1, 30, 40), dtype=numpy.uint16), md)
+        tiff.export(FILENAME, spec)
+
+        das = tiff.open_data(FILENAME).content[0]
+        self.assertEqual(das.shape, spec.shape)
+        px_spec = das.getSubData((slice(None), 0, 0, 5, 6))
+        numpy.testing.assert_array_equal(px_spec, spec[:, 0, 0, 5, 6])
+        self.assertEqual(px_spec.metadata[model.MD_DIMS], "C")
+        wl_im = das.getSubData(12)
+        numpy.testing.assert_array_equal(wl_im, spec[12])
+        self.assertEqual(wl_im.metadata[model.MD_DIMS], "TZYX")
+        band = das.getSubData((slice(3, 8), slice(None), 0, slice(2, 10, 3)))
+        numpy.testing.assert_array_equal(band, spec[3:8, :, 0, 2:10:3])
+        self.assertEqual(band.metadata[model.MD_DIMS], "CTYX")
+        with self.assertRaises(IndexError):
+            das.getSubData(20)
+
+        # The images are only read once
+        with patch.object(das, "_readImage", side_effect=AssertionError("image read again")):
+            px_spec = das.getSubData((slice(None), 0, 0, 7, 8))
+        numpy.testing.assert_array_equal(px_spec, spec[:, 0, 0, 7, 8])
+        # The returned data can be modified without changing the next reads
+        px_spec[:] = 0
+        numpy.testing.assert_array_equal(das.getSubData((slice(None), 0, 0, 7, 8)), spec[:, 0, 0, 7, 8])
+
     def testAcquisitionDataTIFFSmallFile(self):
         num_rows = 10
         num_cols = 5
@@ -2177,6 +2213,232 @@ class TestTiffIO(unittest.TestCase):
             rdata.content[0].getTile(0, 0, 0)
 
 
+    def testAcquisitionDataTIFFGetTiles(self):
+        size = (2000, 1500)
+        md = {
+            model.MD_DIMS: 'YX',
+            model.MD_POS: (2e-6, 10e-6),
+            model.MD_PIXEL_SIZE: (1e-6, 1e-6)
+        }
+        arr = numpy.arange(size[0] * size[1], dtype=numpy.uint16).reshape(size)
+        data = model.DataArray(arr, metadata=md)
+        tiff.export(FILENAME, data, pyramid=True)
+
+        rdata = tiff.open_data(FILENAME)
+        dast = rdata.content[0]
+        reqs = []
+        for z in range(dast.maxzoom + 1):
+            # Number of tiles in X and Y at this zoom level
+            nx = math.ceil((size[1] // 2 ** z) / dast.tile_shape[0])
+            ny = math.ceil((size[0] // 2 ** z) / dast.tile_shape[1])
+            reqs.extend((x, y, z) for x in range(min(nx, 3)) for y in range(min(ny, 3)))
+        t_start = time.time()
+        tiles = dast.getTiles(reqs)
+        logging.info("Read %d tiles in %g s", len(reqs), time.time() - t_start)
+        self.assertEqual(len(tiles), len(reqs))
+
+        # Compare with reading one by one, from a new file (=> no cache)
+        rdata2 = tiff.open_data(FILENAME)
+        for (x, y, z), tile in zip(reqs, tiles):
+            tile2 = rdata2.content[0].getTile(x, y, z)
+            numpy.testing.assert_array_equal(tile, tile2)
+            self.assertEqual(tile.metadata[model.MD_POS], tile2.metadata[model.MD_POS])
+            self.assertEqual(tile.metadata[model.MD_PIXEL_SIZE], tile2.metadata[model.MD_PIXEL_SIZE])
+
+        numpy.testing.assert_array_equal(tiles[0], arr[:256, :256])
+        cache = dast.tiff_info['reader'].cache
+        self.assertGreater(cache.nbytes, 0)
+        # The tiles are cached, but modifying the tile returned doesn't change the cache
+        tiles[0][:] = 0
+        numpy.testing.assert_array_equal(dast.getTile(*reqs[0]), arr[:256, :256])
+
+        with self.assertRaises(ValueError):
+            dast.getTiles([(0, 0, 0), (0, 0, dast.maxzoom + 1)])
+
+        # Closing releases all the file handles, and the threads
+        reader = dast.tiff_info['reader']
+        self.assertGreater(len(reader._handles), 0)
+        rdata.close()
+        self.assertEqual(reader._handles, [])
+        self.assertIsNone(reader._executor)
+        # Can still be read (by opening the file again)
+        tiles = dast.getTiles(reqs[-2:])
+        self.assertEqual(len(tiles), 2)
+        rdata.close()
+        rdata2.close()
+
+    def testAcquisitionDataTIFFZStackTiles(self):
+        """
+        Checks the tiles of a pyramidal Z stack can be read plane by plane, and
+        that its maximum intensity projection is available.
+        """
+        size = (4, 600, 700)  # ZYX
+        md = {
+            model.MD_DIMS: "ZYX",
+            model.MD_POS: (2e-6, 10e-6, 5e-6),
+            model.MD_PIXEL_SIZE: (1e-6, 1e-6, 2e-6),
+            model.MD_IN_WL: (500e-9, 520e-9),
+            model.MD_OUT_WL: (600e-9, 630e-9),
+        }
+        arr = numpy.random.randint(0, 4000, size, dtype=numpy.uint16)
+        data = model.DataArray(arr, metadata=md)
+
+        # By default, the projection is not saved
+        tiff.export(FILENAME, data, pyramid=True)
+        rdata = tiff.open_data(FILENAME)
+        self.assertIsNone(rdata.content[0].mip)
+        rdata.close()
+
+        tiff.export(FILENAME, data, pyramid=True, zstack_mip=True)
+
+        # The projection is not part of the data
+        rdata = tiff.open_data(FILENAME)
+        self.assertEqual(len(rdata.content), 1)
+        dast = rdata.content[0]
+        self.assertEqual(dast.shape, (1, 1) + size)
+
+        # All the planes
+        tile = dast.getTile(1, 2, 0)
+        self.assertEqual(tile.shape, (1, 1, 4, 88, 256))
+        self.assertEqual(tile.metadata[model.MD_DIMS], "CTZYX")
+        numpy.testing.assert_array_equal(tile[0, 0], arr[:, 512:, 256:512])
+
+        # One plane
+        for z in range(size[0]):
+            tile = dast.getTile(1, 2, 0, z=z, c=0)
+            self.assertEqual(tile.metadata[model.MD_DIMS], "TYX")
+            numpy.testing.assert_array_equal(tile[0], arr[z, 512:, 256:512])
+
+        with self.assertRaises(IndexError):
+            dast.getTile(0, 0, 0, z=size[0])
+
+        # Only Z left, as the stream would do
+        zstack = dast[0, 0]
+        self.assertEqual(zstack.shape, size)
+        self.assertEqual(zstack.metadata[model.MD_DIMS], "ZYX")
+        tiles = zstack.getTiles([(0, 0, 0), (1, 0, 1)], z=3)
+        numpy.testing.assert_array_equal(tiles[0], arr[3, :256, :256])
+        self.assertEqual(tiles[0].shape, (256, 256))
+        self.assertEqual(tiles[1].shape, (256, 350 - 256))
+        self.assertEqual(tiles[1].metadata[model.MD_PIXEL_SIZE], (2e-6, 2e-6, 2e-6))
+        # Z position of the plane: stack is centred on 5µm
+        self.assertAlmostEqual(tiles[0].metadata[model.MD_POS][2], 5e-6 + 1.5 * 2e-6)
+
+        # Projection, with the same tiles
+        self.assertIsNotNone(zstack.mip)
+        self.assertEqual(zstack.mip.shape, size[1:])
+        self.assertEqual(zstack.mip.maxzoom, zstack.maxzoom)
+        tile = zstack.mip.getTile(2, 1, 0)
+        numpy.testing.assert_array_equal(tile, arr.max(axis=0)[256:512, 512:])
+
+        # Reading the whole data is not affected
+        rarr = tiff.read_data(FILENAME)
+        self.assertEqual(len(rarr), 1)
+        numpy.testing.assert_array_equal(rarr[0][0, 0], arr)
+
+    def testPyramidalTIFFWriter(self):
+        """
+        Check the streaming writer creates the same file as export(pyramid=True),
+        with the zoom levels computed by 2x2 reduction
+        """
+        size = (1030, 700)  # X, Y: not multiples of the tile size
+        md = {
+            model.MD_POS: (5.0, 7.0),
+            model.MD_PIXEL_SIZE: (1e-6, 1e-6),
+            model.MD_DESCRIPTION: "mosaic",
+        }
+        arr = numpy.random.randint(0, 4000, size=size[::-1], dtype=numpy.uint16)
+
+        with tiff.PyramidalTIFFWriter(FILENAME, arr.shape, arr.dtype, md) as writer:
+            # Write the rows of tiles in reverse order, to check the order doesn't matter
+            for y in reversed(range(0, arr.shape[0], tiff.TILE_SIZE)):
+                writer.write_strip(y // tiff.TILE_SIZE, arr[y:y + tiff.TILE_SIZE])
+
+            with self.assertRaises(ValueError):
+                writer.write_tile(0, 0, arr[:10, :10])
+            with self.assertRaises(IndexError):
+                writer.write_tile(5, 0, arr[:256, :256])
+
+        rdata = tiff.open_data(FILENAME)
+        self.assertEqual(len(rdata.content), 1)
+        das = rdata.content[0]
+        self.assertEqual(das.shape, arr.shape)
+        self.assertEqual(das.dtype, arr.dtype)
+        self.assertEqual(das.metadata[model.MD_POS], md[model.MD_POS])
+        self.assertEqual(das.metadata[model.MD_DESCRIPTION], md[model.MD_DESCRIPTION])
+        numpy.testing.assert_array_equal(das.getData(), arr)
+
+        # Same zoom levels as with the standard export
+        self.assertEqual(das.maxzoom, len(tiff._genResizedShapes(model.DataArray(arr))))
+        self.assertEqual(das.maxzoom, 2)
+        exp_zoom = arr
+        for z in range(1, das.maxzoom + 1):
+            exp_zoom = tiff._reduce2x2(exp_zoom)
+            tile = das.getTile(1, 0, z)
+            numpy.testing.assert_array_equal(tile, exp_zoom[:tile.shape[0], 256:256 + tile.shape[1]])
+            self.assertEqual(tile.metadata[model.MD_PIXEL_SIZE], (1e-6 * 2 ** z, 1e-6 * 2 ** z))
+
+    def testPyramidalTIFFWriterRGBMissingTiles(self):
+        """
+        Check the streaming writer supports RGB, and fills the missing tiles with 0's
+        """
+        arr = numpy.random.randint(1, 255, size=(600, 300, 3), dtype=numpy.uint8)
+        md = {model.MD_PIXEL_SIZE: (1e-6, 1e-6), model.MD_POS: (0, 0)}
+        with tiff.PyramidalTIFFWriter(FILENAME, arr.shape, arr.dtype, md) as writer:
+            writer.write_tile(0, 0, arr[:256, :256])
+            writer.write_tile(1, 1, arr[256:512, 256:])
+
+        rdata = tiff.open_data(FILENAME)
+        das = rdata.content[0]
+        self.assertEqual(das.shape, arr.shape)
+        self.assertEqual(das.maxzoom, 1)
+        rarr = das.getData()
+        numpy.testing.assert_array_equal(rarr[:256, :256], arr[:256, :256])
+        numpy.testing.assert_array_equal(rarr[256:512, 256:], arr[256:512, 256:])
+        self.assertFalse(rarr[512:].any())
+        self.assertFalse(rarr[:256, 256:].any())
+        self.assertEqual(das.getTile(0, 0, 1).shape, (256, 150, 3))
+
+    def testPyramidalTIFFWriterError(self):
+        """
+        Check the streaming writer deletes the file if an error happens while writing
+        """
+        arr = numpy.random.randint(1, 255, size=(600, 300), dtype=numpy.uint8)
+        md = {model.MD_PIXEL_SIZE: (1e-6, 1e-6), model.MD_POS: (0, 0)}
+        with self.assertRaises(ValueError):
+            with tiff.PyramidalTIFFWriter(FILENAME, arr.shape, arr.dtype, md) as writer:
+                writer.write_tile(0, 0, arr[:256, :256])
+                writer.write_tile(0, 1, arr[:10, :10])  # Wrong shape
+
+        self.assertFalse(os.path.exists(FILENAME))
+        self.assertEqual(writer._tmp_files, [])
+
+    def testPyramidParallelWrite(self):
+        """
+        Check the pyramidal export with the tiles compressed in parallel creates
+        exactly the same file as the serial export
+        """
+        ldata = [
+            model.DataArray(numpy.random.randint(0, 4000, size=(1000, 1300), dtype=numpy.uint16),
+                            {model.MD_DIMS: "YX"}),
+            model.DataArray(numpy.random.randint(0, 255, size=(700, 530, 3), dtype=numpy.uint8),
+                            {model.MD_DIMS: "YXC"}),
+            model.DataArray(numpy.random.random((600, 600)).astype(numpy.float32),
+                            {model.MD_DIMS: "YX"}),
+        ]
+        fn_serial = "test-serial" + tiff.EXTENSIONS[0]
+        orig_workers = tiff.MAX_TILE_WRITERS
+        try:
+            for data in ldata:
+                tiff.MAX_TILE_WRITERS = 1
+                tiff.export(fn_serial, data, pyramid=True)
+                tiff.MAX_TILE_WRITERS = 4
+                tiff.export(FILENAME, data, pyramid=True)
+                self.assertTrue(filecmp.cmp(fn_serial, FILENAME, shallow=False))
+        finally:
+            tiff.MAX_TILE_WRITERS = orig_workers
+            os.remove(fn_serial)
+
     def testFindImageGroupsAcquiredMultiChannelZStack(self):
         """
         Similar test as above, except we test the images in the format they are actually acquired in:
@@ -2722,6 +2984,38 @@ class TestTileRead(unittest.TestCase):
         except Exception as e:
             self.fail(f"Error reading tiles: {e}")
 
+    def test_zstack_tiled_projection(self):
+        """Test the projection of a pyramidal Z stack only reads the plane displayed"""
+        size = (4, 600, 700)  # ZYX
+        md = {
+            model.MD_DIMS: "ZYX",
+            model.MD_POS: (2e-6, 10e-6, 5e-6),
+            model.MD_PIXEL_SIZE: (1e-6, 1e-6, 2e-6),
+            model.MD_IN_WL: (500e-9, 520e-9),
+            model.MD_OUT_WL: (600e-9, 630e-9),
+        }
+        arr = numpy.random.randint(0, 4000, size, dtype=numpy.uint16)
+        export(PYRAMID_FILENAME, model.DataArray(arr, md), pyramid=True)
+
+        data = open_acquisition(PYRAMID_FILENAME)
+        stream = data_to_static_streams(data)[0]
+        self.assertIsInstance(stream.raw[0], model.DataArrayShadow)
+        self.assertEqual(stream.raw[0].shape, size)
+        proj = RGBSpatialProjection(stream)
+        proj.mpp.value = proj.mpp.range[0]  # full resolution
+
+        for zi in (0, 3):
+            stream.zIndex.value = zi
+            raw = proj.projectAsRaw()
+            numpy.testing.assert_array_equal(raw, arr[zi])
+            # Only this plane was read
+            self.assertEqual(raw.ndim, 2)
+
+        stream.max_projection.value = True
+        raw = proj.projectAsRaw()
+        numpy.testing.assert_array_equal(raw, arr.max(axis=0))
+        self.assertEqual(proj.getRawValue((5, 7)), arr[:, 7, 5].max())
+
 # Not used anymore
 # def rational2float(rational):
 #     """
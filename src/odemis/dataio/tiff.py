@@ -20,7 +20,9 @@ You should have received a copy of the GNU General Public License along with
 Odemis. If not, see http://www.gnu.org/licenses/.
 '''
 import calendar
+import collections
 import configparser
+import ctypes
 import json
 import logging
 import math
@@ -28,10 +30,12 @@ import operator
 import os
 import re
 import statistics
+import tempfile
 import threading
 import time
 import uuid
 import xml.etree.ElementTree as ET
+from concurrent import futures
 from datetime import datetime
 from typing import List, Optional, Union, TextIO, Any, Dict
 
@@ -41,6 +45,7 @@ from libtiff import TIFF
 
 import odemis
 from odemis import model, util
+from odemis.dataio._base import TileCache
 from odemis.model import AcquisitionData, DataArrayShadow
 from odemis.util import fluo, img, spectrum, units
 from odemis.util.conversion import (
@@ -74,6 +79,38 @@ CAN_SAVE_PYRAMID = True # indicates the support for pyramidal export
 TILE_SIZE = 256 # Tile size of pyramidal images
 LOSSY = False
 
+# Maximum memory used to cache the tiles read from a (pyramidal) TIFF file
+TILE_CACHE_SIZE = 256 * 2 ** 20  # bytes
+# Maximum size of the (non-pyramidal) data kept in memory once read, so that reading
+# parts of it (eg, the spectrum of a pixel) doesn't require to read the file again
+SHADOW_CACHE_MAX_BYTES = 256 * 2 ** 20  # bytes
+# Maximum number of threads reading tiles simultaneously from a TIFF file
+MAX_TILE_READERS = min(os.cpu_count() or 1, 8)
+# Maximum number of threads compressing tiles (and computing the zoom levels)
+# simultaneously, when writing a pyramidal TIFF file
+MAX_TILE_WRITERS = min(os.cpu_count() or 1, 8)
+
+# Prototypes of the I/O functions passed to TIFFClientOpen() (libtiff 4)
+_TIFFReadWriteProc = ctypes.CFUNCTYPE(ctypes.c_ssize_t, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_ssize_t)
+_TIFFSeekProc = ctypes.CFUNCTYPE(ctypes.c_uint64, ctypes.c_void_p, ctypes.c_uint64, ctypes.c_int)
+_TIFFCloseProc = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p)
+_TIFFSizeProc = ctypes.CFUNCTYPE(ctypes.c_uint64, ctypes.c_void_p)
+_TIFFMapFileProc = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.POINTER(ctypes.c_void_p),
+                                    ctypes.POINTER(ctypes.c_uint64))
+_TIFFUnmapFileProc = ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint64)
+T.libtiff.TIFFClientOpen.restype = TIFF
+T.libtiff.TIFFClientOpen.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_void_p,
+                                     _TIFFReadWriteProc, _TIFFReadWriteProc, _TIFFSeekProc,
+                                     _TIFFCloseProc, _TIFFSizeProc, _TIFFMapFileProc,
+                                     _TIFFUnmapFileProc]
+
+# For pyramidal Z stacks, the maximum intensity projection can be saved as an extra
+# image at the end of the file (cf export(zstack_mip=True)). It's not referenced by
+# the OME metadata, so it's only used by Odemis. Its ImageDescription refers to
+# the first plane of the stack.
+MIP_DESCRIPTION = "Maximum intensity projection of IFD %d"
+MIP_DESCRIPTION_RE = re.compile(rb"Maximum intensity projection of IFD (\d+)$")
+
 # We try to make it as much as possible looking like a normal (multi-page) TIFF,
 # with as much metadata as possible saved in the known TIFF tags. In addition,
 # we ensure it's compatible with OME-TIFF, which support much more metadata, and
@@ -2048,6 +2085,8 @@ def _saveAsMultiTiffLT(
     uuid_list: List[str] = None,
     pyramid: bool = False,
     imagej: bool = False,
+    zstack_mip: bool = False,
+    executor: Optional[futures.ThreadPoolExecutor] = None,
 ):
     """
     Saves a list of DataArray as a multiple-page TIFF file.
@@ -2061,6 +2100,8 @@ def _saveAsMultiTiffLT(
     :param pyramid: whether the file should be saved in the pyramid format or not.
       In this format, each image is saved along with different zoom levels
     :param imagej: save the metadata in a way that ImageJ can read it
+    :param zstack_mip: save the maximum intensity projection of the (pyramidal) Z stacks
+    :param executor: to write the pyramidal images in parallel
     """
     if multiple_files:
         # Add index
@@ -2189,11 +2230,17 @@ def _saveAsMultiTiffLT(
     if ometxt:
         f.SetField(T.TIFFTAG_IMAGEDESCRIPTION, ometxt)
 
+    # Index of the next IFD written, to be able to refer to the Z stacks
+    ifd = 0 if thumbnail is None else 1
+    zstacks = []  # list of (int, DataArray): IFD of the first plane, Z stack
+
     for fifd, das in sorted_groups:
         if len(das) == 0:
             continue  # Something is wrong
         elif len(das) == 1:
             data = das[0]
+            if pyramid and zstack_mip and _isZStack(data):
+                zstacks.append((ifd, data))
             # Just normal output
             tags = _convertToTiffTag(data.metadata)
             # if metadata indicates YXC format just handle it as RGB
@@ -2228,7 +2275,9 @@ def _saveAsMultiTiffLT(
                     c = None  # libtiff doesn't support compression on these types
                 else:
                     c = compression
-                write_image(f, data[i], write_rgb=write_rgb, compression=c, pyramid=pyramid)
+                write_image(f, data[i], write_rgb=write_rgb, compression=c, pyramid=pyramid,
+                            executor=executor)
+                ifd += 1
 
         else:
             # len(das) > 1 => list of DataArrays to represent the C dimension
@@ -2237,6 +2286,9 @@ def _saveAsMultiTiffLT(
 
             write_rgb = False
             hdim = das[0].shape[:-2]  # 1TZ or TZ or Z
+            if pyramid and zstack_mip:
+                # The planes of each DataArray are interleaved
+                zstacks.extend((ifd + j, d) for j, d in enumerate(das) if _isZStack(d))
 
             for i in numpy.ndindex(*hdim):
                 for data in das:  # for ImageJ compatible ordering
@@ -2251,7 +2303,50 @@ def _saveAsMultiTiffLT(
                         c = None  # libtiff doesn't support compression on these types
                     else:
                         c = compression
-                    write_image(f, data[i], write_rgb=write_rgb, compression=c, pyramid=pyramid)
+                    write_image(f, data[i], write_rgb=write_rgb, compression=c, pyramid=pyramid,
+                                executor=executor)
+                    ifd += 1
+
+    # Save the projection of the Z stacks after all the data, so that it's
+    # possible to display it without reading every plane.
+    for zifd, data in zstacks:
+        _writeMIP(f, data, zifd, compression, executor)
+
+
+def _isZStack(data):
+    """
+    data (DataArray): the data to be saved
+    return (bool): True if the data is a stack of 2D images along Z (and only Z)
+    """
+    dims = data.metadata.get(model.MD_DIMS, "CTZYX"[-data.ndim::])
+    if "Z" not in dims or data.shape[dims.index("Z")] <= 1:
+        return False
+    return all(l == 1 for d, l in zip(dims, data.shape) if d not in "ZYX")
+
+
+def _writeMIP(f, data, ifd, compression=None, executor=None):
+    """
+    Write the maximum intensity projection of a Z stack, as a pyramidal image
+    f (libtiff file handle): Handle of a TIFF file
+    data (DataArray): the Z stack, as accepted by _isZStack()
+    ifd (int): index of the IFD of the first plane of the stack
+    compression (str or None): Compression type to be used on the TIFF file
+    executor (None or ThreadPoolExecutor): to write the image in parallel
+    """
+    dims = data.metadata.get(model.MD_DIMS, "CTZYX"[-data.ndim::])
+    zstack = model.DataArray(data.reshape(data.shape[dims.index("Z"):]), data.metadata)
+    mip = img.max_intensity_projection(zstack, axis=0)
+
+    tags = _convertToTiffTag(mip.metadata)
+    tags[T.TIFFTAG_IMAGEDESCRIPTION] = (MIP_DESCRIPTION % (ifd,)).encode("ascii")
+    for key, val in tags.items():
+        try:
+            f.SetField(key, val)
+        except Exception:
+            logging.exception("Failed to store tag %s with value '%s'", key, val)
+    if mip.dtype in [numpy.int64, numpy.uint64]:
+        compression = None  # libtiff doesn't support compression on these types
+    write_image(f, mip, compression=compression, pyramid=True, executor=executor)
 
 
 def extract_imagej_metadata(ldata) -> str:
@@ -2281,6 +2376,200 @@ def extract_imagej_metadata(ldata) -> str:
     return imagej_description
 
 
+def _setTileFields(f, shape, dtype, compression, write_rgb=False):
+    """
+    Set the TIFF fields describing a tiled image, the same way as TIFF.write_tiles()
+    f (libtiff file handle): Handle of a TIFF file
+    shape (tuple of int): shape of the image, either YX, or YXC for RGB(A)
+    dtype (numpy.dtype): data type of the image
+    compression (None or str or int): Compression type, as accepted by TIFF.write_tiles()
+    write_rgb (boolean): True if the image is RGB (with shape YXC)
+    """
+    dtype = numpy.dtype(dtype)
+    if numpy.issubdtype(dtype, numpy.floating):
+        sample_format = T.SAMPLEFORMAT_IEEEFP
+    elif numpy.issubdtype(dtype, numpy.unsignedinteger) or dtype == bool:
+        sample_format = T.SAMPLEFORMAT_UINT
+    elif numpy.issubdtype(dtype, numpy.signedinteger):
+        sample_format = T.SAMPLEFORMAT_INT
+    else:
+        raise ValueError("Data type %s not supported" % (dtype,))
+
+    compression = TIFF._fix_compression(compression)
+    f.SetField(T.TIFFTAG_COMPRESSION, compression)
+    if compression == T.COMPRESSION_LZW and sample_format != T.SAMPLEFORMAT_IEEEFP:
+        f.SetField(T.TIFFTAG_PREDICTOR, T.PREDICTOR_HORIZONTAL)
+    f.SetField(T.TIFFTAG_BITSPERSAMPLE, dtype.itemsize * 8)
+    f.SetField(T.TIFFTAG_SAMPLEFORMAT, sample_format)
+    f.SetField(T.TIFFTAG_ORIENTATION, T.ORIENTATION_TOPLEFT)
+    f.SetField(T.TIFFTAG_TILEWIDTH, TILE_SIZE)
+    f.SetField(T.TIFFTAG_TILELENGTH, TILE_SIZE)
+    f.SetField(T.TIFFTAG_IMAGEWIDTH, shape[1])
+    f.SetField(T.TIFFTAG_IMAGELENGTH, shape[0])
+    f.SetField(T.TIFFTAG_PLANARCONFIG, T.PLANARCONFIG_CONTIG)
+    if write_rgb:
+        f.SetField(T.TIFFTAG_PHOTOMETRIC, T.PHOTOMETRIC_RGB)
+        f.SetField(T.TIFFTAG_SAMPLESPERPIXEL, shape[2])
+        if shape[2] == 4:  # RGBA
+            f.SetField(T.TIFFTAG_EXTRASAMPLES, [T.EXTRASAMPLE_UNASSALPHA], count=1)
+    else:
+        f.SetField(T.TIFFTAG_PHOTOMETRIC, T.PHOTOMETRIC_MINISBLACK)
+
+
+class _MemoryTIFF(object):
+    """
+    A TIFF file which is only stored in memory (in a bytearray), by passing
+    our own I/O functions to libtiff.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self._pos = 0
+        # Keep a reference to the callbacks, as long as libtiff might call them
+        self._procs = (_TIFFReadWriteProc(self._read), _TIFFReadWriteProc(self._write),
+                       _TIFFSeekProc(self._seek), _TIFFCloseProc(self._close),
+                       _TIFFSizeProc(self._size), _TIFFMapFileProc(self._map),
+                       _TIFFUnmapFileProc(self._unmap))
+
+    def open(self, mode):
+        """
+        Open the file, to be either written (from scratch) or read
+        mode (str): "r" or "w"
+        return (TIFF): libtiff handle, to be closed after use
+        raise IOError: if libtiff failed to open the file
+        """
+        if mode == "w":
+            self.buffer = bytearray()
+        self._pos = 0
+        # "m" prevents libtiff to try to memory-map the file
+        f = T.libtiff.TIFFClientOpen(b"memory", (mode + "m").encode("ascii"), None, *self._procs)
+        if not f:
+            raise IOError("Failed to open TIFF file in memory")
+        return f
+
+    def _read(self, handle, buf, size):
+        data = bytes(self.buffer[self._pos:self._pos + size])
+        ctypes.memmove(buf, data, len(data))
+        self._pos += len(data)
+        return len(data)
+
+    def _write(self, handle, buf, size):
+        end = self._pos + size
+        if end > len(self.buffer):
+            self.buffer.extend(bytes(end - len(self.buffer)))
+        self.buffer[self._pos:end] = ctypes.string_at(buf, size)
+        self._pos = end
+        return size
+
+    def _seek(self, handle, offset, whence):
+        if offset >= 2 ** 63:  # negative offset, passed as unsigned
+            offset -= 2 ** 64
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += len(self.buffer)
+        self._pos = offset
+        return offset
+
+    def _close(self, handle):
+        return 0
+
+    def _size(self, handle):
+        return len(self.buffer)
+
+    def _map(self, handle, base, size):
+        return 0  # Not supported
+
+    def _unmap(self, handle, base, size):
+        pass
+
+
+def _compressTiles(strip, compression, write_rgb=False):
+    """
+    Compress a row of tiles, the same way libtiff does it when writing them
+    strip (numpy.ndarray): the pixels of the row of tiles, of shape
+      TILE_SIZE (or less) x width (x C)
+    compression (None or str or int): Compression type, as accepted by TIFF.write_tiles()
+    write_rgb (boolean): True if the image is RGB (with shape YXC)
+    return (list of bytes): the compressed data of each tile, from left to right
+    """
+    # libtiff doesn't provide a way to just compress data, so the tiles are
+    # written to a TIFF file in memory, stacked vertically, and read back raw.
+    # As the image is exactly the width of a tile, each tile is compressed
+    # exactly as it would be in the final file.
+    ntiles = math.ceil(strip.shape[1] / TILE_SIZE)
+    tiles = numpy.zeros((ntiles * TILE_SIZE, TILE_SIZE) + strip.shape[2:], dtype=strip.dtype)
+    for i in range(ntiles):
+        t = strip[:, i * TILE_SIZE:(i + 1) * TILE_SIZE]
+        tiles[i * TILE_SIZE:i * TILE_SIZE + t.shape[0], :t.shape[1]] = t
+
+    tile_nbytes = tiles.nbytes // ntiles
+    mf = _MemoryTIFF()
+    tf = mf.open("w")
+    try:
+        tf.write_tiles(tiles, TILE_SIZE, TILE_SIZE, compression, write_rgb)
+    finally:
+        tf.close()
+    del tiles
+
+    tf = mf.open("r")
+    try:
+        # Compression can make the data a little bigger in the worse case
+        buf = numpy.empty(tile_nbytes * 2 + 1024, dtype=numpy.uint8)
+        raw_tiles = []
+        for i in range(ntiles):
+            n = T.libtiff.TIFFReadRawTile(tf, i, buf.ctypes.data, buf.nbytes).value
+            if n < 0:
+                raise IOError("Failed to read back compressed tile %d" % (i,))
+            raw_tiles.append(buf[:n].tobytes())
+    finally:
+        tf.close()
+
+    return raw_tiles
+
+
+def _writeTiles(f, arr, compression=None, write_rgb=False, executor=None):
+    """
+    Write an image as tiles, in the current directory, and then write the directory.
+    The output is identical to f.write_tiles(arr, TILE_SIZE, TILE_SIZE, compression, write_rgb),
+    but if an executor is passed, the tiles are compressed in parallel.
+    f (libtiff file handle): Handle of a TIFF file
+    arr (numpy.ndarray): image of shape YX, or YXC for RGB(A)
+    compression (None or str): Compression type to be used on the TIFF file
+    write_rgb (boolean): True if the image is RGB, False if the image is grayscale
+    executor (None or concurrent.futures.Executor): to run the compression
+    """
+    if (executor is None or MAX_TILE_WRITERS <= 1 or
+        TIFF._fix_compression(compression) == T.COMPRESSION_NONE or
+        not (arr.ndim == 2 or (arr.ndim == 3 and write_rgb and arr.shape[2] in (3, 4)))
+       ):
+        # Nothing to parallelize (or special format)
+        f.write_tiles(arr, TILE_SIZE, TILE_SIZE, compression, write_rgb)
+        return
+
+    _setTileFields(f, arr.shape, arr.dtype, compression, write_rgb)
+
+    def write_raw_tiles(raw_tiles):
+        nonlocal tile_idx
+        for raw in raw_tiles:
+            if T.libtiff.TIFFWriteRawTile(f, tile_idx, raw, len(raw)).value < 0:
+                raise IOError("Failed to write tile %d" % (tile_idx,))
+            tile_idx += 1
+
+    # The tiles must be written in order, so only a few rows of tiles are
+    # compressed in advance, to limit the memory usage.
+    tile_idx = 0
+    pending = collections.deque()
+    for yp in range(0, arr.shape[0], TILE_SIZE):
+        pending.append(executor.submit(_compressTiles, arr[yp:yp + TILE_SIZE], compression, write_rgb))
+        if len(pending) > MAX_TILE_WRITERS * 2:
+            write_raw_tiles(pending.popleft().result())
+    while pending:
+        write_raw_tiles(pending.popleft().result())
+
+    f.WriteDirectory()
+
+
 def _genResizedShapes(data):
     """
     Generates a list of tuples with the size of the resized images
@@ -2303,7 +2592,7 @@ def _genResizedShapes(data):
     return resized_shapes
 
 
-def write_image(f, arr, compression=None, write_rgb=False, pyramid=False):
+def write_image(f, arr, compression=None, write_rgb=False, pyramid=False, executor=None):
     """
     f (libtiff file handle): Handle of a TIFF file
     arr (DataArray): DataArray to be written to the file
@@ -2311,6 +2600,8 @@ def write_image(f, arr, compression=None, write_rgb=False, pyramid=False):
     write_rgb (boolean): True if the image is RGB, False if the image is grayscale
     pyramid (boolean): whether the file should be saved in the pyramid format or not.
       In this format, each image is saved along with different zoom levels
+    executor (None or ThreadPoolExecutor): to compute the zoom levels and compress
+      the tiles of a pyramidal image in parallel. If None, a new one is created.
     """
     # if not pyramid, just save the image in the TIFF file, and return
     if not pyramid:
@@ -2321,6 +2612,13 @@ def write_image(f, arr, compression=None, write_rgb=False, pyramid=False):
     # https://docs.openmicroscopy.org/ome-model/6.0.1/ome-tiff/specification.html#sub-resolutions
     # (It should be very similar to the current implementation)
 
+    # The array might be a plane of a larger DataArray (eg, a Z stack), with
+    # the dimensions of the whole DataArray
+    dims = arr.metadata.get(model.MD_DIMS)
+    if dims is not None and len(dims) != arr.ndim:
+        arr = model.DataArray(arr, arr.metadata.copy())
+        arr.metadata[model.MD_DIMS] = dims[-arr.ndim:]
+
     # generate the sizes of the zoom levels to be generated and saved
     resized_shapes = _genResizedShapes(arr)
 
@@ -2330,17 +2628,265 @@ def write_image(f, arr, compression=None, write_rgb=False, pyramid=False):
         # when this tag is present.
         f.SetField(T.TIFFTAG_SUBIFD, [0] * len(resized_shapes))
 
-    # write the original image
-    f.write_tiles(arr, TILE_SIZE, TILE_SIZE, compression, write_rgb)
-    # generate the rescaled images and write the tiled image
-    for resized_shape in resized_shapes:
-        # rescale the image
-        subim = img.rescale_hq(arr, resized_shape)
+    if executor is None:
+        with futures.ThreadPoolExecutor(max_workers=MAX_TILE_WRITERS) as executor:
+            _writePyramid(f, arr, resized_shapes, compression, write_rgb, executor)
+    else:
+        _writePyramid(f, arr, resized_shapes, compression, write_rgb, executor)
+
 
+def _rescaleLevel(prev, shape):
+    """
+    Computes a zoom level from the previous one
+    prev (DataArray or Future returning a DataArray): the previous zoom level
+    shape (tuple of int): the shape of the zoom level
+    return (DataArray): the zoom level
+    """
+    if isinstance(prev, futures.Future):
+        prev = prev.result()
+    return img.rescale_hq(prev, shape)
+
+
+def _writePyramid(f, arr, resized_shapes, compression, write_rgb, executor):
+    """
+    Write an image, and then its zoom levels (as sub-IFDs)
+    f (libtiff file handle): Handle of a TIFF file, with the SUBIFD tag already set
+    arr (DataArray): the full resolution image
+    resized_shapes (list of tuple of int): the shape of each zoom level
+    compression (None or str): Compression type to be used on the TIFF file
+    write_rgb (boolean): True if the image is RGB, False if the image is grayscale
+    executor (ThreadPoolExecutor): to run the computations in parallel
+    """
+    # Generate the rescaled images in the background, while the previous
+    # images are written. Each zoom level is computed from the previous one,
+    # which is 4x smaller than the image before. As they are submitted in order,
+    # the previous zoom level is always already being computed.
+    subims = []
+    prev = arr
+    for s in resized_shapes:
+        prev = executor.submit(_rescaleLevel, prev, s)
+        subims.append(prev)
+
+    # write the original image
+    _writeTiles(f, arr, compression, write_rgb, executor)
+    for fsubim in subims:
+        subim = fsubim.result()
         # Before writting the actual data, we set the special metadata
         f.SetField(T.TIFFTAG_SUBFILETYPE, T.FILETYPE_REDUCEDIMAGE)
         # write the tiled image to the TIFF file
-        f.write_tiles(subim, TILE_SIZE, TILE_SIZE, compression, write_rgb)
+        _writeTiles(f, subim, compression, write_rgb, executor)
+
+
+def _reduce2x2(data):
+    """
+    Halves the size of an image, by averaging each block of 2x2 pixels
+    data (numpy.ndarray): image of shape YX or YXC. If Y or X is odd, the last
+      row or column is dropped (same as the zoom levels of a pyramidal image).
+    return (numpy.ndarray): image of shape Y//2, X//2 (, C), of the same dtype
+    """
+    h, w = data.shape[0] // 2 * 2, data.shape[1] // 2 * 2
+    if numpy.issubdtype(data.dtype, numpy.integer) or data.dtype == bool:
+        acc = data[0:h:2, 0:w:2].astype(numpy.int64)
+    else:
+        acc = data[0:h:2, 0:w:2].astype(numpy.result_type(data.dtype, numpy.float32))
+    acc += data[1:h:2, 0:w:2]
+    acc += data[0:h:2, 1:w:2]
+    acc += data[1:h:2, 1:w:2]
+
+    if acc.dtype == numpy.int64:
+        acc += 2  # To round to the nearest integer
+        acc //= 4
+    else:
+        acc /= 4
+    return acc.astype(data.dtype)
+
+
+class PyramidalTIFFWriter(object):
+    """
+    Writes one 2D image (greyscale YX, or RGB YXC) as a pyramidal TIFF file, by
+    receiving the data progressively, tile by tile (or row of tiles by row of
+    tiles). Contrarily to export(pyramid=True), the whole image is never needed
+    in memory: the full resolution tiles are directly written to the file, and
+    the zoom levels are computed by 2x2 reduction of these tiles, and stored in
+    temporary (memory-mapped) files until the file is closed.
+    Typical usage:
+    with PyramidalTIFFWriter(fn, (h, w), numpy.uint16, md) as writer:
+        for y in range(0, h, TILE_SIZE):
+            writer.write_strip(y // TILE_SIZE, get_rows(y, TILE_SIZE))
+    If an exception is raised within the "with" block, the (partial) file is
+    deleted.
+    """
+
+    def __init__(self, filename, shape, dtype, metadata=None, compressed=True):
+        """
+        filename (str): name of the file to create (including path)
+        shape (tuple of int): shape of the complete image, either YX, or YXC
+          with C = 3 or 4 for RGB(A).
+        dtype (numpy.dtype): data type of the image
+        metadata (dict str->val): metadata of the image, as for a DataArray
+        compressed (bool): whether the file is (LZW) compressed or not
+        """
+        self.filename = filename
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype)
+        md = dict(metadata or {})
+        if len(self.shape) == 2:
+            self._write_rgb = False
+            md[model.MD_DIMS] = "YX"
+        elif len(self.shape) == 3 and self.shape[-1] in (3, 4):
+            self._write_rgb = True
+            md[model.MD_DIMS] = "YXC"
+        else:
+            raise ValueError("Only YX or YXC images can be written, but got shape %s" % (self.shape,))
+
+        if compressed and self.dtype not in (numpy.int64, numpy.uint64):
+            self._compression = T.COMPRESSION_LZW
+        else:
+            # libtiff doesn't support compression on 64-bit types
+            self._compression = T.COMPRESSION_NONE
+
+        # A stand-in of the image, with all the information except the pixels,
+        # to compute the metadata (and zoom levels) the same way as export()
+        empty_da = model.DataArray(numpy.broadcast_to(numpy.zeros((), dtype=self.dtype), self.shape), md)
+        empty_da = _mergeCorrectionMetadata(empty_da)
+        resized_shapes = _genResizedShapes(empty_da)
+
+        # The zoom levels are stored in temporary files next to the final file,
+        # as there is typically more space there than in /tmp (which could be in RAM)
+        tmpdir = os.path.dirname(os.path.abspath(filename))
+        self._tmp_files = []
+        self._levels = []  # numpy.memmap for each zoom level, from 1 to max
+        for s in resized_shapes:
+            tf = tempfile.TemporaryFile(dir=tmpdir)
+            self._tmp_files.append(tf)
+            self._levels.append(numpy.memmap(tf, dtype=self.dtype, mode="w+", shape=s))
+
+        # To detect the tiles not written
+        self._written = numpy.zeros((math.ceil(self.shape[0] / TILE_SIZE),
+                                     math.ceil(self.shape[1] / TILE_SIZE)), dtype=bool)
+        self._tile_buf = numpy.zeros((TILE_SIZE, TILE_SIZE) + self.shape[2:], dtype=self.dtype)
+
+        self._f = TIFF.open(filename, mode='w')
+        self._f.SetField(T.TIFFTAG_IMAGEDESCRIPTION, _convertToOMEMD([empty_da]))
+        for key, val in _convertToTiffTag(empty_da.metadata).items():
+            try:
+                self._f.SetField(key, val)
+            except Exception:
+                logging.exception("Failed to store tag %s with value '%s'", key, val)
+        if self._levels:
+            # LibTIFF will automatically write the next N directories as subdirectories
+            self._f.SetField(T.TIFFTAG_SUBIFD, [0] * len(self._levels))
+        _setTileFields(self._f, self.shape, self.dtype, self._compression, self._write_rgb)
+
+    def write_tile(self, x, y, tile):
+        """
+        Writes one tile of the full resolution image. Each tile should be written
+        only once. They can be written in any order.
+        x (0<=int): X index of the tile
+        y (0<=int): Y index of the tile
+        tile (numpy.ndarray): the pixels of the tile, of shape TILE_SIZE x TILE_SIZE
+          (x C), or smaller if the tile is on the right or bottom border of the image.
+        raise IndexError: if the tile is outside of the image
+        raise ValueError: if the tile doesn't have the expected shape
+        """
+        if not (0 <= y < self._written.shape[0] and 0 <= x < self._written.shape[1]):
+            raise IndexError("Tile %d,%d is outside of the image of %d x %d tiles"
+                             % (x, y, self._written.shape[1], self._written.shape[0]))
+        xp, yp = x * TILE_SIZE, y * TILE_SIZE
+        h = min(TILE_SIZE, self.shape[0] - yp)
+        w = min(TILE_SIZE, self.shape[1] - xp)
+        if tile.shape != (h, w) + self.shape[2:]:
+            raise ValueError("Tile %d,%d should have shape %s, but got %s"
+                             % (x, y, (h, w) + self.shape[2:], tile.shape))
+
+        # Tiles on the border are padded with 0's
+        self._tile_buf[...] = 0
+        self._tile_buf[:h, :w] = tile
+        self._f.WriteTile(self._tile_buf.ctypes.data, xp, yp, 0, 0)
+        self._written[y, x] = True
+
+        if self._levels:
+            # The first zoom level is directly computed from the tile. As TILE_SIZE
+            # is even, the tile corresponds to exactly one block of the zoom level.
+            rtile = _reduce2x2(tile)
+            self._levels[0][yp // 2:yp // 2 + rtile.shape[0], xp // 2:xp // 2 + rtile.shape[1]] = rtile
+
+    def write_strip(self, y, strip):
+        """
+        Writes one row of tiles of the full resolution image
+        y (0<=int): Y index of the row of tiles
+        strip (numpy.ndarray): the pixels of the whole row, of shape
+          TILE_SIZE x image width (x C), or less rows for the bottom row.
+        """
+        for x in range(self._written.shape[1]):
+            self.write_tile(x, y, strip[:, x * TILE_SIZE:(x + 1) * TILE_SIZE])
+
+    def close(self):
+        """
+        Writes the zoom levels and closes the file. Tiles which were not
+        written are filled with 0's.
+        """
+        if self._f is None:
+            return  # Already closed
+
+        missing = numpy.argwhere(~self._written)
+        if len(missing):
+            logging.warning("%d tiles were not written, will fill them with 0's", len(missing))
+            for y, x in missing:
+                h = min(TILE_SIZE, self.shape[0] - y * TILE_SIZE)
+                w = min(TILE_SIZE, self.shape[1] - x * TILE_SIZE)
+                self.write_tile(x, y, numpy.zeros((h, w) + self.shape[2:], dtype=self.dtype))
+        self._f.WriteDirectory()
+
+        # Compute the other zoom levels, each from the previous one, a few rows at a time
+        for prev, level in zip(self._levels[:-1], self._levels[1:]):
+            for yp in range(0, level.shape[0], TILE_SIZE):
+                level[yp:yp + TILE_SIZE] = _reduce2x2(prev[yp * 2:(yp + TILE_SIZE) * 2])
+
+        with futures.ThreadPoolExecutor(max_workers=MAX_TILE_WRITERS) as executor:
+            for level in self._levels:
+                self._f.SetField(T.TIFFTAG_SUBFILETYPE, T.FILETYPE_REDUCEDIMAGE)
+                # Only the part of the memmap which is needed for each tile is read
+                _writeTiles(self._f, level, self._compression, self._write_rgb, executor)
+
+        self._f.close()
+        self._f = None
+        self._release_levels()
+
+    def abort(self):
+        """
+        Stops writing the file, and deletes it. Nothing happens if the file is
+        already closed.
+        """
+        if self._f is None:
+            return  # Already closed
+
+        self._f.close()
+        self._f = None
+        self._release_levels()
+        try:
+            os.remove(self.filename)
+        except OSError:
+            logging.warning("Failed to delete partial file %s", self.filename, exc_info=True)
+
+    def _release_levels(self):
+        """
+        Deletes the temporary files of the zoom levels
+        """
+        self._levels = []
+        for tf in self._tmp_files:
+            tf.close()
+        self._tmp_files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Don't pad or finish a file which is anyway not complete
+            self.abort()
 
 
 def export(
@@ -2351,6 +2897,7 @@ def export(
     multiple_files: bool = False,
     pyramid: bool = False,
     imagej: bool = False,
+    zstack_mip: bool = False,
 ) -> None:
     """
     Write a TIFF file with the given image and metadata
@@ -2370,6 +2917,11 @@ def export(
       files or not.
     :param pyramid: whether to export data as pyramid
     :param imagej: save the metadata in a format compatible with ImageJ
+    :param zstack_mip: if pyramid is True, also save the maximum intensity
+      projection of each Z stack, as an extra pyramidal image at the end of the
+      file. This allows to display it without reading all the planes. Odemis
+      reads it as the .mip of the Z stack, but it's not part of the OME metadata,
+      so other software show it as an extra image, without metadata.
     """
     filename = str(filename)
     if not isinstance(data, list):
@@ -2384,13 +2936,18 @@ def export(
         uuid_list = []
         for i in range(nfiles):
             uuid_list.append(uuid.uuid4().urn)
-        for i in range(nfiles):
-            # TODO: Take care of thumbnails
-            _saveAsMultiTiffLT(filename, data, None, compressed,
-                                multiple_files, i, uuid_list, pyramid, imagej=imagej)
-        return
 
-    _saveAsMultiTiffLT(filename, data, thumbnail, compressed, pyramid=pyramid, imagej=imagej)
+    # Shared by all the pyramidal images (and files), so that the threads are only created once
+    with futures.ThreadPoolExecutor(max_workers=MAX_TILE_WRITERS) as executor:
+        if multiple_files:
+            for i in range(nfiles):
+                # TODO: Take care of thumbnails
+                _saveAsMultiTiffLT(filename, data, None, compressed,
+                                   multiple_files, i, uuid_list, pyramid, imagej=imagej,
+                                   zstack_mip=zstack_mip, executor=executor)
+        else:
+            _saveAsMultiTiffLT(filename, data, thumbnail, compressed, pyramid=pyramid, imagej=imagej,
+                               zstack_mip=zstack_mip, executor=executor)
 
 
 def read_data(filename):
@@ -2474,6 +3031,12 @@ class DataArrayShadowTIFF(DataArrayShadow):
         metadata (dict str->val): The metadata
         """
         self.tiff_info = tiff_info
+        # dir_index (int) -> numpy.array: the images already read, if the data is small enough.
+        # As most selections require to read all the images, it's only worthy if all fit in memory.
+        if numpy.prod(shape) * numpy.dtype(dtype).itemsize <= SHADOW_CACHE_MAX_BYTES:
+            self._images = {}
+        else:
+            self._images = None
 
         DataArrayShadow.__init__(self, shape, dtype, metadata)
 
@@ -2490,6 +3053,67 @@ class DataArrayShadowTIFF(DataArrayShadow):
             image = self._readImage(self.tiff_info)
             return model.DataArray(image, metadata=self.metadata.copy())
 
+    def getSubData(self, key):
+        """
+        Reads a part of the data. When the data is stored as multiple images
+        (eg, one per wavelength), only the images containing this part are read
+        from the file.
+        key (int, slice, or tuple of int and slice): the selection, as with a
+          numpy array (but Ellipsis, newaxis and advanced indexing are not supported)
+        return (DataArray): the selected data. The metadata is the same as the
+          whole data, excepted for MD_DIMS, which only has the dimensions kept.
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > self.ndim:
+            raise IndexError("Too many indices (%d) for data with %d dimensions" % (len(key), self.ndim))
+        for k in key:
+            if not isinstance(k, (int, numpy.integer, slice)):
+                raise TypeError("Only integers and slices are supported, but got %s" % (k,))
+        key = key + (slice(None),) * (self.ndim - len(key))
+
+        dims = self.metadata.get(model.MD_DIMS, "CTZYX"[-self.ndim::])
+        md = self.metadata.copy()
+        md[model.MD_DIMS] = "".join(d for d, k in zip(dims, key) if isinstance(k, slice))
+
+        if not isinstance(self.tiff_info, list):
+            # Just one image => just select from it (copy, to not change the cached image)
+            return model.DataArray(numpy.array(self._readCachedImage(self.tiff_info)[key]), md)
+
+        # Index of the images to read, in each of the high dimensions
+        nh = len(self.tiff_info[0]['hdim_index'])
+        hranges = [range(l)[k] if isinstance(k, slice) else [range(l)[k]]
+                   for k, l in zip(key[:nh], self.shape[:nh])]
+        hshape = tuple(len(r) for r in hranges)
+        imkey = key[nh:]
+        # Shape of the selection within one image, without reading it
+        imshape = numpy.broadcast_to(numpy.empty((), self.dtype), self.shape[nh:])[imkey].shape
+
+        infos = {ti['hdim_index']: ti for ti in self.tiff_info}
+        subset = numpy.empty(hshape + imshape, self.dtype)
+        for idx in numpy.ndindex(hshape):
+            hdim_index = tuple(r[i] for r, i in zip(hranges, idx))
+            subset[idx] = self._readCachedImage(infos[hdim_index])[imkey]
+
+        # Drop the high dimensions selected by an int
+        shape = tuple(l for l, k in zip(hshape, key) if isinstance(k, slice)) + imshape
+        return model.DataArray(subset.reshape(shape), md)
+
+    def _readCachedImage(self, tiff_info):
+        """
+        Reads the image of a given directory, from memory if it was already read
+        tiff_info (dictionary): see _readImage()
+        return (numpy.array): The image. It should not be modified.
+        """
+        if self._images is None:
+            return self._readImage(tiff_info)
+
+        image = self._images.get(tiff_info['dir_index'])
+        if image is None:
+            image = self._readImage(tiff_info)
+            self._images[tiff_info['dir_index']] = image
+        return image
+
     def _readImage(self, tiff_info):
         """
         Reads the image of a given directory
@@ -2525,6 +3149,8 @@ class DataArrayShadowPyramidalTIFF(DataArrayShadowTIFF):
     This class implements the read of a TIFF file
     It has all the useful attributes of a DataArray and the actual data. It also implements
     the reading of a pyramidal TIFF file. IOW, reading subdirectories and tiles.
+    If the data is a Z stack, and its maximum intensity projection was saved in
+    the file, it is available as .mip (otherwise, .mip is None).
     """
 
     def __init__(self, tiff_info, shape, dtype, metadata=None):
@@ -2534,15 +3160,21 @@ class DataArrayShadowPyramidalTIFF(DataArrayShadowTIFF):
             and directory from which the image should be read. It can be a dictionary or
             a list of dictionaries. It is a list of dictionaries when
             the DataArray has multiple pixelData
-            The dictionary (or each dictionary in the list) has 2 values:
+            The dictionary (or each dictionary in the list) has these values:
             'tiff_file' (handle): Handle of the tiff file
             'dir_index' (int): Index of the directory
             'lock' (threading.Lock): The lock that controls the access to the TIFF file
+            'filename' (str): Name of the tiff file
+            'reader' (_TileReader): Reads the tiles, with a cache shared between all
+              the images of the file
+            'hdim_index' (tuple of int): only when it's a list, the index of the
+              image in the high dimensions (ie, all but the dimensions of the image)
         shape (tuple of int): The shape of the corresponding DataArray
         dtype (numpy.dtype): The data type
         metadata (dict str->val): The metadata
         """
         self.tiff_info = tiff_info
+        self._images = None  # Typically large => only the tiles are cached (by the reader)
         if isinstance(tiff_info, list):
             tiff_info0 = tiff_info[0]
         else:
@@ -2567,54 +3199,316 @@ class DataArrayShadowPyramidalTIFF(DataArrayShadowTIFF):
         tile_shape = (num_tcols, num_trows)
 
         DataArrayShadow.__init__(self, shape, dtype, metadata, maxzoom, tile_shape)
+        self.mip = None  # DataArrayShadowPyramidalTIFF of the Z projection (if saved)
 
-    def getTile(self, x, y, zoom):
+    def __getitem__(self, key):
+        """
+        Selects a part of the data along the high dimensions (ie, all but the
+        dimensions of the tiles), without reading the data.
+        key (int or tuple of int): index in each of the first dimensions. The
+          dimensions of the tiles can only be fully selected (ie, with ":").
+        return (DataArrayShadowPyramidalTIFF): the shadow of the selected data
+        raise IndexError: if the key doesn't only select high dimensions
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        # Selecting a whole dimension is the same as not selecting it
+        while key and key[-1] == slice(None):
+            key = key[:-1]
+
+        hdims = self._getHighDims()
+        if len(key) > len(hdims) or not all(isinstance(i, (int, numpy.integer)) for i in key):
+            raise IndexError("Only the %d first dimensions can be selected, with integers, but got %s"
+                             % (len(hdims), key))
+        sel = []
+        for i, l in zip(key, self.shape):
+            if not -l <= i < l:
+                raise IndexError("Index %d is out of bounds for dimension of size %d" % (i, l))
+            sel.append(int(i) % l)
+        sel = tuple(sel)
+
+        n = len(sel)
+        dims = self.metadata.get(model.MD_DIMS, "CTZYX"[-self.ndim::])
+        md = self.metadata.copy()
+        md[model.MD_DIMS] = dims[n:]
+        if n == 0:
+            tiff_info = self.tiff_info
+        elif n == len(hdims):
+            # Only one image left => simple DAS
+            tiff_info = self._selectPlanes(sel)[0][1].copy()
+            del tiff_info['hdim_index']
+        else:
+            tiff_info = []
+            for hi, ti in self._selectPlanes(sel + (None,) * (len(hdims) - n)):
+                ti = ti.copy()
+                ti['hdim_index'] = hi
+                tiff_info.append(ti)
+
+        das = DataArrayShadowTIFF(tiff_info, self.shape[n:], self.dtype, md)
+        if "Z" not in dims[:n]:
+            das.mip = self.mip
+        return das
+
+    def _getHighDims(self):
+        """
+        return (str): the dimensions which are not part of the tiles (eg, "CTZ").
+          Empty if the data is just one image.
+        """
+        if not isinstance(self.tiff_info, list):
+            return ""
+        nhdims = len(self.tiff_info[0]['hdim_index'])
+        dims = self.metadata.get(model.MD_DIMS, "CTZYX"[-self.ndim::])
+        return dims[:nhdims]
+
+    def _selectPlanes(self, sel):
+        """
+        Find the images corresponding to a selection along the high dimensions
+        sel (tuple of (int or None)): for each high dimension, the index to
+          select, or None to select all of them.
+        return (list of (tuple of int, dict)): for each image selected, its index
+          in the high dimensions which are not selected, and its tiff_info
+        """
+        planes = []
+        for ti in self.tiff_info:
+            hi = ti['hdim_index']
+            if all(s is None or s == i for s, i in zip(sel, hi)):
+                planes.append((tuple(i for s, i in zip(sel, hi) if s is None), ti))
+        return planes
+
+    def getTile(self, x, y, zoom, z=None, c=None):
         '''
         Fetches one tile
         x (0<=int): X index of the tile.
         y (0<=int): Y index of the tile
         zoom (0<=int): zoom level to use. The total shape of the image is shape / 2**zoom.
             The number of tiles available in an image is ceil((shape//zoom)/tile_shape)
+        z (None or 0<=int): index of the Z plane to read. If None, all the planes
+            are read (if the data has a Z dimension).
+        c (None or 0<=int): index of the channel to read. If None, all the
+            channels are read (if the data has a C dimension).
         return (DataArray): the shape of the DataArray is typically of shape
+            the tile shape, preceded by the high dimensions not selected (eg, ZYX).
         '''
+        return self.getTiles([(x, y, zoom)], z=z, c=c)[0]
+
+    def getTiles(self, tiles, z=None, c=None):
+        '''
+        Fetches multiple tiles. The tiles are read (and decompressed) in parallel,
+        so it's faster than calling getTile() for each tile.
+        tiles (list of (0<=int, 0<=int, 0<=int)): X index, Y index and zoom level
+          of each tile, as in getTile()
+        z (None or 0<=int): index of the Z plane to read, as in getTile()
+        c (None or 0<=int): index of the channel to read, as in getTile()
+        return (list of DataArray): the tiles, in the same order as requested
+        '''
+        hdims = self._getHighDims()
+        sel = {"Z": z, "C": c}
+        for d, i in sel.items():
+            if d in hdims:
+                l = self.shape[hdims.index(d)]
+                if i is not None and not 0 <= i < l:
+                    raise IndexError("Index %s=%d is out of bounds for dimension of size %d"
+                                     % (d.lower(), i, l))
+            elif i not in (None, 0):
+                raise IndexError("Data has no %s dimension, cannot select %s=%d" % (d, d.lower(), i))
+
         # get information about how to retrieve the actual pixels from the TIFF file
-        tiff_info = self.tiff_info
-        if isinstance(tiff_info, list):
-            # TODO Implement the reading of the subdata when tiff_info is a list.
-            # It is the case when the DataArray has multiple pixelData (eg, when data has more than 2D).
-            raise NotImplementedError("DataArray has multiple pixelData")
+        if isinstance(self.tiff_info, list):
+            # Multiple images (eg, data has more than 2D) => only read the selected ones
+            planes = self._selectPlanes(tuple(sel.get(d) for d in hdims))
+            dims = self.metadata.get(model.MD_DIMS, "CTZYX"[-self.ndim::])
+            tdims = "".join(d for d in hdims if sel.get(d) is None) + dims[len(hdims):]
+            hshape = tuple(l for d, l in zip(hdims, self.shape) if sel.get(d) is None)
+        else:
+            planes = [((), self.tiff_info)]
+            tdims = None  # Same as the original data
+            hshape = ()
+
+        requests = []
+        for x, y, zoom in tiles:
+            if zoom != 0 and self.maxzoom == 0:
+                raise ValueError("Image does not have zoom levels")
+            if not (0 <= zoom <= self.maxzoom):
+                raise ValueError("Invalid Z value %d" % (zoom,))
+            xp = x * self.tile_shape[0]
+            yp = y * self.tile_shape[1]
+            for _, ti in planes:
+                requests.append((ti['filename'], ti['dir_index'], zoom, xp, yp))
+
+        tiles_data = planes[0][1]['reader'].read_tiles(requests)
+
+        das = []
+        nplanes = len(planes)
+        for i, (x, y, zoom) in enumerate(tiles):
+            tplanes = tiles_data[i * nplanes:(i + 1) * nplanes]
+            if hshape:
+                # Stack all the planes of the tile
+                tile = numpy.empty(hshape + tplanes[0].shape, dtype=tplanes[0].dtype)
+                for (hi, _), td in zip(planes, tplanes):
+                    tile[hi] = td
+            else:
+                # The tiles read are shared with the cache (read-only) => copy
+                tile = tplanes[0].copy()
+            das.append(self._createTile(x, y, zoom, tile, tdims, z))
 
-        with tiff_info['lock']:
-            tiff_file = tiff_info['handle']
-            tiff_file.SetDirectory(tiff_info['dir_index'])
+        return das
 
-            if zoom != 0:
-                # get an array of offsets, one for each subimage
-                sub_ifds = tiff_file.GetField(T.TIFFTAG_SUBIFD)
-                if not sub_ifds:
-                    raise ValueError("Image does not have zoom levels")
+    def _createTile(self, x, y, zoom, tile, dims=None, z=None):
+        '''
+        Creates the DataArray of a tile, with the metadata corresponding to its position
+        x (0<=int): X index of the tile.
+        y (0<=int): Y index of the tile
+        zoom (0<=int): zoom level of the tile
+        tile (numpy.ndarray): the pixels of the tile
+        dims (None or str): the dimensions of the tile, if different from the
+          original data
+        z (None or 0<=int): the Z plane of the tile, if only one was selected
+        return (DataArray): the tile
+        '''
+        orig_pixel_size = self.metadata.get(model.MD_PIXEL_SIZE, (1, 1))
+
+        # calculate the pixel size of the tile for the zoom level (Z is not zoomed)
+        tile_pixel_size = (tuple(ps * 2 ** zoom for ps in orig_pixel_size[:2]) +
+                           tuple(orig_pixel_size[2:]))
+
+        tile = model.DataArray(tile, self.metadata.copy())
+        tile.metadata[model.MD_PIXEL_SIZE] = tile_pixel_size
+        if dims is not None:
+            tile.metadata[model.MD_DIMS] = dims
+        # calculate the center of the tile
+        pos = get_tile_md_pos((x, y), self.tile_shape, tile, self)
+        hdims = self._getHighDims()
+        if z is not None and "Z" in hdims and len(pos) == 3 and len(orig_pixel_size) == 3:
+            # The position of the data is the center of the Z stack => move to the plane
+            nz = self.shape[hdims.index("Z")]
+            pos = pos[:2] + (pos[2] + (z - (nz - 1) / 2) * orig_pixel_size[2],)
+        tile.metadata[model.MD_POS] = pos
+        return tile
 
-                if not (0 <= zoom <= len(sub_ifds)):
-                    raise ValueError("Invalid Z value %d" % (zoom,))
 
-                # set the offset of the subimage. Z=0 is the main image
-                tiff_file.SetSubDirectory(sub_ifds[zoom - 1])
+class _TileReader(object):
+    '''
+    Reads the tiles of the TIFF files of an AcquisitionDataTIFF. Each thread has
+    its own handle on the files, so that the tiles can be read (and decompressed)
+    in parallel. The latest tiles read are kept in a cache, shared by all the
+    DataArrayShadows of the AcquisitionDataTIFF.
+    '''
+
+    def __init__(self, cache_size=TILE_CACHE_SIZE):
+        '''
+        cache_size (0<=int): maximum number of bytes used to cache the tiles
+        '''
+        self.cache = TileCache(cache_size)
+        # .handles: dict str -> [TIFF, (int, int) or None]: filename -> handle,
+        # and directory index + zoom level currently selected
+        self._local = threading.local()
+        # All the handles opened, from any thread, to be able to close them
+        self._handles = []
+        self._handles_lock = threading.Lock()
+        self._executor = None  # Created on first need
+        self._executor_lock = threading.Lock()
+
+    def close(self):
+        '''
+        Stops the reading threads and closes all the files. Tiles can still be
+        read afterwards, in which case the files are opened again.
+        '''
+        self._close(wait=True)
+
+    def _close(self, wait):
+        '''
+        wait (bool): whether to wait for the reading threads to end. If False,
+          no tile should be currently read.
+        '''
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait)
+                self._executor = None
+
+        with self._handles_lock:
+            handles, self._handles = self._handles, []
+            # Forget the handles of every thread
+            self._local = threading.local()
+        for h in handles:
+            h[0].close()
+
+    def __del__(self):
+        try:
+            # Nothing can be reading anymore, and it could be called from a reading thread
+            self._close(wait=False)
+        except Exception:
+            logging.exception("Failed to close the TIFF tile reader")
 
-            orig_pixel_size = self.metadata.get(model.MD_PIXEL_SIZE, (1, 1))
+    def _getHandle(self, filename):
+        '''
+        return (list of TIFF, (int, int) or None): the handle of the file for the
+          current thread, and the directory + zoom level currently selected
+        '''
+        try:
+            handles = self._local.handles
+        except AttributeError:
+            handles = self._local.handles = {}
 
-            # calculate the pixel size of the tile for the zoom level
-            tile_pixel_size = tuple(ps * 2 ** zoom for ps in orig_pixel_size)
+        try:
+            return handles[filename]
+        except KeyError:
+            h = [TIFF.open(filename, mode='r'), None]
+            handles[filename] = h
+            with self._handles_lock:
+                self._handles.append(h)
+            return h
 
-            xp = x * self.tile_shape[0]
-            yp = y * self.tile_shape[1]
-            tile = tiff_file.read_one_tile(xp, yp)
-            tile = model.DataArray(tile, self.metadata.copy())
-            tile.metadata[model.MD_PIXEL_SIZE] = tile_pixel_size
-            # calculate the center of the tile
-            tile.metadata[model.MD_POS] = get_tile_md_pos((x, y), self.tile_shape, tile, self)
+    def read_tile(self, filename, dir_index, zoom, xp, yp):
+        '''
+        Reads one tile, from the cache if possible
+        filename (str): the TIFF file
+        dir_index (int): index of the (main) directory of the image
+        zoom (0<=int): zoom level (0 is the main image)
+        xp (0<=int): X coordinate of a pixel inside the tile
+        yp (0<=int): Y coordinate of a pixel inside the tile
+        return (numpy.ndarray): the tile (read-only, as it's shared via the cache)
+        '''
+        key = (filename, dir_index, zoom, xp, yp)
+        tile = self.cache.get(key)
+        if tile is not None:
+            return tile
+
+        h = self._getHandle(filename)
+        tfile = h[0]
+        if h[1] != (dir_index, zoom):
+            # Changing directory is slow, so only do it when needed
+            h[1] = None  # In case it fails
+            tfile.SetDirectory(dir_index)
+            if zoom != 0:
+                # get an array of offsets, one for each subimage
+                sub_ifds = tfile.GetField(T.TIFFTAG_SUBIFD)
+                if not sub_ifds or not (0 <= zoom <= len(sub_ifds)):
+                    raise ValueError("Invalid Z value %d" % (zoom,))
+                # set the offset of the subimage. Z=0 is the main image
+                tfile.SetSubDirectory(sub_ifds[zoom - 1])
+            h[1] = (dir_index, zoom)
 
+        tile = tfile.read_one_tile(xp, yp)
+        tile.flags.writeable = False
+        self.cache.put(key, tile)
         return tile
 
+    def read_tiles(self, requests):
+        '''
+        Reads multiple tiles in parallel
+        requests (list of (str, int, int, int, int)): the arguments of read_tile()
+          for each tile
+        return (list of numpy.ndarray): the tiles, in the same order as requested
+        '''
+        if len(requests) <= 1:
+            return [self.read_tile(*r) for r in requests]
+
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = futures.ThreadPoolExecutor(max_workers=MAX_TILE_READERS,
+                                                            thread_name_prefix="TIFF tile reader")
+        return list(self._executor.map(lambda r: self.read_tile(*r), requests))
+
 
 class AcquisitionDataTIFF(AcquisitionData):
     """
@@ -2628,6 +3522,8 @@ class AcquisitionDataTIFF(AcquisitionData):
         # lock to avoid race conditions when accessing the TIFF file (as libtiff
         # uses multiple calls to access a specific IFD/tile + tag.
         self._lock = threading.Lock()
+        # Reads the tiles of all the DataArrayShadows, with a shared cache
+        self._tile_reader = _TileReader()
         tiff_file = TIFF.open(filename, mode='r')
         try:
             data, thumbnails = self._getAllOMEDataArrayShadows(filename, tiff_file)
@@ -2652,6 +3548,13 @@ class AcquisitionDataTIFF(AcquisitionData):
 
         AcquisitionData.__init__(self, tuple(data), tuple(thumbnails))
 
+    def close(self):
+        """
+        Closes the files and stops the threads used to read the tiles. It's not
+        required, as it's also done once all the DataArrayShadows are deleted.
+        """
+        self._tile_reader.close()
+
     def _getAllDataArrayShadows(self, filename: str, tfile, lock):
         """
         Create the all DataArrayShadows for the given TIFF file
@@ -2668,7 +3571,7 @@ class AcquisitionDataTIFF(AcquisitionData):
         thumbnails = []
         # iterates all the directories of the TIFF file
         for dir_index in self._iterDirectories(tfile):
-            das, is_thumb = self._createDataArrayShadows(filename, tfile, dir_index, lock)
+            das, is_thumb = self._createDataArrayShadows(filename, tfile, dir_index, lock, self._tile_reader)
             if is_thumb:
                 data.append(None)
                 thumbnails.append(das)
@@ -2746,7 +3649,13 @@ class AcquisitionDataTIFF(AcquisitionData):
                 data, thumbnails = self._getAllDataArrayShadows(filename, tfile, self._lock)
 
             _updateMDFromOME(omeroot, data)
+            # The projections of the Z stacks are not in the OME metadata, so
+            # they are dropped when folding, and attached back to their Z stack.
+            mips = {(d.tiff_info['filename'], d.tiff_info['mip_of']): d for d in data
+                    if d is not None and 'mip_of' in d.tiff_info}
             data = AcquisitionDataTIFF._foldArrayShadowsFromOME(omeroot, data)
+            if mips:
+                self._attachMIPs(data, mips)
         except Exception:
             logging.exception("Failed to decode OME XML")
             raise ValueError("Failure during OME XML decoding")
@@ -2755,6 +3664,31 @@ class AcquisitionDataTIFF(AcquisitionData):
         data = [i for i in data if i is not None]
         return data, thumbnails
 
+    @staticmethod
+    def _attachMIPs(das, mips):
+        """
+        Set the .mip attribute of the Z stacks
+        das (list of DataArrayShadows): the data of the file
+        mips (dict (str, int) -> DataArrayShadow): filename and directory index
+          of the first plane of a Z stack -> projection of the Z stack
+        """
+        for da in das:
+            if not isinstance(da, DataArrayShadowPyramidalTIFF) or not isinstance(da.tiff_info, list):
+                continue
+            tiff_info0 = da.tiff_info[0]  # the first plane
+            try:
+                mip = mips[(tiff_info0['filename'], tiff_info0['dir_index'])]
+            except KeyError:
+                continue
+            if not isinstance(mip, DataArrayShadowPyramidalTIFF):
+                logging.warning("Projection of Z stack at IFD %d is not pyramidal, ignoring it",
+                                tiff_info0['dir_index'])
+                continue
+            # Same metadata as the Z stack, as it's not in the OME metadata
+            mip.metadata = da.metadata.copy()
+            mip.metadata[model.MD_DIMS] = "YX"
+            da.mip = mip
+
     def _findFileByUUID(self, suuid, orig_fn, root_fn):
         """
         Find the file with the given UUID. In addition to immediately
@@ -2846,12 +3780,13 @@ class AcquisitionDataTIFF(AcquisitionData):
         raise LookupError("No OME XML data found")
 
     @staticmethod
-    def _createDataArrayShadows(filename: str, tfile, dir_index, lock):
+    def _createDataArrayShadows(filename: str, tfile, dir_index, lock, tile_reader):
         """
         Create the DataArrayShadow from the TIFF metadata for the current directory
         tfile (tiff handle): Handle for the TIFF file
         dir_index (int): Index of the directory in the TIFF file
         lock (threading.Lock): The lock that controls the access to the TIFF file
+        tile_reader (_TileReader): The reader to use to access the tiles
         return:
             das (DataArrayShadows): DataArrayShadows representing the image
             is_thumbnail (bool): True if the image is a thumbnail
@@ -2878,8 +3813,15 @@ class AcquisitionDataTIFF(AcquisitionData):
         # and it is not a part of DataArrayShadow class
         # It can also be a a list of tiff_info,
         # in case the DataArray has multiple pixelData (eg, when data has more than 2D).
-        # Add also the lock of the TIFF file
-        tiff_info = {'handle': tfile, 'dir_index': dir_index, 'lock': lock}
+        # Add also the lock of the TIFF file, and what is needed to read the
+        # tiles (from any thread)
+        tiff_info = {'handle': tfile, 'dir_index': dir_index, 'lock': lock,
+                     'filename': filename, 'reader': tile_reader}
+        # If it's the projection of a Z stack, remember which one
+        desc = tfile.GetField(T.TIFFTAG_IMAGEDESCRIPTION)
+        m = MIP_DESCRIPTION_RE.match(desc) if desc else None
+        if m:
+            tiff_info['mip_of'] = int(m.group(1))
         das = DataArrayShadowTIFF(tiff_info, shape, typ, md)
 
         return das, _isThumbnail(tfile)
@@ -3019,8 +3961,6 @@ class AcquisitionDataTIFF(AcquisitionData):
         if len(tiff_info_list) == 1:
             # Optimisation: if there is actually only one (because it's split
             # over C), make it a simple DAS.
-            # That's especially useful for now, as Pyramidal DAS don't support
-            # high dimensions yet.
             tiff_info_list = tiff_info_list[0]
             del tiff_info_list['hdim_index']
             tshape = fim.shape
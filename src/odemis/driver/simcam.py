@@ -29,13 +29,15 @@ from builtins import str
 
 import numpy
 from PIL import Image, ImageDraw, ImageFont
-from scipy import ndimage
 
 from odemis import dataio, model, util
 from odemis.model import oneway
+from odemis.util.imports import lazy_import
 from odemis.util.synthetic import ParabolicMirrorRayTracer
 from odemis.util.synthetic import simulate_peak
 
+ndimage = lazy_import("scipy.ndimage")
+
 ERROR_STATE_FILE = "simcam-hw.error"
 GOFFSET_TO_PIXEL = 0.25  # Conversion factor for grating offset to image pixels.
 PEAK_WIDTH = 2.5  # Width of the simulated spectrograph peak in pixels (before binning).
@@ -30,13 +30,15 @@ import numpy
 from odemis import model, util, dataio
 from odemis.model import isasync, oneway, roattribute
 from odemis.util import img
+from odemis.util.imports import lazy_import
 import os
 import random
-from scipy import ndimage
 import threading
 import time
 import weakref
 
+ndimage = lazy_import("scipy.ndimage")
+
 
 class SimSEM(model.HwComponent):
     '''
@@ -123,6 +123,7 @@ class SparcAcquiController(object):
         self.btn_change_file = self._tab_panel.btn_sparc_change_file
         self.btn_cancel = self._tab_panel.btn_sparc_cancel
         self.acq_future = None
+        self._flush_files = {}  # SEMCCDMDStream -> filename where its data is written during acquisition
         self.gauge_acq = self._tab_panel.gauge_sparc_acq
         self.lbl_acqestimate = self._tab_panel.lbl_sparc_acq_estimate
         self.lbl_fold_acq = self._tab_panel.lbl_sparc_fold_acq
@@ -458,6 +459,8 @@ class SparcAcquiController(object):
         if len(self._tab_data_model.acquisitionStreams) > len(folds):
             self.lbl_acqestimate.SetLabel("EBIC and CL streams acquired simultaneously")
 
+        self._set_flush_files(folds)
+
         # start acquisition
         self.acq_future = acqmng.acquire(folds, self._main_data_model.settings_obs)
 
@@ -467,6 +470,39 @@ class SparcAcquiController(object):
                                                                 self.lbl_acqestimate)
         self.acq_future.add_done_callback(self.on_acquisition_done)
 
+    def _set_flush_files(self, streams):
+        """
+        Configure the streams which support it to write their data to a file during the
+        acquisition, next to the final file. So if the acquisition fails (or Odemis crashes),
+        the data acquired so far is not lost.
+        streams (iterable of Streams): the streams which are going to be acquired
+        """
+        fn_root, _ = splitext(self.filename.value)
+        self._flush_files = {}
+        for s in streams:
+            if isinstance(s, stream.SEMCCDMDStream):
+                s.flush_filename = f"{fn_root}-partial{len(self._flush_files) + 1}.h5"
+                self._flush_files[s] = s.flush_filename
+
+    def _clean_flush_files(self, keep=False):
+        """
+        Stop writing the streams data during the acquisition, and remove the files written
+        keep (bool): if True, the files are not deleted, as they contain data not saved otherwise
+        """
+        for s, fn in self._flush_files.items():
+            s.flush_filename = None
+            if keep:
+                if os.path.exists(fn):
+                    logging.warning("Data acquired so far kept in %s", fn)
+                continue
+            try:
+                os.remove(fn)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                logging.warning("Failed to delete file %s", fn, exc_info=True)
+        self._flush_files = {}
+
     def on_cancel(self, evt):
         """
         Called during acquisition when pressing the cancel button
@@ -502,10 +538,17 @@ class SparcAcquiController(object):
                 for d in data:
                     d.metadata[model.MD_ACQ_RECIPES] = recipes
             exporter = dataio.get_converter(self.conf.last_format)
-            exporter.export(filename, data, thumb)
+            try:
+                exporter.export(filename, data, thumb)
+            except Exception:
+                # The data is still in the files written during the acquisition
+                self._clean_flush_files(keep=True)
+                raise
             logging.info("Acquisition saved as file '%s'.", filename)
         else:
             logging.debug("Not saving into file '%s' as there is no data", filename)
+        # All the data acquired is in the final file
+        self._clean_flush_files()
 
         return data, exp, filename
 
@@ -523,6 +566,7 @@ class SparcAcquiController(object):
         try:
             data, exp = future.result()
         except CancelledError:
+            self._clean_flush_files()
             # hide progress bar (+ put pack estimated time)
             self.gauge_acq.Hide()
             # don't change filename => we can reuse it
@@ -531,6 +575,7 @@ class SparcAcquiController(object):
         except Exception as exp:
             # leave the gauge, to give a hint on what went wrong.
             logging.exception("Acquisition failed")
+            self._clean_flush_files(keep=True)
             self._reset_acquisition_gui("Acquisition failed (see log panel).",
                                         level=logging.WARNING,
                                         keep_filename=True)
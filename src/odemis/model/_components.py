@@ -69,6 +69,17 @@ def hasVA(component, vaname):
     return isinstance(getattr(component, vaname, None), _vattributes.VigilantAttributeBase)
 
 
+def _getVA(component, vaname):
+    """
+    return (VigilantAttributeBase): the VA with the given name
+    raise AttributeError: if the component has no such VA
+    """
+    va = getattr(component, vaname)
+    if not isinstance(va, _vattributes.VigilantAttributeBase):
+        raise AttributeError("%s is not a VigilantAttribute" % (vaname,))
+    return va
+
+
 def getROAttributes(component):
     """
     returns (dict of name -> value): all the names of the roattributes and their values
@@ -174,6 +185,48 @@ class Component(ComponentBase):
     def name(self):
         return self._name
 
+    def getVAValues(self, names):
+        """
+        Read the value of multiple VigilantAttributes at once. Remotely, it is
+        done in a single call, which is much faster than reading each VA.
+        names (iterable of str): names of the VAs
+        return:
+          values (dict str -> value): VA name -> value, for the VAs which could be read
+          errors (dict str -> Exception): VA name -> error, for the VAs which couldn't be read
+        """
+        values = {}
+        errors = {}
+        for n in names:
+            try:
+                values[n] = _getVA(self, n).value
+            except Exception as ex:
+                errors[n] = ex
+        return values, errors
+
+    def setVAValues(self, values):
+        """
+        Change the value of multiple VigilantAttributes at once. Remotely, it is
+        done in a single call, which is much faster than setting each VA.
+        If setting a VA fails, the next ones are still set.
+        values (dict str -> value): VA name -> new value. They are set in the
+          order of the dict.
+        return:
+          values (dict str -> value): VA name -> value accepted, for the VAs
+            which could be set.
+          errors (dict str -> Exception): VA name -> error, for the VAs which
+            couldn't be set.
+        """
+        accepted = {}
+        errors = {}
+        for n, v in values.items():
+            try:
+                va = _getVA(self, n)
+                va.value = v
+                accepted[n] = va.value
+            except Exception as ex:
+                errors[n] = ex
+        return accepted, errors
+
     def terminate(self):
         """
         Stop the Component from executing.
@@ -241,8 +294,45 @@ class ComponentProxy(ComponentBase, Pyro4.Proxy):
         _core.load_roattributes(self, roattributes)
         _dataflow.load_dataflows(self, dataflows)
         _vattributes.load_vigilant_attributes(self, vas)
+        # Setting a VA can change the value of other ones
+        _vattributes.share_va_cache(vas.values())
         _dataflow.load_events(self, events)
 
+    def getVAValues(self, names):
+        """
+        See Component.getVAValues(). The VAs with a live subscription are read
+        from their cache, and only the other ones are read remotely.
+        """
+        values = {}
+        remote_names = []
+        for n in names:
+            va = getattr(self, n, None)
+            if isinstance(va, _vattributes.VigilantAttributeProxy):
+                cached, v = va._get_cached_value()
+                if cached:
+                    values[n] = v
+                    continue
+            remote_names.append(n)
+
+        if not remote_names:
+            return values, {}
+
+        # a bit tricky because the underlying method gets created on the fly
+        remote_values, errors = Pyro4.Proxy.__getattr__(self, "getVAValues")(remote_names)
+        values.update(remote_values)
+        return values, errors
+
+    def setVAValues(self, values):
+        """
+        See Component.setVAValues()
+        """
+        for n in values:
+            va = getattr(self, n, None)
+            if isinstance(va, _vattributes.VigilantAttributeProxy):
+                va._invalidate_cache()
+                break  # All the VAs of the component share the same cache
+        return Pyro4.Proxy.__getattr__(self, "setVAValues")(values)
+
     def __setattr__(self, name, value):
         # Detect that the user is trying to replace a VigilantAttribute, which is
         # most likely a typo of forgetting VA.value .
@@ -561,10 +651,14 @@ class Microscope(HwComponent):
         if kwargs:
             raise ValueError("Microscope component cannot have initialisation arguments.")
 
-        # These 2 VAs should not modified, but by the backend
+        # These 3 VAs should not modified, but by the backend
         self.alive = _vattributes.VigilantAttribute(set())  # set of components
         # dict str -> int or Exception: name of component -> State
         self.ghosts = _vattributes.VigilantAttribute(dict())
+        # dict str -> (float, float, str or None): name of component ->
+        # start time, end time of its (successful) instantiation, and the name
+        # of the dependency it had to wait for the longest (None if none)
+        self.startup = _vattributes.VigilantAttribute(dict())
 
     @roattribute
     def model(self):
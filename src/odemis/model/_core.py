@@ -53,6 +53,9 @@ Pyro4.config.THREADPOOL_MAXTHREADS = 128
 # and the standard call (normally, the long ones return a future).
 INIT_TIMEOUT = 300  # s
 CALL_TIMEOUT = 30  # s
+# Maximum time for a new container process to be ready (it can be slow when
+# the computer is busy starting many things simultaneously)
+CONTAINER_TIMEOUT = 20  # s
 
 # Set the base directory
 BASE_DIRECTORY = "/var/run/odemisd"
@@ -429,7 +432,7 @@ def createNewContainer(name, validate=True, in_own_process=True):
         p = threading.Thread(name="Container " + name, target=_manageContainer,
                              args=(name, isready))
     p.start()
-    if not isready.wait(5):  # wait maximum 5s
+    if not isready.wait(CONTAINER_TIMEOUT):
         logging.error("Container %s is taking too long to get ready", name)
         raise IOError("Container creation timeout")
 
@@ -25,12 +25,18 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 # losslessly and with metadata attached (see _metadata for the conventional ones).
 
 import Pyro4
+from Pyro4.core import oneway
+import copy
 import logging
 import numpy
+from numpy.lib.stride_tricks import as_strided
 from odemis.model import _metadata, _vattributes
 from odemis.util import inspect_getmembers
 from odemis.util.weak import WeakMethod, WeakRefLostError
+import mmap
 import os
+import pickle
+import struct
 import threading
 import time
 import weakref
@@ -38,6 +44,26 @@ import zmq
 
 from . import _core
 
+# Transports available to send the DataArrays to a remote subscriber (ie, in
+# another container). ZMQ always works. The shared memory is only possible if
+# the subscriber runs on the same computer, and can access the shared memory.
+TRANSPORT_ZMQ = "zmq"
+TRANSPORT_SHM = "shm"
+
+# Topic (first part) of each message sent on the 0MQ pipe, to allow the
+# subscribers to only receive the messages of the transport they use.
+_TOPIC_ZMQ = b"Z"
+_TOPIC_SHM = b"S"
+
+SHM_DIRECTORY = "/dev/shm"
+# Prefix of the shared memory files, followed by the PID of the process owning it
+SHM_PREFIX = "odemis-df-"
+SHM_SLOTS = 4  # number of DataArrays which can be in the ring buffer simultaneously
+
+# Maximum ratio between the memory spanned by a non-contiguous array and its
+# actual size, to send it without copy. Above, it's cheaper to copy it.
+MAX_SPAN_RATIO = 2
+
 
 class DataArray(numpy.ndarray):
     """
@@ -192,6 +218,307 @@ class DataFlowBase(object):
                 logging.exception("Exception when notifying a data_flow")
 
 
+def _unlink_shm(path):
+    """
+    Delete a shared memory file, if it still exists
+    path (str): the full path of the file
+    """
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    except OSError:
+        logging.warning("Failed to delete shared memory %s", path)
+
+
+_stale_shm_cleaned = False
+
+
+def _cleanup_stale_shm():
+    """
+    Delete the shared memory files left by processes which have crashed (and
+    so couldn't delete them). Only done the first time it's called.
+    """
+    global _stale_shm_cleaned
+    if _stale_shm_cleaned:
+        return
+    _stale_shm_cleaned = True
+
+    try:
+        filenames = os.listdir(SHM_DIRECTORY)
+    except OSError:
+        return
+    for fn in filenames:
+        if not fn.startswith(SHM_PREFIX):
+            continue
+        try:
+            pid = int(fn[len(SHM_PREFIX):].split("-")[0])
+        except ValueError:
+            continue
+        try:
+            os.kill(pid, 0)  # Just checks whether the process exists
+        except ProcessLookupError:
+            logging.info("Deleting shared memory %s left by process %d", fn, pid)
+            _unlink_shm(os.path.join(SHM_DIRECTORY, fn))
+        except OSError:
+            pass  # Process exists, but belongs to another user
+
+
+class SharedMemoryRing(object):
+    """
+    Ring buffer in shared memory, used to pass the DataArrays to the subscribers
+    running on the same computer, without copying the data through a socket.
+    It is a file in SHM_DIRECTORY, split into slots of equal size. Each slot
+    starts with a header containing the sequence number of the DataArray it
+    holds, so that a reader can detect the slot has already been overwritten.
+    Only the DataFlow writes to it, the subscribers map it read-only (see
+    SharedMemoryReader). Each subscriber reports the last sequence number it has
+    consumed in its own "acknowledgement" file (see SharedMemoryAck), so that a
+    slot is only overwritten once every subscriber is done with it.
+    The file is deleted when the ring is closed or garbage collected, or at the
+    latest when the next ring is created, if the process has crashed.
+    """
+    HEADER_SIZE = 64  # bytes, large enough to keep the data aligned
+    _SEQ_FORMAT = "<q"
+
+    def __init__(self, name, slot_size, nslots=SHM_SLOTS, first_seq=0):
+        """
+        name (str): name of the file in SHM_DIRECTORY. Must be unique.
+        slot_size (int): minimum number of bytes available for the data of each slot
+        nslots (int): number of slots
+        first_seq (int): sequence number before the first one to use. It allows
+          to keep increasing sequence numbers when a ring replaces another one.
+        raise OSError: if the shared memory cannot be created
+        """
+        # Round up to full pages, so that every slot is page-aligned
+        slot_size += self.HEADER_SIZE
+        self.slot_size = -(-slot_size // mmap.PAGESIZE) * mmap.PAGESIZE
+        self.data_size = self.slot_size - self.HEADER_SIZE
+        self.nslots = nslots
+        self.path = os.path.join(SHM_DIRECTORY, name)
+        self._first_seq = first_seq
+        self._seq = first_seq
+
+        _cleanup_stale_shm()
+        _unlink_shm(self.path)  # In case a previous one had the same name
+        fd = os.open(self.path, os.O_CREAT | os.O_TRUNC | os.O_RDWR, 0o644)
+        # Delete the file even if close() is not called
+        self._finalizer = weakref.finalize(self, _unlink_shm, self.path)
+        try:
+            os.ftruncate(fd, self.slot_size * nslots)
+            self._mm = mmap.mmap(fd, self.slot_size * nslots)
+        except Exception:
+            self._finalizer()
+            raise
+        finally:
+            os.close(fd)  # The mapping stays valid
+
+    @property
+    def seq(self):
+        """
+        (int): sequence number of the last array written
+        """
+        return self._seq
+
+    def next_overwritten(self):
+        """
+        return (int): the sequence number of the array which will be overwritten
+          by the next write(). If the slot is still empty, it is at most first_seq.
+        """
+        return max(self._seq + 1 - self.nslots, self._first_seq)
+
+    def write(self, data):
+        """
+        Copy the data into the next slot
+        data (numpy.ndarray): the array to copy, of at most data_size bytes.
+          It can have any strides.
+        return (int, int): sequence number and offset of the slot
+        """
+        self._seq += 1
+        offset = ((self._seq - 1) % self.nslots) * self.slot_size
+        # Mark the slot as invalid while it's being written
+        struct.pack_into(self._SEQ_FORMAT, self._mm, offset, -1)
+        dest = numpy.ndarray(data.shape, data.dtype, buffer=self._mm,
+                             offset=offset + self.HEADER_SIZE)
+        dest[...] = data
+        del dest  # release the buffer, so that the mmap can be closed
+        struct.pack_into(self._SEQ_FORMAT, self._mm, offset, self._seq)
+        return self._seq, offset
+
+    def close(self):
+        """
+        Release the shared memory. The readers still having it mapped can keep
+        using it.
+        """
+        self._finalizer()
+        self._mm.close()
+
+
+class SharedMemoryAck(object):
+    """
+    Small file in shared memory, in which a subscriber writes the sequence
+    number of the last array it has consumed from a SharedMemoryRing. The
+    subscriber creates it, and the DataFlow maps it read-only.
+    """
+    SIZE = 8  # bytes, for the sequence number
+
+    def __init__(self, path, create=False):
+        """
+        path (str): full path of the file
+        create (bool): if True, the file is created (and deleted when closed),
+          otherwise an existing file is opened read-only.
+        raise OSError: if the shared memory cannot be accessed
+        """
+        self.path = path
+        if create:
+            _cleanup_stale_shm()
+            _unlink_shm(path)
+            fd = os.open(path, os.O_CREAT | os.O_TRUNC | os.O_RDWR, 0o644)
+            self._finalizer = weakref.finalize(self, _unlink_shm, path)
+            try:
+                os.ftruncate(fd, self.SIZE)
+                self._mm = mmap.mmap(fd, self.SIZE)
+            except Exception:
+                self._finalizer()
+                raise
+            finally:
+                os.close(fd)
+            self.write(-1)
+        else:
+            self._finalizer = None
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                self._mm = mmap.mmap(fd, self.SIZE, access=mmap.ACCESS_READ)
+            finally:
+                os.close(fd)
+
+    def write(self, seq):
+        """
+        seq (int): sequence number of the last array consumed
+        """
+        struct.pack_into(SharedMemoryRing._SEQ_FORMAT, self._mm, 0, seq)
+
+    def read(self):
+        """
+        return (int): sequence number of the last array consumed
+        """
+        return struct.unpack_from(SharedMemoryRing._SEQ_FORMAT, self._mm, 0)[0]
+
+    def close(self):
+        if self._finalizer:
+            self._finalizer()
+        self._mm.close()
+
+
+class SharedMemoryReader(object):
+    """
+    Gives access to the DataArrays of a SharedMemoryRing from another process
+    """
+
+    def __init__(self):
+        self.path = None
+        self._mm = None
+
+    def _attach(self, path):
+        """
+        raise OSError: if the shared memory cannot be accessed
+        """
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+
+        if self._mm is not None:
+            self._mm.close()
+        self._mm = mm
+        self.path = path
+
+    def get_array(self, shm_info, dtype, shape):
+        """
+        Copy the array from the shared memory. The sequence number of the slot is
+        checked before and after the copy, so that an array partly overwritten
+        by the DataFlow in the meantime is never returned.
+        shm_info (str, int, int): path of the shared memory, sequence number
+          and offset of the slot, as returned by SharedMemoryRing.write()
+        dtype (str): numpy dtype of the array
+        shape (tuple of int): shape of the array
+        return (numpy.ndarray or None): the array, or None if the slot has
+          already been overwritten.
+        raise OSError: if the shared memory cannot be accessed
+        """
+        path, seq, offset = shm_info
+        if path != self.path:
+            self._attach(path)
+
+        count = int(numpy.prod(shape))
+        if count == 0:  # frombuffer doesn't support zero length array
+            return numpy.empty(shape, dtype=dtype)
+
+        hdr_seq, = struct.unpack_from(SharedMemoryRing._SEQ_FORMAT, self._mm, offset)
+        if hdr_seq != seq:
+            return None
+        shm_array = numpy.frombuffer(self._mm, dtype=dtype, count=count,
+                                     offset=offset + SharedMemoryRing.HEADER_SIZE)
+        array = shm_array.reshape(shape).copy()
+        del shm_array  # Don't keep a reference to the mapping
+
+        # If the slot got rewritten during the copy, the data might be mixed
+        hdr_seq, = struct.unpack_from(SharedMemoryRing._SEQ_FORMAT, self._mm, offset)
+        if hdr_seq != seq:
+            return None
+        return array
+
+
+def _get_span_buffer(data):
+    """
+    Find the memory area containing all the elements of an array, which can be
+    non-contiguous (eg, cropped), transposed or flipped (ie, negative strides).
+    data (numpy.ndarray): the array, with at least one element
+    return (numpy.ndarray, int): 1D contiguous array covering the whole memory
+      area, and offset (in bytes) of the first element of data in that area.
+      The original array can be reconstructed with:
+      numpy.ndarray(data.shape, data.dtype, buf, offset, data.strides)
+    raise ValueError: if the memory area cannot be used directly
+    """
+    itemsize = data.itemsize
+    if any(s % itemsize for s in data.strides):
+        raise ValueError("Strides %s not multiple of the item size" % (data.strides,))
+
+    start = 0  # position of the first element (in items) from the lowest address
+    span = 1  # number of items in the memory area
+    for n, s in zip(data.shape, data.strides):
+        ext = (n - 1) * (s // itemsize)
+        if ext < 0:
+            start -= ext
+            span -= ext
+        else:
+            span += ext
+
+    if span > MAX_SPAN_RATIO * data.size:
+        raise ValueError("Array spans %d items for %d items" % (span, data.size))
+
+    # Flip the axes going backwards, so that the first element is at the lowest address
+    low = data[tuple(slice(None, None, -1) if s < 0 else slice(None) for s in data.strides)]
+    buf = as_strided(low, shape=(span,), strides=(itemsize,), writeable=False)
+    return buf, start * itemsize
+
+
+def _md_value_equal(a, b):
+    """
+    Compare two metadata values
+    return (bool): True if the values are known to be identical (including their type)
+    """
+    try:
+        if type(a) is not type(b):
+            return False
+        if isinstance(a, numpy.ndarray):
+            return a.dtype == b.dtype and numpy.array_equal(a, b)
+        return bool(a == b)
+    except Exception:  # Can happen when comparing arrays inside containers
+        return False
+
+
 # DataFlow object to create on the server (in a component)
 class DataFlow(DataFlowBase):
     def __init__(self, max_discard=100):
@@ -204,6 +531,13 @@ class DataFlow(DataFlowBase):
         DataFlowBase.__init__(self)
         # different from ._listeners for notify() to do different things
         self._remote_listeners = set()  # any unique string works
+        # remote listeners which receive the data via shared memory (subset of _remote_listeners)
+        self._shm_listeners = set()
+        self._shm_ring = None  # SharedMemoryRing, created on first use
+        # remote listener -> (SharedMemoryAck, int): acknowledgement file, and
+        # sequence number of the last array sent before the subscription
+        self._shm_acks = {}
+        self._old_shm_rings = []  # SharedMemoryRings replaced, but still read by some subscribers
         self._sync_lock = threading.RLock()  # To ensure only one sync change at a time
         self._was_synchronized = False
 
@@ -212,6 +546,14 @@ class DataFlow(DataFlowBase):
         self.pipe = None
 
         self._max_discard = max_discard
+        # Number of DataArrays which had to be copied to be sent remotely
+        self.fallback_copies = 0
+
+        # The metadata is sent remotely as the difference from the last full
+        # metadata sent (aka "keyframe"), as it rarely changes between DataArrays.
+        # (int, dict): identifier and copy of the last full metadata sent, or None to send a new one
+        self._md_keyframe = None
+        self._md_version = 0  # int: identifier of the last keyframe
         self._max_discard_orig = max_discard  # Used when switching between synchronized and not
         self._max_discard_last_update = None  # Value when last updated (when there are no remote listeners)
 
@@ -238,6 +580,52 @@ class DataFlow(DataFlowBase):
     def _set_max_discard(self, value):
         self.max_discard = value
 
+    def _get_fallback_copies(self):
+        return self.fallback_copies
+
+    def _get_md_keyframe(self):
+        """
+        Called by the subscribers, before subscribing, so that they can decode
+        the next DataArrays, even if they are not keyframes.
+        return (int, dict) or None: identifier and full metadata of the last
+          keyframe sent, or None if the next DataArray will be sent with a keyframe.
+        """
+        return self._md_keyframe
+
+    @oneway
+    def _request_md_keyframe(self):
+        """
+        Force the full metadata to be sent with the next DataArray. Called by the
+        subscribers which missed the last keyframe. It's asynchronous, so that the
+        subscriber doesn't block while receiving the data.
+        """
+        self._md_keyframe = None
+
+    def _encode_metadata(self, md):
+        """
+        Encode the metadata to be sent remotely. Either the full metadata is
+        sent (keyframe), or only the difference with the last keyframe.
+        md (dict): metadata of the DataArray
+        return (dict): entries to add to the description of the array
+        """
+        kf = self._md_keyframe
+        if kf is not None:
+            version, kf_md = kf
+            changed = {k: v for k, v in md.items() if k not in kf_md or not _md_value_equal(kf_md[k], v)}
+            removed = tuple(k for k in kf_md if k not in md)
+            # If most of the metadata changed, it's simpler to send a new keyframe
+            if len(changed) + len(removed) <= len(md) // 2:
+                return {"md_version": version, "md_changed": changed, "md_removed": removed}
+
+        self._md_version += 1
+        try:
+            # Deep copy, as the producer might update the values in-place later
+            self._md_keyframe = self._md_version, copy.deepcopy(md)
+        except Exception:
+            logging.debug("Failed to copy metadata, will always send it fully", exc_info=True)
+            self._md_keyframe = None
+        return {"md_version": self._md_version, "metadata": md}
+
     def _update_pipe_hwm(self):
         """
         updates the high water mark option of OMQ pipe according to max_discard
@@ -292,6 +680,53 @@ class DataFlow(DataFlowBase):
             else:
                 self.max_discard = self._max_discard_orig
 
+    def _negotiate_transport(self, listener, transport, ack_path=None):
+        """
+        Select how the DataArrays are sent to a remote listener. Called by the
+        DataFlowProxy, just before subscribing.
+        listener (str): the name of the remote listener
+        transport (TRANSPORT_*): the transport requested by the listener
+        ack_path (str or None): path of the SharedMemoryAck of the listener.
+          Required for TRANSPORT_SHM.
+        return (TRANSPORT_*): the transport which will be used
+        """
+        with self._lock:
+            self._remove_shm_listener(listener)
+            if transport == TRANSPORT_SHM and ack_path and os.path.isdir(SHM_DIRECTORY):
+                try:
+                    ack = SharedMemoryAck(ack_path)
+                except OSError:
+                    logging.warning("Failed to open shared memory %s, will use 0MQ", ack_path, exc_info=True)
+                else:
+                    last_seq = self._shm_ring.seq if self._shm_ring else 0
+                    self._shm_acks[listener] = ack, last_seq
+                    self._shm_listeners.add(listener)
+                    return TRANSPORT_SHM
+            return TRANSPORT_ZMQ
+
+    def _remove_shm_listener(self, listener):
+        """
+        Stop passing the data via shared memory to the given remote listener
+        """
+        self._shm_listeners.discard(listener)
+        ack, _ = self._shm_acks.pop(listener, (None, None))
+        if ack:
+            ack.close()
+
+    def _get_shm_consumed(self):
+        """
+        return (int or None): the sequence number up to which every subscriber
+          via shared memory has consumed the arrays, or None if there is no such subscriber
+        """
+        consumed = None
+        for ack, last_seq in list(self._shm_acks.values()):
+            try:
+                seq = max(ack.read(), last_seq)
+            except ValueError:  # closed in the meantime
+                continue
+            consumed = seq if consumed is None else min(consumed, seq)
+        return consumed
+
     def _register(self, daemon):
         """
         Get the dataflow ready to be shared. It gets registered to the Pyro
@@ -333,6 +768,20 @@ class DataFlow(DataFlowBase):
             self.pipe = None
             self._ctx.term()
             self._ctx = None
+        self._close_shm()
+
+    def _close_shm(self):
+        """
+        Release all the shared memory used to pass the data
+        """
+        if self._shm_ring:
+            self._shm_ring.close()
+            self._shm_ring = None
+        for ring in self._old_shm_rings:
+            ring.close()
+        self._old_shm_rings = []
+        for listener in list(self._shm_acks):
+            self._remove_shm_listener(listener)
 
     def _count_listeners(self):
         return len(self._listeners) + len(self._remote_listeners)
@@ -374,6 +823,8 @@ class DataFlow(DataFlowBase):
 
             # add string to listeners if listener is string
             if isinstance(listener, str):
+                # Note: no need to send a new metadata keyframe, as the subscriber
+                # has just received the current one (via _get_md_keyframe())
                 self._remote_listeners.add(listener)
             else:
                 assert callable(listener)
@@ -403,6 +854,7 @@ class DataFlow(DataFlowBase):
             if isinstance(listener, str):
                 # remove string from listeners
                 self._remote_listeners.discard(listener)
+                self._remove_shm_listener(listener)
             else:
                 self._listeners.discard(WeakMethod(listener))
 
@@ -425,26 +877,94 @@ class DataFlow(DataFlowBase):
             # update the count of subscribers, or detect when a remote_listener
             # is gone (if there is a way to associate it)
 
+            # Copies, as the sets can be modified by another thread
+            remote_listeners = frozenset(self._remote_listeners)
+            shm_listeners = frozenset(self._shm_listeners)
+
             # TODO thread-safe for self.pipe ?
-            dformat = {"dtype": str(data.dtype), "shape": data.shape, "metadata": data.metadata}
-            self.pipe.send_pyobj(dformat, zmq.SNDMORE)
-            try:
-                if not data.flags["C_CONTIGUOUS"]:
-                    # if not in C order, it will be received incorrectly
-                    # TODO: if it's just rotated, send the info to reconstruct it
-                    # and avoid the memory copy
-                    raise TypeError("Need C ordered array")
-                self.pipe.send(memoryview(data), copy=False)
-            except TypeError:
-                # not all buffers can be sent zero-copy (e.g., has strides)
-                # try harder by copying (which removes the strides)
-                logging.debug("Failed to send data with zero-copy")
-                data = numpy.require(data, requirements=["C_CONTIGUOUS"])
-                self.pipe.send(memoryview(data), copy=False)
+            dformat = {"dtype": str(data.dtype), "shape": data.shape}
+            dformat.update(self._encode_metadata(data.metadata))
+            if not shm_listeners.isdisjoint(remote_listeners):
+                self._send_shm(dformat, data)
+            if not remote_listeners <= shm_listeners:
+                self._send_zmq(dformat, data)
 
         # publish locally
         DataFlowBase.notify(self, data)
 
+    def _send_zmq(self, dformat, data, topic=_TOPIC_ZMQ):
+        """
+        Send the DataArray over the 0MQ pipe (to the subscribers using TRANSPORT_ZMQ)
+        dformat (dict): description of the array
+        data (DataArray): the data to send
+        topic (bytes): the topic of the subscribers to which it's sent
+        """
+        if data.flags["C_CONTIGUOUS"]:
+            buf = data
+        else:
+            # Send the whole memory area with the strides, so that the subscriber
+            # can reconstruct the same view (eg, cropped, transposed or flipped).
+            try:
+                buf, offset = _get_span_buffer(data)
+                dformat = dict(dformat, strides=data.strides, offset=offset)
+            except ValueError as ex:
+                # Too complicated, or not worthy => copy it (which removes the strides)
+                logging.debug("Copying data before sending: %s", ex)
+                self.fallback_copies += 1
+                buf = numpy.require(data, requirements=["C_CONTIGUOUS"])
+
+        self.pipe.send(topic, zmq.SNDMORE)
+        self.pipe.send_pyobj(dformat, zmq.SNDMORE)
+        self.pipe.send(memoryview(buf), copy=False)
+
+    def _send_shm(self, dformat, data):
+        """
+        Copy the DataArray into the shared memory, and only send its location
+        over the 0MQ pipe (to the subscribers using TRANSPORT_SHM).
+        If a subscriber hasn't consumed yet the array which would be overwritten,
+        or if the shared memory fails, this DataArray is sent directly over the
+        0MQ pipe instead, so that no subscriber misses it.
+        dformat (dict): description of the array
+        data (DataArray): the data to send
+        """
+        try:
+            consumed = self._get_shm_consumed()
+            ring = self._shm_ring
+            if ring is None or ring.data_size < data.nbytes:
+                # (Re)create the ring buffer, big enough for the new data
+                last_seq = 0
+                if ring:
+                    # Keep it until all the subscribers are done with it
+                    self._old_shm_rings.append(ring)
+                    last_seq = ring.seq
+                name = "%s%d-%x-%x" % (SHM_PREFIX, os.getpid(), id(self), time.monotonic_ns())
+                ring = SharedMemoryRing(name, data.nbytes, first_seq=last_seq)
+                self._shm_ring = ring
+                logging.debug("Created shared memory %s for dataflow %s",
+                              ring.path, self._global_name)
+
+            for old_ring in self._old_shm_rings[:]:
+                if consumed is None or consumed >= old_ring.seq:
+                    old_ring.close()
+                    self._old_shm_rings.remove(old_ring)
+
+            if consumed is not None and consumed < ring.next_overwritten():
+                # A subscriber is late => don't overwrite the data it will read
+                self._send_zmq(dict(dformat, shm=None), data, _TOPIC_SHM)
+                return
+
+            seq, offset = ring.write(data)
+            shm_info = (ring.path, seq, offset)
+        except OSError:
+            logging.exception("Failed to pass data via shared memory on %s", self._global_name)
+            self._send_zmq(dict(dformat, shm=None), data, _TOPIC_SHM)
+            return
+
+        shm_format = dict(dformat, shm=shm_info)
+        self.pipe.send(_TOPIC_SHM, zmq.SNDMORE)
+        self.pipe.send_pyobj(shm_format, zmq.SNDMORE)
+        self.pipe.send(b"")
+
     def __del__(self):
         if self._count_listeners() > 0:
             self.stop_generate()
@@ -469,6 +989,7 @@ class DataFlowProxy(DataFlowBase, Pyro4.Proxy):
         self._ctx = None
         self._commands = None
         self._thread = None
+        self._transport = TRANSPORT_ZMQ
 
     @property
     def max_discard(self):
@@ -478,6 +999,35 @@ class DataFlowProxy(DataFlowBase, Pyro4.Proxy):
     def max_discard(self, value):
         self._set_max_discard(value)
 
+    @property
+    def fallback_copies(self):
+        """
+        (int): number of DataArrays which had to be copied by the DataFlow to be
+          sent, because their memory layout was too complicated.
+        """
+        return self._get_fallback_copies()
+
+    @property
+    def transport(self):
+        """
+        (TRANSPORT_*): the transport requested to receive the data. With
+        TRANSPORT_SHM, the DataArrays are passed via shared memory, which avoids
+        sending them through a socket. They are copied out of the shared memory
+        when received, so they stay valid as long as needed. If the subscriber
+        is late, the DataArrays which don't fit in the shared memory are sent
+        via 0MQ, so none is lost (apart from the ones discarded according to
+        max_discard). If the shared memory is not accessible, it automatically
+        falls back to TRANSPORT_ZMQ.
+        The change is taken into account at the next subscription.
+        """
+        return self._transport
+
+    @transport.setter
+    def transport(self, value):
+        if value not in (TRANSPORT_ZMQ, TRANSPORT_SHM):
+            raise ValueError("Unknown transport %s" % (value,))
+        self._transport = value
+
     def __getstate__(self):
         # must permit to recreate a proxy to a data-flow in a different container
         proxy_state = Pyro4.Proxy.__getstate__(self)
@@ -495,6 +1045,7 @@ class DataFlowProxy(DataFlowBase, Pyro4.Proxy):
         self._ctx = None
         self._commands = None
         self._thread = None
+        self._transport = TRANSPORT_ZMQ
 
     # .get() is a direct remote call
 
@@ -514,7 +1065,29 @@ class DataFlowProxy(DataFlowBase, Pyro4.Proxy):
         # start the remote subscription
         if not self._thread:
             self._create_thread()
-        self._commands.send(b"SUB")
+
+        # Agree on the transport before subscribing, so that the data is sent
+        # the right way from the start
+        transport = TRANSPORT_ZMQ
+        if self._transport != TRANSPORT_ZMQ:
+            try:
+                ack_path = None
+                if self._transport == TRANSPORT_SHM:
+                    ack_path = self._thread.create_shm_ack()
+                transport = self._negotiate_transport(self._proxy_name, self._transport, ack_path)
+            except Exception:
+                logging.warning("Failed to select transport %s for dataflow %s, will use %s",
+                                self._transport, self._global_name, transport, exc_info=True)
+
+        # Get the current metadata, so that the DataArrays received before the
+        # next keyframe can be decoded.
+        try:
+            md_keyframe = self._get_md_keyframe()
+        except Exception:
+            logging.warning("Failed to get the metadata of dataflow %s", self._global_name, exc_info=True)
+            md_keyframe = None
+
+        self._commands.send_multipart([b"SUB", transport.encode("ascii"), pickle.dumps(md_keyframe)])
         self._commands.recv()  # synchronise
 
         try:
@@ -574,6 +1147,13 @@ class SubscribeProxyThread(threading.Thread):
         self._commands = zmq_ctx.socket(zmq.PAIR)
         self._commands.connect("inproc://" + uri)
 
+        # topic of the transport currently used, or None if not subscribed
+        self._topic = None
+        self._md_keyframe = None  # (int, dict): version and full metadata last received
+        self._md_requested = None  # int: version after which a keyframe was requested
+        self._shm_reader = SharedMemoryReader()
+        self._shm_ack = None  # SharedMemoryAck, created on first subscription via shared memory
+
         # create a zmq subscription to receive the data
         self._data = zmq_ctx.socket(zmq.SUB)
         # Don't automatically discard messages on 0MQ as it's hard to change live (based on max_discard)
@@ -603,14 +1183,17 @@ class SubscribeProxyThread(threading.Thread):
 
                 # process commands
                 if self._commands in socks:
-                    message = self._commands.recv()
+                    message, *args = self._commands.recv_multipart()
                     if message == b"SUB":
-                        self._data.setsockopt(zmq.SUBSCRIBE, b'')
+                        transport = args[0].decode("ascii")
+                        self._set_topic(_TOPIC_SHM if transport == TRANSPORT_SHM else _TOPIC_ZMQ)
+                        self._update_md_keyframe(pickle.loads(args[1]))
                         max_discard = self.weak_df.max_discard
-                        logging.debug("Subscribed to remote dataflow %s, with max_discard = %s", self.uri, max_discard)
+                        logging.debug("Subscribed to remote dataflow %s, via %s with max_discard = %s",
+                                      self.uri, transport, max_discard)
                         self._commands.send(b"SUBD")
                     elif message == b"UNSUB":
-                        self._data.setsockopt(zmq.UNSUBSCRIBE, b'')
+                        self._set_topic(None)
                         if logging:
                             logging.debug("Unsubscribed from remote dataflow %s", self.uri)
                         # no confirmation (async)
@@ -622,13 +1205,21 @@ class SubscribeProxyThread(threading.Thread):
                 # receive data
                 if self._data in socks:
                     # TODO: be more resilient if wrong data is received (can block forever)
+                    topic = self._data.recv()
                     array_format = self._data.recv_pyobj()
                     array_buf = self._data.recv(copy=False)
+                    if topic != self._topic:
+                        # Sent just before (un)subscribing, or for other subscribers
+                        continue
+                    if "metadata" in array_format:
+                        # Always keep the keyframes, even if the data is discarded
+                        self._md_keyframe = array_format["md_version"], array_format["metadata"]
                     # logging.debug("Received new DataArray over ZMQ for %s", self.uri)
                     # more fresh data already?
                     if (discarded < max_discard
                         and self._data.getsockopt(zmq.EVENTS) & zmq.POLLIN
                        ):
+                        self._ack_shm(array_format)
                         discarded += 1
                         # logging.debug("Discarding object received as a newer one is available")
                         continue
@@ -638,13 +1229,26 @@ class SubscribeProxyThread(threading.Thread):
                     if discarded:
                         logging.warning("Dataflow %s dropped %d arrays", self.uri, discarded)
                     discarded = 0
-                    # TODO: any need to use zmq.utils.rebuffer.array_from_buffer()?
-                    if len(array_buf):
-                        array = numpy.frombuffer(array_buf, dtype=array_format["dtype"])
-                    else:  # frombuffer doesn't support zero length array
-                        array = numpy.empty((0,), dtype=array_format["dtype"])
-                    array.shape = array_format["shape"]
-                    darray = DataArray(array, metadata=array_format["metadata"])
+                    md = self._decode_metadata(array_format)
+                    if md is None:
+                        self._ack_shm(array_format)
+                        continue
+                    if topic == _TOPIC_SHM and array_format["shm"] is not None:
+                        array = self._get_shm_array(array_format)
+                        if array is None:
+                            continue
+                    else:  # Data directly in the message
+                        # TODO: any need to use zmq.utils.rebuffer.array_from_buffer()?
+                        if not len(array_buf):  # frombuffer doesn't support zero length array
+                            array = numpy.empty(array_format["shape"], dtype=array_format["dtype"])
+                        elif "strides" in array_format:  # non-contiguous array
+                            array = numpy.ndarray(array_format["shape"], dtype=array_format["dtype"],
+                                                  buffer=array_buf, offset=array_format["offset"],
+                                                  strides=array_format["strides"])
+                        else:
+                            array = numpy.frombuffer(array_buf, dtype=array_format["dtype"])
+                            array.shape = array_format["shape"]
+                    darray = DataArray(array, metadata=md)
                     self.weak_df.notify(darray)
 
         except ReferenceError:  # The DataFlow(Proxy) is gone
@@ -663,6 +1267,111 @@ class SubscribeProxyThread(threading.Thread):
                 self._data.close()
             except Exception:
                 print("Exception closing ZMQ data connection")
+            if self._shm_ack:
+                self._shm_ack.close()
+
+    def _set_topic(self, topic):
+        """
+        Change the messages received on the data pipe
+        topic (bytes or None): the new topic to receive, or None to not receive anything
+        """
+        if topic == self._topic:
+            return
+        # Subscribe to the new one first, to not miss any message
+        if topic is not None:
+            self._data.setsockopt(zmq.SUBSCRIBE, topic)
+        if self._topic is not None:
+            self._data.setsockopt(zmq.UNSUBSCRIBE, self._topic)
+        self._topic = topic
+
+    def _update_md_keyframe(self, keyframe):
+        """
+        Use the given keyframe, unless a newer one has already been received
+        keyframe (None or (int, dict)): version and full metadata
+        """
+        if keyframe is None:
+            return
+        if self._md_keyframe is None or self._md_keyframe[0] < keyframe[0]:
+            self._md_keyframe = keyframe
+
+    def _decode_metadata(self, array_format):
+        """
+        Reconstruct the metadata, from the last keyframe and the changes
+        array_format (dict): the description of the array, as sent by the DataFlow
+        return (dict or None): the metadata, or None if the keyframe is missing
+        """
+        version = array_format["md_version"]
+        if self._md_keyframe is None or self._md_keyframe[0] != version:
+            # Can happen if the keyframe was sent just when subscribing, before
+            # the 0MQ subscription was active. => Ask for a new one (asynchronously)
+            if self._md_requested != version:
+                logging.debug("Missing metadata keyframe %s on %s, requesting a new one", version, self.uri)
+                self._md_requested = version
+                try:
+                    self.weak_df._request_md_keyframe()
+                except ReferenceError:
+                    raise
+                except Exception:
+                    logging.warning("Failed to request metadata keyframe on %s", self.uri, exc_info=True)
+            return None
+
+        # Always return a new dict, as the listeners might modify it
+        md = dict(self._md_keyframe[1])
+        if "md_changed" in array_format:
+            md.update(array_format["md_changed"])
+            for k in array_format["md_removed"]:
+                del md[k]
+        return md
+
+    def create_shm_ack(self):
+        """
+        Create the file to report to the DataFlow which arrays have been consumed
+        from the shared memory. Called by the DataFlowProxy, before subscribing.
+        return (str): the path of the file
+        raise OSError: if the shared memory cannot be created
+        """
+        if self._shm_ack is None:
+            name = "%s%d-ack-%x" % (SHM_PREFIX, os.getpid(), id(self))
+            self._shm_ack = SharedMemoryAck(os.path.join(SHM_DIRECTORY, name), create=True)
+        return self._shm_ack.path
+
+    def _ack_shm(self, array_format):
+        """
+        Report to the DataFlow that an array passed via shared memory is consumed
+        array_format (dict): the description of the array, as sent by the DataFlow
+        """
+        shm_info = array_format.get("shm")
+        if shm_info is not None and self._shm_ack is not None:
+            self._shm_ack.write(shm_info[1])
+
+    def _get_shm_array(self, array_format):
+        """
+        Get the array passed via shared memory. If the shared memory is not
+        accessible, the subscription is switched to TRANSPORT_ZMQ.
+        array_format (dict): the description of the array, as sent by the DataFlow
+        return (numpy.ndarray or None): the array, or None if it's not available
+        """
+        shm_info = array_format["shm"]
+        try:
+            array = self._shm_reader.get_array(shm_info, array_format["dtype"], array_format["shape"])
+        except FileNotFoundError:
+            # The shared memory was already released (eg, the DataFlow was
+            # unregistered). Nothing wrong with the shared memory itself.
+            logging.warning("Dataflow %s dropped 1 array, as the shared memory is gone", self.uri)
+            return None
+        except (IOError, OSError) as ex:
+            logging.warning("Failed to receive data via shared memory on %s (%s), switching to 0MQ",
+                            self.uri, ex)
+            self._set_topic(_TOPIC_ZMQ)
+            self.weak_df._negotiate_transport(self.weak_df._proxy_name, TRANSPORT_ZMQ)
+            return None
+        finally:
+            self._ack_shm(array_format)
+
+        if array is None:
+            # Should not happen, as the DataFlow doesn't overwrite the arrays not yet consumed
+            logging.warning("Dataflow %s dropped 1 array, as it was overwritten in shared memory", self.uri)
+        return array
 
 
 def unregister_dataflows(self):
@@ -77,6 +77,15 @@ class DataArrayShadow(metaclass=ABCMeta):
 #         return (DataArray): the shape of the DataArray is typically of shape
 #         """
 
+    # Optionally defined if the object supports per tile access, and can read
+    # multiple tiles faster than one by one.
+#     def getTiles(self, tiles):
+#         """
+#         tiles (list of (0<=int, 0<=int, 0<=int)): X index, Y index and zoom
+#             level of each tile, as in getTile()
+#         return (list of DataArray): the tiles, in the same order as requested
+#         """
+
 
 class AcquisitionData(metaclass=ABCMeta):
     """
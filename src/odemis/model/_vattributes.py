@@ -32,10 +32,12 @@ import threading
 import types
 import sys
 import zmq
-from scipy.spatial import distance
 
 from . import _core
 from odemis.util import inspect_getmembers
+from odemis.util.imports import lazy_import
+
+distance = lazy_import("scipy.spatial.distance")
 
 
 class NotSettableError(AttributeError):
@@ -161,8 +163,9 @@ class VigilantAttribute(VigilantAttributeBase):
         Equivalent to __getstate__() of the proxy version
         """
         proxy_state = Pyro4.core.pyroObjectSerializer(self)[2]
+        # With a getter, the value can change without notification => the proxy cannot cache it
         return (proxy_state, _core.dump_roattributes(self), self.unit,
-                self.readonly, self.max_discard)
+                self.readonly, self.max_discard, self._getter is None)
 
     def _check(self, value):
         """
@@ -342,6 +345,50 @@ class VigilantAttribute(VigilantAttributeBase):
         self._unregister()
 
 
+def _is_immutable(value):
+    """
+    return (bool): True if the value cannot be modified in place, so that it
+      can be shared between callers without copy.
+    """
+    if value is None or isinstance(value, (numbers.Number, str, bytes)):
+        return True
+    if isinstance(value, (tuple, frozenset)):
+        return all(_is_immutable(v) for v in value)
+    return False
+
+
+class VACacheGroup(object):
+    """
+    Validity of the cached values of VigilantAttributeProxys which depend on
+    each other. Typically, all the VAs of a component are in the same group, as
+    changing a VA can change the value of other ones (eg, binning and resolution).
+    Any change of a VA of the group invalidates the cache of all the VAs of the group.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.gen = 0  # incremented at every change of any VA of the group
+
+    def invalidate(self):
+        """
+        Must be called with the lock held
+        """
+        self.gen += 1
+
+
+def share_va_cache(vas):
+    """
+    Put VigilantAttributeProxys in the same cache group, so that a change of
+    any of them invalidates the cache of all of them.
+    vas (iterable of VigilantAttributeBase): the VAs. The ones which are not
+      proxies are ignored.
+    """
+    group = VACacheGroup()
+    for va in vas:
+        if isinstance(va, VigilantAttributeProxy):
+            va._cache_group = group
+
+
 class VigilantAttributeProxy(VigilantAttributeBase, Pyro4.Proxy):
     # init is as light as possible to reduce creation overhead in case the
     # object is actually never used
@@ -360,6 +407,22 @@ class VigilantAttributeProxy(VigilantAttributeBase, Pyro4.Proxy):
         self._ctx = None
         self._commands = None
         self._thread = None
+        self._init_cache(False)  # will be updated in __setstate__
+
+    def _init_cache(self, cacheable):
+        """
+        While subscribed, the value received by the notifications is cached,
+        so that reading the value doesn't need a remote call. The value read
+        remotely is never cached, as the VA might have been changed without
+        notification. Only immutable values are cached, so that they can be
+        returned without copy.
+        cacheable (bool): False if the value of the VA can change without notification.
+        """
+        self._cacheable = cacheable
+        self._cache_group = VACacheGroup()  # Changed to the group of the component (see share_va_cache())
+        self._cache_value = None
+        self._cache_gen = None  # generation of the group when the value was cached, None if not cached
+        self._listening = False  # True when the remote VA sends notifications
 
     def __getattr__(self, name):
         # Behaviour of .range and .choices remote attributes:
@@ -379,15 +442,58 @@ class VigilantAttributeProxy(VigilantAttributeBase, Pyro4.Proxy):
 
     @property
     def value(self):
-        return self.__getattr__("_get_value")()
+        return self._read_value()
 
     @value.setter
     def value(self, v):
         if self.readonly:
             raise NotSettableError("Value is read-only")
+        self._invalidate_cache()
         return self.__getattr__("_set_value")(v)
     # no delete remotely
 
+    def _get_cached_value(self):
+        """
+        return (bool, value): True and the value if it's known without remote
+          call, or False and None otherwise.
+        """
+        group = self._cache_group
+        with group.lock:
+            if self._listening and self._cache_gen == group.gen:
+                return True, self._cache_value
+        return False, None
+
+    def _read_value(self):
+        """
+        return: the current value of the remote VA. Only does a remote call if
+          the value is not cached.
+        """
+        cached, value = self._get_cached_value()
+        if cached:
+            return value
+        return self.__getattr__("_get_value")()
+
+    def _invalidate_cache(self):
+        """
+        Called when the VA is changed from this proxy. As other VAs of the group
+        might change too, the cache of all of them is invalidated.
+        """
+        group = self._cache_group
+        with group.lock:
+            group.invalidate()
+
+    def _on_remote_value(self, v):
+        """
+        Called by the subscription thread when a new value is received
+        """
+        group = self._cache_group
+        with group.lock:
+            group.invalidate()
+            if self._cacheable and self._listening and _is_immutable(v):
+                self._cache_value = v
+                self._cache_gen = group.gen
+        self.notify(v)
+
     # for enumerated VA
     @property
     def choices(self):
@@ -407,7 +513,7 @@ class VigilantAttributeProxy(VigilantAttributeBase, Pyro4.Proxy):
         proxy_state = Pyro4.Proxy.__getstate__(self)
         # we don't need value, it's always remotely accessed
         return (proxy_state, _core.dump_roattributes(self), self.unit,
-                self.readonly, self.max_discard)
+                self.readonly, self.max_discard, self._cacheable)
 
     def __setstate__(self, state):
         """
@@ -416,8 +522,9 @@ class VigilantAttributeProxy(VigilantAttributeBase, Pyro4.Proxy):
                             a new one is already available. 0 to keep (notify)
                             all the messages (dangerous if callback is slower
                             than the generator).
+        cacheable (bool): False if the value can change without notification
         """
-        proxy_state, roattributes, unit, self.readonly, self.max_discard = state
+        proxy_state, roattributes, unit, self.readonly, self.max_discard, cacheable = state
         Pyro4.Proxy.__setstate__(self, proxy_state)
         VigilantAttributeBase.__init__(self, unit=unit)
         _core.load_roattributes(self, roattributes)
@@ -428,13 +535,14 @@ class VigilantAttributeProxy(VigilantAttributeBase, Pyro4.Proxy):
         self._ctx = None
         self._commands = None
         self._thread = None
+        self._init_cache(cacheable)
 
     def _create_thread(self):
         logging.debug("Creating thread for VA %s", self._global_name)
         self._ctx = zmq.Context(1) # apparently 0MQ reuse contexts
         self._commands = self._ctx.socket(zmq.PAIR)
         self._commands.bind("inproc://" + self._global_name)
-        self._thread = SubscribeProxyThread(self.notify, self._global_name, self.max_discard, self._ctx)
+        self._thread = SubscribeProxyThread(self._on_remote_value, self._global_name, self.max_discard, self._ctx)
         self._thread.start()
 
     def subscribe(self, listener, init=False):
@@ -459,6 +567,11 @@ class VigilantAttributeProxy(VigilantAttributeBase, Pyro4.Proxy):
         # a bit tricky because the underlying method gets created on the fly
         Pyro4.Proxy.__getattr__(self, "subscribe")(self._proxy_name)
 
+        # From now on, the value is known to be up-to-date, once received
+        with self._cache_group.lock:
+            self._listening = True
+            self._cache_gen = None
+
     def unsubscribe(self, listener):
         VigilantAttributeBase.unsubscribe(self, listener)
         if len(self._listeners) == 0:
@@ -468,6 +581,9 @@ class VigilantAttributeProxy(VigilantAttributeBase, Pyro4.Proxy):
         """
         stop the remote subscription
         """
+        with self._cache_group.lock:
+            self._listening = False
+            self._cache_gen = None
         Pyro4.Proxy.__getattr__(self, "unsubscribe")(self._proxy_name)
         if self._commands:
             self._commands.send(b"UNSUB")
@@ -780,7 +896,7 @@ class ListVAProxy(VigilantAttributeProxy):
     @property
     def value(self):
         # Transform a normal list into a notifying one
-        raw_list = self.__getattr__("_get_value")()
+        raw_list = self._read_value()
         # When value change, same as setting the value
         val = _NotifyingList(raw_list, notifier=self.__value_setter)
         return val
@@ -793,6 +909,7 @@ class ListVAProxy(VigilantAttributeProxy):
     def __value_setter(self, v):
         if self.readonly:
             raise NotSettableError("Value is read-only")
+        self._invalidate_cache()
         self.__getattr__("_set_value")(v)
 
 
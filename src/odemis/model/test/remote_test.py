@@ -29,12 +29,13 @@ import time
 import unittest
 from concurrent import futures
 from multiprocessing import Process
+from unittest import mock as umock
 
 import numpy
 import Pyro4
 
 from odemis import model
-from odemis.model import VigilantAttributeBase, isasync, oneway, roattribute
+from odemis.model import VigilantAttributeBase, isasync, oneway, roattribute, _dataflow, _vattributes
 from odemis.util import executeAsyncTask, mock, timeout, testing
 
 logging.basicConfig(format="%(asctime)s  %(levelname)-7s %(module)-15s: %(message)s")
@@ -155,6 +156,232 @@ class SerializerTest(unittest.TestCase):
         daemon.shutdown()
 
 
+class SharedMemoryTest(unittest.TestCase):
+
+    def test_read_write(self):
+        ring = _dataflow.SharedMemoryRing("odemis-df-test-%d" % os.getpid(), 1000, nslots=2)
+        reader = _dataflow.SharedMemoryReader()
+        try:
+            data = numpy.arange(100, dtype=numpy.uint16).reshape(10, 10)
+            seq, offset = ring.write(data)
+            shm_info = (ring.path, seq, offset)
+            received = reader.get_array(shm_info, "uint16", (10, 10))
+            numpy.testing.assert_array_equal(received, data)
+
+            # The received array is a copy, which stays valid when the slot is reused
+            received[0, 0] = 42  # writable
+            ring.write(data + 1)
+            ring.write(data + 2)
+            self.assertEqual(received[1, 1], 11)
+            self.assertIsNone(reader.get_array(shm_info, "uint16", (10, 10)))
+        finally:
+            ring.close()
+        self.assertFalse(os.path.exists(ring.path))
+
+    def test_delete_on_gc(self):
+        ring = _dataflow.SharedMemoryRing("odemis-df-test-%d" % os.getpid(), 1000)
+        path = ring.path
+        self.assertTrue(os.path.exists(path))
+        del ring
+        gc.collect()
+        self.assertFalse(os.path.exists(path))
+
+    def test_slow_subscriber(self):
+        """
+        Check the arrays not yet consumed by a subscriber are not overwritten
+        """
+        df = model.DataFlow()
+        df.pipe = umock.Mock()  # Not registered, only record the messages sent
+        ack = _dataflow.SharedMemoryAck(os.path.join(_dataflow.SHM_DIRECTORY, "odemis-df-%d-acktest" % os.getpid()),
+                                        create=True)
+        try:
+            transport = df._negotiate_transport("slow", model.TRANSPORT_SHM, ack.path)
+            self.assertEqual(transport, model.TRANSPORT_SHM)
+
+            def send(i):
+                df.pipe.reset_mock()
+                df._send_shm({"dtype": "uint16", "shape": (10, 10)},
+                             numpy.full((10, 10), i, dtype=numpy.uint16))
+                # 3 parts: topic, format, and either the data or nothing
+                fmt = df.pipe.send_pyobj.call_args[0][0]
+                buf = df.pipe.send.call_args[0][0]
+                return fmt["shm"], memoryview(buf).nbytes
+
+            # The subscriber doesn't consume anything => after all the slots are
+            # used, the arrays are sent directly via 0MQ
+            for i in range(_dataflow.SHM_SLOTS):
+                shm_info, buf_len = send(i)
+                self.assertIsNotNone(shm_info)
+                self.assertEqual(buf_len, 0)
+            first_seq = df._shm_ring.seq - _dataflow.SHM_SLOTS + 1
+            shm_info, buf_len = send(100)
+            self.assertIsNone(shm_info)
+            self.assertEqual(buf_len, 100 * 2)
+
+            # The data still in the shared memory is intact
+            reader = _dataflow.SharedMemoryReader()
+            array = reader.get_array((df._shm_ring.path, first_seq, 0), "uint16", (10, 10))
+            numpy.testing.assert_array_equal(array, 0)
+
+            # Once the first array is consumed, its slot can be used again
+            ack.write(first_seq)
+            shm_info, buf_len = send(101)
+            self.assertIsNotNone(shm_info)
+            shm_info, buf_len = send(102)
+            self.assertIsNone(shm_info)
+
+            # When the array is bigger, the old ring is kept until it's all consumed
+            old_ring = df._shm_ring
+            df._send_shm({"dtype": "uint16", "shape": (100, 100)},
+                         numpy.zeros((100, 100), dtype=numpy.uint16))
+            self.assertIsNot(df._shm_ring, old_ring)
+            self.assertIn(old_ring, df._old_shm_rings)
+            self.assertTrue(os.path.exists(old_ring.path))
+            ack.write(df._shm_ring.seq)
+            send(103)
+            self.assertEqual(df._old_shm_rings, [])
+            self.assertFalse(os.path.exists(old_ring.path))
+
+            # Without acknowledgement file, shared memory is not possible
+            transport = df._negotiate_transport("other", model.TRANSPORT_SHM, None)
+            self.assertEqual(transport, model.TRANSPORT_ZMQ)
+        finally:
+            df._close_shm()
+            ack.close()
+        self.assertFalse(os.path.exists(ack.path))
+
+    def test_delete_stale(self):
+        # Find a PID which is not running
+        pid = 2 ** 22
+        while True:
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                break
+            except OSError:
+                pass
+            pid -= 1
+        stale_path = os.path.join(_dataflow.SHM_DIRECTORY, "%s%d-1-1" % (_dataflow.SHM_PREFIX, pid))
+        with open(stale_path, "wb") as f:
+            f.write(b"old")
+
+        _dataflow._stale_shm_cleaned = False
+        ring = _dataflow.SharedMemoryRing("%s%d-test" % (_dataflow.SHM_PREFIX, os.getpid()), 1000)
+        try:
+            self.assertFalse(os.path.exists(stale_path))
+            self.assertTrue(os.path.exists(ring.path))  # Our own process is still running
+        finally:
+            ring.close()
+
+
+class VACacheTest(unittest.TestCase):
+    """
+    Test the cache of the VigilantAttributeProxy, without actual remote calls
+    """
+
+    def setUp(self):
+        self.remote_values = {}
+        remote_values = self.remote_values
+
+        def proxy_getattr(proxy, name):
+            if name == "_get_value":
+                return lambda: remote_values[proxy._pyroUri.object]
+            elif name == "_set_value":
+                return lambda v: remote_values.__setitem__(proxy._pyroUri.object, v)
+            raise AttributeError(name)
+
+        for patcher in (umock.patch.object(Pyro4.Proxy, "__getattr__", proxy_getattr),
+                        # Attributes are local on the proxy, without checking the remote object
+                        umock.patch.object(Pyro4.core.config, "METADATA", False, create=True)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _create_va(self, name, value):
+        va = _vattributes.VigilantAttributeProxy(Pyro4.URI("PYRO:%s@./u:test" % name))
+        va._init_cache(True)
+        va._listening = True  # As if subscribed
+        self.remote_values[name] = value
+        return va
+
+    def test_dependent(self):
+        binning = self._create_va("binning", 1)
+        res = self._create_va("resolution", (1024, 1024))
+        _vattributes.share_va_cache([binning, res])
+
+        # Only cached after a notification
+        self.assertEqual(res.value, (1024, 1024))
+        self.assertEqual(res._get_cached_value(), (False, None))
+        res._on_remote_value((1024, 1024))
+        self.assertEqual(res._get_cached_value(), (True, (1024, 1024)))
+
+        # Setting another VA of the component invalidates the cache
+        binning.value = 2
+        self.remote_values["resolution"] = (512, 512)
+        self.assertEqual(res.value, (512, 512))
+
+        # Same for a notification of another VA
+        res._on_remote_value((512, 512))
+        self.assertTrue(res._get_cached_value()[0])
+        self.remote_values["resolution"] = (256, 256)
+        binning._on_remote_value(4)
+        self.assertEqual(res.value, (256, 256))
+        self.assertEqual(binning.value, 4)
+
+    def test_mutable(self):
+        va = self._create_va("pos", {"x": 1})
+        va._on_remote_value({"x": 1})
+        # Mutable values are not cached, so the caller can modify them
+        self.assertFalse(va._get_cached_value()[0])
+        va._on_remote_value((1, (2.5, "a")))
+        self.assertEqual(va._get_cached_value(), (True, (1, (2.5, "a"))))
+
+        # Not cached when not subscribed
+        va._listening = False
+        self.assertFalse(va._get_cached_value()[0])
+
+
+class MetadataKeyframeTest(unittest.TestCase):
+
+    def test_late_subscriber(self):
+        """
+        A subscriber which starts after the keyframe was sent can decode the metadata
+        """
+        df = model.DataFlow()
+        md1 = {model.MD_DESCRIPTION: "fake", model.MD_WL_LIST: list(range(100)), "count": 1}
+        fmt1 = df._encode_metadata(md1)
+        self.assertIn("metadata", fmt1)  # First one is a keyframe
+        md2 = dict(md1, count=2)
+        fmt2 = df._encode_metadata(md2)
+        self.assertNotIn("metadata", fmt2)  # Only the changes
+
+        # A subscriber which missed the keyframe, but got it when subscribing
+        thread = object.__new__(_dataflow.SubscribeProxyThread)
+        thread.uri = "test"
+        thread._md_keyframe = None
+        thread._md_requested = None
+        thread.weak_df = umock.Mock()
+        thread._update_md_keyframe(df._get_md_keyframe())
+        self.assertEqual(thread._decode_metadata(fmt2), md2)
+        thread.weak_df._request_md_keyframe.assert_not_called()
+
+        # An older keyframe doesn't replace the one received
+        md3 = {"count": 3}
+        fmt3 = df._encode_metadata(md3)
+        self.assertIn("metadata", fmt3)
+        thread._md_keyframe = fmt3["md_version"], fmt3["metadata"]
+        thread._update_md_keyframe((fmt1["md_version"], md1))
+        self.assertEqual(thread._decode_metadata(fmt3), md3)
+
+        # Without any keyframe, a new one is requested, only once
+        thread._md_keyframe = None
+        self.assertIsNone(thread._decode_metadata(fmt3))
+        self.assertIsNone(thread._decode_metadata(fmt3))
+        thread.weak_df._request_md_keyframe.assert_called_once()
+        df._request_md_keyframe()
+        self.assertIsNone(df._get_md_keyframe())
+        self.assertIn("metadata", df._encode_metadata(md3))
+
+
 # @unittest.skip("simple")
 class ProxyOfProxyTest(unittest.TestCase):
     # Test sharing a shared component from the client
@@ -643,6 +870,136 @@ class RemoteTest(unittest.TestCase):
         self.assertEqual(count_end, self.count)
         self.assertGreaterEqual(count_end, 1)
 
+    def test_dataflow_shm(self):
+        """
+        Test receiving the data via shared memory, including stridden arrays
+        """
+        df = self.comp.data
+        df.transport = model.TRANSPORT_SHM
+        try:
+            for cut, shape in ((0, (2048, 2048)), (3, (2048, 2045))):
+                self.count = 0
+                self.data_arrays_sent = 0
+                self.expected_shape = shape
+                self.comp.cut.value = cut
+                df.reset()
+
+                df.subscribe(self.receive_data)
+                time.sleep(0.5)
+                df.unsubscribe(self.receive_data)
+                count_end = self.count
+                print("received %d arrays over %d via shm" % (self.count, self.data_arrays_sent))
+
+                time.sleep(0.1)
+                self.assertEqual(count_end, self.count)
+                self.assertGreaterEqual(count_end, 1)
+
+            # Should also work with a subscriber via 0MQ at the same time
+            self.comp.cut.value = 0
+            self.count = 0
+            self.expected_shape = (2048, 2048)
+            self.zmq_shapes = []
+            df_zmq = self.rdaemon.getObject("mycomp").data
+            df_zmq.subscribe(self.receive_data_shape)
+            df.subscribe(self.receive_data)
+            time.sleep(0.5)
+            df.unsubscribe(self.receive_data)
+            df_zmq.unsubscribe(self.receive_data_shape)
+            self.assertGreaterEqual(self.count, 1)
+            self.assertGreaterEqual(len(self.zmq_shapes), 1)
+            self.assertEqual(self.zmq_shapes[0], (2048, 2048))
+        finally:
+            self.comp.cut.value = 0
+            df.transport = model.TRANSPORT_ZMQ
+
+        with self.assertRaises(ValueError):
+            df.transport = "pigeon"
+
+    def test_dataflow_shm_slow(self):
+        """
+        Test a subscriber via shared memory much slower than the dataflow doesn't
+        lose any data, when max_discard is 0.
+        """
+        df = self.comp.data
+        df.transport = model.TRANSPORT_SHM
+        df.max_discard = 0
+        received = []
+
+        def receive_slowly(dataflow, data):
+            received.append(int(data[0][0]))
+            time.sleep(0.2)  # Much slower than the generator
+
+        try:
+            df.subscribe(receive_slowly)
+            time.sleep(2)
+            df.unsubscribe(receive_slowly)
+        finally:
+            df.transport = model.TRANSPORT_ZMQ
+            df.max_discard = 100
+
+        self.assertGreaterEqual(len(received), 5)
+        # No array skipped
+        self.assertEqual(received, list(range(received[0], received[0] + len(received))))
+
+    def test_dataflow_flipped(self):
+        """
+        Test passing transposed and flipped arrays, which should not need a copy
+        """
+        self.count = 0
+        self.data_arrays_sent = 0
+        self.expected_shape = (2045, 2048)
+        self.comp.cut.value = 3
+        self.comp.flip.value = True
+        self.comp.data.reset()
+        copies_start = self.comp.data.fallback_copies
+
+        self.comp.data.subscribe(self.receive_data)
+        time.sleep(0.5)
+        self.comp.data.unsubscribe(self.receive_data)
+        self.comp.cut.value = 0  # put it back
+        self.comp.flip.value = False
+        count_end = self.count
+        print("received %d flipped arrays over %d" % (self.count, self.data_arrays_sent))
+
+        time.sleep(0.1)
+        self.assertEqual(count_end, self.count)
+        self.assertGreaterEqual(count_end, 1)
+        self.assertEqual(self.comp.data.fallback_copies, copies_start)
+
+    def test_dataflow_metadata(self):
+        """
+        Check the metadata is correctly received, even when it's only partly sent
+        """
+        self.count = 0
+        self.data_arrays_sent = 0
+        self.comp.data.reset()
+
+        self.comp.data.subscribe(self.receive_data_md)
+        time.sleep(0.5)
+        self.comp.data.unsubscribe(self.receive_data_md)
+        self.assertGreaterEqual(self.count, 3)
+
+        # A second subscription should also receive the full metadata
+        count_end = self.count
+        self.comp.data.subscribe(self.receive_data_md)
+        time.sleep(0.5)
+        self.comp.data.unsubscribe(self.receive_data_md)
+        self.assertGreater(self.count, count_end)
+
+    def receive_data_md(self, dataflow, data):
+        self.count += 1
+        md = data.metadata
+        self.assertEqual(md["count"], data[0][0])
+        self.assertEqual(md[model.MD_WL_LIST], list(range(1024)))
+        self.assertEqual(md[model.MD_DESCRIPTION], "fake")
+        self.assertIn(model.MD_ACQ_DATE, md)
+        if md["count"] % 3 == 0:
+            self.assertEqual(md["extra"], md["count"])
+        else:
+            self.assertNotIn("extra", md)
+        # Modifying the metadata shouldn't affect the next DataArrays
+        md[model.MD_DESCRIPTION] = "modified"
+
     def test_dataflow_empty(self):
         """
         test passing empty DataArray
@@ -669,6 +1026,9 @@ class RemoteTest(unittest.TestCase):
             self.data_arrays_sent = data[0][0]
             self.assertGreaterEqual(self.data_arrays_sent, self.count)
 
+    def receive_data_shape(self, dataflow, data):
+        self.zmq_shapes.append(data.shape)
+
     def receive_data_auto_unsub(self, dataflow, data):
         """
         callback for df
@@ -762,6 +1122,92 @@ class RemoteTest(unittest.TestCase):
         except TypeError:
             pass # as it should be
 
+    def test_va_cache(self):
+        """
+        Check the value of a VA is read from the cache while subscribed
+        """
+        prop = self.comp.prop
+        self.assertFalse(prop._get_cached_value()[0])
+
+        self.called = 0
+        self.last_value = None
+        prop.subscribe(self.receive_va_update)
+        time.sleep(0.01)  # It can take some time to subscribe
+
+        # Until a notification is received, the value is read remotely
+        self.assertEqual(prop.value, 42)
+        self.assertFalse(prop._get_cached_value()[0])
+
+        # change remotely => cache updated via the notification
+        self.comp.change_prop(45)
+        time.sleep(0.1)  # give time to receive notifications
+        self.assertEqual(prop._get_cached_value(), (True, 45))
+        self.assertEqual(prop.value, 45)
+
+        # change locally => always up-to-date
+        prop.value = 3
+        self.assertEqual(prop.value, 3)
+        time.sleep(0.1)
+        self.assertEqual(prop._get_cached_value(), (True, 3))
+
+        # Not subscribed => not cached anymore
+        prop.unsubscribe(self.receive_va_update)
+        self.assertFalse(prop._get_cached_value()[0])
+        self.comp.change_prop(46)
+        self.assertEqual(prop.value, 46)
+
+    def test_va_batch(self):
+        """
+        Check reading and writing multiple VAs at once
+        """
+        values, errors = self.comp.getVAValues(["prop", "cont", "enum", "nonexistent"])
+        self.assertEqual(values, {"prop": 42, "cont": 2.0, "enum": "a"})
+        self.assertEqual(set(errors.keys()), {"nonexistent"})
+        self.assertIsInstance(errors["nonexistent"], AttributeError)
+
+        # One VA is set to an out-of-range value, the other ones should still be set
+        values, errors = self.comp.setVAValues({"prop": 12, "cont": 10.0, "enum": "c"})
+        self.assertEqual(values, {"prop": 12, "enum": "c"})
+        self.assertEqual(set(errors.keys()), {"cont"})
+        self.assertEqual(self.comp.prop.value, 12)
+        self.assertEqual(self.comp.cont.value, 2.0)
+        self.assertEqual(self.comp.enum.value, "c")
+
+        # With a subscribed VA, it should be read from the cache
+        self.called = 0
+        self.last_value = None
+        self.comp.prop.subscribe(self.receive_va_update, init=True)
+        self.comp.change_prop(13)
+        time.sleep(0.1)
+        self.assertEqual(self.comp.prop._get_cached_value(), (True, 13))
+        values, errors = self.comp.getVAValues(["prop", "enum"])
+        self.assertEqual(values, {"prop": 13, "enum": "c"})
+        self.assertEqual(errors, {})
+        self.comp.prop.unsubscribe(self.receive_va_update)
+
+    def test_va_cache_dependent(self):
+        """
+        Check that reading a VA which depends on another VA just set is up-to-date
+        """
+        self.called = 0
+        self.last_value = None
+        res_values = []
+        self.comp.binning.subscribe(self.receive_va_update)
+        self.comp.resolution.subscribe(res_values.append)
+        try:
+            self.comp.binning.value = 2
+            time.sleep(0.1)  # give time to receive notifications
+            self.assertEqual(self.comp.resolution._get_cached_value(), (True, (512, 512)))
+
+            # No waiting => the notification of the resolution is probably not yet received
+            self.comp.binning.value = 4
+            self.assertEqual(self.comp.resolution.value, (256, 256))
+            self.comp.setVAValues({"binning": 1})
+            self.assertEqual(self.comp.resolution.value, (1024, 1024))
+        finally:
+            self.comp.binning.unsubscribe(self.receive_va_update)
+            self.comp.resolution.unsubscribe(res_values.append)
+
     def receive_va_update(self, value):
         logging.debug("Update va to %s", value)
         self.called += 1
@@ -904,12 +1350,24 @@ class MyComponent(model.Component):
         self.cont = model.FloatContinuous(2.0, [-1, 3.4], unit="C")
         self.enum = model.StringEnumerated("a", {"a", "c", "bfds"})
         self.cut = model.IntVA(0, setter=self._setCut)
+        self.flip = model.BooleanVA(False, setter=self._setFlip)
         self.listval = model.ListVA([2, 65])
+        # resolution depends on binning
+        self.resolution = model.TupleVA((1024, 1024), readonly=True)
+        self.binning = model.IntVA(1, setter=self._setBinning)
+
+    def _setBinning(self, value):
+        self.resolution._set_value((1024 // value, 1024 // value), force_write=True)
+        return value
 
     def _setCut(self, value):
         self.data.cut = value
         return self.data.cut
 
+    def _setFlip(self, value):
+        self.data.flip = value
+        return self.data.flip
+
     @roattribute
     def my_value(self):
         return "ro"
@@ -1048,6 +1506,7 @@ class FakeDataFlow(model.DataFlow):
         self._thread = None
         self.count = 0
         self.cut = 0 # to test non stride arrays
+        self.flip = False  # to test transposed and flipped arrays
         self._startAcquire = sae
 
     def _create_one(self, shape, bpp, index):
@@ -1059,9 +1518,10 @@ class FakeDataFlow(model.DataFlow):
         if shape[0] > 0:
             array[index % shape[0], :] = 255
         if self.cut:
-            return array[:, self.cut:]
-        else:
-            return array
+            array = array[:, self.cut:]
+        if self.flip:
+            array = array.T[::-1]
+        return array
 
     def reset(self):
         self.count = 0
@@ -1103,6 +1563,13 @@ class FakeDataFlow(model.DataFlow):
             array = self._create_one(self.shape, self.bpp, self.count)
             if len(array):
                 array[0][0] = self.count
+            # Mostly constant metadata, with some changing or appearing entries
+            array.metadata = {model.MD_ACQ_DATE: time.time(),
+                              model.MD_WL_LIST: list(range(1024)),
+                              model.MD_DESCRIPTION: "fake",
+                              "count": self.count}
+            if self.count % 3 == 0:
+                array.metadata["extra"] = self.count
 #            print "generating array %d" % self.count
             self.notify(array)
             time.sleep(0.05) # wait a bit see if the subscribers still want data
@@ -42,12 +42,16 @@ from odemis.model import ST_STARTING, ST_UNLOADED
 from odemis.odemisd import modelgen
 from odemis.odemisd.mdupdater import MetadataUpdater
 from odemis.util.conversion import YamlExtraDumper
+from odemis.util.imports import print_import_profile
 from odemis.util.driver import (BACKEND_DEAD, BACKEND_RUNNING,
                                 BACKEND_STARTING, BACKEND_STOPPED,
-                                get_backend_status)
+                                get_backend_status, get_startup_critical_path)
 
 DEFAULT_SETTINGS_FILE = "/etc/odemis-settings.yaml"
 
+# Maximum number of components instantiated simultaneously
+MAX_PARALLEL_INSTANTIATIONS = 20
+
 status_to_xtcode = {BACKEND_RUNNING: 0,
                     BACKEND_DEAD: 1,
                     BACKEND_STOPPED: 2,
@@ -82,6 +86,10 @@ class BackendContainer(model.Container):
         self._inst_thread = None # thread running the component instantiation
         self._must_stop = threading.Event()
         self._dry_run = dry_run
+        # Protects the read-modify-write of the microscope .ghosts, .alive and
+        # .startup VAs, as components are instantiated in parallel.
+        self._mic_lock = threading.Lock()
+        self._startup_logged = False
         # TODO: have an argument to ask for disabling parallel start? same as create_sub_containers?
 
         # parse the instantiation file
@@ -209,69 +217,28 @@ class BackendContainer(model.Container):
     def _instantiate_all(self):
         """
         Thread continuously monitoring the components that need to be instantiated
+        All the components whose dependencies are alive are instantiated in
+        parallel, and as soon as one is instantiated, the components depending
+        on it are started.
         """
         try:
             # Hack warning: there is a bug in python when using lock (eg, logging)
-            # and simultaneously using threads and process: is a thread acquires
-            # a lock while a process is created, it will never be released.
-            # See http://bugs.python.org/issue6721
-            # To ensure this is not happening, we wait long enough that all (2)
-            # threads have started (and logging nothing) before creating new processes.
+            # and simultaneously using threads and process: if a thread holds
+            # a lock while a process is forked, it will never be released in
+            # the new process. See http://bugs.python.org/issue6721
+            # To ensure this is not happening, the containers (processes) are
+            # only created from this thread, while no component is being
+            # instantiated (see _instantiate_all_parallel()). In addition, we
+            # wait long enough that all (2) threads have started (and logging
+            # nothing) before creating new processes.
             time.sleep(1)
 
-            mic = self._instantiator.microscope
-            failed = set() # set of str: name of components that failed recently
-            while not self._must_stop.is_set():
-                # Try to start simultaneously all the components that are
-                # independent from each other
-                nexts = set()
-                while not nexts:
-                    instantiated = set(c.name for c in mic.alive.value) | {mic.name}
-                    nexts = self._instantiator.get_instantiables(instantiated)
-                    # If still some non-failed component, immediately try again,
-                    # otherwise give some time for things to get fixed or broken
-                    nexts -= failed
-                    if not nexts:
-                        if self._dry_run:
-                            return # everything instantiated, good enough
-
-                        if self._must_stop.wait(10):
-                            return
-                        failed = set() # not recent anymore
-
-                logging.debug("Trying to instantiate comps: %s", ", ".join(nexts))
-
-                for n in nexts:
-                    ghosts = mic.ghosts.value.copy()
-                    if n not in ghosts:
-                        logging.warning("going to instantiate %s but not a ghost", n)
-                    # TODO: run each of them in a future, so that they start
-                    # in parallel, and (bonus) when the future is done, check
-                    # immediately which component can be started. The only
-                    # difficulty is to ensure non-concurrent access to .ghosts
-                    # and .alive .
-                    try:
-                        ghosts[n] = ST_STARTING
-                        mic.ghosts.value = ghosts
-                        newcmps = self._instantiate_component(n)
-                        if self._must_stop.is_set():
-                            # in case the termination was too late to stop these new component
-                            for c in newcmps:
-                                try:
-                                    c.terminate()
-                                except Exception:
-                                    logging.warning("Failed to terminate component '%s'", c.name, exc_info=True)
-                            break
-                    except ValueError:
-                        if self._dry_run:
-                            raise
-                        # We now need to stop, but cannot call terminate()
-                        # directly, as it would deadlock, waiting for us
-                        logging.debug("Stopping instantiation due to unrecoverable error")
-                        threading.Thread(target=self.terminate).start()
-                        return
-                    if not newcmps:
-                        failed.add(n)
+            executor = futures.ThreadPoolExecutor(max_workers=MAX_PARALLEL_INSTANTIATIONS,
+                                                  thread_name_prefix="Component instantiation")
+            try:
+                self._instantiate_all_parallel(executor)
+            finally:
+                executor.shutdown(wait=False)
             self._update_persistent_metadata()
 
         except Exception:
@@ -280,9 +247,167 @@ class BackendContainer(model.Container):
         finally:
             logging.debug("Instantiator thread finished")
 
+    def _instantiate_all_parallel(self, executor):
+        """
+        Schedule the instantiation of the components, until all of them are
+          instantiated (in dry-run), or the backend is stopped.
+        executor (ThreadPoolExecutor): the executor to run the instantiations
+        Components which run in their own container are only started when no
+          other component is being instantiated: first, their container is created
+          (which forks the process) from this thread, and then they are instantiated
+          in parallel like any other component.
+        raise ValueError: if a component failed to instantiate (only in dry-run)
+        """
+        mic = self._instantiator.microscope
+        failed = set()  # set of str: name of components that failed recently
+        starting = {}  # Future -> str: name of the component being instantiated
+        tstart = time.time()
+        while not self._must_stop.is_set():
+            # Start simultaneously all the components that are ready
+            with self._mic_lock:
+                instantiated = set(c.name for c in mic.alive.value) | {mic.name}
+            nexts = self._instantiator.get_instantiables(instantiated)
+            nexts -= failed | set(starting.values())
+            # Components needing a new container have to wait that no other
+            # instantiation is running, to fork the process safely.
+            forking = {n for n in nexts if self._instantiator.needs_new_container(n)}
+            if forking:
+                if starting:
+                    nexts -= forking
+                else:
+                    for n in sorted(forking):
+                        try:
+                            self._instantiator.create_container(n)
+                        except Exception as exp:
+                            logging.exception("Failed to create the container for component %s", n)
+                            self._update_ghost(n, exp)
+                            failed.add(n)
+                            nexts.discard(n)
+            if nexts:
+                logging.debug("Trying to instantiate comps: %s", ", ".join(nexts))
+            for n in nexts:
+                self._update_ghost(n, ST_STARTING)
+                f = executor.submit(self._instantiate_timed, n)
+                starting[f] = n
+
+            if not starting:
+                # If still some non-failed component, immediately try again,
+                # otherwise give some time for things to get fixed or broken
+                if self._dry_run:
+                    return  # everything instantiated, good enough
+                if not failed:
+                    self._log_startup_timeline(tstart)
+                if self._must_stop.wait(10):
+                    return
+                failed = set()  # not recent anymore
+                continue
+
+            # Block until one instantiation is completed, then look for the
+            # components which can now be instantiated.
+            done, _ = futures.wait(starting, return_when=futures.FIRST_COMPLETED)
+            for f in done:
+                n = starting.pop(f)
+                try:
+                    newcmps = f.result()
+                except ValueError:
+                    # Let the other instantiations finish, so that the components
+                    # are all known when terminating
+                    futures.wait(starting)
+                    if self._dry_run:
+                        raise
+                    # We now need to stop, but cannot call terminate()
+                    # directly, as it would deadlock, waiting for us
+                    logging.debug("Stopping instantiation due to unrecoverable error")
+                    threading.Thread(target=self.terminate).start()
+                    return
+                if not newcmps:
+                    failed.add(n)
+
+        # In case the termination was too late to stop the new components
+        for f in futures.as_completed(starting):
+            try:
+                newcmps = f.result()
+            except ValueError:
+                continue
+            for c in newcmps:
+                try:
+                    c.terminate()
+                except Exception:
+                    logging.warning("Failed to terminate component '%s'", c.name, exc_info=True)
+
+    def _instantiate_timed(self, name):
+        """
+        Instantiate a component, and record the time it took in the microscope
+          .startup VA
+        return (set of HwComponent): see _instantiate_component()
+        raise ValueError: see _instantiate_component()
+        """
+        start = time.time()
+        newcmps = self._instantiate_component(name)
+        end = time.time()
+        if newcmps:
+            logging.info("Component %s instantiated in %g s", name, end - start)
+            self._update_startup(name, start, end)
+        return newcmps
+
+    def _update_startup(self, name, start, end):
+        """
+        Add the instantiation of a component to the startup timeline
+        name (str): the (explicitly created) component
+        start (float): time at which the instantiation started
+        end (float): time at which the instantiation ended
+        """
+        mic = self._instantiator.microscope
+        ast = self._instantiator.ast
+        with self._mic_lock:
+            timeline = mic.startup.value.copy()
+            # Find the dependency which was ready the latest. Components created
+            # by delegation are ready at the same time as their creator.
+            waited, waited_end = None, None
+            for d in self._instantiator.get_dependencies_names(name):
+                d = ast[d].get("creator", d)
+                if d in timeline and (waited_end is None or timeline[d][1] > waited_end):
+                    waited, waited_end = d, timeline[d][1]
+            timeline[name] = (start, end, waited)
+            mic.startup.value = timeline
+
+    def _log_startup_timeline(self, tstart):
+        """
+        Log the startup timeline, once all the components are instantiated.
+        Only done the first time it's called.
+        tstart (float): time at which the instantiation started
+        """
+        if self._startup_logged:
+            return
+        self._startup_logged = True
+
+        timeline = self._instantiator.microscope.startup.value
+        if not timeline:
+            return
+        tend = max(e for s, e, w in timeline.values())
+        path = get_startup_critical_path(timeline)
+        logging.info("All components instantiated in %g s, critical path: %s",
+                     tend - tstart,
+                     " -> ".join("%s (%g s)" % (n, timeline[n][1] - timeline[n][0]) for n in path))
+
+    def _update_ghost(self, name, state):
+        """
+        Change the state of a component in the microscope .ghosts VA
+        name (str): name of the component
+        state (int or Exception): new state
+        """
+        mic = self._instantiator.microscope
+        with self._mic_lock:
+            ghosts = mic.ghosts.value.copy()
+            if name not in ghosts:
+                logging.warning("going to instantiate %s but not a ghost", name)
+            ghosts[name] = state
+            mic.ghosts.value = ghosts
+
     def _instantiate_component(self, name):
         """
         Instantiate a component and handle the outcome
+        Can be called simultaneously from several threads, for different components.
         return (set of HwComponent): all the components instantiated, so it is an
           empty set if the component failed to instantiate (due to HwError)
         raise ValueError: if the component failed so badly to instantiate that
@@ -291,15 +416,16 @@ class BackendContainer(model.Container):
         # TODO: use the AST from the microscope (instead of the original one
         # in _instantiator) to allow modifying it online?
         mic = self._instantiator.microscope
-        ghosts = mic.ghosts.value.copy()
         try:
             comp = self._instantiator.instantiate_component(name)
         except model.HwError as exp:
             # HwError means: hardware problem, try again later
             logging.warning("Failed to start component %s due to device error: %s",
                             name, exp)
-            ghosts[name] = exp
-            mic.ghosts.value = ghosts
+            with self._mic_lock:
+                ghosts = mic.ghosts.value.copy()
+                ghosts[name] = exp
+                mic.ghosts.value = ghosts
             return set()
         except Exception as exp:
             # Anything else means: microscope file or driver is borked => give up
@@ -326,13 +452,13 @@ class BackendContainer(model.Container):
                 logging.warning("Component %s instantiated extra unexpected components %s",
                                 name, new_names - exp_names)
 
-            mic.alive.value = mic.alive.value | new_cmps
-            # update ghosts by removing all the new components
-            dchildren = self._instantiator.get_children_names(name)
-            for n in dchildren:
-                del ghosts[n]
-
-            mic.ghosts.value = ghosts
+            with self._mic_lock:
+                mic.alive.value = mic.alive.value | new_cmps
+                # update ghosts by removing all the new components
+                ghosts = mic.ghosts.value.copy()
+                for n in exp_names:
+                    del ghosts[n]
+                mic.ghosts.value = ghosts
 
             for c in new_cmps:
                 prop_names, _ = self._instantiator.get_persistent(c.name)
@@ -688,6 +814,10 @@ def main(args):
                          help="Validate the microscope description file and exit")
     opt_grp.add_argument("--strict-children", dest="strict_children", action="store_true", default=False,
                          help="Stricter microscope file check forbidding using children as dependencies")
+    opt_grp.add_argument("--profile-imports", dest="profile_imports", nargs="?", metavar="module",
+                         const="odemis.odemisd.main", default=None,
+                         help="Display the modules which take the most time to import at start-up "
+                              "(or when importing the given module, such as a driver), and exit")
     opt_grp.add_argument("--debug", action="store_true", dest="debug",
                          default=False, help="Activate debug mode, where everything runs in one process")
     opt_grp.add_argument("--log-level", dest="loglev", metavar="LEVEL", type=int,
@@ -712,6 +842,14 @@ def main(args):
               "Licensed under the " + odemis.__license__)
         return 0
 
+    if options.profile_imports:
+        try:
+            print_import_profile(options.profile_imports)
+        except ImportError as exp:
+            print(exp, file=sys.stderr)
+            return 127
+        return 0
+
     # Set up logging before everything else
     if options.loglev < 0:
         parser.error("log-level must be positive.")
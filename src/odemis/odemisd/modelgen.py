@@ -29,6 +29,7 @@ import itertools
 import logging
 import os
 import re
+import threading
 import yaml
 
 from odemis import model
@@ -263,6 +264,9 @@ class Instantiator(object):
         self.create_sub_containers = create_sub_containers # flag for creating sub-containers
         self.dry_run = dry_run # flag for instantiating mock version of the components
         self.strict_children = strict_children  # Flag to indicate
+        # Protects .components, .sub_containers and ._comp_container, as the
+        # components can be instantiated from several threads simultaneously
+        self._lock = threading.RLock()
 
         self._check_structure()
         self._preparate_microscope()
@@ -613,7 +617,7 @@ class Instantiator(object):
 
         # If it's a leaf, use its own container
         if self.create_sub_containers and self.is_leaf(name):
-            return None
+            return self.sub_containers.get(name)
 
         # If it's not a leaf, it's probably a wrapper (eg, MultiplexActuator),
         # which is simple Python code and so doesn't need to run in a
@@ -650,6 +654,33 @@ class Instantiator(object):
         # Multiple dependencies -> just use the root container then
         return self.root_container
 
+    def needs_new_container(self, name):
+        """
+        Check whether a component will run in its own container, which is not
+          yet created.
+        name (str): name of the component to instantiate
+        return (bool): True if a new container should be created, with create_container()
+        """
+        attr = self.ast[name]
+        if not self.create_sub_containers or attr.get("class") == "Microscope":
+            return False
+        with self._lock:
+            return name not in self.sub_containers and self.is_leaf(name)
+
+    def create_container(self, name):
+        """
+        Create the container in which a component will run.
+        As it creates a new process (by forking), it should be called while no
+          other thread is busy.
+        name (str): name of the component, which will also be the name of the
+          container
+        return (Container): the new container
+        """
+        cont = model.createNewContainer(name, validate=False)
+        with self._lock:
+            self.sub_containers[name] = cont
+        return cont
+
     def _instantiate_comp(self, name):
         """
         Instantiate a component
@@ -692,24 +723,43 @@ class Instantiator(object):
             class_comp = mock.MockComponent
 
         try:
-            cont = self._get_container(name)
+            with self._lock:
+                cont = self._get_container(name)
             if cont is None:
                 # new container has the same name as the component
                 cont, comp = model.createInNewContainer(name, class_comp, args)
-                self.sub_containers[name] = cont
+                with self._lock:
+                    self.sub_containers[name] = cont
             else:
                 logging.debug("Creating %s in container %s", name, cont)
-                comp = model.createInContainer(cont, class_comp, args)
-            self._comp_container[name] = cont
+                try:
+                    comp = model.createInContainer(cont, class_comp, args)
+                except Exception:
+                    # If the container was created just for this component, stop it
+                    with self._lock:
+                        own_cont = self.sub_containers.get(name) is cont
+                        if own_cont:
+                            del self.sub_containers[name]
+                    if own_cont:
+                        try:
+                            cont.terminate()  # Non blocking
+                        except Exception:
+                            logging.exception("Failed to stop the container %s after component failure",
+                                              name)
+                    raise
+            with self._lock:
+                self._comp_container[name] = cont
         except Exception:
             logging.error("Error while instantiating component %s.", name)
             raise
 
-        self.components.add(comp)
-        # Add all the children, which were created by delegation, to our list of components.
-        self.components |= comp.children.value
-        for child in comp.children.value:
-            self._comp_container[child.name] = cont
+        children = comp.children.value
+        with self._lock:
+            self.components.add(comp)
+            # Add all the children, which were created by delegation, to our list of components.
+            self.components |= children
+            for child in children:
+                self._comp_container[child.name] = cont
 
         return comp
 
@@ -721,9 +771,10 @@ class Instantiator(object):
         Raises:
              LookupError: if no component is found
         """
-        for comp in self.components:
-            if comp.name == name:
-                return comp
+        with self._lock:
+            for comp in self.components:
+                if comp.name == name:
+                    return comp
         raise LookupError("No component named '%s' found" % name)
 
     def get_children_names(self, name):
@@ -911,9 +962,10 @@ class Instantiator(object):
             ValueError: if the component has already been instantiated
             KeyError: if component should be created by delegation
         """
-        for c in self.components:
-            if c.name == name:
-                raise ValueError("Trying to instantiate again component %s" % name)
+        with self._lock:
+            for c in self.components:
+                if c.name == name:
+                    raise ValueError("Trying to instantiate again component %s" % name)
 
         comp = self._instantiate_comp(name)
 
@@ -926,6 +978,31 @@ class Instantiator(object):
 
         return comp
 
+    def get_dependencies_names(self, name):
+        """
+        Find the components which must be instantiated before the given component
+        can be instantiated: its dependencies, its power supplier, and the ones
+        of the children it creates by delegation.
+        name (str): name of the component (created explicitly)
+        return (set of str): names of the components needed
+        """
+        attrs = self.ast[name]
+        deps = set(attrs.get("dependencies", {}).values())
+        if "power_supplier" in attrs:  # the power supplier is just some special dependency
+            deps.add(attrs["power_supplier"])
+
+        for child in attrs.get("children", {}).values():
+            child_attrs = self.ast[child]
+            if child_attrs.get("creator") == name:
+                # All the children should also have their dependencies instantiated
+                deps |= set(child_attrs.get("dependencies", {}).values())
+                if "power_supplier" in child_attrs:
+                    deps.add(child_attrs["power_supplier"])
+            else:  # Old style dependencies (legacy code)
+                deps.add(child)
+
+        return deps
+
     def get_instantiables(self, instantiated=None):
         """
         Find the components that are currently not yet instantiated, but
@@ -938,43 +1015,18 @@ class Instantiator(object):
         """
         comps = set()
         if instantiated is None:
-            instantiated = set(c.name for c in self.components)
+            with self._lock:
+                instantiated = set(c.name for c in self.components)
         for n, attrs in self.ast.items():
             if n in instantiated: # should not be already instantiated
                 continue
             if "class" not in attrs: # created by delegation
                 continue
-            if "power_supplier" in attrs:
-                psuname = attrs["power_supplier"]
-                if psuname not in instantiated:
-                    logging.debug("Component %s is not instantiable yet (needs %s)", n, psuname)
-                    continue
-
-            # All the children should also have their dependencies instantiated
-            all_children_instantiable = True
-            for child in attrs.get("children", {}).values():
-                child_attrs = self.ast[child]
-                if child_attrs.get("creator") != n:  # Old style dependencies => skip
-                    continue
-                deps = list(child_attrs.get("dependencies", {}).values())
-                if "power_supplier" in child_attrs:  # the power supplier is just some special dependency
-                    deps.append(child_attrs["power_supplier"])
-                for name in deps:
-                    if name not in instantiated:
-                        logging.debug("Component %s is not instantiable yet (%s needs %s)", n, child, name)
-                        all_children_instantiable = False
-                        break
-            if not all_children_instantiable:
-                continue
 
-            # All its dependencies should be instantiated
-            deps = list(attrs.get("dependencies", {}).values())
-            # support legacy code
-            deps += [c for c in attrs.get("children", {}).values() if self.ast[c].get("creator") != n]
-            for name in deps:
-                if name not in instantiated:
-                    logging.debug("Component %s is not instantiable yet", n)
-                    break
+            missing = self.get_dependencies_names(n) - instantiated
+            if missing:
+                logging.debug("Component %s is not instantiable yet (needs %s)",
+                              n, ", ".join(sorted(missing)))
             else:
                 comps.add(n)
 
@@ -29,8 +29,10 @@ import logging
 import os
 import subprocess
 import sys
+import threading
 import time
 import unittest
+from concurrent import futures
 
 import yaml
 
@@ -527,6 +529,157 @@ class TestCommandLine(unittest.TestCase):
         return ret
 
 
+class FakeComponent(object):
+    """
+    Minimal stand-in for a component, as seen by the BackendContainer
+    """
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeInstantiator(object):
+    """
+    Instantiator which doesn't create any component, but just records when
+    each of them is instantiated, and checks the order is correct.
+    """
+    def __init__(self, deps, in_container=(), duration=0.1):
+        """
+        deps (dict str -> set of str): component name -> names of its dependencies
+        in_container (set of str): names of the components running in their own container
+        duration (float): time (in s) it takes to instantiate each component
+        """
+        self.ast = {n: {"class": "Fake"} for n in deps}
+        self.ast["Microscope"] = {"class": "Microscope"}
+        self._deps = deps
+        self._duration = duration
+        self.microscope = FakeComponent("Microscope")
+        self.microscope.alive = model.VigilantAttribute(set())
+        self.microscope.ghosts = model.VigilantAttribute({n: model.ST_UNLOADED for n in deps})
+        self.microscope.startup = model.VigilantAttribute({})
+        self.sub_containers = {}
+        self._to_containerize = set(in_container)
+        self._lock = threading.Lock()
+        self.running = set()  # names of the components currently being instantiated
+        self.events = []  # (str, str, set of str): action, name, components being instantiated
+
+    def get_instantiables(self, instantiated):
+        return {n for n, d in self._deps.items()
+                if n not in instantiated and d <= instantiated}
+
+    def get_dependencies_names(self, name):
+        return self._deps[name]
+
+    def get_children_names(self, name):
+        return {name}
+
+    def get_children(self, comp):
+        return {comp}
+
+    def get_persistent(self, name):
+        return [], []
+
+    def needs_new_container(self, name):
+        return name in self._to_containerize and name not in self.sub_containers
+
+    def create_container(self, name):
+        with self._lock:
+            self.events.append(("container", name, set(self.running)))
+        self.sub_containers[name] = name
+        return name
+
+    def instantiate_component(self, name):
+        with self._lock:
+            alive = {c.name for c in self.microscope.alive.value} | {self.microscope.name}
+            self.events.append(("start", name, alive))
+            self.running.add(name)
+        time.sleep(self._duration)
+        with self._lock:
+            self.running.discard(name)
+        return FakeComponent(name)
+
+
+class TestParallelInstantiation(unittest.TestCase):
+    """
+    Test the scheduling of the component instantiation of the BackendContainer,
+    without actually creating the back-end.
+    """
+
+    def _create_backend(self, instantiator):
+        backend = main.BackendContainer.__new__(main.BackendContainer)
+        backend._instantiator = instantiator
+        backend._must_stop = threading.Event()
+        backend._dry_run = True
+        backend._mic_lock = threading.Lock()
+        backend._startup_logged = False
+        backend._persistent_listeners = []
+        return backend
+
+    def _instantiate(self, instantiator):
+        backend = self._create_backend(instantiator)
+        executor = futures.ThreadPoolExecutor(max_workers=main.MAX_PARALLEL_INSTANTIATIONS)
+        try:
+            backend._instantiate_all_parallel(executor)
+        finally:
+            executor.shutdown()
+
+    def test_dependency_order(self):
+        """
+        The independent components are instantiated simultaneously, and the
+        components are only instantiated after all their dependencies.
+        """
+        deps = {"a": {"Microscope"},
+                "b": {"Microscope"},
+                "c": {"Microscope"},
+                "d": {"a"},
+                "e": {"a", "b"},
+                "f": {"d", "e"},
+                }
+        inst = FakeInstantiator(deps, duration=0.2)
+        tstart = time.time()
+        self._instantiate(inst)
+        dur = time.time() - tstart
+
+        started = [n for a, n, _ in inst.events]
+        self.assertEqual(set(started), set(deps.keys()))
+        self.assertEqual(len(started), len(deps))  # each component only once
+        for a, n, alive in inst.events:
+            self.assertLessEqual(deps[n], alive, "%s started before its dependencies" % n)
+
+        alive = {c.name for c in inst.microscope.alive.value}
+        self.assertEqual(alive, set(deps.keys()))
+        self.assertEqual(inst.microscope.ghosts.value, {})
+        self.assertEqual(set(inst.microscope.startup.value.keys()), set(deps.keys()))
+        self.assertIn(inst.microscope.startup.value["f"][2], {"d", "e"})
+
+        # a -> d -> f is the critical path: 3 * 0.2 s, while it would take
+        # 6 * 0.2 s if instantiated serially.
+        self.assertLess(dur, 6 * 0.2)
+
+    def test_container_serialized(self):
+        """
+        The containers are only created while no component is being instantiated
+        """
+        deps = {"a": {"Microscope"},
+                "b": {"Microscope"},
+                "c": {"Microscope"},
+                "d": {"a"},
+                "e": {"a"},
+                }
+        inst = FakeInstantiator(deps, in_container={"b", "c", "e"})
+        self._instantiate(inst)
+
+        started = [n for a, n, _ in inst.events if a == "start"]
+        self.assertEqual(set(started), set(deps.keys()))
+        created = set()
+        for a, n, running in inst.events:
+            if a == "container":
+                self.assertEqual(running, set(), "Container %s created while instantiating %s" % (n, running))
+                created.add(n)
+            elif n in inst.sub_containers:
+                self.assertIn(n, created, "Component %s instantiated before its container" % (n,))
+        self.assertEqual(created, {"b", "c", "e"})
+
+
 # extends the class fully at module
 TestCommandLine.create_tests()
 
@@ -19,17 +19,16 @@ You should have received a copy of the GNU General Public License along with Ode
 If not, see http://www.gnu.org/licenses/.
 """
 
+import collections
 import logging
 import math
+import threading
 from typing import List, Optional, Tuple
 
 import matplotlib
 matplotlib.use("Agg")  # use non-GUI backend
-import matplotlib.pyplot as plt
 import numpy
 from numpy import ma
-from scipy.interpolate import LinearNDInterpolator
-from scipy.spatial import Delaunay as DelaunayTriangulation
 
 from odemis import model
 from odemis.model import (MD_POL_DOCP, MD_POL_DOLP, MD_POL_DOP, MD_POL_DS1,
@@ -38,7 +37,11 @@ from odemis.model import (MD_POL_DOCP, MD_POL_DOLP, MD_POL_DOP, MD_POL_DS1,
                           MD_POL_S2, MD_POL_S2N, MD_POL_S3, MD_POL_S3N,
                           MD_POL_UP)
 from odemis.util import img
+from odemis.util.imports import lazy_import
 
+plt = lazy_import("matplotlib.pyplot")
+spatial = lazy_import("scipy.spatial")
+sparse = lazy_import("scipy.sparse")
 
 # Functions to convert/manipulate Angle resolved image to polar projection
 # Based on matlab script created by Ernst Jan Vesseur (from AMOLF).
@@ -57,6 +60,18 @@ DEFAULT_SLIT_WIDTH = 10e-6  # m, width of the slit used in the spectrometer
 DEFAULT_SENSOR_PIXEL_SIZE = (10e-6, 10e-6)  # m, pixel size of the sensor used in the spectrometer
 DEFAULT_BINNING = (1, 1)  # (x, y) binning of the sensor used in the spectrometer
 
+# Parameters of the conversion to theta/phi representation, when exporting the raw data
+AR_RAW_OUTPUT_SIZE = (90, 360)  # px, theta x phi. Note: increase if data is high def
+AR_RAW_MAX_PIXELS = 800 * 800  # px, larger images are reduced before conversion
+AR_RAW_RESIZE = 768  # px, size of the largest dimension of the reduced images
+
+# Maximum number of projection plans kept in memory. There is one plan per
+# combination of AR image geometry (shape, pole position, mirror...) and output size.
+AR_PLAN_CACHE_SIZE = 8
+# key -> scipy.sparse.csr_matrix, least recently used first
+_plan_cache = collections.OrderedDict()
+_plan_cache_lock = threading.Lock()
+
 
 def _ExtractAngleInformation(data, hole):
     """
@@ -211,12 +226,133 @@ def AngleResolved2Polar(data, output_size, hole=True):
 
     data = _flipDataIfMirrorFlipped(data)
 
+    # The projection only depends on the geometry, which is typically identical for all the
+    # images of an acquisition => it's precomputed once, and applied as a (sparse) matrix.
+    plan = _get_projection_plan(_compute_polar_plan, data, output_size, hole)
+    qz = plan.dot(data.ravel()).reshape(output_size, output_size)
+
+    # polar coordinate transformation starts with 0 at horizontal axis by definition
+    qz = numpy.rot90(qz)  # rotate by 90 degrees CCW so we start 0 at top (angles will be CW orientated)
+    assert numpy.all(qz > -1)  # there should be no negative values, some very small due to interpolation are possible
+    qz[qz < 0] = 0  # all negative values (due to interpolation or wrong background subtraction) set to zero
+
+    return model.DataArray(qz, data.metadata)
+
+
+def AngleResolved2Rectangular(data, output_size, hole=True):
+    """
+    Converts an angle resolved image to equirectangular (aka cylindrical) projection (ie, phi/theta axes).
+    Note: Even if the input contains only positive values, there might be some small negative
+    values in the output due to interpolation. Also note, that NaNs occurring in the
+    interpolation step are set to 0.
+    :param data: (model.DataArray) The image that was projected on the detector after being
+                reflected on the parabolic mirror. The flat line of the D shape is
+                expected to be horizontal, at the top. It needs MD_PIXEL_SIZE and MD_AR_POLE
+                metadata. Pixel size is the sensor pixel size * binning / magnification.
+    :param output_size: (int, int) The size of the output DataArray (theta, phi),
+                not including the theta/phi angles at the first row/column.
+    :param hole: (boolean) Crop the pole if True.
+    :returns: (model.DataArray) Converted image in equi-rectangular view. Shape is output_size.
+    """
+
+    data = _flipDataIfMirrorFlipped(data)
+
+    # The projection only depends on the geometry => precomputed once, and applied as a matrix
+    plan = _get_projection_plan(_compute_rectangular_plan, data, tuple(output_size), hole)
+    qz = plan.dot(data.ravel()).reshape(output_size)
+    # Note: values outside of the data are 0 (and negative values are kept)
+
+    return model.DataArray(qz, data.metadata)
+
+
+def _get_projection_plan(compute, data, output_size, hole):
+    """
+    Get the projection plan for the given data, either from the cache, or by computing it.
+    :param compute: (callable) function computing the plan, with the same arguments
+      as this function (excepted compute).
+    :param data: (model.DataArray) The AR image (already flipped, if needed).
+    :param output_size: the size of the output image (as passed to compute)
+    :param hole: (boolean) Crop the pole if True.
+    :returns: (scipy.sparse.csr_matrix) The projection plan, of shape
+      (number of output pixels, number of data pixels).
+    """
+    md = data.metadata
+    try:
+        # The plan is independent of the actual data, only the geometry matters
+        key = (compute, output_size, hole, data.shape,
+               tuple(md[model.MD_PIXEL_SIZE]), tuple(md[model.MD_AR_POLE]),
+               md.get(model.MD_AR_PARABOLA_F, AR_PARABOLA_F),
+               md.get(model.MD_AR_XMAX, AR_XMAX),
+               md.get(model.MD_AR_HOLE_DIAMETER, AR_HOLE_DIAMETER),
+               md.get(model.MD_AR_FOCUS_DISTANCE, AR_FOCUS_DISTANCE))
+    except KeyError:
+        raise ValueError("Metadata required: MD_PIXEL_SIZE, MD_AR_POLE, MD_AR_PARABOLA_F.")
+
+    with _plan_cache_lock:
+        try:
+            plan = _plan_cache.pop(key)
+            _plan_cache[key] = plan  # Put it back as most recently used
+            return plan
+        except KeyError:
+            pass
+
+    # Compute it outside of the lock, as it's slow. In the worst case, it's
+    # computed simultaneously by multiple threads.
+    logging.debug("Computing AR projection plan for data of shape %s to %s", data.shape, output_size)
+    plan = compute(data, output_size, hole)
+    with _plan_cache_lock:
+        _plan_cache[key] = plan
+        while len(_plan_cache) > AR_PLAN_CACHE_SIZE:
+            _plan_cache.popitem(last=False)
+
+    return plan
+
+
+def _compute_interpolation_matrix(points, grid, data_idx, scale, data_size):
+    """
+    Computes the matrix equivalent to a linear interpolation over the Delaunay
+    triangulation of some points (ie, the same as LinearNDInterpolator).
+    :param points: (ndarray of shape (M, 2)) The position of the data points.
+    :param grid: (ndarray of shape (N, 2)) The positions where to interpolate.
+    :param data_idx: (ndarray of int of shape M) The index of each data point in the (flattened) data.
+    :param scale: (ndarray of float of shape M) Factor to apply to each data point.
+    :param data_size: (int) The number of elements in the data.
+    :returns: (scipy.sparse.csr_matrix of shape (N, data_size)) The value at each grid position
+      is computed by multiplying this matrix with the (flattened) data. Positions outside
+      of the triangulation are 0.
+    """
+    triang = spatial.Delaunay(points)
+    simplex = triang.find_simplex(grid)
+    inside = simplex >= 0
+    simplex = simplex[inside]
+
+    # Barycentric coordinates of each grid position within its triangle
+    transform = triang.transform[simplex]
+    bary = numpy.einsum("ijk,ik->ij", transform[:, :2, :], grid[inside] - transform[:, 2, :])
+    weights = numpy.column_stack((bary, 1 - bary.sum(axis=1)))
+    vertices = triang.simplices[simplex]
+
+    rows = numpy.repeat(numpy.flatnonzero(inside), 3)
+    values = (weights * scale[vertices]).ravel()
+    cols = data_idx[vertices].ravel()
+    # Drop the vertices which don't contribute (ie, the grid position is on the
+    # opposite edge), so that their value doesn't propagate if it's NaN or inf.
+    used = weights.ravel() != 0
+    # Note: duplicated entries (ie, a data point used twice) are summed
+    return sparse.csr_matrix((values[used], (rows[used], cols[used])), shape=(len(grid), data_size))
+
+
+def _compute_polar_plan(data, output_size, hole):
+    """
+    Computes the projection plan to convert an AR image to polar projection.
+    See _get_projection_plan() for the arguments.
+    """
     # calculate the corresponding theta and phi angles based on the geometrical properties
-    # of the mirror for each px on the raw data
-    # TODO the angles are all the same for a given mirror shape
-    # TODO runtime could be improved by calc mirror shape with pole pos at center and always move data to center
-    # TODO implement: if not theta, phi, intensity -> calc angles
-    theta_data, phi_data, intensity_data, circle_mask_dilated = _ExtractAngleInformation(data, hole)
+    # of the mirror for each px on the raw data. As the data is all 1's, the intensity data
+    # corresponds to the factor to apply to each px to obtain the intensity.
+    ones = model.DataArray(numpy.ones(data.shape), data.metadata)
+    theta_data, phi_data, intensity_data, circle_mask_dilated = _ExtractAngleInformation(ones, hole)
+    data_idx = numpy.arange(data.size).reshape(data.shape)
 
     # Crop the raw input data based on the mirror mask (circle_mask) to save memory and improve runtime.
     # We use a dilated mask for cropping to avoid edge effects during triangulation and interpolation.
@@ -224,6 +360,7 @@ def AngleResolved2Polar(data, output_size, hole=True):
     theta_data_masked = theta_data[circle_mask_dilated]  # list of values for theta within mask
     phi_data_masked = phi_data[circle_mask_dilated]  # list of values for phi within mask
     intensity_data_masked = intensity_data[circle_mask_dilated]  # list of values for intensity within mask
+    data_idx_masked = data_idx[circle_mask_dilated]
 
     # Convert the spherical coordinates theta and phi into polar coordinates for display in GUI
     # theta equals radial distance r to center of whole (0 - 90 degree)
@@ -238,82 +375,37 @@ def AngleResolved2Polar(data, output_size, hole=True):
     # Therefore, not all px in the output image are populated.
     # Moreover, the data is masked with the mirror shape (mask_circle).
     # Therefore, we perform a delaunay triangulation of the given data points.
-    # The delaunay object is passed to the interpolator with the corresponding intensity values (intensity_data).
-    # The interpolator also receives a meshgrid (set of coordinates) of the size specified for the output image.
-    # The input data points (theta and phi) are mapped on the meshgrid. As the meshgrid contains much more positions
-    # compared to the input data points, the interpolator fills up the empty grid positions with intensity values.
-    # These intensity values are interpolated from the intensity values of the positions spanning the triangle they
-    # are contained in (triangle from delaunay triangulation).
-    # Grid positions located outside of any delaunay triangle are set to NaN.
+    # The output image is filled with intensity values interpolated from the intensity values of the positions
+    # spanning the triangle they are contained in (triangle from delaunay triangulation).
+    # Grid positions located outside of any delaunay triangle are set to 0.
 
     # Note: delaunay triangulation input points: ndarray of floats, shape (numpyoints, ndim) -> transpose data for input
     data_transposed = numpy.array([x_data_polar, y_data_polar]).T  # transpose moves angle orientation from CCW to CW
-    triang = DelaunayTriangulation(data_transposed)
-    # create interpolation object
-    interp = LinearNDInterpolator(triang, intensity_data_masked.flat)
     # create grid of positions for interpolation: neg to pos as x/y data polar
     # contain now values from -output_size/2 to +output_size/2
     xi, yi = numpy.meshgrid(numpy.linspace(-output_size / 2, output_size / 2, output_size),
                             numpy.linspace(-output_size / 2, output_size / 2, output_size))
+    grid = numpy.column_stack((xi.ravel(), yi.ravel()))
 
-    # interpolate
-    qz = interp(xi, yi)
-    # polar coordinate transformation starts with 0 at horizontal axis by definition
-    qz = numpy.rot90(qz)  # rotate by 90 degrees CCW so we start 0 at top (angles will be CW orientated)
-    qz[numpy.isnan(qz)] = 0  # remove NaNs created during interpolation
-    assert numpy.all(qz > -1)  # there should be no negative values, some very small due to interpolation are possible
-    qz[qz < 0] = 0  # all negative values (due to interpolation or wrong background subtraction) set to zero
+    return _compute_interpolation_matrix(data_transposed, grid, data_idx_masked, intensity_data_masked,
+                                         data.size)
 
-    # plot the data
-    # plt.figure()
-    # plt.plot(theta_data_polar, phi_data_polar)
-    #
-    # plt.figure()
-    # plt.plot(triang.points[:, 0], triang.points[:, 1])
-    #
-    # plt.figure()
-    # plt.plot(triang.points[:, 0], triang.points[:, 1], 'o')
-    # plt.triplot(triang.points[:, 0], triang.points[:, 1], triang.simplices.copy())
-    # plt.title("delaunay tesselation (triangulation)")
 
-    return model.DataArray(qz, data.metadata)
-
-
-def AngleResolved2Rectangular(data, output_size, hole=True):
+def _compute_rectangular_plan(data, output_size, hole):
     """
-    Converts an angle resolved image to equirectangular (aka cylindrical) projection (ie, phi/theta axes).
-    Note: Even if the input contains only positive values, there might be some small negative
-    values in the output due to interpolation. Also note, that NaNs occurring in the
-    interpolation step are set to 0.
-    :param data: (model.DataArray) The image that was projected on the detector after being
-                reflected on the parabolic mirror. The flat line of the D shape is
-                expected to be horizontal, at the top. It needs MD_PIXEL_SIZE and MD_AR_POLE
-                metadata. Pixel size is the sensor pixel size * binning / magnification.
-    :param output_size: (int, int) The size of the output DataArray (theta, phi),
-                not including the theta/phi angles at the first row/column.
-    :param hole: (boolean) Crop the pole if True.
-    :returns: (model.DataArray) Converted image in equi-rectangular view. Shape is output_size.
+    Computes the projection plan to convert an AR image to equirectangular projection.
+    See _get_projection_plan() for the arguments.
     """
-
-    data = _flipDataIfMirrorFlipped(data)
-
     # calculate the corresponding theta and phi angles based on the geometrical properties
     # of the mirror for each px on the raw data
-    theta_data, phi_data, intensity_data, circle_mask_dilated = _ExtractAngleInformation(data, hole)
+    ones = model.DataArray(numpy.ones(data.shape), data.metadata)
+    theta_data, phi_data, intensity_data, circle_mask_dilated = _ExtractAngleInformation(ones, hole)
+    data_idx = numpy.arange(data.size).reshape(data.shape)
 
     # extend the data range to take care of edge effects during interpolation step
     # extend the range of phi from 0 - 2pi to -2pi to 4pi to take care of periodicity of phi
     # Note: Don't try to extend the image left and right by an amount < pi.
     # It will lead to the mentioned problems with the interpolation (even pi is not enough).
-    # e.g. don't try the following - it produces edge effects...
-    # num = int(phi_data.shape[0] / 4)  # = pi
-    # phi_data_edge = numpy.append(numpy.append((phi_data - 2 * math.pi)[:, -num:], phi_data, axis=1),
-    #                              (phi_data + 2 * math.pi)[:, :num], axis=1)
-    # theta_data_edge = numpy.append(numpy.append(theta_data[:,-num:], theta_data, axis=1), theta_data[:,:num], axis=1)
-    # intensity_data_edge = numpy.append(numpy.append(intensity_data[:,-num:], intensity_data, axis=1),
-    #                                      intensity_data[:,:num], axis=1)
-    # circle_mask_dilated_2 = numpy.append(numpy.append(circle_mask_dilated[:, -num:], circle_mask_dilated, axis=1),
-    #                                      circle_mask_dilated[:, :num], axis=1)
 
     # So triple the data for theta, intensity and mask, and extend phi to cover the range from -2pi to +4pi
     # for interpolation only use the data from -pi to +3pi, which is sufficient to take care of most edge effects
@@ -325,6 +417,7 @@ def AngleResolved2Rectangular(data, output_size, hole=True):
     theta_data_doubled = numpy.tile(theta_data, (1, 3))[:, low_border: high_border]
     intensity_data_doubled = numpy.tile(intensity_data, (1, 3))[:, low_border: high_border]
     circle_mask_dilated_doubled = numpy.tile(circle_mask_dilated, (1, 3))[:, low_border: high_border]
+    data_idx_doubled = numpy.tile(data_idx, (1, 3))[:, low_border: high_border]
 
     # Crop the raw input data based on the mirror mask (circle_mask) to save memory and improve runtime.
     # We use a dilated mask for cropping to avoid edge effects during triangulation.
@@ -332,33 +425,19 @@ def AngleResolved2Rectangular(data, output_size, hole=True):
     theta_data_masked = theta_data_doubled[circle_mask_dilated_doubled]  # list containing values from 0 to +pi/2
     phi_data_masked = phi_data_doubled[circle_mask_dilated_doubled]  # list containing values from -pi to + 3pi
     intensity_data_masked = intensity_data_doubled[circle_mask_dilated_doubled]
+    data_idx_masked = data_idx_doubled[circle_mask_dilated_doubled]
 
-    # Multiple theta-phi combinations will be mapped to the same px in the output image after polar-transformation.
-    # Therefore, not all px in the output image are populated.
-    # Moreover, the data is masked with the mirror shape (mask_circle).
-    # Therefore, we perform a delaunay triangulation of the given data points.
-    # The delaunay object is passed to the interpolator with the corresponding intensity values (intensity_data).
-    # The interpolator also receives a meshgrid (set of coordinates) of the size specified for the output image.
-    # The input data points (theta and phi) are mapped on the meshgrid. As the meshgrid contains much more positions
-    # compared to the input data points, the interpolator fills up the empty grid positions with intensity values.
-    # These intensity values are interpolated from the intensity values of the positions spanning the triangle they
-    # are contained in (triangle from delaunay triangulation).
-    # Grid positions located outside of any delaunay triangle are set to NaN.
-
+    # Perform a delaunay triangulation of the given data points, and interpolate the
+    # output image from it (see _compute_polar_plan() for more information).
     # Note: delaunay triangulation input points: ndarray of floats, shape (numpoints, ndim) -> transpose data for input
     data_transposed = numpy.array([phi_data_masked, theta_data_masked]).T
-    triang = DelaunayTriangulation(data_transposed)
-    # create interpolation object
-    interp = LinearNDInterpolator(triang, intensity_data_masked.flat)
     # create grid of positions for interpolation
     xi, yi = numpy.meshgrid(numpy.linspace(0, 2 * numpy.pi, output_size[1]),
                             numpy.linspace(0, numpy.pi / 2, output_size[0]))
+    grid = numpy.column_stack((xi.ravel(), yi.ravel()))
 
-    # interpolate
-    qz = interp(xi, yi)
-    qz[numpy.isnan(qz)] = 0  # remove NaNs created during interpolation but keep negative values
-
-    return model.DataArray(qz, data.metadata)
+    return _compute_interpolation_matrix(data_transposed, grid, data_idx_masked, intensity_data_masked,
+                                         data.size)
 
 
 def ARBackgroundSubtract(data):
@@ -398,6 +477,68 @@ def ARBackgroundSubtract(data):
     return model.DataArray(ret_data, data.metadata)
 
 
+def ARBackgroundCorrect(data, bg_image=None, clip_data=True):
+    """
+    Corrects the data for the background. If a background image is available, it's subtracted,
+    otherwise a simple background processing is done (see ARBackgroundSubtract()).
+    :param data: (model.DataArray) The data that will be background corrected. Must be 2D.
+    :param bg_image: (model.DataArray or None) The background image, of the same shape as the data.
+    :param clip_data: (bool) If True, data is clipped at 0. If False (e.g. csv export), negative
+      values are kept (only when a background image is passed).
+    :returns: (model.DataArray) The background corrected data.
+    """
+    if bg_image is None:
+        # Simple version: remove the background value, will clip data
+        return ARBackgroundSubtract(data)
+    elif clip_data:
+        return img.Subtract(data, bg_image)  # metadata from data
+    else:
+        # subtract bg image, but don't clip (keep negative values for export)
+        return model.DataArray(data.astype(numpy.float64) - bg_image.astype(numpy.float64),
+                               data.metadata)
+
+
+def ARResize(data, size):
+    """
+    Reduces a (very large) AR image, before converting it, as the conversion might fail
+    due to too much memory consumed (> 2Gb). As the output is much smaller than the input
+    image, it shouldn't actually affect much the output.
+    :param data: (2D model.DataArray) Image to resize.
+    :param size: (int) Size of the resized image in px. Size of the largest dimension. The aspect
+                 ratio is kept, when computing the other dimension.
+    :returns: (2D model.DataArray) Resized image.
+    """
+    logging.info("AR image is very large %s, will convert to projection in reduced precision.", data.shape)
+
+    y, x = data.shape
+    if y > x:
+        small_shape = size, int(round(size * x / y))
+    else:
+        small_shape = int(round(size * y / x)), size
+    return img.rescale_hq(data, small_shape)
+
+
+def AngleResolved2RawRectangular(data, bg_image=None):
+    """
+    Converts an AR image to the theta/phi representation used when exporting the raw data.
+    The background is subtracted, keeping the negative values.
+    :param data: (model.DataArray) The AR image. Must be 2D, with the metadata needed
+      by AngleResolved2Rectangular().
+    :param bg_image: (model.DataArray or None) The background image. If None, the baseline
+      is subtracted.
+    :returns: (model.DataArray) The data of shape AR_RAW_OUTPUT_SIZE (theta, phi).
+    """
+    calibrated = ARBackgroundCorrect(data, bg_image, clip_data=False)
+
+    # resize if too large to not run into memory problems
+    if calibrated.size > AR_RAW_MAX_PIXELS:
+        calibrated = ARResize(calibrated, AR_RAW_RESIZE)
+
+    projected = AngleResolved2Rectangular(calibrated, AR_RAW_OUTPUT_SIZE, hole=False)
+    projected.metadata[model.MD_ACQ_TYPE] = model.MD_AT_AR
+    return projected
+
+
 def _CropHalfCircle(data, pixel_size, pole_pos, offset_radius=0, hole=True):
     """
     Crops the image to half circle shape based on focus_distance, xmax, parabola_f, and hole_diameter.
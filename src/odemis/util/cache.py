@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 18 Oct 2026
+
+@author: agent
+
+Copyright © 2026 agent
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License version 2 as published by the Free
+Software Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Odemis. If not, see http://www.gnu.org/licenses/.
+"""
+import collections
+import threading
+
+import numpy
+
+
+def get_nbytes(value):
+    """
+    Estimate the memory used by a value, as stored in a cache.
+    value (numpy.ndarray, or dict/list/tuple of numpy.ndarray, or None)
+    return (0<=int): number of bytes used by the arrays
+    """
+    if isinstance(value, numpy.ndarray):
+        return value.nbytes
+    elif isinstance(value, dict):
+        return sum(get_nbytes(v) for v in value.values())
+    elif isinstance(value, (list, tuple)):
+        return sum(get_nbytes(v) for v in value)
+    else:  # Other types are considered negligible
+        return 0
+
+
+class LRUCache(object):
+    """
+    Least-recently-used cache of numpy arrays (or containers of numpy arrays),
+    bounded by the total memory used by the values. It is safe to use from
+    multiple threads.
+    """
+
+    def __init__(self, max_bytes):
+        """
+        max_bytes (0<=int): maximum number of bytes used by the values in the cache
+        """
+        self._max_bytes = max_bytes
+        self._values = collections.OrderedDict()  # key -> (value, nbytes), least recently used first
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+        # Statistics, for debugging
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def max_bytes(self):
+        """
+        (0<=int): maximum number of bytes used by the values in the cache. If
+          it is reduced, the least recently used values are dropped immediately.
+        """
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, value):
+        with self._lock:
+            self._max_bytes = value
+            self._shrink()
+
+    @property
+    def nbytes(self):
+        """
+        (0<=int): number of bytes used by the values currently in the cache
+        """
+        return self._nbytes
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, key):
+        # Note: doesn't count as an access (ie, not in the statistics, and
+        # the order is not changed)
+        return key in self._values
+
+    def get(self, key):
+        """
+        key (hashable): identifier of the value
+        return (object or None): the value, or None if it's not in the cache
+        """
+        with self._lock:
+            try:
+                self._values.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return self._values[key][0]
+
+    def put(self, key, value):
+        """
+        Add a value to the cache, and drop the least recently used values if the
+          cache is full.
+        key (hashable): identifier of the value
+        value (numpy.ndarray, or dict/list/tuple of numpy.ndarray): the value.
+          It should not be modified afterwards.
+        """
+        nbytes = get_nbytes(value)
+        if nbytes > self._max_bytes:
+            return  # Would just empty the cache for nothing
+
+        with self._lock:
+            old = self._values.pop(key, None)
+            if old is not None:
+                self._nbytes -= old[1]
+            self._values[key] = (value, nbytes)
+            self._nbytes += nbytes
+            self._shrink()
+
+    def _shrink(self):
+        """
+        Drop the least recently used values until the cache is not too big.
+        Must be called with the lock taken.
+        """
+        while self._nbytes > self._max_bytes:
+            _, (v, nbytes) = self._values.popitem(last=False)
+            self._nbytes -= nbytes
+            self.evictions += 1
+
+    def clear(self):
+        """
+        Remove all the values from the cache
+        """
+        with self._lock:
+            self._values.clear()
+            self._nbytes = 0
+
+    def get_stats(self):
+        """
+        return (dict str -> int): statistics about the cache usage: "hits",
+          "misses", "evictions", "entries", "nbytes", "max_bytes".
+        """
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "entries": len(self._values),
+                    "nbytes": self._nbytes,
+                    "max_bytes": self._max_bytes,
+                    }
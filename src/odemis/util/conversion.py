@@ -25,7 +25,6 @@ import re
 from collections.abc import Iterable
 from typing import Tuple
 
-import cv2
 import numpy
 import yaml
 from yaml.emitter import Emitter
@@ -34,6 +33,9 @@ from yaml.resolver import Resolver
 from yaml.serializer import Serializer
 
 from odemis import model
+from odemis.util.imports import lazy_import
+
+cv2 = lazy_import("cv2")
 
 
 def wavelength2rgb(wavelength):
@@ -382,15 +384,17 @@ def get_tile_md_pos(i, tile_size, tileda, origda):
         It can be smaller than the tile_size in case
     origda (DataArray or DataArrayShadow): the original/raw DataArray. If
         no MD_POS is provided, the image is considered located at (0,0).
-    return (float, float): the center position
+    return (float, float(, float)): the center position. If the original
+      position is 3D, the Z position is kept as-is.
     """
     md = origda.metadata
     tile_md = tileda.metadata
     md_pos = numpy.asarray(md.get(model.MD_POS, (0.0, 0.0)))
     if model.MD_PIXEL_SIZE not in md or model.MD_PIXEL_SIZE not in tile_md:
         raise ValueError("MD_PIXEL_SIZE must be set")
-    orig_ps = numpy.asarray(md[model.MD_PIXEL_SIZE])
-    tile_ps = numpy.asarray(tile_md[model.MD_PIXEL_SIZE])
+    # In case of 3D data, only X & Y matter
+    orig_ps = numpy.asarray(md[model.MD_PIXEL_SIZE])[:2]
+    tile_ps = numpy.asarray(tile_md[model.MD_PIXEL_SIZE])[:2]
 
     dims = md.get(model.MD_DIMS, "CTZYX"[-origda.ndim::])
     img_shape = [origda.shape[dims.index('X')], origda.shape[dims.index('Y')]]
@@ -398,7 +402,9 @@ def get_tile_md_pos(i, tile_size, tileda, origda):
     # center of the image in pixels
     img_center = img_shape / 2
 
-    tile_shape = [tileda.shape[dims.index('X')], tileda.shape[dims.index('Y')]]
+    # The tile might have less dimensions than the original data (eg, a single Z plane)
+    tile_dims = tile_md.get(model.MD_DIMS, dims)
+    tile_shape = [tileda.shape[tile_dims.index('X')], tileda.shape[tile_dims.index('Y')]]
     # center of the tile in pixels
     tile_center_pixels = numpy.array([
         i[0] * tile_size[0] + tile_shape[0] / 2,
@@ -421,8 +427,9 @@ def get_tile_md_pos(i, tile_size, tileda, origda):
     new_tile_pos_rel = tmat @ tile_rel_to_img_center_pixels
     new_tile_pos_rel = numpy.ravel(new_tile_pos_rel)
     # calculate the final position of the tile, in world coordinates
-    tile_pos_world_final = md_pos + new_tile_pos_rel
-    return tuple(tile_pos_world_final)
+    tile_pos_world_final = md_pos[:2] + new_tile_pos_rel
+    # The Z position (if any) is the same as the original data
+    return tuple(tile_pos_world_final) + tuple(md_pos[2:])
 
 
 def get_img_transformation_md(mat, timage, src_img):
@@ -21,9 +21,13 @@ see http://www.gnu.org/licenses/.
 """
 from __future__ import annotations  # allows the use of Python3.9 style typing in Python3.8
 
+import collections
 import json
 import logging
+import multiprocessing
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 from typing import Any, Optional, List, Tuple, Union
 
 import numpy
@@ -39,7 +43,7 @@ from odemis.acq.stream import (
     StaticSpectrumStream,
 )
 from odemis.model import MD_THETA_LIST, MD_TIME_LIST, MD_WL_LIST, DataArray, DataArrayShadow
-from odemis.util import img, rot_almost_equal
+from odemis.util import angleres, img, rot_almost_equal
 
 
 def data_to_static_streams(data):
@@ -156,6 +160,10 @@ def data_to_static_streams(data):
                 #      T  Z  X  Y
                 #     d[0,0] -> d[0,0,:,:]
                 d = d[(0,) * (d.ndim - 2)]
+            elif isinstance(d, model.DataArrayShadow) and hasattr(d, "maxzoom") and d.ndim > 3:
+                # Tiled data is only displayed as YX or ZYX => select the only
+                # image in the other dimensions (without reading the data)
+                d = d[(0,) * (d.ndim - (3 if d.shape[-3] > 1 else 2))]
 
         stream_instance = klass(name, d)
         result_streams.append(stream_instance)
@@ -389,6 +397,116 @@ def _use_scan_rotation_as_rotation(tiles: Tuple[model.DataArray]) -> Optional[fl
     return rot
 
 
+def _get_ar_background(background: Optional[List[DataArray]], pol_mode: str) -> Optional[DataArray]:
+    """
+    Find the background image corresponding to a polarization mode
+    :param background: the background images (or None)
+    :param pol_mode: the polarization mode of the data (MD_POL_NONE if no polarization)
+    :return: the background image matching the polarization, or None if not found
+    """
+    for bg in (background or []):
+        if bg.metadata.get(model.MD_POL_MODE, model.MD_POL_NONE) == pol_mode:
+            return bg
+    return None
+
+
+def _export_ar_position(data: DataArray, bg: Optional[DataArray], filename: str) -> float:
+    """
+    Convert one AR image into its theta/phi representation and save it to a file.
+    It is the same conversion as the raw export in the GUI (see ARRawProjection.projectAsRaw()).
+    Runs in a separate process (so it must be a top-level function).
+    :param data: the raw AR image (2D)
+    :param bg: background image to subtract. If None, the baseline is subtracted.
+    :param filename: the file to save the result to. The format is guessed from the extension.
+    :return: the duration of the conversion and export (s)
+    """
+    start = time.time()
+    projected = angleres.AngleResolved2RawRectangular(data, bg)
+
+    # Lossy formats are fine, as CSV is the most common format for this data
+    exporter = dataio.find_fittest_converter(filename, allowlossy=True)
+    exporter.export(filename, projected)
+    return time.time() - start
+
+
+def export_ar_batch(data: List[Union[DataArray, DataArrayShadow]], filename: str,
+                    background: Optional[List[DataArray]] = None,
+                    max_workers: Optional[int] = None) -> List[Tuple[str, float]]:
+    """
+    Convert every ebeam position of an AR acquisition to its theta/phi representation,
+    and save each of them in a separate file.
+    The conversions run in parallel, in a pool of processes, and each result is
+    written to disk by the process which computed it, as soon as it's ready.
+    :param data: the acquisition data. Only the AR data (ie, with MD_AR_POLE and MD_POS)
+      is converted, the rest is ignored.
+    :param filename: pattern for the names of the files. Each file is named
+      <base>_x<X>_y<Y>[_<pol mode>]<ext>, with X and Y the index of the ebeam position
+      in the scanned grid. The format is guessed from the extension (eg, .csv).
+    :param background: the background images, to be subtracted from the data with
+      the same polarization mode. If no background matches, the baseline is subtracted.
+    :param max_workers: number of processes to use. If None, uses the number of CPUs.
+    :return: the name of each file created, with the time it took to compute it (s),
+      in the same order as the data.
+    :raises ValueError: if the data doesn't contain any AR image
+    """
+    ar_data = [d for d in data if model.MD_AR_POLE in d.metadata and model.MD_POS in d.metadata]
+    if not ar_data:
+        raise ValueError("No AR data found")
+
+    # Index of each ebeam position in the grid. The positions of the same row
+    # (or column) can differ a little due to floating point errors, so round them.
+    xs = sorted({round(d.metadata[model.MD_POS][0], 9) for d in ar_data})
+    ys = sorted({round(d.metadata[model.MD_POS][1], 9) for d in ar_data}, reverse=True)  # Y goes up
+
+    if background is not None:
+        background = [img.ensure2DImage(bg) for bg in background]
+
+    base, ext = splitext(filename)
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    start = time.time()
+    results = []
+    # "spawn" starts fresh processes, instead of forking this one, which could have
+    # threads running (eg, in the GUI), and so locks held which would never be released.
+    mp_context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context) as executor:
+        # (filename, position, Future) of the conversions submitted
+        pending = collections.deque()
+
+        def wait_oldest():
+            fn, pos, f = pending.popleft()
+            dur = f.result()
+            logging.debug("Exported AR data at %s to %s in %g s", pos, fn, dur)
+            results.append((fn, dur))
+
+        for d in ar_data:
+            pos = d.metadata[model.MD_POS]
+            fn = "%s_x%d_y%d" % (base, xs.index(round(pos[0], 9)), ys.index(round(pos[1], 9)))
+            pol_mode = d.metadata.get(model.MD_POL_MODE)
+            if pol_mode is not None:
+                fn += "_" + pol_mode
+            fn += ext
+
+            # Limit the number of images waiting to be converted, so that with
+            # DataArrayShadows, only a few images are in memory at a time.
+            if len(pending) >= 2 * max_workers:
+                wait_oldest()
+
+            if isinstance(d, DataArrayShadow):
+                d = d.getData()
+            d = img.ensure2DImage(d)
+            bg = _get_ar_background(background, d.metadata.get(model.MD_POL_MODE, model.MD_POL_NONE))
+            pending.append((fn, pos, executor.submit(_export_ar_position, d, bg, fn)))
+
+        while pending:
+            wait_oldest()
+
+    dur_total = time.time() - start
+    logging.info("Exported %d AR images in %g s (%g s per image on average, %g s of computation)",
+                 len(results), dur_total, dur_total / len(results), sum(d for _, d in results))
+    return results
+
+
 def read_json(file_path: str) -> Optional[Any]:
     """
     Read a json file.
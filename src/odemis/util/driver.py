@@ -464,3 +464,29 @@ def get_backend_status():
         return BACKEND_DEAD
 
     return BACKEND_DEAD  # Note: unreachable, but leave in case code will be changed
+
+
+def get_startup_critical_path(timeline):
+    """
+    Find the chain of components which determined the duration of the back-end
+      start-up.
+    timeline (dict str -> (float, float, str or None)): name of component ->
+      start time, end time, name of the dependency it waited for the longest,
+      as in Microscope.startup .
+    return (list of str): names of the components on the critical path, from
+      the first one started to the last one which finished. Empty if the
+      timeline is empty.
+    """
+    if not timeline:
+        return []
+
+    # Start from the component which finished last, and go back following the
+    # dependency which was waited for.
+    name = max(timeline, key=lambda n: timeline[n][1])
+    path = []
+    while name in timeline and name not in path:  # "not in path" in case of (unexpected) cycle
+        path.append(name)
+        name = timeline[name][2]
+
+    path.reverse()
+    return path
@@ -26,16 +26,18 @@ import logging
 import math
 import numpy
 from odemis import model
-import scipy.ndimage
-import cv2
 import copy
 from odemis.model import DataArray
 from odemis.model import MD_DWELL_TIME, MD_EXP_TIME, TINT_FIT_TO_RGB, TINT_RGB_AS_IS
 from odemis.util import get_best_dtype_for_acc, transform
 from odemis.util.conversion import get_img_transformation_matrix, rgb_to_frgb
+from odemis.util.imports import lazy_import
 from typing import Tuple, List, Optional
-import matplotlib.colors as colors
-from matplotlib import cm
+
+cv2 = lazy_import("cv2")
+cm = lazy_import("matplotlib.cm")
+colors = lazy_import("matplotlib.colors")
+ndimage = lazy_import("scipy.ndimage")
 
 # See if the optimised (cython-based) functions are available
 try:
@@ -253,21 +255,51 @@ def compactHistogram(hist, length):
 # for comparison, a.min() + a.max() are 0.01s for 2048x2048 array
 
 
-def histogram(data, irange=None):
+def _subsample(data, max_samples):
+    """
+    Pick a regular subset of the data
+    data (numpy.ndarray): the data
+    max_samples (int > 0): maximum number of values to keep
+    return (numpy.ndarray): at most max_samples values of the data, as 1D array.
+      It's a view on the data if possible.
+    """
+    step = math.ceil(data.size / max_samples)
+    if data.flags.c_contiguous:
+        # As the step is not typically a multiple of the width, the values are
+        # spread over the whole image (and not aligned on a few columns)
+        return data.reshape(-1)[::step]
+    elif data.ndim >= 2:
+        # Keep one row and column every few ones
+        s = math.ceil(math.sqrt(step))
+        return data[..., ::s, ::s].ravel()
+    else:
+        return data[::step]
+
+
+def histogram(data, irange=None, max_samples=None):
     """
     Compute the histogram of the given image.
     data (numpy.ndarray of numbers): greyscale image
     irange (None or tuple of 2 unsigned int): min/max values to be found
       in the data. None => auto (min, max will be detected from the data)
+    max_samples (None or int > 0): if the data contains more values, the
+      histogram is estimated from a regular subset of max_samples values. This
+      is much faster on large data, and typically precise enough for display
+      purposes. None => the histogram is computed on all the data (exact).
     return hist, edges:
      hist (ndarray 1D of 0<=int): number of pixels with the given value
       Note that the length of the returned histogram is not fixed. If irange
-      is defined and data is integer, the length is always equal to
-      irange[1] - irange[0] + 1.
+      is defined and data is integer, the length is equal to
+      irange[1] - irange[0] + 1, but limited to 8192 bins (except for unsigned
+      integers with irange[0] == 0).
+      If the data is subsampled, it's the number of pixels in the subset.
      edges (tuple of numbers): lowest and highest bound of the histogram.
        edges[1] is included in the bin. If irange is defined, it's the same
        values.
     """
+    if max_samples is not None and data.size > max_samples:
+        data = _subsample(data, max_samples)
+
     if irange is None:
         if data.dtype.kind in "biu":
             idt = numpy.iinfo(data.dtype)
@@ -281,25 +313,52 @@ def histogram(data, irange=None):
             irange = (data.view(numpy.ndarray).min(), data.view(numpy.ndarray).max())
 
     # short-cuts (for the most usual types)
-    if data.dtype.kind in "bu" and irange[0] == 0 and data.itemsize <= 2 and len(data) > 0:
-        # TODO: for int (irange[0] < 0), treat as unsigned, and swap the first
-        # and second halves of the histogram.
-        # TODO: for 32 or 64 bits with full range, convert to a view looking
-        # only at the 2 high bytes.
+    if data.dtype.kind in "bu" and irange[0] == 0 and data.itemsize <= 2 and data.size > 0:
         length = irange[1] - irange[0] + 1
         hist = numpy.bincount(data.flat, minlength=length)
         edges = (0, hist.size - 1)
         if edges[1] > irange[1]:
             logging.warning("Unexpected value %d outside of range %s", edges[1], irange)
+    elif (data.dtype.kind == "i" and data.itemsize <= 2 and data.size > 0 and
+          numpy.iinfo(data.dtype).min <= irange[0] <= irange[1] <= numpy.iinfo(data.dtype).max):
+        # Look at the data as unsigned: the negative values are then in the
+        # second half of the histogram, so it just needs to be rotated.
+        idt = numpy.iinfo(data.dtype)
+        udata = data.view(data.dtype.str.replace("i", "u"))
+        hist = numpy.bincount(udata.flat, minlength=2 ** (8 * data.itemsize))
+        hist = numpy.roll(hist, idt.min)
+        hist = hist[int(irange[0]) - idt.min:int(irange[1]) - idt.min + 1]
+        edges = (int(irange[0]), int(irange[1]))
+        if hist.size > 8192:
+            # Same number of bins as the generic case: group the values together.
+            # The values are passed as weights, so it's only a histogram of the bins.
+            values = numpy.arange(edges[0], edges[1] + 1)
+            hist, all_edges = numpy.histogram(values, bins=8192, range=irange, weights=hist)
+            hist = hist.astype(numpy.int64)
+            edges = (max(irange[0], all_edges[0]),
+                     min(irange[1], all_edges[-1]))
     else:
         if data.dtype.kind in "biu":
             length = min(8192, irange[1] - irange[0] + 1)
         else:
             # For floats, it will automatically find the minimum and maximum
             length = 256
-        hist, all_edges = numpy.histogram(data, bins=length, range=irange)
-        edges = (max(irange[0], all_edges[0]),
-                 min(irange[1], all_edges[-1]))
+
+        hist = None
+        if img_fast and data.dtype.kind in "iu" and data.size > 0:
+            try:
+                # Up to 32-bit integers, multi-threaded and without temporary array
+                hist = img_fast.histogram(data, irange, length)
+                edges = (irange[0], irange[1])
+            except ValueError as exp:
+                logging.debug("Fast histogram cannot run: %s", exp)
+            except Exception:
+                logging.exception("Failed to use the fast histogram")
+
+        if hist is None:
+            hist, all_edges = numpy.histogram(data, bins=length, range=irange)
+            edges = (max(irange[0], all_edges[0]),
+                     min(irange[1], all_edges[-1]))
 
     return hist, edges
 
@@ -768,7 +827,7 @@ def rescale_hq(data, shape):
         # Weird number of dimensions => default to the less pretty but more
         # generic scipy version
         out = numpy.empty(shape, dtype=data.dtype)
-        scipy.ndimage.interpolation.zoom(data, zoom=scale, output=out, order=1, prefilter=False)
+        ndimage.zoom(data, zoom=scale, output=out, order=1, prefilter=False)
 
     # Update the metadata
     if hasattr(data, "metadata"):
@@ -1028,7 +1087,7 @@ def getCenterOfTiles(tiles, result_shape):
 
     tiles (tuple of tuple of DataArray): Tiles
     result_shape (height, width): Size in pixels of the result image from the tiles
-    return (x, y): Physical coordinates of the center of the image
+    return (x, y(, z)): Physical coordinates of the center of the image
     """
 
     first_tile = tiles[0][0]
@@ -1052,9 +1111,9 @@ def getCenterOfTiles(tiles, result_shape):
     dist_centers_w = numpy.ravel(dist_centers_w)
     # center of the tile in world coordinates
     center_tile_w = first_tile.metadata[model.MD_POS]
-    # center of the image in world coordinates
-    image_pos = center_tile_w - dist_centers_w
-    return tuple(image_pos)
+    # center of the image in world coordinates (Z, if present, is the same as the tile)
+    image_pos = numpy.asarray(center_tile_w[:2]) - dist_centers_w
+    return tuple(image_pos) + tuple(center_tile_w[2:])
 
 
 def mergeTiles(tiles):
@@ -1384,15 +1443,29 @@ def max_intensity_projection(data: model.DataArray, axis: int = 0) -> model.Data
     return model.DataArray(proj, md)
 
 
-def get_merged_raw_image(das: model.DataArrayShadow, z: int) -> model.DataArray:
+def get_merged_raw_image(das: model.DataArrayShadow, z: int, zIndex: Optional[int] = None) -> model.DataArray:
     """
     Returns the entire raw data of DataArrayShadow at a given zoom level
     :param das: shadow of the raw data
     :param z: Zoom level index
+    :param zIndex: In case the data is a Z stack (ZYX), the index of the plane
+      to read. If None, the maximum intensity projection of the stack is returned.
     :return: The merged image
     """
+    dims = das.metadata.get(model.MD_DIMS, "CTZYX"[-das.ndim::])
+    kwargs = {}
+    if dims == "ZYX":
+        if zIndex is not None:
+            kwargs["z"] = zIndex
+        elif getattr(das, "mip", None) is not None:
+            # Projection already computed
+            return get_merged_raw_image(das.mip, z)
+        else:
+            planes = [get_merged_raw_image(das, z, zi) for zi in range(das.shape[0])]
+            return max_intensity_projection(model.DataArray(numpy.array(planes), das.metadata.copy()))
+
     # get the full sized image rect (pixel dimensions)
-    image_rect = (0, 0, das.shape[1], das.shape[0])  # xmin, ymin, xmax, ymax
+    image_rect = (0, 0, das.shape[dims.index("X")], das.shape[dims.index("Y")])  # xmin, ymin, xmax, ymax
 
     # get the zoomed rect (pixel dimensions)
     zoom_rect = apply_zoom_on_image_coordinates(image_rect, z)
@@ -1400,13 +1473,19 @@ def get_merged_raw_image(das: model.DataArrayShadow, z: int) -> model.DataArray:
     # get the tile indexes
     x1, y1, x2, y2 = get_tile_indices(zoom_rect, das.tile_shape)
 
-    tiles = []
-    for x in range(x1, x2 + 1):
-        tiles_column = []
-        for y in range(y1, y2 + 1):
-            tile = das.getTile(x, y, z)
-            tiles_column.append(tile)
-        tiles.append(tiles_column)
+    if hasattr(das, "getTiles"):
+        # Faster, as the tiles can be read in parallel
+        ny = y2 - y1 + 1
+        flat_tiles = das.getTiles([(x, y, z) for x in range(x1, x2 + 1) for y in range(y1, y2 + 1)], **kwargs)
+        tiles = [flat_tiles[i:i + ny] for i in range(0, len(flat_tiles), ny)]
+    else:
+        tiles = []
+        for x in range(x1, x2 + 1):
+            tiles_column = []
+            for y in range(y1, y2 + 1):
+                tile = das.getTile(x, y, z, **kwargs)
+                tiles_column.append(tile)
+            tiles.append(tiles_column)
 
     return mergeTiles(tiles)
 
@@ -1469,5 +1548,5 @@ def compute_center_of_mass(image: numpy.ndarray,
     """
     baseline = numpy.percentile(image, baseline_ratio * 100)
     image_weights = numpy.where(image > baseline, image - baseline, 0)
-    com = scipy.ndimage.center_of_mass(numpy.asarray(image_weights))
+    com = ndimage.center_of_mass(numpy.asarray(image_weights))
     return com
@@ -16,6 +16,9 @@ You should have received a copy of the GNU General Public License along with Ode
 '''
 # Optimised versions of the functions of odemis.util.img
 
+import os
+import threading
+
 import cython
 
 # import both numpy and the Cython declarations for numpy
@@ -113,3 +116,99 @@ def DataArray2RGB(data, irange, tint=(255, 255, 255)):
     wrapDataArray2RGB(data, irange, tint, ret)
     return ret
 
+
+
+# Integer types supported by histogram()
+ctypedef fused hist_t:
+    numpy.uint8_t
+    numpy.int8_t
+    numpy.uint16_t
+    numpy.int16_t
+    numpy.uint32_t
+    numpy.int32_t
+
+# Minimum number of values to process per thread, as starting a thread has some overhead
+MIN_VALUES_PER_THREAD = 2 ** 20
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void cHistogram(const hist_t[:] data, long long irange0, long long irange1,
+                     numpy.int64_t[::1] hist) nogil:
+    cdef Py_ssize_t nbins = hist.shape[0]
+    cdef long long width = irange1 - irange0
+    cdef long long v
+    cdef Py_ssize_t i, b
+
+    for i in range(data.shape[0]):
+        v = data[i]
+        # Values out of the range are ignored
+        if v < irange0 or v > irange1:
+            continue
+        if width == 0:
+            b = 0
+        else:
+            # Same as numpy.histogram(), but exact as it's only integers
+            # (the product fits in 64 bits as values are <= 32 bits and nbins is "small")
+            b = <Py_ssize_t>(((v - irange0) * nbins) // width)
+            if b == nbins:  # the last bin includes the upper bound
+                b = nbins - 1
+        hist[b] += 1
+
+
+def _histogram_part(const hist_t[:] data, long long irange0, long long irange1,
+                    numpy.int64_t[::1] hist):
+    with nogil:
+        cHistogram(data, irange0, irange1, hist)
+
+
+def histogram(data, irange, nbins, max_threads=None):
+    """
+    Compute the histogram of integer data, with nbins bins of equal width between
+    irange[0] and irange[1] (included), like numpy.histogram(). Values outside
+    of the range are ignored.
+    data (numpy.ndarray of (u)int8, (u)int16 or (u)int32): the data. It can be
+      strided, but if it's not 1D, it should be C-contiguous to avoid a copy.
+    irange (tuple of 2 int): lowest and highest value of the histogram
+    nbins (1 <= int <= 2**16): number of bins
+    max_threads (None or int > 0): maximum number of threads to use.
+      None => as many as CPUs.
+    return (ndarray of int64 of shape nbins): number of values in each bin
+    raise ValueError: if the data type is not supported
+    """
+    if data.dtype.kind not in "iu" or data.itemsize > 4:
+        raise ValueError("Optimised version only works on 8, 16 or 32-bit integers (got %s)" % (data.dtype,))
+    if not 1 <= nbins <= 2 ** 16:
+        raise ValueError("nbins must be between 1 and 65536 (got %s)" % (nbins,))
+    if irange[0] > irange[1]:
+        raise ValueError("irange needs to be a tuple of low/high values")
+    irange0, irange1 = int(irange[0]), int(irange[1])
+    if nbins > 1 and irange1 - irange0 > 2 ** 32:
+        raise ValueError("irange %s is too wide" % (irange,))
+
+    # The memoryviews only handle 1D, so flatten the data (without copy if possible)
+    data = data.view(numpy.ndarray).reshape(-1)
+    if max_threads is None:
+        max_threads = os.cpu_count() or 1
+    nthreads = max(1, min(max_threads, data.size // MIN_VALUES_PER_THREAD))
+    if nthreads == 1:
+        hist = numpy.zeros(nbins, dtype=numpy.int64)
+        _histogram_part(data, irange0, irange1, hist)
+        return hist
+
+    # Each thread computes the histogram of a part of the data, and they are
+    # summed at the end. As the computation doesn't hold the GIL, they run in parallel.
+    hists = numpy.zeros((nthreads, nbins), dtype=numpy.int64)
+    bounds = numpy.linspace(0, data.size, nthreads + 1).astype(int)
+    threads = []
+    for i in range(nthreads):
+        t = threading.Thread(target=_histogram_part,
+                             args=(data[bounds[i]:bounds[i + 1]], irange0, irange1, hists[i]),
+                             name="Histogram part %d" % (i,))
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+
+    return hists.sum(axis=0)
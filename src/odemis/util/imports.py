@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 18 Oct 2026
+
+@author: agent
+
+Copyright © 2026 agent
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License version 2 as published by the Free Software Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with Odemis. If not, see http://www.gnu.org/licenses/.
+'''
+# Helpers to delay the import of heavy modules (eg, scipy, cv2, matplotlib) until
+# they are actually used, and to measure the time spent importing modules.
+# Warning: only depends on the standard python modules, as it's used by odemis.model
+
+import importlib
+import logging
+import re
+import subprocess
+import sys
+
+
+class LazyModule(object):
+    """
+    Placeholder for a module, which is actually imported the first time one of
+    its attributes is accessed.
+    Note: if the module is not available, the ImportError is only raised at
+    this first access.
+    """
+
+    def __init__(self, name):
+        """
+        name (str): full name of the module (eg, "scipy.ndimage")
+        """
+        self.__name = name
+        self.__module = None
+
+    def __load(self):
+        if self.__module is None:
+            # The import machinery takes care of concurrent imports
+            self.__module = importlib.import_module(self.__name)
+            logging.debug("Lazily imported module %s", self.__name)
+        return self.__module
+
+    def __getattr__(self, attr):
+        # Only called for the attributes not found on the placeholder itself
+        return getattr(self.__load(), attr)
+
+    def __dir__(self):
+        return dir(self.__load())
+
+    def __repr__(self):
+        if self.__module is None:
+            return "<lazy module '%s' (not loaded)>" % (self.__name,)
+        return repr(self.__module)
+
+
+def lazy_import(name):
+    """
+    Get a module, to be imported only when it's first used.
+    To be used at the top of a module, instead of "import name".
+    name (str): full name of the module (eg, "scipy.ndimage")
+    return (module or LazyModule): the module itself if it's already imported,
+      otherwise a placeholder which behaves like the module.
+    """
+    try:
+        return sys.modules[name]
+    except KeyError:
+        return LazyModule(name)
+
+
+# Format of a line from python -X importtime:
+# import time: self [us] | cumulative | imported package
+_IMPORTTIME_RE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s+)(\S+)")
+
+
+def measure_imports(module):
+    """
+    Import a module in a new python interpreter, and measure the time spent
+      importing each module it depends on.
+    module (str): full name of the module to import (eg, "odemis.cli.main")
+    return (list of (str, float, float, int)): for each module imported, in the
+      order the imports ended: name, self time (s), cumulative time (s), and
+      nesting level (0 for the modules directly imported).
+    raise ImportError: if the module failed to be imported
+    """
+    cmd = [sys.executable, "-X", "importtime", "-c", "import %s" % (module,)]
+    p = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                       universal_newlines=True)
+
+    imports = []
+    errors = []
+    for l in p.stderr.splitlines():
+        m = _IMPORTTIME_RE.match(l)
+        if m:
+            # The name is indented by 2 spaces per level (after the first one)
+            level = (len(m.group(3)) - 1) // 2
+            imports.append((m.group(4), int(m.group(1)) * 1e-6, int(m.group(2)) * 1e-6, level))
+        elif not l.startswith("import time:"):
+            errors.append(l)
+
+    if p.returncode != 0:
+        raise ImportError("Failed to import %s: %s" % (module, "\n".join(errors)), name=module)
+
+    return imports
+
+
+def print_import_profile(module, top=25):
+    """
+    Display the modules which take the most time to import, when importing the
+      given module in a new python interpreter.
+    module (str): full name of the module to import (eg, "odemis.cli.main")
+    top (int > 0): number of modules to display
+    """
+    imports = measure_imports(module)
+    total = sum(s for n, s, c, l in imports)
+    print("Importing %s took %.3f s (%d modules)" % (module, total, len(imports)))
+
+    print("cumulative (s)\tself (s)\tmodule")
+    for n, s, c, l in sorted(imports, key=lambda i: i[2], reverse=True)[:top]:
+        print("%.3f\t%.3f\t%s%s" % (c, s, "  " * l, n))
@@ -47,8 +47,11 @@ import math
 from typing import Iterable, Tuple, List
 
 import numpy
-from scipy.linalg.lapack import get_lapack_funcs
-from scipy.linalg import LinAlgError
+from numpy.linalg import LinAlgError
+
+from odemis.util.imports import lazy_import
+
+lapack = lazy_import("scipy.linalg.lapack")
 
 __all__ = ['qrp', 'qlp', 'tri_inv']
 
@@ -119,7 +122,7 @@ def tri_inv(c, lower=False, unit_diagonal=False, overwrite_c=False,
     if len(c1.shape) != 2 or c1.shape[0] != c1.shape[1]:
         raise ValueError('expected square matrix')
     overwrite_c = overwrite_c or _datacopied(c1, c)
-    trtri, = get_lapack_funcs(('trtri',), (c1,))
+    trtri, = lapack.get_lapack_funcs(('trtri',), (c1,))
     inv_c, info = trtri(c1, overwrite_c=overwrite_c, lower=lower,
                         unitdiag=unit_diagonal)
     if info > 0:
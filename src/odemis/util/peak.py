@@ -14,10 +14,15 @@ Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRAN
 
 You should have received a copy of the GNU General Public License along with Odemis. If not, see http://www.gnu.org/licenses/.
 '''
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from concurrent.futures._base import CancelledError, CANCELLED, FINISHED, RUNNING
 import logging
+import math
 import numpy
 from odemis import model
+from odemis.util import executeAsyncTask
+from odemis.util.spectrum import get_spectrum_range
+import os
 from scipy.optimize import curve_fit, OptimizeWarning
 import threading
 import time
@@ -201,6 +206,118 @@ def Detect(y_vector, x_vector=None, lookahead=5, delta=0):
     return maxtab, mintab
 
 
+def _fit_spectrum(spectrum, wavelength, type, is_cancelled=lambda: False):
+    """
+    Smooths the spectrum signal, detects the peaks and fits them all.
+    spectrum (1d array of floats): The data representing the spectrum.
+    wavelength (1d array of floats): The wavelength values corresponding to the
+    spectrum given.
+    type (str): Type of fitting to be applied (one of PEAK_FUNCTIONS).
+    is_cancelled (callable returning bool): checked regularly to stop early
+    returns (1d array of floats): the fitted parameters, in the fitting domain
+      (ie, energy for the *_energy types), as (pos, width, amplitude)*N + (offset,)
+    raises:
+        KeyError if given type not available
+        ValueError if fitting cannot be applied
+        CancelledError if is_cancelled() returned True
+    """
+    # values based on experimental datasets
+    if len(wavelength) >= 2000:
+        divider = 20
+    elif len(wavelength) >= 1000:
+        divider = 25
+    else:
+        divider = 30
+    init_window_size = max(3, len(wavelength) // divider)
+    window_size = init_window_size
+    logging.debug("Starting peak detection on data (len = %d) with window = %d",
+                  len(wavelength), window_size)
+    try:
+        wl_rng = wavelength[-1] - wavelength[0]
+        width = wl_rng * WIDTH_RATIO  # initial peak width estimation
+        FitFunction = PEAK_FUNCTIONS[type]
+    except KeyError:
+        raise KeyError("Given type %s not in available fitting types: %s" % (type, list(PEAK_FUNCTIONS.keys())))
+    for step in range(5):
+        if is_cancelled():
+            raise CancelledError()
+        smoothed = Smooth(spectrum, window_len=window_size)
+        # Increase window size until peak detection finds enough peaks to fit
+        # the spectrum curve
+        peaks = Detect(smoothed, wavelength, lookahead=window_size, delta=5)[0]
+        if not peaks:
+            window_size = int(round(window_size * 1.2))
+            logging.debug("Retrying to fit peak with window = %d", window_size)
+            continue
+
+        fit_list = []
+        lower_bounds = []
+        upper_bounds = []
+        peak_lower, peak_upper = _peak_bounds(wavelength, type)
+        for (pos, amplitude) in peaks:
+            if type in {'gaussian_energy', 'lorentzian_energy'}:
+                energy = apply_jacobian_x(wavelength)
+                spectra_energy = apply_jacobian_y(wavelength, spectrum)
+                fit_list.extend(peak_to_energy(pos, width, amplitude))
+            else:
+                fit_list.extend([pos, width, amplitude])
+            lower_bounds.extend(peak_lower)
+            upper_bounds.extend(peak_upper)
+
+        # Initialize the offset with the minimum possible value
+        offset = 0
+        fit_list.append(offset)
+        # Set the lower & upper bounds for the offset
+        lower_bounds.extend([0])
+        upper_bounds.extend([min(spectrum)])
+        param_bounds = (lower_bounds, upper_bounds)
+
+        if is_cancelled():
+            raise CancelledError()
+
+        try:
+            with warnings.catch_warnings():
+                # Hide scipy/optimize/minpack.py:690: OptimizeWarning: Covariance of the parameters could not be estimated
+                warnings.filterwarnings("ignore", "", OptimizeWarning)
+                # TODO, from scipy 0.17, curve_fit() supports the 'bounds' parameter.
+                # It could be used to ensure the peaks params are positives.
+                # (Once we don't support Ubuntu 12.04)
+                if type in {'gaussian_energy', 'lorentzian_energy'}:
+                    params, _ = curve_fit(FitFunction, energy, spectra_energy, p0=fit_list, bounds=param_bounds)
+                else:
+                    params, _ = curve_fit(FitFunction, wavelength, spectrum, p0=fit_list, bounds=param_bounds)
+            break
+        except Exception as ex:
+            window_size = int(round(window_size * 1.2))
+            logging.debug("Retrying to fit peak with window = %d due to error %s", window_size, ex)
+            continue
+    else:
+        raise ValueError("Could not apply peak fitting of type %s." % type)
+
+    return params
+
+
+def _peak_bounds(wavelength, type):
+    """
+    Computes the lower & upper bounds of the parameters of one peak
+    wavelength (1d array of floats): The wavelength values of the spectrum
+    type (str): Type of fitting (one of PEAK_FUNCTIONS)
+    returns (list of 3 floats, list of 3 floats): lower and upper bounds of
+      center position, width, amplitude, in the fitting domain
+    """
+    if type in {'gaussian_energy', 'lorentzian_energy'}:
+        # in energy domain
+        energy = apply_jacobian_x(wavelength)
+        en_rng = energy[0] - energy[-1]
+        return ([energy[-1] - en_rng / 2, en_rng / 1e4, 0],
+                [energy[0] + en_rng / 2, en_rng * 10, numpy.inf])
+    else:
+        # in space domain
+        wl_rng = wavelength[-1] - wavelength[0]
+        return ([wavelength[0] - wl_rng / 2, wl_rng / 1e3, 0],
+                [wavelength[-1] + wl_rng / 2, wl_rng * 10, numpy.inf])
+
+
 class PeakFitter(object):
     def __init__(self):
         # will take care of executing peak fitting asynchronously
@@ -253,82 +370,8 @@ class PeakFitter(object):
                 ValueError if fitting cannot be applied
         """
         try:
-            # values based on experimental datasets
-            if len(wavelength) >= 2000:
-                divider = 20
-            elif len(wavelength) >= 1000:
-                divider = 25
-            else:
-                divider = 30
-            init_window_size = max(3, len(wavelength) // divider)
-            window_size = init_window_size
-            logging.debug("Starting peak detection on data (len = %d) with window = %d",
-                          len(wavelength), window_size)
-            try:
-                wl_rng = wavelength[-1] - wavelength[0]
-                width = wl_rng * WIDTH_RATIO  # initial peak width estimation
-                FitFunction = PEAK_FUNCTIONS[type]
-            except KeyError:
-                raise KeyError("Given type %s not in available fitting types: %s" % (type, list(PEAK_FUNCTIONS.keys())))
-            for step in range(5):
-                if future._fit_state == CANCELLED:
-                    raise CancelledError()
-                smoothed = Smooth(spectrum, window_len=window_size)
-                # Increase window size until peak detection finds enough peaks to fit
-                # the spectrum curve
-                peaks = Detect(smoothed, wavelength, lookahead=window_size, delta=5)[0]
-                if not peaks:
-                    window_size = int(round(window_size * 1.2))
-                    logging.debug("Retrying to fit peak with window = %d", window_size)
-                    continue
-
-                fit_list = []
-                lower_bounds = []
-                upper_bounds = []
-                for (pos, amplitude) in peaks:
-                    if type in {'gaussian_energy', 'lorentzian_energy'}:
-                        energy = apply_jacobian_x(wavelength)
-                        spectra_energy = apply_jacobian_y(wavelength, spectrum)
-                        fit_list.extend(peak_to_energy(pos, width, amplitude))
-                        # lower & upper bounds for center position, width, amplitude in energy domain
-                        en_rng = energy[0] - energy[-1]
-                        lower_bounds.extend([energy[-1] - en_rng / 2, en_rng / 1e4, 0])
-                        upper_bounds.extend([energy[0] + en_rng / 2, en_rng * 10, numpy.inf])
-                    else:
-                        # lower & upper bounds for center position, width, amplitude in space domain
-                        fit_list.extend([pos, width, amplitude])
-                        lower_bounds.extend([wavelength[0] - wl_rng / 2, wl_rng / 1e3, 0])
-                        upper_bounds.extend([wavelength[-1] + wl_rng / 2, wl_rng * 10, numpy.inf])
-
-                # Initialize the offset with the minimum possible value
-                offset = 0
-                fit_list.append(offset)
-                # Set the lower & upper bounds for the offset
-                lower_bounds.extend([0])
-                upper_bounds.extend([min(spectrum)])
-                param_bounds = (lower_bounds, upper_bounds)
-
-                if future._fit_state == CANCELLED:
-                    raise CancelledError()
-
-                try:
-                    with warnings.catch_warnings():
-                        # Hide scipy/optimize/minpack.py:690: OptimizeWarning: Covariance of the parameters could not be estimated
-                        warnings.filterwarnings("ignore", "", OptimizeWarning)
-                        # TODO, from scipy 0.17, curve_fit() supports the 'bounds' parameter.
-                        # It could be used to ensure the peaks params are positives.
-                        # (Once we don't support Ubuntu 12.04)
-                        if type in {'gaussian_energy', 'lorentzian_energy'}:
-                            params, _ = curve_fit(FitFunction, energy, spectra_energy, p0=fit_list, bounds=param_bounds)
-                        else:
-                            params, _ = curve_fit(FitFunction, wavelength, spectrum, p0=fit_list, bounds=param_bounds)
-                    break
-                except Exception as ex:
-                    window_size = int(round(window_size * 1.2))
-                    logging.debug("Retrying to fit peak with window = %d due to error %s", window_size, ex)
-                    continue
-            else:
-                raise ValueError("Could not apply peak fitting of type %s." % type)
+            params = _fit_spectrum(spectrum, wavelength, type,
+                                   lambda: future._fit_state == CANCELLED)
             # reformat parameters to (list of 3 tuples, offset)
             peaks_params = []
             for pos, width, amplitude in _Grouped(params[:-1], 3):
@@ -371,6 +414,276 @@ class PeakFitter(object):
         return len(data) * 10e-3  # s
 
 
+# Names of the parameter images returned by FitMap()
+MAP_PARAMETERS = ("position", "width", "amplitude", "offset")
+# In FitMap(), a fit started from the previous pixel is rejected (and the peaks are detected again)
+# if its residual is larger than the one of the previous pixel by this ratio...
+FIT_RESIDUAL_TOLERANCE = 2
+# ... and larger than this ratio of the spectrum range.
+FIT_RESIDUAL_MIN = 0.01
+
+
+def FitMap(data, wavelength=None, type='gaussian_space', max_workers=None):
+    """
+    Fits the main peak of every spectrum of a spectrum cube, in parallel in
+    separate processes. The pixels are fitted one line at a time, and each fit
+    is started from the peaks of the previous pixel on the line, which is
+    much faster than a peak detection on neighbouring pixels with similar
+    spectra. If that fit fails, or fits much worse than on the previous pixel,
+    the standard detection + fitting is used.
+    data (DataArray of shape CTZYX, CZYX or CYX): the spectrum cube. If there
+      are T or Z dimensions, the spectrum is averaged over them.
+    wavelength (None or 1d array of floats): The wavelength values corresponding
+      to the C dimension. If None, it is read from the metadata of the data.
+    type (str): Type of fitting to be applied ('gaussian_space', 'lorentzian_space',
+      'gaussian_energy' or 'lorentzian_energy')
+    max_workers (None or int): number of processes. None uses the number of CPUs.
+    returns (model.ProgressiveFuture): Progress of the fitting, whose result()
+      returns a dict str (one of MAP_PARAMETERS) -> DataArray of shape YX (float):
+      the position, width and amplitude of the highest peak, and the offset of
+      the spectrum. The position and width are in the same unit as wavelength.
+      Pixels which could not be fitted are NaN.
+    raises:
+        KeyError if given type not available
+        ValueError if the data is not a spectrum cube
+    """
+    if type not in PEAK_FUNCTIONS:
+        raise KeyError("Given type %s not in available fitting types: %s" % (type, list(PEAK_FUNCTIONS.keys())))
+    if isinstance(data, model.DataArrayShadow):
+        data = data.getData()
+
+    dims = data.metadata.get(model.MD_DIMS, "CTZYX"[-data.ndim:])
+    if dims[0] != "C" or dims[-2:] != "YX":
+        raise ValueError("Data should be a spectrum cube, but has dimensions %s" % (dims,))
+    if wavelength is None:
+        wavelength = get_spectrum_range(data)[0]
+    wavelength = numpy.asarray(wavelength, dtype=float)
+    if len(wavelength) != data.shape[0]:
+        raise ValueError("Wavelength has %d values, while data has %d" % (len(wavelength), data.shape[0]))
+
+    # YXC, so that each line of spectra is contiguous, and cheap to send to the processes
+    if data.ndim > 3:
+        spectra = numpy.mean(data, axis=tuple(range(1, data.ndim - 2)))
+    else:
+        spectra = numpy.asarray(data, dtype=float)
+    spectra = numpy.ascontiguousarray(numpy.moveaxis(spectra, 0, -1))
+
+    est_start = time.time() + 0.1
+    f = model.ProgressiveFuture(start=est_start,
+                                end=est_start + estimateFitMapTime(data, max_workers))
+    f._task_state = RUNNING
+    f._task_lock = threading.Lock()
+    f.task_canceller = _CancelFitMap
+
+    md = data.metadata.copy()
+    md[model.MD_DIMS] = "YX"
+    for k in (model.MD_WL_LIST, model.MD_TIME_LIST, model.MD_THETA_LIST, model.MD_DESCRIPTION):
+        md.pop(k, None)
+
+    executeAsyncTask(f, _DoFitMap, args=(f, spectra, wavelength, type, md, max_workers))
+    return f
+
+
+def estimateFitMapTime(data, max_workers=None):
+    """
+    Estimates the duration of FitMap()
+    data (DataArray of shape C...YX): the spectrum cube
+    max_workers (None or int): number of processes
+    returns (float): estimated duration (s)
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    npixels = data.shape[-1] * data.shape[-2]
+    # really rough estimation, based on the seeded fit, which is the most common case
+    return npixels * data.shape[0] * 20e-6 / max_workers + 0.5  # s
+
+
+def _DoFitMap(future, spectra, wavelength, type, md, max_workers):
+    """
+    Runs the fitting of every line of spectra in a process pool
+    future (model.ProgressiveFuture): Progressive future provided by the wrapper
+    spectra (ndarray of shape YXC): the spectra to fit
+    wavelength (1d array of floats): the wavelength values of the spectra
+    type (str): Type of fitting to be applied
+    md (dict): metadata of the parameter images
+    returns (dict str -> DataArray): see FitMap()
+    raises:
+        CancelledError if cancelled
+    """
+    nlines = spectra.shape[0]
+    params = numpy.full(spectra.shape[:2] + (len(MAP_PARAMETERS),), numpy.nan)
+    try:
+        start = time.time()
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            with future._task_lock:
+                if future._task_state == CANCELLED:
+                    raise CancelledError()
+                future._executor = executor
+                fits = {executor.submit(_fit_spectra_line, spectra[y], wavelength, type): y
+                        for y in range(nlines)}
+                future._line_futures = list(fits)
+            ndone = 0
+            for lf in as_completed(fits):
+                if future._task_state == CANCELLED:
+                    raise CancelledError()
+                params[fits[lf]] = lf.result()
+                ndone += 1
+                elapsed = time.time() - start
+                future.set_progress(end=time.time() + elapsed * (nlines - ndone) / ndone)
+
+        npx = params.shape[0] * params.shape[1]
+        logging.debug("Fitted %d pixels in %g s, %d failed", npx, time.time() - start,
+                      numpy.count_nonzero(numpy.isnan(params[..., 0])))
+        return {n: model.DataArray(params[..., i].copy(), md.copy())
+                for i, n in enumerate(MAP_PARAMETERS)}
+    except CancelledError:
+        logging.debug("Fitting map of type %s was cancelled.", type)
+        raise
+    finally:
+        future._executor = None
+        future._line_futures = []
+        with future._task_lock:
+            if future._task_state == CANCELLED:
+                raise CancelledError()
+            future._task_state = FINISHED
+
+
+def _CancelFitMap(future):
+    """
+    Canceller of _DoFitMap task.
+    """
+    logging.debug("Cancelling fitting map...")
+
+    with future._task_lock:
+        if future._task_state == FINISHED:
+            return False
+        future._task_state = CANCELLED
+        # Drop all the lines not yet started
+        for lf in getattr(future, "_line_futures", []):
+            lf.cancel()
+        executor = getattr(future, "_executor", None)
+        if executor is not None:
+            executor.shutdown(wait=False)
+        logging.debug("Fitting map cancelled.")
+
+    return True
+
+
+def _fit_spectra_line(spectra, wavelength, type):
+    """
+    Fits the main peak of each spectrum of a line. Run in a separate process.
+    All the peaks are fitted, as with PeakFitter.Fit(), so that the main peak is
+    the same as if each spectrum was fitted independently.
+    spectra (ndarray of shape XC): the spectra
+    wavelength (1d array of floats): the wavelength values of the spectra
+    type (str): Type of fitting to be applied
+    returns (ndarray of shape X4): position, width, amplitude, offset of each
+      spectrum, in the wavelength domain. NaN if the fitting failed.
+    """
+    params = numpy.full((spectra.shape[0], len(MAP_PARAMETERS)), numpy.nan)
+    seed = None  # parameters of the previous pixel, in the fitting domain
+    seed_residual = None  # residual of the fit of the previous pixel
+    for x, spec in enumerate(spectra):
+        p = None
+        if seed is not None:
+            try:
+                p = _fit_peaks(spec, wavelength, type, seed)
+                residual = _fit_residual(spec, wavelength, type, p)
+                if residual > max(seed_residual * FIT_RESIDUAL_TOLERANCE, FIT_RESIDUAL_MIN):
+                    logging.debug("Seeded fit at pixel %d has residual %g (previous %g), will detect peaks",
+                                  x, residual, seed_residual)
+                    p = None
+            except Exception as ex:
+                logging.debug("Seeded fit failed at pixel %d: %s", x, ex)
+                p = None
+        if p is None:
+            try:
+                p = _fit_spectrum(spec, wavelength, type)
+                residual = _fit_residual(spec, wavelength, type, p)
+            except ValueError:
+                logging.debug("Failed to fit peak at pixel %d", x)
+                seed = None
+                continue
+        seed, seed_residual = p, residual
+        main = _main_peak(p, type)
+        if type in {'gaussian_energy', 'lorentzian_energy'}:
+            params[x, :3] = peak_to_wavelength(*main[:3])
+        else:
+            params[x, :3] = main[:3]
+        params[x, 3] = main[3]
+
+    return params
+
+
+def _main_peak(params, type):
+    """
+    Selects the peak with the highest amplitude (in the wavelength domain)
+    params (1d array of floats): (pos, width, amplitude)*N + (offset,), in the
+      fitting domain
+    type (str): Type of fitting applied
+    returns (ndarray of 4 floats): pos, width, amplitude, offset, in the fitting domain
+    """
+    peaks = numpy.reshape(params[:-1], (-1, 3))
+    if type in {'gaussian_energy', 'lorentzian_energy'}:
+        amplitudes = [peak_to_wavelength(*p)[2] for p in peaks]
+    else:
+        amplitudes = peaks[:, 2]
+    main = peaks[numpy.argmax(amplitudes)]
+    return numpy.append(main, params[-1])
+
+
+def _fit_domain(spectrum, wavelength, type):
+    """
+    spectrum (1d array of floats): The data representing the spectrum.
+    wavelength (1d array of floats): The wavelength values of the spectrum
+    type (str): Type of fitting
+    returns (1d array of floats, 1d array of floats): x and y values to fit
+    """
+    if type in {'gaussian_energy', 'lorentzian_energy'}:
+        return apply_jacobian_x(wavelength), apply_jacobian_y(wavelength, spectrum)
+    else:
+        return wavelength, spectrum
+
+
+def _fit_peaks(spectrum, wavelength, type, p0):
+    """
+    Fits the peaks, starting from the given parameters
+    spectrum (1d array of floats): The data representing the spectrum.
+    wavelength (1d array of floats): The wavelength values of the spectrum
+    type (str): Type of fitting to be applied
+    p0 (array of floats): initial (pos, width, amplitude)*N + (offset,), in the fitting domain
+    returns (ndarray of floats): (pos, width, amplitude)*N + (offset,), in the fitting domain
+    raises:
+        Exception if the fitting failed
+    """
+    peak_lower, peak_upper = _peak_bounds(wavelength, type)
+    npeaks = len(p0) // 3
+    lower = peak_lower * npeaks + [0]
+    upper = peak_upper * npeaks + [min(spectrum)]
+    # The optimizer refuses initial values out of the bounds
+    p0 = numpy.clip(p0, lower, upper)
+    x, y = _fit_domain(spectrum, wavelength, type)
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", "", OptimizeWarning)
+        params, _ = curve_fit(PEAK_FUNCTIONS[type], x, y, p0=p0, bounds=(lower, upper))
+    return params
+
+
+def _fit_residual(spectrum, wavelength, type, params):
+    """
+    Computes how well the peaks fit the spectrum
+    spectrum (1d array of floats): The data representing the spectrum.
+    wavelength (1d array of floats): The wavelength values of the spectrum
+    type (str): Type of fitting applied
+    params (array of floats): (pos, width, amplitude)*N + (offset,), in the fitting domain
+    returns (float): root mean square of the difference between the spectrum and
+      the fitted curve, relative to the range of the spectrum (in the fitting domain)
+    """
+    x, y = _fit_domain(spectrum, wavelength, type)
+    diff = y - PEAK_FUNCTIONS[type](x, *params)
+    return math.sqrt(numpy.mean(diff ** 2)) / max(numpy.ptp(y), 1e-18)
+
+
 def peak_to_energy(pos, width, amplitude):
     """
     Converts the peaks to energy domain.
@@ -29,6 +29,10 @@ from typing import List, Tuple, Union
 import numpy
 
 from odemis import model
+from odemis.util.imports import lazy_import
+
+# Only needed by generate_texture(), and odemis.model imports this module
+ndimage = lazy_import("scipy.ndimage")
 
 Shape2D = Tuple[int, int]
 Coordinate = Tuple[float, float]
@@ -166,6 +170,45 @@ def simulate_peak(amplitude: float,
         return numpy.tile(peak_1d, (shape[0], 1))
 
 
+def generate_texture(shape: Tuple[int, ...],
+                     dtype: numpy.dtype = numpy.uint16,
+                     sigma: Union[float, Tuple[float, ...]] = 3,
+                     noise: float = 0,
+                     seed: int = 0) -> numpy.ndarray:
+    """
+    Generate an image with a smooth random texture, plus some noise. It compresses
+    approximately like a real acquisition, and is easy to register.
+    :param shape: the shape of the output array (any number of dimensions)
+    :param dtype: the data type of the output array. For an integer type, the whole
+    range is used. For a float type, the values are between 0 and 1.
+    :param sigma: the standard deviation of the Gaussian filter smoothing the texture (px).
+    It can also be a tuple, with one value per dimension.
+    :param noise: ratio of the range of the values which is random noise (0 -> 1).
+    :param seed: the seed of the random generator, so that the image is reproducible
+    :return: a numpy array of the given shape and dtype
+    """
+    if not 0 <= noise <= 1:
+        raise ValueError(f"noise ({noise}) should be between 0 and 1")
+
+    rng = numpy.random.default_rng(seed)
+    arr = rng.random(shape, dtype=numpy.float32)
+    ndimage.gaussian_filter(arr, sigma, output=arr)
+    # Stretch the texture to the whole range (0 -> 1), minus the noise
+    amin, amax = arr.min(), arr.max()
+    arr -= amin
+    arr *= (1 - noise) / max(amax - amin, numpy.finfo(numpy.float32).tiny)
+    if noise:
+        arr += rng.random(shape, dtype=numpy.float32) * noise
+
+    if numpy.issubdtype(dtype, numpy.integer):
+        idt = numpy.iinfo(dtype)
+        arr *= float(idt.max) - idt.min
+        arr += idt.min
+        # Rounding can go very slightly beyond the range with float32
+        numpy.clip(arr, idt.min, idt.max, out=arr)
+    return arr.astype(dtype, copy=False)
+
+
 class ParabolicMirrorRayTracer:
     """
     Simulates ray tracing for a parabolic mirror system with a lens and camera.
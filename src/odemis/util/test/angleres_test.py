@@ -139,6 +139,58 @@ class TestAngleResolvedDataConversion(unittest.TestCase):
 
         numpy.testing.assert_allclose(result, desired_output[0], atol=1e-07)
 
+    def test_projection_plan_cache(self):
+        """
+        Tests the projection plan is reused for data with the same geometry, and
+        gives the same result as the first computation.
+        """
+        data = ensure2DImage(self.data[0])
+        result = angleres.AngleResolved2Polar(data, 201)
+        nplans = len(angleres._plan_cache)
+
+        # Same geometry, but different data (and position) => same plan
+        data2 = model.DataArray(data[::-1, ::-1].copy(), data.metadata.copy())
+        data2.metadata[model.MD_POS] = (1e-3, 2e-3)
+        result2 = angleres.AngleResolved2Polar(data2, 201)
+        self.assertEqual(len(angleres._plan_cache), nplans)
+
+        # The projection is linear
+        data_sum = model.DataArray(data.astype(numpy.float64) + data2, data.metadata)
+        result_sum = angleres.AngleResolved2Polar(data_sum, 201)
+        numpy.testing.assert_allclose(result_sum, result + result2, rtol=1e-6)
+        self.assertEqual(len(angleres._plan_cache), nplans)
+
+        # Recomputed from scratch => same result
+        angleres._plan_cache.clear()
+        result_new = angleres.AngleResolved2Polar(data, 201)
+        numpy.testing.assert_array_equal(result, result_new)
+
+        # Different geometry => different plan
+        data_pole = model.DataArray(data, data.metadata.copy())
+        pole = data.metadata[model.MD_AR_POLE]
+        data_pole.metadata[model.MD_AR_POLE] = (pole[0] + 10, pole[1])
+        result_pole = angleres.AngleResolved2Polar(data_pole, 201)
+        self.assertEqual(len(angleres._plan_cache), 2)
+        self.assertFalse(numpy.array_equal(result, result_pole))
+
+    def test_interpolation_matrix_nan(self):
+        """
+        Tests the interpolation matrix only uses the data points contributing to
+        each position, so that NaN values don't propagate further.
+        """
+        # 2 triangles: (0, 1, 2) and (1, 2, 3)
+        points = numpy.array([(0, 0), (1, 0), (0, 1), (1.5, 1.5)])
+        grid = numpy.array([(0, 0), (1, 0), (1.5, 1.5), (1.25, 0.75), (0.25, 0.25), (2, 2)])
+        data = numpy.array([1, 2, numpy.nan, 4])
+        mat = angleres._compute_interpolation_matrix(points, grid, numpy.arange(4), numpy.ones(4), 4)
+        result = mat @ data
+        # On the vertices, and on the edge opposite to the NaN => not NaN
+        numpy.testing.assert_allclose(result[:4], [1, 2, 4, 3])
+        # In a triangle with the NaN => NaN
+        self.assertTrue(numpy.isnan(result[4]))
+        # Outside of the triangulation => 0
+        self.assertEqual(result[5], 0)
+
     def test_uint16_input(self):
         """
         Tests for input of DataArray with uint16 ndarray.
@@ -370,6 +422,29 @@ class TestAngleResolvedDataConversion(unittest.TestCase):
 
         numpy.testing.assert_allclose(result, desired_output[0], rtol=1e-04)
 
+    def test_raw_rectangular(self):
+        """
+        Test the conversion used to export the raw data, with and without background image
+        """
+        data = ensure2DImage(self.data[0])
+        result = angleres.AngleResolved2RawRectangular(data)
+        self.assertEqual(result.shape, angleres.AR_RAW_OUTPUT_SIZE)
+        self.assertEqual(result.metadata[model.MD_ACQ_TYPE], model.MD_AT_AR)
+
+        # A background larger than the data => negative values are kept
+        bg = model.DataArray(numpy.full(data.shape, data.max() + 10, dtype=numpy.float64), data.metadata)
+        result_bg = angleres.AngleResolved2RawRectangular(data, bg)
+        self.assertEqual(result_bg.shape, angleres.AR_RAW_OUTPUT_SIZE)
+        self.assertLess(numpy.nanmin(result_bg), 0)
+
+        # Very large images are reduced
+        big = model.DataArray(numpy.repeat(numpy.repeat(data, 4, axis=0), 4, axis=1), data.metadata.copy())
+        big.metadata[model.MD_PIXEL_SIZE] = tuple(p / 4 for p in data.metadata[model.MD_PIXEL_SIZE])
+        big.metadata[model.MD_AR_POLE] = tuple(p * 4 for p in data.metadata[model.MD_AR_POLE])
+        self.assertGreater(big.size, angleres.AR_RAW_MAX_PIXELS)
+        result_big = angleres.AngleResolved2RawRectangular(big)
+        self.assertEqual(result_big.shape, angleres.AR_RAW_OUTPUT_SIZE)
+
     def test_background_substraction_uint16_input(self):
         """
         Tests for input of DataArray with uint16 ndarray.
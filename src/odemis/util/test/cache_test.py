@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 18 Oct 2026
+
+@author: agent
+
+Copyright © 2026 agent
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License version 2 as published by the Free
+Software Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Odemis. If not, see http://www.gnu.org/licenses/.
+"""
+import threading
+import unittest
+
+import numpy
+
+from odemis.util.cache import LRUCache, get_nbytes
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_get_nbytes(self):
+        a = numpy.zeros((16, 16), dtype=numpy.uint16)  # 512 bytes
+        self.assertEqual(get_nbytes(a), 512)
+        self.assertEqual(get_nbytes({"a": a, "b": a[:8]}), 768)
+        self.assertEqual(get_nbytes([a, (a, None)]), 1024)
+        self.assertEqual(get_nbytes(None), 0)
+
+    def test_stats(self):
+        a = numpy.zeros((16, 16), dtype=numpy.uint16)  # 512 bytes
+        cache = LRUCache(4 * a.nbytes)
+        self.assertIsNone(cache.get("a"))
+
+        cache.put("a", a)
+        cache.put("dict", {"x": a, "y": a})  # Counts as 2 arrays
+        self.assertIn("a", cache)
+        self.assertIs(cache.get("a"), a)
+        stats = cache.get_stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["entries"], 2)
+        self.assertEqual(stats["nbytes"], 3 * a.nbytes)
+        self.assertEqual(stats["evictions"], 0)
+
+        # "dict" is the least recently used => dropped
+        cache.put("b", a.copy())
+        cache.put("c", a.copy())
+        self.assertNotIn("dict", cache)
+        stats = cache.get_stats()
+        self.assertEqual(stats["entries"], 3)
+        self.assertEqual(stats["evictions"], 1)
+
+        # Reducing the maximum size drops immediately the extra values
+        cache.max_bytes = a.nbytes
+        self.assertEqual(len(cache), 1)
+        self.assertIn("c", cache)
+        self.assertEqual(cache.nbytes, a.nbytes)
+
+    def test_threads(self):
+        a = numpy.zeros((4, 4), dtype=numpy.uint8)  # 16 bytes
+        cache = LRUCache(100 * a.nbytes)
+
+        def use_cache(n):
+            for i in range(1000):
+                k = (n, i % 150)
+                if cache.get(k) is None:
+                    cache.put(k, a)
+
+        threads = [threading.Thread(target=use_cache, args=(n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(cache), 100)
+        self.assertEqual(cache.nbytes, 100 * a.nbytes)
+        stats = cache.get_stats()
+        self.assertEqual(stats["hits"] + stats["misses"], 4000)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -15,9 +15,11 @@ Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRAN
 
 You should have received a copy of the GNU General Public License along with Odemis. If not, see http://www.gnu.org/licenses/.
 '''
+import glob
 import json
 import os
 import re
+import shutil
 import tempfile
 import time
 import unittest
@@ -27,11 +29,12 @@ import numpy
 
 from odemis import model
 from odemis.acq import stream
-from odemis.dataio import tiff
-from odemis.util import testing
+from odemis.dataio import hdf5, tiff
+from odemis.util import angleres, img, testing
 from odemis.util.dataio import (
     _split_planes,
     data_to_static_streams,
+    export_ar_batch,
     open_acquisition,
     open_files_and_stitch,
     read_json,
@@ -39,6 +42,7 @@ from odemis.util.dataio import (
     write_json,
 )
 
+AR_TEST_IMAGE = os.path.join(os.path.dirname(__file__), "ar-example-input.h5")
 FILENAMES = ["test_%d" % i + tiff.EXTENSIONS[0] for i in range(4)]
 
 class TestDataIO(unittest.TestCase):
@@ -476,5 +480,81 @@ class TestJsonUtils(unittest.TestCase):
             )
 
 
+class TestExportARBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _create_ar_map(self, shape):
+        """
+        Create AR data as acquired by a SEM+AR acquisition over a grid
+        shape (int, int): number of ebeam positions in X and Y
+        return (list of DataArray): one AR image per ebeam position
+        """
+        ar = img.ensure2DImage(hdf5.read_data(AR_TEST_IMAGE)[0])
+        data = []
+        for y in range(shape[1]):
+            for x in range(shape[0]):
+                md = ar.metadata.copy()
+                md[model.MD_POS] = (1e-3 + x * 10e-9, 2e-3 - y * 10e-9)
+                data.append(model.DataArray(ar * (1 + x + y * shape[0]), md))
+        return data
+
+    def test_csv(self):
+        """
+        Every position is exported to a CSV file, with the same projection as one-by-one
+        """
+        data = self._create_ar_map((3, 2))
+        # Non-AR data is ignored
+        data.append(model.DataArray(numpy.zeros((10, 10), dtype=numpy.uint16),
+                                    {model.MD_POS: (0, 0), model.MD_PIXEL_SIZE: (1e-6, 1e-6)}))
+        fn = os.path.join(self.tmpdir, "ar.csv")
+
+        results = export_ar_batch(data, fn, max_workers=2)
+        self.assertEqual(len(results), 6)
+        self.assertEqual(len(glob.glob(os.path.join(self.tmpdir, "ar_x*_y*.csv"))), 6)
+        for fn_res, dur in results:
+            self.assertTrue(os.path.exists(fn_res))
+            self.assertGreater(dur, 0)
+
+        # The last position is x=2, y=1
+        fn_last, _ = results[-1]
+        self.assertEqual(os.path.basename(fn_last), "ar_x2_y1.csv")
+        exp = angleres.AngleResolved2Rectangular(angleres.ARBackgroundSubtract(data[5]),
+                                                 (90, 360), hole=False)
+        # First row and column contain the angles
+        csv_data = numpy.loadtxt(fn_last, delimiter=",", skiprows=1)[:, 1:]
+        numpy.testing.assert_allclose(csv_data, exp, rtol=1e-6)
+
+    def test_background_polarization(self):
+        """
+        The background is matched on the polarization, and is part of the filename
+        """
+        data = self._create_ar_map((2, 1))
+        for d, pol in zip(data, (model.MD_POL_HORIZONTAL, model.MD_POL_VERTICAL)):
+            d.metadata[model.MD_POL_MODE] = pol
+            d.metadata[model.MD_POS] = data[0].metadata[model.MD_POS]
+        bg = model.DataArray(numpy.full(data[0].shape, 10.0), data[0].metadata.copy())
+        bg.metadata[model.MD_POL_MODE] = model.MD_POL_VERTICAL
+        fn = os.path.join(self.tmpdir, "ar.tiff")
+
+        results = export_ar_batch(data, fn, [bg])
+        self.assertEqual([os.path.basename(fn) for fn, _ in results],
+                         ["ar_x0_y0_horizontal.tiff", "ar_x0_y0_vertical.tiff"])
+
+        exp = angleres.AngleResolved2Rectangular(model.DataArray(data[1] - 10.0, data[1].metadata),
+                                                 (90, 360), hole=False)
+        res = tiff.read_data(results[1][0])[0]
+        numpy.testing.assert_allclose(img.ensure2DImage(res), exp, rtol=1e-6)
+
+    def test_no_ar_data(self):
+        data = [model.DataArray(numpy.zeros((10, 10), dtype=numpy.uint16))]
+        with self.assertRaises(ValueError):
+            export_ar_batch(data, os.path.join(self.tmpdir, "ar.csv"))
+
+
 if __name__ == "__main__":
     unittest.main()
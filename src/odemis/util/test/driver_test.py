@@ -38,6 +38,7 @@ from odemis.util.driver import (
     estimate_stage_movement_time,
     estimateMoveDuration,
     get_linux_version,
+    get_startup_critical_path,
     getSerialDriver,
     guessActuatorMoveDuration,
     readMemoryUsage,
@@ -95,6 +96,21 @@ class TestDriver(unittest.TestCase):
             with self.assertRaises(LookupError):
                 v = get_linux_version()
 
+    def test_startup_critical_path(self):
+        self.assertEqual(get_startup_critical_path({}), [])
+
+        # "stage" waited for "psu" and "stage-x", which both started immediately
+        timeline = {"psu": (0, 2, None),
+                    "stage-x": (0, 5, None),
+                    "ccd": (0, 12, "psu"),
+                    "stage": (5, 8, "stage-x"),
+                    "focus": (8, 9, "stage"),
+                    }
+        self.assertEqual(get_startup_critical_path(timeline), ["psu", "ccd"])
+
+        timeline["focus"] = (8, 15, "stage")
+        self.assertEqual(get_startup_critical_path(timeline), ["stage-x", "stage", "focus"])
+
     def onEvent(self):
         """
         callback for the Event
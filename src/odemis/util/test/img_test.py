@@ -297,6 +297,111 @@ class TestHistogram(unittest.TestCase):
         hist_forced, edges = img.histogram(grey_img, edges)
         numpy.testing.assert_array_equal(hist, hist_forced)
 
+    def test_int16(self):
+        size = (1024, 965)
+        grey_img = numpy.zeros(size, dtype="int16") - 1500
+        grey_img[0, 0] = -32768
+        grey_img[0, 1] = 32767
+        grey_img[0, 2] = 0
+        # Full range => limited to 8192 bins, as numpy.histogram()
+        hist, edges = img.histogram(grey_img)
+        self.assertEqual(len(hist), 8192)
+        self.assertEqual(edges, (-32768, 32767))
+        self.assertEqual(hist[0], 1)
+        self.assertEqual(hist[-1], 1)
+        self.assertEqual(hist.sum(), grey_img.size)
+        hist_np, _ = numpy.histogram(grey_img, bins=8192, range=edges)
+        numpy.testing.assert_array_equal(hist, hist_np)
+        self.assertEqual(hist.dtype, hist_np.dtype)
+
+        # Limited range => only that part
+        hist, edges = img.histogram(grey_img, (-2048, 2047))
+        self.assertEqual(len(hist), 4096)
+        self.assertEqual(edges, (-2048, 2047))
+        self.assertEqual(hist[2048], 1)
+        self.assertEqual(hist[2048 - 1500], grey_img.size - 3)
+        self.assertEqual(hist.sum(), grey_img.size - 2)
+
+    def test_int32(self):
+        size = (512, 100)
+        grey_img = numpy.zeros(size, dtype="int32") - 100000
+        grey_img[0, 0] = -2 ** 31
+        grey_img[0, 1] = 2 ** 31 - 1
+        hist, edges = img.histogram(grey_img, (-2 ** 31, 2 ** 31 - 1))
+        self.assertTrue(256 <= len(hist) <= 2 ** 16)
+        self.assertEqual(edges, (-2 ** 31, 2 ** 31 - 1))
+        self.assertEqual(hist[0], 1)
+        self.assertEqual(hist[-1], 1)
+        self.assertEqual(hist.sum(), grey_img.size)
+        hist_np, _ = numpy.histogram(grey_img, bins=len(hist), range=edges)
+        numpy.testing.assert_array_equal(hist, hist_np)
+
+        hist_auto, edges = img.histogram(grey_img)
+        self.assertEqual(edges, (-2 ** 31, 2 ** 31 - 1))
+        numpy.testing.assert_array_equal(hist, hist_auto)
+
+    def test_subsample(self):
+        """
+        Check the histogram estimated from a subset of the data is close to the
+        exact one
+        """
+        size = (2048, 2001)
+        for dtype in ("uint16", "int16", "uint32"):
+            grey_img = numpy.random.randint(0, 4096, size).astype(dtype)
+            hist, edges = img.histogram(grey_img, (0, 4095))
+            hist_sub, edges_sub = img.histogram(grey_img, (0, 4095), max_samples=2 ** 16)
+            self.assertEqual(edges_sub, edges)
+            self.assertEqual(len(hist_sub), len(hist))
+            self.assertLessEqual(hist_sub.sum(), 2 ** 16)
+            self.assertGreater(hist_sub.sum(), 2 ** 15)
+            # The optimal range should be the same, up to a few values
+            irange = img.findOptimalRange(hist, edges, 1 / 256)
+            irange_sub = img.findOptimalRange(hist_sub, edges_sub, 1 / 256)
+            numpy.testing.assert_allclose(irange_sub, irange, atol=20)
+
+            # Also works on non contiguous data
+            grey_img_t = grey_img.T
+            hist_sub, edges_sub = img.histogram(grey_img_t, (0, 4095), max_samples=2 ** 16)
+            self.assertLessEqual(hist_sub.sum(), 2 ** 16)
+            irange_sub = img.findOptimalRange(hist_sub, edges_sub, 1 / 256)
+            numpy.testing.assert_allclose(irange_sub, irange, atol=20)
+
+        # Small data is never subsampled
+        hist_sub, edges_sub = img.histogram(grey_img, (0, 4095), max_samples=grey_img.size)
+        numpy.testing.assert_array_equal(hist_sub, hist)
+
+    def test_fast(self):
+        """Test the fast histogram is identical to the numpy version"""
+        try:
+            import odemis.util.img_fast
+        except ImportError as ex:
+            self.skipTest(f"img_fast not available ({ex}), cannot test it")
+
+        for dtype in ("uint16", "int16", "uint32", "int32"):
+            idt = numpy.iinfo(dtype)
+            data = numpy.random.randint(idt.min, idt.max, (2048, 1500), dtype=dtype)
+            for irange, nbins in (((idt.min, idt.max), 8192),
+                                  ((-100, 100), 201),
+                                  ((0, 1000), 17)):
+                hist = odemis.util.img_fast.histogram(data, irange, nbins)
+                hist_np, _ = numpy.histogram(data, bins=nbins, range=irange)
+                numpy.testing.assert_array_equal(hist, hist_np)
+
+                # Same thing with multiple threads
+                hist = odemis.util.img_fast.histogram(data, irange, nbins, max_threads=4)
+                numpy.testing.assert_array_equal(hist, hist_np)
+
+        data = numpy.random.randint(0, 2 ** 32, (4096, 2048), dtype="uint32")
+        tstart = time.time()
+        hist = odemis.util.img_fast.histogram(data, (0, 2 ** 32 - 1), 8192)
+        fast_dur = time.time() - tstart
+        tstart = time.time()
+        hist_np, _ = numpy.histogram(data, bins=8192, range=(0, 2 ** 32 - 1))
+        std_dur = time.time() - tstart
+        print("Time fast histogram = %g s, standard = %g s" % (fast_dur, std_dur))
+        numpy.testing.assert_array_equal(hist, hist_np)
+        self.assertLess(fast_dur, std_dur)
+
     def test_compact(self):
         """
         test the compactHistogram()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 18 Oct 2026
+
+@author: agent
+
+Copyright © 2026 agent
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License version 2 as published by the Free Software Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with Odemis. If not, see http://www.gnu.org/licenses/.
+'''
+import logging
+import sys
+import unittest
+
+from odemis.util.imports import LazyModule, lazy_import, measure_imports
+
+logging.getLogger().setLevel(logging.DEBUG)
+
+
+class TestLazyImport(unittest.TestCase):
+
+    def test_already_imported(self):
+        m = lazy_import("logging")
+        self.assertIs(m, logging)
+
+    def test_lazy(self):
+        # Pick a standard module which is unlikely to be already imported
+        name = "xml.dom.minidom"
+        sys.modules.pop(name, None)
+        m = lazy_import(name)
+        self.assertIsInstance(m, LazyModule)
+        self.assertNotIn(name, sys.modules)
+
+        doc = m.parseString("<a/>")  # Triggers the import
+        self.assertEqual(doc.documentElement.tagName, "a")
+        self.assertIn(name, sys.modules)
+        self.assertIn("parseString", dir(m))
+
+    def test_missing(self):
+        m = lazy_import("odemis.non_existing_module")
+        with self.assertRaises(ImportError):
+            m.foo
+
+
+class TestMeasureImports(unittest.TestCase):
+
+    def test_simple(self):
+        imports = measure_imports("odemis.util.units")
+        names = [n for n, s, c, l in imports]
+        self.assertIn("odemis.util.units", names)
+        self.assertIn("numpy", names)
+        # The requested module is imported last, at the top level
+        n, s, c, l = imports[-1]
+        self.assertEqual((n, l), ("odemis.util.units", 0))
+        self.assertGreaterEqual(c, s)
+
+    def test_error(self):
+        with self.assertRaises(ImportError):
+            measure_imports("odemis.non_existing_module")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -14,11 +14,14 @@ Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRAN
 
 You should have received a copy of the GNU General Public License along with Odemis. If not, see http://www.gnu.org/licenses/.
 '''
+from concurrent.futures import CancelledError
 import logging
 import numpy
+from odemis import model
 from odemis.dataio import hdf5
 from odemis.util import peak
 import os
+import time
 import unittest
 import matplotlib.pyplot as plt
 
@@ -131,5 +134,93 @@ class TestPeak(unittest.TestCase):
         self.assertRaises(KeyError, peak.Curve, wl, params, offset, type='wrongType')
 
 
+class TestFitMap(unittest.TestCase):
+    """
+    Test peak fitting on a whole spectrum cube
+    """
+    def test_synthetic(self):
+        """
+        The peak position shifts along X and Y, check it's found back on every pixel
+        """
+        wl = numpy.linspace(500e-9, 700e-9, 150)
+        shape = (150, 1, 1, 4, 6)
+        pos = 550e-9 + 10e-9 * numpy.arange(shape[3])[:, numpy.newaxis] + 5e-9 * numpy.arange(shape[4])
+        width = 15e-9
+        cube = numpy.empty(shape, dtype=numpy.uint16)
+        for y, x in numpy.ndindex(pos.shape):
+            spec = 20 + 1000 * numpy.exp(-(wl - pos[y, x]) ** 2 / (2 * width ** 2))
+            cube[:, 0, 0, y, x] = spec
+        md = {model.MD_WL_LIST: list(wl), model.MD_PIXEL_SIZE: (1e-6, 1e-6), model.MD_POS: (1e-3, 2e-3)}
+        data = model.DataArray(cube, md)
+
+        f = peak.FitMap(data, type='gaussian_space', max_workers=2)
+        res = f.result()
+        self.assertEqual(set(res.keys()), set(peak.MAP_PARAMETERS))
+        for im in res.values():
+            self.assertEqual(im.shape, pos.shape)
+            self.assertEqual(im.metadata[model.MD_DIMS], "YX")
+            self.assertEqual(im.metadata[model.MD_POS], md[model.MD_POS])
+            self.assertNotIn(model.MD_WL_LIST, im.metadata)
+        numpy.testing.assert_allclose(res["position"], pos, atol=1e-9)
+        numpy.testing.assert_allclose(res["width"], width, rtol=0.1)
+        numpy.testing.assert_allclose(res["amplitude"], 1000, rtol=0.05)
+
+    def test_dominant_peak_change(self):
+        """
+        Two peaks, whose amplitudes change along the line, so that the main peak
+        switches from one to the other in the middle of the line
+        """
+        wl = numpy.linspace(500e-9, 700e-9, 200)
+        shape = (200, 1, 1, 2, 6)
+        amp1 = 1000 - 160 * numpy.arange(shape[4])  # 1000 -> 200
+        amp2 = 200 + 160 * numpy.arange(shape[4])  # 200 -> 1000
+        width = 10e-9
+        cube = numpy.empty(shape, dtype=numpy.uint16)
+        for y, x in numpy.ndindex(shape[3:]):
+            spec = (20 + amp1[x] * numpy.exp(-(wl - 550e-9) ** 2 / (2 * width ** 2)) +
+                    amp2[x] * numpy.exp(-(wl - 650e-9) ** 2 / (2 * width ** 2)))
+            cube[:, 0, 0, y, x] = spec
+        data = model.DataArray(cube, {model.MD_WL_LIST: list(wl)})
+
+        f = peak.FitMap(data, type='gaussian_space', max_workers=1)
+        res = f.result()
+        exp_pos = numpy.where(amp1 > amp2, 550e-9, 650e-9)
+        for y in range(shape[3]):
+            numpy.testing.assert_allclose(res["position"][y], exp_pos, atol=1e-9)
+            numpy.testing.assert_allclose(res["amplitude"][y], numpy.maximum(amp1, amp2), rtol=0.05)
+
+    def test_real_data(self):
+        data = hdf5.read_data(os.path.join(PATH, "spectrum_fitting.h5"))[1]
+        data = data[:, :, :, 20:24, 20:30]
+        f = peak.FitMap(data, type='gaussian_energy')
+        res = f.result()
+        self.assertEqual(res["position"].shape, data.shape[-2:])
+        self.assertFalse(numpy.isnan(res["position"]).all())
+        # The first pixel of a line is fitted without seed => same as the single fitting
+        pf = peak.PeakFitter()
+        params, offset, _ = pf.Fit(data[:, 0, 0, 0, 0], peak.get_spectrum_range(data)[0],
+                                   type='gaussian_energy').result()
+        main = max(params, key=lambda p: p[2])
+        self.assertAlmostEqual(res["position"][0, 0], main[0])
+        self.assertAlmostEqual(res["offset"][0, 0], offset)
+
+    def test_cancel(self):
+        data = hdf5.read_data(os.path.join(PATH, "spectrum_fitting.h5"))[1]
+        f = peak.FitMap(data, type='gaussian_space', max_workers=1)
+        time.sleep(0.5)
+        self.assertTrue(f.cancel())
+        self.assertTrue(f.cancelled())
+        with self.assertRaises(CancelledError):
+            f.result(10)
+
+    def test_wrong_input(self):
+        data = model.DataArray(numpy.zeros((10, 10, 5)), {model.MD_DIMS: "YXC"})
+        with self.assertRaises(ValueError):
+            peak.FitMap(data)
+        data = model.DataArray(numpy.zeros((5, 10, 10)))
+        with self.assertRaises(KeyError):
+            peak.FitMap(data, type='wrongType')
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -23,7 +23,7 @@ import unittest
 
 import numpy
 
-from odemis.util.synthetic import ParabolicMirrorRayTracer, simulate_peak
+from odemis.util.synthetic import ParabolicMirrorRayTracer, generate_texture, simulate_peak
 
 
 class TestParabolicMirrorRayTracer(unittest.TestCase):
@@ -204,5 +204,36 @@ class TestPeakSimulation(unittest.TestCase):
         dtype_max = numpy.iinfo(numpy.uint8).max
         self.assertLessEqual(peak.max(), dtype_max)
 
+
+class TestGenerateTexture(unittest.TestCase):
+
+    def test_generate_texture(self):
+        """
+        Check the texture uses the whole range of the dtype, and is reproducible
+        """
+        img = generate_texture((200, 300), numpy.uint16, sigma=3, noise=0.1)
+        self.assertEqual(img.shape, (200, 300))
+        self.assertEqual(img.dtype, numpy.uint16)
+        self.assertLess(img.min(), 0.15 * 65535)
+        self.assertGreater(img.max(), 0.85 * 65535)
+        numpy.testing.assert_array_equal(img, generate_texture((200, 300), numpy.uint16, sigma=3, noise=0.1))
+        self.assertFalse(numpy.array_equal(img, generate_texture((200, 300), numpy.uint16, sigma=3, noise=0.1,
+                                                                 seed=1)))
+
+        # 3D, with one sigma per dimension, and floats between 0 and 1
+        img = generate_texture((50, 20, 30), numpy.float32, sigma=(10, 2, 2))
+        self.assertEqual(img.shape, (50, 20, 30))
+        self.assertEqual(img.dtype, numpy.float32)
+        self.assertAlmostEqual(img.min(), 0)
+        self.assertAlmostEqual(img.max(), 1, places=5)
+
+        # Signed integers
+        img = generate_texture((100, 100), numpy.int16)
+        self.assertLess(img.min(), 0)
+
+        with self.assertRaises(ValueError):
+            generate_texture((10, 10), noise=2)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -57,10 +57,12 @@ from abc import ABCMeta, abstractmethod
 from typing import List, Optional, Tuple, Type, TypeVar, Union
 
 import numpy
-import scipy.linalg
 from numpy.linalg import LinAlgError
+from odemis.util.imports import lazy_import
 from odemis.util.linalg import qlp, qrp
 
+scipy_linalg = lazy_import("scipy.linalg")
+
 T = TypeVar("T", bound="GeometricTransform")
 
 __all__ = [
@@ -559,7 +561,7 @@ def _transformation_matrix_to_implicit(
         Shear factor.
 
     """
-    R, S3 = scipy.linalg.polar(matrix)
+    R, S3 = scipy_linalg.polar(matrix)
     if not numpy.allclose(numpy.linalg.det(R), 1.0):
         raise ValueError("Matrix is not a proper rotation matrix")
     rotation = _rotation_matrix_to_angle(R)